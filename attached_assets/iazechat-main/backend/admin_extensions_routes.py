@@ -8,7 +8,6 @@ Routes para funcionalidades administrativas adicionais:
 """
 
 from fastapi import APIRouter, HTTPException, Depends
-from motor.motor_asyncio import AsyncIOMotorClient
 from typing import List, Optional
 from pydantic import BaseModel
 from datetime import datetime, timezone
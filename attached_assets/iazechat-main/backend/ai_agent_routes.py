@@ -7,15 +7,14 @@ from typing import List
 import uuid
 from datetime import datetime, timezone
 from models import *
-from motor.motor_asyncio import AsyncIOMotorClient
+from database import get_db
 from tenant_helpers import get_tenant_filter
 import jwt
 from ai_agent_templates import get_template, get_all_templates
+from ai_response_cache import ai_response_cache
 
-# Configuração do MongoDB
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[os.environ.get("DB_NAME", "support_chat")]
+# Conexão compartilhada do servidor (database.py)
+db = get_db()
 
 # Configuração do JWT
 JWT_SECRET = os.environ.get('JWT_SECRET', 'fallback-secret-key-change-in-production')
@@ -54,6 +53,28 @@ async def list_ai_templates(current_user: dict = Depends(get_current_user)):
     """Lista todos os templates de agentes IA disponíveis"""
     return get_all_templates()
 
+@ai_router.get("/agents/response-cache/stats")
+async def list_response_cache_stats(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Estatísticas do cache de respostas (hit rate e tokens economizados) por agente"""
+    # ISOLAMENTO MULTI-TENANT: Apenas agentes da revenda
+    query = get_tenant_filter(request, current_user)
+    
+    agents = await db.ai_agents.find(query, {"_id": 0, "id": 1, "name": 1}).to_list(length=None)
+    stats = []
+    for agent in agents:
+        agent_stats = ai_response_cache.get_stats(agent["id"])
+        agent_stats["name"] = agent.get("name")
+        stats.append(agent_stats)
+    
+    return {
+        "agents": stats,
+        "total_hits": sum(s["hits"] for s in stats),
+        "total_saved_tokens": sum(s["saved_tokens"] for s in stats)
+    }
+
 @ai_router.post("/agents/templates/{template_name}")
 async def create_agent_from_template(
     template_name: str,
@@ -201,6 +222,9 @@ async def update_ai_agent(
     
     await db.ai_agents.update_one(query, {"$set": update_data})
     
+    # Nova versão da configuração: respostas antigas não servem mais
+    ai_response_cache.invalidate_agent(agent_id)
+    
     updated_agent = await db.ai_agents.find_one(query)
     return AIAgentFull(**updated_agent)
 
@@ -224,6 +248,50 @@ async def delete_ai_agent(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Agente não encontrado")
     
+    ai_response_cache.invalidate_agent(agent_id)
+    
+    return {"ok": True}
+
+@ai_router.get("/agents/{agent_id}/response-cache")
+async def get_agent_response_cache_stats(
+    agent_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Estatísticas do cache de respostas de um agente IA"""
+    # ISOLAMENTO MULTI-TENANT: Usar função centralizada
+    tenant_filter = get_tenant_filter(request, current_user)
+    
+    query = {"id": agent_id}
+    query.update(tenant_filter)
+    
+    agent = await db.ai_agents.find_one(query, {"_id": 0, "id": 1})
+    if not agent:
+        raise HTTPException(status_code=404, detail="Agente não encontrado")
+    
+    return ai_response_cache.get_stats(agent_id)
+
+@ai_router.delete("/agents/{agent_id}/response-cache")
+async def clear_agent_response_cache(
+    agent_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Limpa o cache de respostas de um agente IA"""
+    if current_user["user_type"] not in ["admin", "reseller"]:
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    # ISOLAMENTO MULTI-TENANT: Usar função centralizada
+    tenant_filter = get_tenant_filter(request, current_user)
+    
+    query = {"id": agent_id}
+    query.update(tenant_filter)
+    
+    agent = await db.ai_agents.find_one(query, {"_id": 0, "id": 1})
+    if not agent:
+        raise HTTPException(status_code=404, detail="Agente não encontrado")
+    
+    ai_response_cache.invalidate_agent(agent_id)
     return {"ok": True}
 
 # ============================================
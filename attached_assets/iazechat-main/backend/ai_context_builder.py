@@ -0,0 +1,369 @@
+"""
+Montagem de contexto para chamadas de IA com orçamento de tokens
+Mantém prompts pequenos e latência previsível
+
+- Contagem de tokens por provider/modelo (tiktoken se instalado, senão estimativa)
+- Empacotamento por orçamento: system prompt, trechos de instruções (RAG) e histórico
+- Resumo incremental das mensagens antigas, salvo em ai_conversation_summaries
+  e reaproveitado nas próximas chamadas (sem reprocessar a conversa toda)
+"""
+import os
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Janela de contexto (tokens) por modelo - prefixo mais longo vence
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1000000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "claude": 200000,
+    "gemini-1.5": 1000000,
+    "gemini-2": 1000000,
+    "gemini": 32000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Caracteres por token (estimativa para texto em português quando tiktoken não está disponível)
+CHARS_PER_TOKEN = {
+    "openai": 3.6,
+    "anthropic": 3.3,
+    "gemini": 3.8,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.6
+
+# Overhead de formatação por mensagem no formato chat
+MESSAGE_OVERHEAD_TOKENS = 4
+
+ROLE_LABELS = {"user": "Cliente", "assistant": "Atendente"}
+
+
+class ContextBuilder:
+    """
+    Empacota system prompt, instruções e histórico dentro de um orçamento de tokens
+    """
+
+    def __init__(self):
+        # Teto padrão de tokens de prompt (além da janela do modelo)
+        self.max_prompt_tokens = int(os.environ.get("AI_CONTEXT_MAX_PROMPT_TOKENS", "12000"))
+        # Máximo de mensagens recentes enviadas literalmente (o resto vai para o resumo)
+        self.max_history_messages = int(os.environ.get("AI_CONTEXT_MAX_HISTORY_MESSAGES", "20"))
+        # Fração do orçamento para instruções e para o resumo
+        self.instructions_share = 0.5
+        self.summary_share = 0.1
+        # Tamanho de cada turno dentro do resumo
+        self.summary_line_chars = 160
+        self._encodings = {}
+
+    # ------------------------------------------------------------------
+    # Contagem de tokens
+    # ------------------------------------------------------------------
+
+    def context_window(self, model: Optional[str]) -> int:
+        """Janela de contexto do modelo"""
+        model = (model or "").lower()
+        best_prefix = ""
+        for prefix in MODEL_CONTEXT_WINDOWS:
+            if model.startswith(prefix) and len(prefix) > len(best_prefix):
+                best_prefix = prefix
+        return MODEL_CONTEXT_WINDOWS.get(best_prefix, DEFAULT_CONTEXT_WINDOW)
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        if model not in self._encodings:
+            try:
+                self._encodings[model] = tiktoken.encoding_for_model(model)
+            except Exception:
+                self._encodings[model] = tiktoken.get_encoding("cl100k_base")
+        return self._encodings[model]
+
+    def count_tokens(self, text: str, provider: str = "openai", model: str = "gpt-4o-mini") -> int:
+        """Conta tokens de um texto para o provider/modelo"""
+        if not text:
+            return 0
+        if provider == "openai":
+            encoding = self._encoding(model or "gpt-4o-mini")
+            if encoding is not None:
+                return len(encoding.encode(text, disallowed_special=()))
+        ratio = CHARS_PER_TOKEN.get(provider, DEFAULT_CHARS_PER_TOKEN)
+        return int(len(text) / ratio) + 1
+
+    def count_message_tokens(self, messages: List[Dict], provider: str = "openai", model: str = "gpt-4o-mini") -> int:
+        """Conta tokens de uma lista de mensagens {"role", "content"}"""
+        return sum(
+            self.count_tokens(m.get("content") or "", provider, model) + MESSAGE_OVERHEAD_TOKENS
+            for m in messages
+        )
+
+    def truncate_to_tokens(self, text: str, max_tokens: int, provider: str = "openai", model: str = "gpt-4o-mini") -> str:
+        """Corta o texto para caber em max_tokens"""
+        if max_tokens <= 0 or not text:
+            return ""
+        tokens = self.count_tokens(text, provider, model)
+        if tokens <= max_tokens:
+            return text
+        # Corte proporcional com margem, refinado até caber
+        cut = int(len(text) * max_tokens / tokens * 0.95)
+        while cut > 0 and self.count_tokens(text[:cut], provider, model) > max_tokens:
+            cut = int(cut * 0.9)
+        return text[:cut] + "\n[... restante omitido por tamanho ...]"
+
+    # ------------------------------------------------------------------
+    # Orçamento
+    # ------------------------------------------------------------------
+
+    def prompt_budget(self, agent_config: Optional[Dict]) -> Tuple[str, str, int]:
+        """
+        Retorna (provider, model, orçamento de tokens de prompt) para o agente
+        Orçamento = min(janela do modelo - saída reservada, teto configurado)
+        """
+        agent_config = agent_config or {}
+        provider = agent_config.get("llm_provider") or "openai"
+        model = agent_config.get("llm_model") or "gpt-4o-mini"
+        reserved_output = int(agent_config.get("max_tokens") or 500)
+        cap = int(agent_config.get("context_token_budget") or self.max_prompt_tokens)
+        budget = min(self.context_window(model) - reserved_output, cap)
+        return provider, model, max(budget, 512)
+
+    # ------------------------------------------------------------------
+    # Empacotamento
+    # ------------------------------------------------------------------
+
+    def pack_chunks(self, chunks: List[str], max_tokens: int, provider: str, model: str) -> List[str]:
+        """Adiciona trechos (em ordem de relevância) enquanto couberem no orçamento"""
+        packed = []
+        used = 0
+        for chunk in chunks:
+            tokens = self.count_tokens(chunk, provider, model)
+            if used + tokens > max_tokens:
+                if not packed:
+                    # Nem o primeiro trecho cabe: enviar versão cortada
+                    packed.append(self.truncate_to_tokens(chunk, max_tokens, provider, model))
+                break
+            packed.append(chunk)
+            used += tokens
+        return packed
+
+    def pack_history(
+        self,
+        history: List[Dict],
+        max_tokens: int,
+        provider: str,
+        model: str
+    ) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Seleciona as mensagens mais recentes que cabem no orçamento
+        Retorna (mensagens enviadas, mensagens antigas que ficaram de fora)
+        """
+        packed = []
+        used = 0
+        for position in range(len(history) - 1, -1, -1):
+            message = history[position]
+            tokens = self.count_tokens(message.get("content") or "", provider, model) + MESSAGE_OVERHEAD_TOKENS
+            if used + tokens > max_tokens or len(packed) >= self.max_history_messages:
+                return list(reversed(packed)), history[:position + 1]
+            packed.append(message)
+            used += tokens
+        return list(reversed(packed)), []
+
+    # ------------------------------------------------------------------
+    # Resumo incremental
+    # ------------------------------------------------------------------
+
+    def _summary_line(self, message: Dict) -> str:
+        content = " ".join((message.get("content") or "").split())
+        if len(content) > self.summary_line_chars:
+            content = content[:self.summary_line_chars].rsplit(" ", 1)[0] + "…"
+        return f"- {ROLE_LABELS.get(message.get('role'), 'Sistema')}: {content}"
+
+    def _trim_summary(self, lines: List[str], max_tokens: int, provider: str, model: str) -> List[str]:
+        """Remove as linhas mais antigas até o resumo caber no orçamento"""
+        while lines and self.count_tokens("\n".join(lines), provider, model) > max_tokens:
+            lines = lines[1:]
+        return lines
+
+    async def get_rolling_summary(
+        self,
+        db,
+        conversation_id: Optional[str],
+        overflow: List[Dict],
+        max_tokens: int,
+        provider: str,
+        model: str
+    ) -> str:
+        """
+        Resumo das mensagens antigas (que não couberam no histórico)
+        Só os turnos ainda não resumidos são processados; o resultado fica salvo
+        em ai_conversation_summaries e é reaproveitado nas próximas chamadas
+        """
+        if not overflow or max_tokens <= 0:
+            return ""
+
+        stored = None
+        if db is not None and conversation_id:
+            try:
+                stored = await db.ai_conversation_summaries.find_one(
+                    {"conversation_id": conversation_id}, {"_id": 0}
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Erro ao buscar resumo da conversa: {e}")
+
+        lines = list(stored.get("lines", [])) if stored else []
+        summarized_until = stored.get("summarized_until") if stored else None
+
+        new_messages = [
+            m for m in overflow
+            if not summarized_until or (m.get("timestamp") or "") > summarized_until
+        ]
+        if not new_messages:
+            return "\n".join(lines)
+
+        lines.extend(self._summary_line(m) for m in new_messages)
+        lines = self._trim_summary(lines, max_tokens, provider, model)
+
+        last_timestamp = max((m.get("timestamp") or "" for m in new_messages), default="")
+        if db is not None and conversation_id and last_timestamp:
+            try:
+                await db.ai_conversation_summaries.update_one(
+                    {"conversation_id": conversation_id},
+                    {"$set": {
+                        "lines": lines,
+                        "summarized_until": last_timestamp,
+                        "updated_at": datetime.now(timezone.utc).isoformat()
+                    }},
+                    upsert=True
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Erro ao salvar resumo da conversa: {e}")
+
+        return "\n".join(lines)
+
+    # ------------------------------------------------------------------
+    # Montagem completa
+    # ------------------------------------------------------------------
+
+    async def build(
+        self,
+        agent_config: Optional[Dict],
+        system_prompt: str,
+        history: List[Dict],
+        current_message: str,
+        instruction_chunks: Optional[List[str]] = None,
+        prefix_messages: Optional[List[Dict]] = None,
+        db=None,
+        conversation_id: Optional[str] = None
+    ) -> Dict:
+        """
+        Monta system message + mensagens iniciais dentro do orçamento do agente
+
+        Args:
+            agent_config: Configuração do agente (provider, modelo, max_tokens, context_token_budget)
+            system_prompt: Parte fixa do system prompt
+            history: Histórico [{"role", "content", "timestamp"}] do mais antigo para o mais recente
+            current_message: Mensagem atual (enviada à parte, removida do fim do histórico)
+            instruction_chunks: Trechos de instruções em ordem de relevância
+            prefix_messages: Mensagens fixas enviadas antes do histórico (few-shot)
+            db / conversation_id: Onde salvar o resumo incremental
+
+        Returns:
+            {"system_message", "messages", "tokens": {...}}
+        """
+        provider, model, budget = self.prompt_budget(agent_config)
+        prefix_messages = prefix_messages or []
+        history = [m for m in (history or []) if m.get("content")]
+
+        # Mensagem atual já salva no histórico: não enviar duplicada
+        if history and history[-1].get("role") == "user" and history[-1].get("content") == current_message:
+            history = history[:-1]
+
+        # 1. Partes obrigatórias: system prompt, few-shot e mensagem atual
+        system_tokens = self.count_tokens(system_prompt, provider, model)
+        fixed_tokens = (
+            system_tokens
+            + self.count_message_tokens(prefix_messages, provider, model)
+            + self.count_tokens(current_message, provider, model) + MESSAGE_OVERHEAD_TOKENS
+        )
+        remaining = max(budget - fixed_tokens, 0)
+
+        # 2. Instruções recuperadas (RAG) até a fração configurada
+        instructions_text = ""
+        instructions_tokens = 0
+        if instruction_chunks:
+            packed_chunks = self.pack_chunks(
+                instruction_chunks, int(remaining * self.instructions_share) if history else remaining, provider, model
+            )
+            instructions_text = "\n\n═══════════════════════════════════════════\n\n".join(packed_chunks)
+            instructions_tokens = self.count_tokens(instructions_text, provider, model)
+            remaining = max(remaining - instructions_tokens, 0)
+
+        # 3. Histórico recente + resumo das mensagens antigas
+        summary_budget = int(budget * self.summary_share)
+        packed_history, overflow = self.pack_history(history, max(remaining - summary_budget, 0), provider, model)
+        summary = await self.get_rolling_summary(db, conversation_id, overflow, summary_budget, provider, model)
+
+        # Placeholder sempre substituído: sem espaço para as instruções vira "" (nunca vai literal ao LLM)
+        system_message = system_prompt
+        if "{{INSTRUCTIONS}}" in system_message:
+            system_message = system_message.replace("{{INSTRUCTIONS}}", instructions_text)
+        elif instructions_text:
+            system_message = f"{system_message}\n\n{instructions_text}"
+        if summary:
+            system_message += f"\n\n📝 RESUMO DA CONVERSA ANTERIOR:\n{summary}"
+
+        messages = prefix_messages + [{"role": m["role"], "content": m["content"]} for m in packed_history]
+
+        tokens = {
+            "budget": budget,
+            "system": self.count_tokens(system_message, provider, model),
+            "instructions": instructions_tokens,
+            "history": self.count_message_tokens(messages, provider, model),
+            "history_messages": len(packed_history),
+            "summarized_messages": len(overflow),
+        }
+        tokens["total"] = tokens["system"] + tokens["history"] + self.count_tokens(current_message, provider, model)
+
+        logger.info(
+            f"📦 Contexto montado: {tokens['total']}/{budget} tokens | "
+            f"histórico {len(packed_history)} msgs | resumo de {len(overflow)} msgs | {provider}/{model}"
+        )
+
+        return {"system_message": system_message, "messages": messages, "tokens": tokens}
+
+
+def messages_to_history(messages: List[Dict]) -> List[Dict]:
+    """
+    Converte documentos da collection messages (tickets) para o formato de histórico
+    Cliente → user; atendente/IA → assistant; mensagens de sistema são ignoradas
+    """
+    history = []
+    for message in messages:
+        from_type = message.get("from_type")
+        if from_type == "client":
+            role = "user"
+        elif from_type in ("agent", "ai"):
+            role = "assistant"
+        else:
+            continue
+        history.append({
+            "role": role,
+            "content": message.get("text") or "",
+            "timestamp": message.get("created_at") or ""
+        })
+    return history
+
+
+# Instância global
+context_builder = ContextBuilder()
@@ -0,0 +1,265 @@
+"""
+Memória de conversa da IA em buckets (ai_conversation_memory)
+
+Em vez de um único documento por sessão com um array "messages" sem limite
+(que cresce até o teto de 16MB do BSON), cada sessão é gravada em vários
+documentos "bucket" com no máximo BUCKET_SIZE mensagens:
+
+    {session_id, department_id, count, messages: [...], created_at, updated_at, expire_at}
+
+- Append: um único update_one com upsert (sem find_one antes). O filtro
+  {"count": {"$lt": BUCKET_SIZE}} encontra o bucket aberto; quando todos estão
+  cheios o upsert cria um novo.
+- Leitura das últimas K mensagens: lê só os buckets do fim (normalmente um),
+  ordenados por _id, com $slice na projeção.
+- Documentos antigos (array único, sem "count") continuam legíveis e nunca
+  recebem novas mensagens.
+- Metadata da conversa fica em ai_conversation_sessions (um doc pequeno por sessão).
+
+Expiração: cada documento recebe "expire_at" (data BSON) calculado a partir da
+retenção do departamento (ai_config.ai_memory_cleanup_days) no momento da escrita.
+Um índice TTL (expireAfterSeconds=0) remove os documentos conforme vencem - sem
+job agendado. Departamento configurado para nunca limpar = documento sem expire_at.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SIZE = int(os.environ.get("AI_MEMORY_BUCKET_SIZE", "50"))
+# Retenção quando a conversa não está ligada a um departamento
+DEFAULT_RETENTION_DAYS = int(os.environ.get("AI_MEMORY_DEFAULT_RETENTION_DAYS", "60"))
+# Cache de retenção/departamento por worker (configuração muda raramente)
+RETENTION_CACHE_TTL = 300
+
+
+class ConversationMemoryStore:
+    """Armazena e lê mensagens de conversa da IA em buckets limitados"""
+
+    def __init__(self, bucket_size: int = BUCKET_SIZE):
+        self.bucket_size = max(bucket_size, 1)
+        self._indexed_dbs = set()
+        self._retention_cache: Dict[str, tuple] = {}  # department_id -> (dias ou None, carregado_em)
+        self._agent_department_cache: Dict[str, tuple] = {}  # agent_id -> (department_id, carregado_em)
+
+    async def ensure_indexes(self, db):
+        """
+        Índices usados pelo append (session_id + count), pela leitura do fim
+        (session_id + _id), pela reaplicação de retenção (department_id) e TTL (expire_at)
+        """
+        if id(db) in self._indexed_dbs:
+            return
+        try:
+            await db.ai_conversation_memory.create_index([("session_id", 1), ("_id", -1)])
+            await db.ai_conversation_memory.create_index([("session_id", 1), ("count", 1)])
+            await db.ai_conversation_memory.create_index([("department_id", 1)])
+            await db.ai_conversation_memory.create_index([("expire_at", 1)], expireAfterSeconds=0)
+            await db.ai_conversation_sessions.create_index([("session_id", 1)], unique=True)
+            await db.ai_conversation_sessions.create_index([("expire_at", 1)], expireAfterSeconds=0)
+            self._indexed_dbs.add(id(db))
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices da memória de conversa: {e}")
+
+    # ------------------------------------------------------------------
+    # Retenção por departamento
+    # ------------------------------------------------------------------
+
+    async def retention_days(self, db, department_id: Optional[str]) -> Optional[int]:
+        """
+        Dias de retenção para conversas do departamento (None = nunca expira)
+        """
+        if not department_id:
+            return DEFAULT_RETENTION_DAYS
+
+        cached = self._retention_cache.get(department_id)
+        if cached and time.monotonic() - cached[1] < RETENTION_CACHE_TTL:
+            return cached[0]
+
+        department = await db.departments.find_one({"id": department_id}, {"_id": 0, "ai_config": 1})
+        if department is None:
+            days = DEFAULT_RETENTION_DAYS
+        else:
+            # None ou 0 = nunca limpar
+            days = (department.get("ai_config") or {}).get("ai_memory_cleanup_days") or None
+
+        self._retention_cache[department_id] = (days, time.monotonic())
+        return days
+
+    async def department_for_agent(self, db, agent_config: Optional[Dict]) -> Optional[str]:
+        """
+        Departamento que usa o agente IA (departments.ai_agent_id) - define a retenção da memória
+        """
+        agent_id = (agent_config or {}).get("id")
+        if not agent_id or db is None:
+            return None
+
+        cached = self._agent_department_cache.get(agent_id)
+        if cached and time.monotonic() - cached[1] < RETENTION_CACHE_TTL:
+            return cached[0]
+
+        try:
+            department = await db.departments.find_one({"ai_agent_id": agent_id}, {"_id": 0, "id": 1})
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao buscar departamento do agente {agent_id}: {e}")
+            return None
+
+        department_id = department.get("id") if department else None
+        self._agent_department_cache[agent_id] = (department_id, time.monotonic())
+        return department_id
+
+    def invalidate_retention(self, department_id: Optional[str] = None):
+        """Descarta a retenção em cache (chamar quando a configuração do departamento mudar)"""
+        if department_id is None:
+            self._retention_cache.clear()
+            self._agent_department_cache.clear()
+        else:
+            self._retention_cache.pop(department_id, None)
+
+    async def expiry_for(self, db, department_id: Optional[str], now: datetime) -> Optional[datetime]:
+        """expire_at de um write feito agora (None = nunca expira)"""
+        days = await self.retention_days(db, department_id)
+        if days is None:
+            return None
+        return now + timedelta(days=days)
+
+    async def _expiry_update(self, db, department_id: Optional[str], now: datetime) -> Dict:
+        """Operadores $set/$unset de expire_at para um write feito agora"""
+        expire_at = await self.expiry_for(db, department_id, now)
+        if expire_at is None:
+            return {"$unset": {"expire_at": "", "expires_at": ""}}
+        return {
+            "$set": {"expire_at": expire_at},
+            "$unset": {"expires_at": ""}
+        }
+
+    async def apply_retention(self, db, department_id: str, days: Optional[int], only_missing: bool = False) -> int:
+        """
+        Recalcula expire_at das conversas já gravadas de um departamento
+        (updated_at + nova retenção). O índice TTL cuida da remoção.
+
+        only_missing=True: só documentos ainda sem expire_at (backfill no startup)
+        """
+        self.invalidate_retention(department_id)
+        query = {"department_id": department_id}
+        if only_missing:
+            if not days:
+                return 0
+            query["expire_at"] = {"$exists": False}
+
+        if not days:
+            result = await db.ai_conversation_memory.update_many(
+                query,
+                {"$unset": {"expire_at": ""}}
+            )
+            return result.modified_count
+
+        result = await db.ai_conversation_memory.update_many(
+            query,
+            [{"$set": {"expire_at": {"$add": [last_write_date_expr(), days * 86400000]}}}]
+        )
+        return result.modified_count
+
+    # ------------------------------------------------------------------
+    # Mensagens
+    # ------------------------------------------------------------------
+
+    async def append(self, session_id: str, messages: List[Dict], db, department_id: Optional[str] = None) -> None:
+        """
+        Adiciona mensagens ao bucket aberto da sessão (upsert, sem leitura prévia)
+        """
+        if not messages:
+            return
+        await self.ensure_indexes(db)
+
+        now = datetime.now(timezone.utc)
+        update = await self._expiry_update(db, department_id, now)
+        update.setdefault("$set", {}).update({"updated_at": now.isoformat(), "updated_at_dt": now})
+        if department_id:
+            update["$set"]["department_id"] = department_id
+        update.update({
+            "$push": {"messages": {"$each": messages}},
+            "$inc": {"count": len(messages)},
+            "$setOnInsert": {"created_at": now.isoformat(), "created_at_dt": now}
+        })
+
+        await db.ai_conversation_memory.update_one(
+            {"session_id": session_id, "count": {"$lt": self.bucket_size}},
+            update,
+            upsert=True
+        )
+
+    async def get_recent(self, session_id: str, db, max_messages: int = 200) -> List[Dict]:
+        """
+        Retorna as últimas max_messages mensagens da sessão (ordem cronológica)
+        Lê os buckets do fim para o começo e para assim que tiver o suficiente
+        """
+        if max_messages <= 0:
+            return []
+
+        cursor = db.ai_conversation_memory.find(
+            {"session_id": session_id, "messages": {"$exists": True}},
+            {"_id": 0, "messages": {"$slice": -max_messages}}
+        ).sort("_id", -1)
+
+        collected: List[List[Dict]] = []
+        total = 0
+        async for bucket in cursor:
+            bucket_messages = bucket.get("messages") or []
+            collected.append(bucket_messages)
+            total += len(bucket_messages)
+            if total >= max_messages:
+                break
+
+        messages = [m for bucket_messages in reversed(collected) for m in bucket_messages]
+        return messages[-max_messages:]
+
+    async def get_all(self, session_id: str, db) -> List[Dict]:
+        """Retorna todas as mensagens da sessão (ordem cronológica)"""
+        buckets = await db.ai_conversation_memory.find(
+            {"session_id": session_id, "messages": {"$exists": True}},
+            {"_id": 0, "messages": 1}
+        ).sort("_id", 1).to_list(length=None)
+        return [m for bucket in buckets for m in (bucket.get("messages") or [])]
+
+    async def get_metadata(self, session_id: str, db) -> Dict:
+        session = await db.ai_conversation_sessions.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "metadata": 1}
+        )
+        return (session or {}).get("metadata") or {}
+
+    async def set_metadata(self, session_id: str, metadata: Dict, db, department_id: Optional[str] = None) -> None:
+        await self.ensure_indexes(db)
+        now = datetime.now(timezone.utc)
+        update = await self._expiry_update(db, department_id, now)
+        update.setdefault("$set", {}).update({"metadata": metadata, "updated_at": now.isoformat(), "updated_at_dt": now})
+        update["$setOnInsert"] = {"created_at": now.isoformat(), "created_at_dt": now}
+        await db.ai_conversation_sessions.update_one({"session_id": session_id}, update, upsert=True)
+
+    async def delete_session(self, session_id: str, db) -> int:
+        """Remove todos os buckets e a metadata da sessão"""
+        result = await db.ai_conversation_memory.delete_many({"session_id": session_id})
+        await db.ai_conversation_sessions.delete_one({"session_id": session_id})
+        return result.deleted_count
+
+
+def last_write_date_expr(fallback: str = "$$NOW") -> Dict:
+    """
+    Expressão de agregação: data BSON da última escrita do documento
+    (updated_at_dt já tipado; docs antigos: updated_at / created_at / timestamp
+    em ISO string, conforme o formato do doc)
+    """
+    return {"$ifNull": ["$updated_at_dt", {
+        "$dateFromString": {
+            "dateString": {"$ifNull": ["$updated_at", {"$ifNull": ["$created_at", "$timestamp"]}]},
+            "onError": fallback,
+            "onNull": fallback
+        }
+    }]}
+
+
+# Instância global
+conversation_memory = ConversationMemoryStore()
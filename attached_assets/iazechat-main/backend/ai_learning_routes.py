@@ -5,10 +5,11 @@ Rotas para feedback, memória e padrões de conhecimento
 from fastapi import APIRouter, HTTPException, Depends
 from motor.motor_asyncio import AsyncIOMotorDatabase
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import logging
 from typing import List, Optional
 from pydantic import BaseModel
+from ai_conversation_memory import conversation_memory
 
 logger = logging.getLogger(__name__)
 
@@ -48,15 +49,10 @@ async def get_conversation_memory(
     Obter memória de conversa específica
     """
     try:
-        memory = await db.ai_conversation_memory.find_one(
-            {"session_id": session_id},
-            {"_id": 0}
-        )
+        messages = await conversation_memory.get_all(session_id, db)
+        metadata = await conversation_memory.get_metadata(session_id, db)
         
-        if not memory:
-            return {"session_id": session_id, "messages": [], "metadata": {}}
-        
-        return memory
+        return {"session_id": session_id, "messages": messages, "metadata": metadata}
         
     except Exception as e:
         logger.error(f"❌ Erro ao buscar memória: {e}")
@@ -72,31 +68,7 @@ async def save_conversation_message(
     Salvar mensagem na memória de conversa
     """
     try:
-        # Verificar se já existe memória
-        memory = await db.ai_conversation_memory.find_one({"session_id": session_id})
-        
-        now = datetime.now(timezone.utc)
-        expires_at = now + timedelta(days=60)
-        
-        if memory:
-            # Atualizar memória existente
-            await db.ai_conversation_memory.update_one(
-                {"session_id": session_id},
-                {
-                    "$push": {"messages": message},
-                    "$set": {"expires_at": expires_at.isoformat()}
-                }
-            )
-        else:
-            # Criar nova memória
-            new_memory = {
-                "session_id": session_id,
-                "messages": [message],
-                "metadata": {},
-                "created_at": now.isoformat(),
-                "expires_at": expires_at.isoformat()
-            }
-            await db.ai_conversation_memory.insert_one(new_memory)
+        await conversation_memory.append(session_id, [message], db)
         
         logger.info(f"✅ Mensagem salva na memória: {session_id}")
         return {"success": True}
@@ -115,10 +87,7 @@ async def update_conversation_metadata(
     Atualizar metadata da conversa
     """
     try:
-        await db.ai_conversation_memory.update_one(
-            {"session_id": session_id},
-            {"$set": {"metadata": metadata}}
-        )
+        await conversation_memory.set_metadata(session_id, metadata, db)
         
         logger.info(f"✅ Metadata atualizada: {session_id}")
         return {"success": True}
@@ -324,14 +293,19 @@ async def cleanup_expired_conversations(
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
-    Limpar conversas expiradas (> 60 dias)
-    Usado pelo script de limpeza automática
+    Limpar conversas expiradas
+    O índice TTL em expire_at já remove as conversas vencidas; esta rota apenas
+    antecipa o que o monitor de TTL ainda não processou
     """
     try:
-        now = datetime.now(timezone.utc).isoformat()
+        now_dt = datetime.now(timezone.utc)
+        now = now_dt.isoformat()
         
         result = await db.ai_conversation_memory.delete_many({
-            "expires_at": {"$lt": now}
+            "expire_at": {"$lt": now_dt}
+        })
+        await db.ai_conversation_sessions.delete_many({
+            "expire_at": {"$lt": now_dt}
         })
         
         logger.info(f"✅ {result.deleted_count} conversas expiradas foram deletadas")
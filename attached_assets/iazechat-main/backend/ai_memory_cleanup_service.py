@@ -1,12 +1,11 @@
 """
 Serviço de Limpeza Automática de Memória da IA
-Limpa conversas antigas baseado na configuração de cada departamento
+Retenção por departamento via índice TTL (expire_at) - ver ai_conversation_memory
 """
 import logging
-from datetime import datetime, timezone, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
 from dotenv import load_dotenv
+from database import get_db
+from ai_conversation_memory import conversation_memory, last_write_date_expr, DEFAULT_RETENTION_DAYS
 
 load_dotenv()
 
@@ -17,69 +16,66 @@ class AIMemoryCleanupService:
     Serviço para limpar memórias antigas da IA baseado em configuração de departamento
     """
     
-    def __init__(self, mongo_url: str = None):
-        if mongo_url is None:
-            mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        
-        self.client = AsyncIOMotorClient(mongo_url)
-        self.db = self.client.support_chat
+    def __init__(self, db=None):
+        # Conexão compartilhada do servidor (database.py), sem cliente próprio
+        self.db = db if db is not None else get_db()
     
-    async def cleanup_old_conversations(self):
+    async def cleanup_old_conversations(self, only_missing: bool = False):
         """
-        Limpar conversas antigas baseado na configuração de cada departamento
+        Reaplicar a retenção de cada departamento nas conversas já gravadas
+        
+        A remoção em si é feita pelo índice TTL em expire_at (documento a documento,
+        conforme vencem). Aqui apenas recalculamos expire_at - útil após mudar a
+        configuração ou para documentos antigos gravados antes do TTL.
+        
+        only_missing=True: só conversas ainda sem expire_at (backfill idempotente
+        rodado no startup, substitui o antigo scheduler diário de limpeza)
         """
         try:
-            logger.info("🧹 Iniciando limpeza de memórias antigas da IA...")
+            logger.info("🧹 Reaplicando retenção de memórias da IA...")
+            await conversation_memory.ensure_indexes(self.db)
             
             # Buscar todos os departamentos com IA ativada
-            departments = await self.db.departments.find({"ai_enabled": True}).to_list(length=None)
+            departments = await self.db.departments.find(
+                {"ai_enabled": True},
+                {"_id": 0, "id": 1, "name": 1, "ai_config": 1}
+            ).to_list(length=None)
             
-            if not departments:
-                logger.info("📭 Nenhum departamento com IA ativada encontrado")
-                return
-            
-            total_cleaned = 0
+            total_updated = 0
             
             for dept in departments:
                 dept_id = dept.get("id")
-                dept_name = dept.get("name", "Unknown")
-                ai_config = dept.get("ai_config", {})
+                ai_config = dept.get("ai_config") or {}
                 
-                # Pegar configuração de limpeza (em dias)
+                # Pegar configuração de limpeza (em dias) - None ou 0 = nunca limpar
                 cleanup_days = ai_config.get("ai_memory_cleanup_days", None)
                 
-                if cleanup_days is None or cleanup_days == 0:
-                    logger.debug(f"⏭️ Departamento '{dept_name}' configurado para nunca limpar memória")
-                    continue
-                
-                # Calcular data de corte
-                cutoff_date = datetime.now(timezone.utc) - timedelta(days=cleanup_days)
+                updated = await conversation_memory.apply_retention(self.db, dept_id, cleanup_days, only_missing)
+                total_updated += updated
                 
-                # Limpar conversas antigas deste departamento
-                result = await self.db.ai_conversation_memory.delete_many({
-                    "department_id": dept_id,
-                    "created_at": {"$lt": cutoff_date.isoformat()}
-                })
-                
-                deleted_count = result.deleted_count
-                total_cleaned += deleted_count
-                
-                if deleted_count > 0:
-                    logger.info(f"✅ Departamento '{dept_name}': {deleted_count} conversas limpas (> {cleanup_days} dias)")
+                if updated > 0:
+                    logger.info(f"✅ Departamento '{dept.get('name', 'Unknown')}': expire_at recalculado em {updated} documentos")
             
-            logger.info(f"🎉 Limpeza concluída! Total: {total_cleaned} conversas removidas")
+            # Documentos antigos (sem departamento e sem expire_at) recebem a retenção padrão
+            result = await self.db.ai_conversation_memory.update_many(
+                {"department_id": {"$exists": False}, "expire_at": {"$exists": False}},
+                [{"$set": {"expire_at": {"$add": [last_write_date_expr(), DEFAULT_RETENTION_DAYS * 86400000]}}}]
+            )
+            total_updated += result.modified_count
+            
+            logger.info(f"🎉 Retenção aplicada! {total_updated} documentos atualizados (remoção via índice TTL)")
             
         except Exception as e:
-            logger.error(f"❌ Erro na limpeza de memórias: {e}")
+            logger.error(f"❌ Erro ao aplicar retenção de memórias: {e}")
     
     async def cleanup_by_session_id(self, session_id: str):
         """
         Limpar conversas de uma sessão específica
         """
         try:
-            result = await self.db.ai_conversation_memory.delete_one({"session_id": session_id})
+            deleted_count = await conversation_memory.delete_session(session_id, self.db)
             
-            if result.deleted_count > 0:
+            if deleted_count > 0:
                 logger.info(f"✅ Conversa {session_id} removida")
                 return True
             else:
@@ -95,20 +91,24 @@ class AIMemoryCleanupService:
         Obter estatísticas de uso de memória
         """
         try:
-            # Total de conversas
-            total_conversations = await self.db.ai_conversation_memory.count_documents({})
-            
-            # Total de mensagens
+            # Total de conversas e mensagens (cada conversa pode ter vários buckets;
+            # docs antigos sem "count" usam o tamanho do array)
             pipeline = [
-                {"$project": {"messages_count": {"$size": "$messages"}}},
-                {"$group": {"_id": None, "total": {"$sum": "$messages_count"}}}
+                {"$project": {
+                    "session_id": 1,
+                    "messages_count": {"$ifNull": ["$count", {"$size": {"$ifNull": ["$messages", []]}}]}
+                }},
+                {"$group": {"_id": None, "sessions": {"$addToSet": "$session_id"}, "total": {"$sum": "$messages_count"}}},
+                {"$project": {"conversations": {"$size": "$sessions"}, "total": 1}}
             ]
             result = await self.db.ai_conversation_memory.aggregate(pipeline).to_list(length=1)
+            total_conversations = result[0]["conversations"] if result else 0
             total_messages = result[0]["total"] if result else 0
             
             # Conversas por departamento
             pipeline_dept = [
-                {"$group": {"_id": "$department_id", "count": {"$sum": 1}}}
+                {"$group": {"_id": {"department_id": "$department_id", "session_id": "$session_id"}}},
+                {"$group": {"_id": "$_id.department_id", "count": {"$sum": 1}}}
             ]
             dept_stats = await self.db.ai_conversation_memory.aggregate(pipeline_dept).to_list(length=None)
             
@@ -4,11 +4,14 @@ Rotas para gerenciamento de memória da IA
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
 from typing import Optional
 from pydantic import BaseModel
+import asyncio
 import logging
-from motor.motor_asyncio import AsyncIOMotorClient
+from database import get_db
 import os
 from dotenv import load_dotenv
 from ai_memory_cleanup_service import ai_memory_cleanup_service
+from ai_conversation_memory import conversation_memory
+from instructions_rag import instructions_rag
 
 load_dotenv()
 
@@ -16,10 +19,8 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# Database connection
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'support_chat')]
+# Database connection (compartilhada - database.py)
+db = get_db()
 
 class AIMemoryCleanupConfig(BaseModel):
     ai_memory_cleanup_days: Optional[int] = None  # None ou 0 = nunca limpar, valores: 7, 15, 30, 60, 90
@@ -71,6 +72,8 @@ async def update_ai_memory_config(department_id: str, config: AIMemoryCleanupCon
         )
         
         if result.modified_count > 0:
+            # Recalcular expire_at das conversas existentes (o índice TTL remove as vencidas)
+            await conversation_memory.apply_retention(db, department_id, config.ai_memory_cleanup_days)
             logger.info(f"✅ Configuração de memória atualizada para departamento: {department_id}")
             return {
                 "success": True,
@@ -181,12 +184,18 @@ async def upload_department_instructions(
         filename = f"department_{department_id}.txt"
         filepath = os.path.join(instructions_dir, filename)
         
+        # Descartar índice e artefato da versão anterior (antes de sobrescrever)
+        instructions_rag.invalidate(filepath, drop_artifact=True)
+        
         # Salvar arquivo
         with open(filepath, 'w', encoding='utf-8') as f:
             f.write(text_content)
         
         logger.info(f"✅ Instruções salvas para departamento {department_id}: {len(text_content)} chars")
         
+        # Compilar o novo artefato (tokenização + BM25) fora do event loop
+        await asyncio.get_running_loop().run_in_executor(None, instructions_rag.load_and_prepare, filepath)
+        
         # Atualizar departamento com nome do arquivo
         department = await db.departments.find_one({"id": department_id})
         if not department:
@@ -276,6 +285,7 @@ async def delete_department_instructions_file(department_id: str):
         
         if filename:
             filepath = f"/app/instructions/{filename}"
+            instructions_rag.invalidate(filepath, drop_artifact=True)
             if os.path.exists(filepath):
                 os.remove(filepath)
                 logger.info(f"✅ Arquivo removido: {filepath}")
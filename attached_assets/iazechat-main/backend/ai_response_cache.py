@@ -0,0 +1,376 @@
+"""
+Cache de respostas da IA para perguntas repetidas
+Evita chamar o LLM para perguntas quase idênticas ("qual meu usuario", "como instalar no firestick")
+
+- Chave: agente + versão da configuração do agente + estado da conversa +
+  pergunta normalizada. Estado = última resposta do assistente na sessão ("" em
+  conversa nova): no fluxo de vendas em etapas a mesma frase ("quero esse") tem
+  respostas diferentes conforme a pergunta anterior do bot
+- Similaridade opcional via MinHash (LSH) para perguntas com pequenas variações,
+  só entre entradas do mesmo estado de conversa
+- TTL e limite de entradas (LRU) por agente
+- Respostas com credenciais do cliente NUNCA são armazenadas
+- Estatísticas por agente: hits, misses e tokens economizados
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Campos do agente que alteram a resposta gerada (mudou qualquer um → nova versão)
+AGENT_VERSION_FIELDS = [
+    "who_is", "what_does", "objective", "how_respond", "instructions",
+    "knowledge_base", "avoid_topics", "avoid_words", "allowed_links",
+    "custom_rules", "knowledge_restriction", "auto_detect_language",
+    "timezone", "llm_provider", "llm_model", "instructions_file",
+    "instructions_url", "updated_at"
+]
+
+# Padrões de credenciais em respostas (nunca cachear)
+CREDENTIAL_PATTERNS = [
+    re.compile(r'usu[aá]rio\s*\**\s*:\s*\**\s*\S+', re.IGNORECASE),
+    re.compile(r'senha\s*\**\s*:\s*\**\s*\S+', re.IGNORECASE),
+    re.compile(r'password\s*:\s*\S+', re.IGNORECASE),
+    re.compile(r'login\s*\**\s*:\s*\**\s*\S+', re.IGNORECASE),
+]
+
+# Parâmetros do MinHash: 64 permutações em 16 bandas de 4 linhas (LSH)
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_COEFFICIENTS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME or 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME
+    )
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normaliza pergunta para comparação:
+    minúsculas, sem acentos, sem pontuação e com espaços colapsados
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa simples de tokens (~4 caracteres por token)"""
+    return max(1, len(text or "") // 4)
+
+
+def last_assistant_reply(history: Optional[List[Dict]]) -> str:
+    """Última resposta do assistente no histórico [{"role", "content"}] ("" = conversa nova)"""
+    for message in reversed(history or []):
+        if message.get("role") == "assistant" and message.get("content"):
+            return message["content"]
+    return ""
+
+
+def _minhash_signature(normalized: str) -> Tuple[int, ...]:
+    """Assinatura MinHash a partir de trigramas de caracteres"""
+    padded = f" {normalized} "
+    shingles = {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _MINHASH_COEFFICIENTS
+    )
+
+
+def _signature_bands(signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [
+        (band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+def _jaccard_estimate(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class _AgentCache:
+    """Entradas e estatísticas de um único agente"""
+
+    def __init__(self):
+        # chave → {"version", "context", "question", "response", "tokens", "expires_at", "signature"}
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # (banda, valores) → conjunto de chaves (LSH)
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], set] = {}
+        self.stats = {
+            "hits": 0,
+            "similar_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "skipped_credentials": 0,
+            "evictions": 0,
+            "saved_tokens": 0
+        }
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry and entry.get("signature"):
+            for band_key in _signature_bands(entry["signature"]):
+                bucket = self.buckets.get(band_key)
+                if bucket:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self.buckets[band_key]
+
+
+class AIResponseCache:
+    """
+    Cache de respostas da IA por agente
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = None,
+        max_entries_per_agent: int = None,
+        similarity_threshold: float = None
+    ):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(
+            os.environ.get("AI_RESPONSE_CACHE_TTL", "3600")
+        )
+        self.max_entries_per_agent = max_entries_per_agent if max_entries_per_agent is not None else int(
+            os.environ.get("AI_RESPONSE_CACHE_MAX_ENTRIES", "500")
+        )
+        # 0 desativa a busca por similaridade (apenas match exato)
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else float(
+            os.environ.get("AI_RESPONSE_CACHE_SIMILARITY", "0.85")
+        )
+        self.enabled = os.environ.get("AI_RESPONSE_CACHE_ENABLED", "true").lower() != "false"
+        # Perguntas muito curtas ("sim", "tv box") dependem do contexto da conversa
+        self.min_question_words = 3
+        self.agents: Dict[str, _AgentCache] = {}
+
+    def agent_config_version(self, agent_config: Dict) -> str:
+        """
+        Versão da configuração do agente (hash dos campos que influenciam a resposta)
+        Inclui o mtime do arquivo de instruções, que pode ser re-enviado sem alterar o agente
+        """
+        parts = [str(agent_config.get(field, "")) for field in AGENT_VERSION_FIELDS]
+
+        instructions_file = agent_config.get("instructions_file")
+        if instructions_file:
+            try:
+                parts.append(str(os.path.getmtime(f"/app/instructions/{instructions_file}")))
+            except OSError:
+                parts.append("missing")
+
+        return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    def _is_cacheable_agent(self, agent_config: Optional[Dict]) -> bool:
+        return bool(
+            self.enabled
+            and agent_config
+            and agent_config.get("id")
+            and agent_config.get("response_cache_enabled", True)
+        )
+
+    def _entry_key(self, version: str, context: str, normalized: str) -> str:
+        return f"{version}:{context}:{normalized}"
+
+    def context_key(self, previous_reply: Optional[str]) -> str:
+        """Estado da conversa: hash da última resposta do assistente ("" = conversa nova)"""
+        normalized = normalize_question(previous_reply or "")
+        if not normalized:
+            return ""
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+    def _agent(self, agent_id: str) -> _AgentCache:
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            agent = _AgentCache()
+            self.agents[agent_id] = agent
+        return agent
+
+    def contains_credentials(self, response: str, client_data: Optional[Dict] = None) -> bool:
+        """Verifica se a resposta contém credenciais (padrões ou dados do cliente)"""
+        if not response:
+            return False
+
+        for pattern in CREDENTIAL_PATTERNS:
+            if pattern.search(response):
+                return True
+
+        if client_data:
+            for field in ("pinned_user", "pinned_pass", "usuario", "senha", "iptv_user", "iptv_pass", "pin", "whatsapp"):
+                value = client_data.get(field)
+                if value and len(str(value)) >= 3 and str(value) in response:
+                    return True
+
+        return False
+
+    def get(self, agent_config: Optional[Dict], question: str, previous_reply: Optional[str] = None) -> Optional[str]:
+        """
+        Busca resposta em cache para a pergunta
+        previous_reply: última resposta do assistente na sessão (estado da conversa)
+        Retorna a resposta armazenada ou None (cache miss)
+        """
+        if not self._is_cacheable_agent(agent_config):
+            return None
+
+        normalized = normalize_question(question)
+        if len(normalized.split()) < self.min_question_words:
+            return None
+
+        agent = self._agent(agent_config["id"])
+        version = self.agent_config_version(agent_config)
+        context = self.context_key(previous_reply)
+        now = time.monotonic()
+
+        # 1. Match exato
+        key = self._entry_key(version, context, normalized)
+        entry = agent.entries.get(key)
+        if entry and entry["expires_at"] > now:
+            agent.entries.move_to_end(key)
+            agent.stats["hits"] += 1
+            agent.stats["saved_tokens"] += entry["tokens"]
+            logger.info(f"⚡ Cache HIT (exato) para agente {agent_config['id']}: '{normalized[:50]}'")
+            return entry["response"]
+        if entry:
+            agent.remove(key)
+
+        # 2. Similaridade (MinHash + LSH)
+        if self.similarity_threshold > 0:
+            signature = _minhash_signature(normalized)
+            candidates = set()
+            for band_key in _signature_bands(signature):
+                candidates.update(agent.buckets.get(band_key, ()))
+
+            best_key, best_score = None, 0.0
+            for candidate_key in candidates:
+                candidate = agent.entries.get(candidate_key)
+                if (
+                    not candidate
+                    or candidate["version"] != version
+                    or candidate["context"] != context
+                    or candidate["expires_at"] <= now
+                ):
+                    continue
+                score = _jaccard_estimate(signature, candidate["signature"])
+                if score > best_score:
+                    best_key, best_score = candidate_key, score
+
+            if best_key and best_score >= self.similarity_threshold:
+                entry = agent.entries[best_key]
+                agent.entries.move_to_end(best_key)
+                agent.stats["hits"] += 1
+                agent.stats["similar_hits"] += 1
+                agent.stats["saved_tokens"] += entry["tokens"]
+                logger.info(
+                    f"⚡ Cache HIT (similar {best_score:.2f}) para agente {agent_config['id']}: "
+                    f"'{normalized[:50]}' ≈ '{entry['question'][:50]}'"
+                )
+                return entry["response"]
+
+        agent.stats["misses"] += 1
+        return None
+
+    def put(
+        self,
+        agent_config: Optional[Dict],
+        question: str,
+        response: str,
+        prompt_tokens: int = 0,
+        client_data: Optional[Dict] = None,
+        previous_reply: Optional[str] = None
+    ) -> bool:
+        """
+        Armazena resposta no cache
+        client_data: dados do cliente da sessão (respostas que os contêm não são cacheadas)
+        previous_reply: última resposta do assistente antes da pergunta (mesmo valor do get)
+        Retorna False se a resposta não puder ser cacheada (ex: contém credenciais)
+        """
+        if not self._is_cacheable_agent(agent_config) or not response:
+            return False
+
+        normalized = normalize_question(question)
+        if len(normalized.split()) < self.min_question_words:
+            return False
+
+        agent = self._agent(agent_config["id"])
+
+        if self.contains_credentials(response, client_data):
+            agent.stats["skipped_credentials"] += 1
+            logger.info(f"🔒 Resposta com credenciais NÃO cacheada (agente {agent_config['id']})")
+            return False
+
+        version = self.agent_config_version(agent_config)
+        context = self.context_key(previous_reply)
+        key = self._entry_key(version, context, normalized)
+        agent.remove(key)
+
+        signature = _minhash_signature(normalized) if self.similarity_threshold > 0 else None
+        agent.entries[key] = {
+            "version": version,
+            "context": context,
+            "question": normalized,
+            "response": response,
+            "tokens": prompt_tokens + estimate_tokens(question) + estimate_tokens(response),
+            "expires_at": time.monotonic() + self.ttl_seconds,
+            "signature": signature
+        }
+        if signature:
+            for band_key in _signature_bands(signature):
+                agent.buckets.setdefault(band_key, set()).add(key)
+        agent.stats["stores"] += 1
+
+        # Evicção LRU
+        while len(agent.entries) > self.max_entries_per_agent:
+            oldest_key = next(iter(agent.entries))
+            agent.remove(oldest_key)
+            agent.stats["evictions"] += 1
+
+        return True
+
+    def purge_expired(self) -> int:
+        """Remove entradas expiradas de todos os agentes"""
+        now = time.monotonic()
+        removed = 0
+        for agent in self.agents.values():
+            for key in [k for k, e in agent.entries.items() if e["expires_at"] <= now]:
+                agent.remove(key)
+                removed += 1
+        return removed
+
+    def invalidate_agent(self, agent_id: str):
+        """Descarta todas as respostas de um agente (mantém estatísticas)"""
+        agent = self.agents.get(agent_id)
+        if agent:
+            agent.entries.clear()
+            agent.buckets.clear()
+            logger.info(f"🗑️ Cache de respostas invalidado para agente {agent_id}")
+
+    def get_stats(self, agent_id: str) -> Dict:
+        """Estatísticas de uso do cache de um agente"""
+        agent = self.agents.get(agent_id)
+        stats = dict(agent.stats) if agent else dict(_AgentCache().stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["agent_id"] = agent_id
+        stats["entries"] = len(agent.entries) if agent else 0
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def get_all_stats(self) -> List[Dict]:
+        """Estatísticas de todos os agentes com cache"""
+        return [self.get_stats(agent_id) for agent_id in self.agents]
+
+
+# Instância global
+ai_response_cache = AIResponseCache()
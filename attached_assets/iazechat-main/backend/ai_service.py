@@ -4,26 +4,14 @@ Suporta OpenAI, Anthropic Claude e Google Gemini via Emergent LLM Key
 """
 import os
 from typing import List, Dict, Optional
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from ai_response_cache import ai_response_cache, last_assistant_reply
+from ai_context_builder import context_builder
+from metrics import track_llm
 import logging
 from datetime import datetime
 
-# Configurar logger específico para IA com arquivo dedicado
+# Logger da IA: handlers (stdout + /var/log/ai_agent.log) ficam no logging_setup
 logger = logging.getLogger("ai_agent")
-logger.setLevel(logging.INFO)
-
-# Handler para arquivo
-file_handler = logging.FileHandler("/var/log/ai_agent.log")
-file_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-
-# Handler para console
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 class AIAgentService:
     """Serviço para gerenciar respostas de IA"""
@@ -36,7 +24,9 @@ class AIAgentService:
         agent_config: Dict,
         message: str,
         conversation_history: List[Dict] = None,
-        client_data: Dict = None
+        client_data: Dict = None,
+        db=None,
+        conversation_id: Optional[str] = None
     ) -> Optional[str]:
         """
         Gera resposta da IA baseada nas configurações do agente
@@ -44,8 +34,10 @@ class AIAgentService:
         Args:
             agent_config: Configuração do agente IA (instruções, modelo, etc)
             message: Mensagem do cliente
-            conversation_history: Histórico de mensagens (opcional)
+            conversation_history: Histórico [{"role", "content", "timestamp"}] (opcional)
             client_data: Dados do cliente (credenciais se permitido)
+            db: Banco para salvar/reutilizar o resumo de mensagens antigas (opcional)
+            conversation_id: ID da conversa (ticket) para o resumo (opcional)
         
         Returns:
             Resposta da IA ou None se houver erro
@@ -64,11 +56,30 @@ class AIAgentService:
             
             logger.info(f"🔑 API Key presente: {api_key[:10]}...{api_key[-4:] if len(api_key) > 14 else ''}")
             
+            # Cache de respostas: pergunta repetida não chama o LLM
+            previous_reply = last_assistant_reply(conversation_history)
+            cached_response = ai_response_cache.get(agent_config, message, previous_reply)
+            if cached_response:
+                logger.info(f"⚡ Resposta servida do cache ({len(cached_response)} caracteres)")
+                logger.info("="*80)
+                return cached_response
+            
             # Construir system message com todas as instruções
             system_message = self._build_system_prompt(agent_config, client_data)
             logger.info(f"📋 System Prompt construído ({len(system_message)} caracteres)")
             logger.info(f"📋 System Prompt preview: {system_message[:200]}...")
             
+            # Empacotar system prompt + histórico dentro do orçamento de tokens do modelo
+            context = await context_builder.build(
+                agent_config=agent_config,
+                system_prompt=system_message,
+                history=conversation_history or [],
+                current_message=message,
+                db=db,
+                conversation_id=conversation_id
+            )
+            system_message = context["system_message"]
+            
             # Configurar chat
             provider = agent_config.get('llm_provider', 'openai')
             model = agent_config.get('llm_model', 'gpt-4o-mini')
@@ -77,11 +88,17 @@ class AIAgentService:
             logger.info(f"   - Provider: {provider}")
             logger.info(f"   - Model: {model}")
             logger.info(f"   - Session ID: agent_{agent_config.get('id', 'default')}")
+            logger.info(f"   - Tokens de prompt: {context['tokens']['total']}/{context['tokens']['budget']}")
+            
+            # Import só na primeira resposta: emergentintegrations (e o SDK do provedor)
+            # fica fora do import do server.py
+            from emergentintegrations.llm.chat import LlmChat, UserMessage
             
             chat = LlmChat(
                 api_key=api_key,
                 session_id=f"agent_{agent_config.get('id', 'default')}",
-                system_message=system_message
+                system_message=system_message,
+                initial_messages=context["messages"] or None
             ).with_model(provider, model)
             
             logger.info(f"✅ LlmChat configurado com sucesso")
@@ -91,12 +108,23 @@ class AIAgentService:
             logger.info(f"📨 Enviando mensagem para LLM...")
             
             # Enviar e obter resposta
-            response = await chat.send_message(user_message)
+            async with track_llm(provider, model, prompt_tokens=context["tokens"]["total"]) as call:
+                response = await chat.send_message(user_message)
+                call["completion_tokens"] = context_builder.count_tokens(response, provider, model)
             
             logger.info(f"✅ RESPOSTA RECEBIDA DO LLM!")
             logger.info(f"📤 Resposta ({len(response)} caracteres): {response[:200]}...")
             logger.info("="*80)
             
+            ai_response_cache.put(
+                agent_config,
+                message,
+                response,
+                prompt_tokens=context["tokens"]["total"],
+                client_data=client_data,
+                previous_reply=previous_reply
+            )
+            
             return response
             
         except Exception as e:
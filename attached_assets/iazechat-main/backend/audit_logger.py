@@ -1,33 +1,239 @@
 """
 🔍 SISTEMA DE AUDIT LOG - Rastreamento completo de ações críticas
 LGPD/GDPR Compliance Ready
+
+Escrita em buffer: log_action só enfileira em memória (sem round-trip no login
+ou na troca de config). Um loop em background grava com insert_many quando o
+buffer atinge BATCH_SIZE ou a cada FLUSH_INTERVAL segundos.
+
+- Buffer limitado (BUFFER_SIZE). Cheio: ações críticas (violação de segurança,
+  login) esperam um flush (backpressure); as demais descartam a entrada mais
+  antiga e contam em "dropped".
+- Shutdown para o loop (sem cancelar um insert_many em andamento) e grava tudo
+  que estiver pendente.
+- Collection time-series (timeField=timestamp, metaField=meta) com retenção de
+  RETENTION_DAYS; em MongoDB sem time-series - ou quando audit_logs já existia
+  como collection normal - mesmos índices e TTL. Registros antigos (campos no
+  topo, timestamp ISO em string) são migrados para o formato meta/BSON date.
 """
 
-from datetime import datetime, timezone
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
-from typing import Optional, Dict, Any
-import json
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, List
+
+from pymongo.errors import CollectionInvalid
+
+from metrics import loop_tick
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = int(os.environ.get("AUDIT_BUFFER_SIZE", "10000"))
+BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", "2"))
+RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", "365"))
+
+# Ações que nunca são descartadas quando o buffer enche
+CRITICAL_ACTIONS = {"SECURITY_VIOLATION", "LOGIN"}
+
+
+def _flatten(doc: Dict) -> Dict:
+    """Documento no formato antigo (campos de meta no topo)"""
+    meta = doc.pop("meta", {}) or {}
+    doc.pop("_id", None)
+    return {**meta, **doc}
+
 
 class AuditLogger:
     """
     Sistema de auditoria para compliance e segurança
-    
+
     Registra todas as ações críticas:
     - Login/Logout
     - Criação/Modificação de dados sensíveis
     - Acesso a dados de outras revendas (tentativas de violação)
     - Alterações de configuração
     """
-    
+
     def __init__(self):
-        MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        DB_NAME = os.environ.get('DB_NAME', 'support_chat')
-        
-        self.client = AsyncIOMotorClient(MONGO_URL)
-        self.db = self.client[DB_NAME]
-        self.audit_collection = self.db.audit_logs
-    
+        self.db = None
+        self.buffer: deque = deque()
+        self.dropped = 0
+        self.written = 0
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def audit_collection(self):
+        return self.db.audit_logs
+
+    async def start(self, db):
+        """Usa a conexão do servidor, prepara a collection e inicia o loop de flush"""
+        self.db = db
+        await self.ensure_collection()
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def ensure_collection(self):
+        try:
+            await self.db.create_collection(
+                "audit_logs",
+                timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "seconds"},
+                expireAfterSeconds=RETENTION_DAYS * 86400
+            )
+            logger.info("✅ audit_logs criada como time-series")
+        except CollectionInvalid:
+            # Já existe: se for a collection normal de antes, TTL + migração dos registros antigos
+            options = await self.audit_collection.options()
+            if "timeseries" not in options:
+                await self._ensure_ttl_index()
+                asyncio.create_task(self.migrate_legacy())
+        except Exception as e:
+            # MongoDB sem suporte a time-series: collection normal + TTL
+            logger.warning(f"⚠️ audit_logs sem time-series ({e}); usando collection normal")
+            await self._ensure_ttl_index()
+
+        try:
+            # get_user_activity
+            await self.audit_collection.create_index([("meta.user_id", 1), ("timestamp", -1)])
+            # get_security_violations
+            await self.audit_collection.create_index([("meta.action", 1), ("meta.reseller_id", 1), ("timestamp", -1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de audit_logs: {e}")
+
+    async def _ensure_ttl_index(self):
+        try:
+            await self.audit_collection.create_index(
+                [("timestamp", 1)], expireAfterSeconds=RETENTION_DAYS * 86400
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar TTL de audit_logs: {e}")
+
+    async def migrate_legacy(self) -> int:
+        """
+        Registros gravados antes do buffer: action/user_id/user_type/reseller_id
+        no topo e timestamp ISO em string. Move para meta.* e converte o timestamp
+        para BSON date (consultas e TTL). Idempotente.
+        """
+        try:
+            result = await self.audit_collection.update_many(
+                {"meta": {"$exists": False}, "action": {"$exists": True}},
+                [
+                    {"$set": {
+                        "meta": {
+                            "action": "$action",
+                            "user_id": "$user_id",
+                            "user_type": "$user_type",
+                            "reseller_id": "$reseller_id"
+                        },
+                        "timestamp": {"$cond": [
+                            {"$eq": [{"$type": "$timestamp"}, "string"]},
+                            {"$dateFromString": {"dateString": "$timestamp", "onError": "$timestamp"}},
+                            "$timestamp"
+                        ]}
+                    }},
+                    {"$unset": ["action", "user_id", "user_type", "reseller_id"]}
+                ]
+            )
+        except Exception as e:
+            logger.error(f"❌ Audit log: erro ao migrar registros antigos: {e}")
+            return 0
+        if result.modified_count:
+            logger.info(f"📝 Audit log: {result.modified_count} registros antigos migrados para meta/BSON date")
+        return result.modified_count
+
+    # ------------------------------------------------------------------
+    # Buffer
+    # ------------------------------------------------------------------
+
+    async def _enqueue(self, entry: Dict):
+        if len(self.buffer) >= BUFFER_SIZE:
+            if entry["meta"]["action"] in CRITICAL_ACTIONS and self.db is not None:
+                # Backpressure: quem registra ação crítica espera o flush
+                await self.flush()
+            if len(self.buffer) >= BUFFER_SIZE:
+                self.buffer.popleft()
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning(f"⚠️ Audit log: buffer cheio, {self.dropped} entradas descartadas")
+        self.buffer.append(entry)
+        if len(self.buffer) >= BATCH_SIZE:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Grava o buffer com insert_many em lotes de BATCH_SIZE"""
+        if self.db is None:
+            return 0
+        written = 0
+        async with self._flush_lock:
+            while self.buffer:
+                batch: List[Dict] = []
+                while self.buffer and len(batch) < BATCH_SIZE:
+                    batch.append(self.buffer.popleft())
+                try:
+                    await self.audit_collection.insert_many(batch, ordered=False)
+                    written += len(batch)
+                except asyncio.CancelledError:
+                    # Lote já retirado do buffer: devolve antes de propagar o cancelamento
+                    self.buffer.extendleft(reversed(batch))
+                    raise
+                except Exception as e:
+                    # Devolve ao início do buffer e tenta no próximo ciclo
+                    logger.error(f"❌ Audit log: erro ao gravar {len(batch)} entradas: {e}")
+                    room = BUFFER_SIZE - len(self.buffer)
+                    self.dropped += max(0, len(batch) - room)
+                    self.buffer.extendleft(reversed(batch[:room]))
+                    break
+        self.written += written
+        return written
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                async with loop_tick("audit_flush"):
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Audit log: erro no flush: {e}")
+
+    async def shutdown(self):
+        """Para o loop (deixa o flush em andamento terminar) e grava o que estiver pendente"""
+        if self._task is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout=FLUSH_INTERVAL * 5)
+            except asyncio.TimeoutError:
+                # Cancelado no meio do insert_many: o lote volta ao buffer (flush)
+                logger.warning("⚠️ Audit log: loop de flush não terminou a tempo; cancelado")
+            except Exception as e:
+                logger.error(f"❌ Audit log: erro ao parar o loop de flush: {e}")
+            self._task = None
+        pending = len(self.buffer)
+        written = await self.flush()
+        if pending:
+            logger.info(f"📝 Audit log: {written}/{pending} entradas pendentes gravadas no shutdown")
+
+    def get_stats(self) -> Dict:
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+    # ------------------------------------------------------------------
+    # Registro
+    # ------------------------------------------------------------------
+
     async def log_action(
         self,
         action: str,
@@ -40,8 +246,8 @@ class AuditLogger:
         success: bool = True
     ):
         """
-        Registra uma ação no audit log
-        
+        Registra uma ação no audit log (enfileira - gravado pelo loop de flush)
+
         Args:
             action: Nome da ação (ex: "LOGIN", "CREATE_TICKET", "DELETE_AGENT")
             user_id: ID do usuário que executou
@@ -52,21 +258,23 @@ class AuditLogger:
             user_agent: User agent do navegador
             success: Se a ação foi bem-sucedida
         """
-        
+
         log_entry = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "action": action,
-            "user_id": user_id,
-            "user_type": user_type,
-            "reseller_id": reseller_id,
+            "timestamp": datetime.now(timezone.utc),
+            "meta": {
+                "action": action,
+                "user_id": user_id,
+                "user_type": user_type,
+                "reseller_id": reseller_id
+            },
             "details": details,
             "ip_address": ip_address,
             "user_agent": user_agent,
             "success": success
         }
-        
-        await self.audit_collection.insert_one(log_entry)
-    
+
+        await self._enqueue(log_entry)
+
     async def log_security_violation(
         self,
         user_id: str,
@@ -78,10 +286,10 @@ class AuditLogger:
     ):
         """
         Registra tentativa de violação de segurança multi-tenant
-        
+
         ALERTA: Este log deve disparar notificações para admins
         """
-        
+
         await self.log_action(
             action="SECURITY_VIOLATION",
             user_id=user_id,
@@ -96,7 +304,7 @@ class AuditLogger:
             ip_address=ip_address,
             success=False
         )
-    
+
     async def log_login(
         self,
         user_id: str,
@@ -106,7 +314,7 @@ class AuditLogger:
         success: bool = True
     ):
         """Registra tentativa de login"""
-        
+
         await self.log_action(
             action="LOGIN",
             user_id=user_id,
@@ -116,7 +324,7 @@ class AuditLogger:
             ip_address=ip_address,
             success=success
         )
-    
+
     async def log_data_access(
         self,
         user_id: str,
@@ -127,7 +335,7 @@ class AuditLogger:
         action: str = "READ"
     ):
         """Registra acesso a dados sensíveis"""
-        
+
         await self.log_action(
             action=f"DATA_ACCESS_{action}",
             user_id=user_id,
@@ -139,7 +347,7 @@ class AuditLogger:
             },
             success=True
         )
-    
+
     async def log_config_change(
         self,
         user_id: str,
@@ -150,7 +358,7 @@ class AuditLogger:
         new_value: Any
     ):
         """Registra mudanças de configuração"""
-        
+
         await self.log_action(
             action="CONFIG_CHANGE",
             user_id=user_id,
@@ -163,7 +371,11 @@ class AuditLogger:
             },
             success=True
         )
-    
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
     async def get_user_activity(
         self,
         user_id: str,
@@ -172,20 +384,22 @@ class AuditLogger:
         limit: int = 100
     ):
         """Retorna atividade de um usuário específico"""
-        
-        query = {"user_id": user_id}
-        
+
+        # Inclui o que ainda está no buffer
+        await self.flush()
+
+        query = {"meta.user_id": user_id}
+
+        if start_date or end_date:
+            query["timestamp"] = {}
         if start_date:
-            query["timestamp"] = {"$gte": start_date.isoformat()}
+            query["timestamp"]["$gte"] = start_date
         if end_date:
-            if "timestamp" in query:
-                query["timestamp"]["$lte"] = end_date.isoformat()
-            else:
-                query["timestamp"] = {"$lte": end_date.isoformat()}
-        
+            query["timestamp"]["$lte"] = end_date
+
         logs = await self.audit_collection.find(query).sort("timestamp", -1).limit(limit).to_list(None)
-        return logs
-    
+        return [_flatten(log) for log in logs]
+
     async def get_security_violations(
         self,
         reseller_id: Optional[str] = None,
@@ -193,21 +407,21 @@ class AuditLogger:
         limit: int = 100
     ):
         """Retorna violações de segurança recentes"""
-        
-        from datetime import timedelta
-        
+
+        await self.flush()
+
         start_date = datetime.now(timezone.utc) - timedelta(days=days)
-        
+
         query = {
-            "action": "SECURITY_VIOLATION",
-            "timestamp": {"$gte": start_date.isoformat()}
+            "meta.action": "SECURITY_VIOLATION",
+            "timestamp": {"$gte": start_date}
         }
-        
+
         if reseller_id:
-            query["reseller_id"] = reseller_id
-        
+            query["meta.reseller_id"] = reseller_id
+
         violations = await self.audit_collection.find(query).sort("timestamp", -1).limit(limit).to_list(None)
-        return violations
+        return [_flatten(violation) for violation in violations]
 
 # Instância global
 audit_logger = AuditLogger()
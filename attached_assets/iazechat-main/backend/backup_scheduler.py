@@ -16,7 +16,6 @@ DB_NAME = os.environ.get('DB_NAME', 'support_chat')
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[DB_NAME]
 backup_config_collection = db.backup_config
-scheduled_messages_collection = db.scheduled_messages
 
 # URL do backend
 BACKEND_URL = os.environ.get('REACT_APP_BACKEND_URL', 'http://localhost:8001')
@@ -47,22 +46,6 @@ async def check_and_run_backup():
         logger.error(f"❌ Erro no backup automático: {str(e)}")
 
 
-async def process_scheduled_messages():
-    """Processa e envia mensagens agendadas"""
-    try:
-        # Chamar API para processar mensagens
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(f"{BACKEND_URL}/api/send-scheduled-messages")
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("sent", 0) > 0:
-                    logger.info(f"✅ {data['sent']} mensagens agendadas enviadas")
-            
-    except Exception as e:
-        logger.error(f"❌ Erro ao processar mensagens agendadas: {str(e)}")
-
-
 async def process_reminders():
     """Processa e envia lembretes de vencimento"""
     try:
@@ -95,22 +78,6 @@ async def backup_scheduler():
             await asyncio.sleep(60)  # Aguardar 1 minuto em caso de erro
 
 
-async def scheduled_messages_scheduler():
-    """Loop para processar mensagens agendadas - executa a cada minuto"""
-    logger.info("🚀 Scheduler de mensagens agendadas iniciado")
-    
-    while True:
-        try:
-            await process_scheduled_messages()
-            
-            # Aguardar 1 minuto (60 segundos)
-            await asyncio.sleep(60)
-            
-        except Exception as e:
-            logger.error(f"❌ Erro no scheduler de mensagens: {str(e)}")
-            await asyncio.sleep(60)
-
-
 async def reminders_scheduler():
     """Loop para processar lembretes - executa uma vez por dia no horário configurado"""
     logger.info("🚀 Scheduler de lembretes de vencimento iniciado")
@@ -141,10 +108,8 @@ def start_backup_scheduler():
     try:
         loop = asyncio.get_event_loop()
         loop.create_task(backup_scheduler())
-        loop.create_task(scheduled_messages_scheduler())
         loop.create_task(reminders_scheduler())
         logger.info("✅ Scheduler de backup iniciado com sucesso")
-        logger.info("✅ Scheduler de mensagens agendadas iniciado com sucesso")
         logger.info("✅ Scheduler de lembretes de vencimento iniciado com sucesso")
     except Exception as e:
         logger.error(f"❌ Erro ao iniciar scheduler: {str(e)}")
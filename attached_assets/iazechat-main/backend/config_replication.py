@@ -0,0 +1,351 @@
+"""
+Replicação de configurações do admin para as revendas (job em background)
+
+- POST inicia um job e retorna o job_id na hora; o progresso fica em
+  "config_replication_jobs" (total, processadas, replicadas, iguais, falhas).
+- Revendas processadas em lotes ordenados por id: para cada lote UMA leitura por
+  collection (diff) e UMA bulk_write por collection (só as revendas que mudaram).
+- Diff: revendas cujo conteúdo já é igual ao do admin são puladas.
+- Falha em um lote não para o job: os ids vão para failed_ids e o job termina como
+  "completed_with_errors". resume() reprocessa as falhas e continua do cursor
+  (last_id) - inclusive jobs interrompidos por restart do servidor.
+- Ao final de cada lote os listeners recebem as revendas alteradas (invalidação
+  de cache / aviso por WebSocket).
+"""
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo import DeleteMany, InsertOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get("CONFIG_REPLICATION_BATCH_SIZE", "100"))
+# Job "running" sem atualização por mais que isso = worker morreu, pode retomar
+STALE_SECONDS = int(os.environ.get("CONFIG_REPLICATION_STALE_SECONDS", "300"))
+MAX_ERRORS_KEPT = 20
+
+DEFAULT_AI_AGENT = {
+    "name": "Assistente IA",
+    "personality": "",
+    "instructions": "",
+    "llm_provider": "openai",
+    "llm_model": "gpt-4",
+    "api_key": "",
+    "temperature": 0.7,
+    "max_tokens": 500,
+    "mode": "standby",
+    "active_hours": "24/7",
+    "enabled": False,
+    "can_access_credentials": True,
+    "knowledge_base": ""
+}
+
+# Documentos clonados do admin (reseller_id=None) para cada revenda
+CLONED_COLLECTIONS = {
+    "messages": {"type": "auto_response"},
+    "tutorials": {},
+    "iptv_apps": {}
+}
+
+# Campos que não entram na comparação de documentos clonados
+CLONE_IGNORED_FIELDS = ("_id", "id", "reseller_id")
+
+InvalidationListener = Callable[[List[str], str], Awaitable[None]]
+
+
+def _fingerprint(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _clone_fingerprint(docs: List[Dict]) -> str:
+    """Hash do conjunto de documentos, independente de ordem e de id/reseller_id"""
+    items = sorted(
+        _fingerprint({k: v for k, v in doc.items() if k not in CLONE_IGNORED_FIELDS})
+        for doc in docs
+    )
+    return _fingerprint(items)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ConfigReplicationService:
+    """Jobs de replicação de config admin -> revendas"""
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._listeners: List[InvalidationListener] = []
+
+    def add_listener(self, listener: InvalidationListener):
+        """listener(reseller_ids, profile) chamado após cada lote com revendas alteradas"""
+        self._listeners.append(listener)
+
+    # ------------------------------------------------------------------
+    # Fonte (config do admin)
+    # ------------------------------------------------------------------
+
+    async def _load_source(self, db, profile: str) -> Optional[Dict]:
+        """
+        Conteúdo a replicar:
+          full  - config do sistema + auto-respostas, tutoriais e apps IPTV (/admin/replicate-config-to-resellers)
+          basic - quick_blocks/auto_reply/apps da config principal (/api/resellers/replicate-config)
+        """
+        admin_config = await db.config.find_one({"id": "config"}, {"_id": 0})
+        if not admin_config:
+            return None
+
+        if profile == "basic":
+            return {
+                "config": {
+                    "quick_blocks": admin_config.get("quick_blocks", []),
+                    "auto_reply": admin_config.get("auto_reply", []),
+                    "apps": admin_config.get("apps", [])
+                },
+                "clones": {}
+            }
+
+        # Configurações replicadas (EXCLUINDO dados manuais)
+        config = {
+            "support_avatar": admin_config.get("support_avatar"),
+            "pix_key": admin_config.get("pix_key", ""),
+            "allowed_data": admin_config.get("allowed_data", {"cpfs": [], "emails": [], "phones": [], "random_keys": []}),
+            "api_integration": admin_config.get("api_integration", {"api_url": "", "api_token": "", "api_enabled": False}),
+            "ai_agent": admin_config.get("ai_agent", DEFAULT_AI_AGENT)
+        }
+        clones = {}
+        for collection, base_filter in CLONED_COLLECTIONS.items():
+            clones[collection] = await db[collection].find(
+                {**base_filter, "reseller_id": None},
+                {"_id": 0}
+            ).to_list(None)
+        return {"config": config, "clones": clones}
+
+    # ------------------------------------------------------------------
+    # Jobs
+    # ------------------------------------------------------------------
+
+    def _is_stale(self, job: Dict) -> bool:
+        updated_at = datetime.fromisoformat(job["updated_at"])
+        return datetime.now(timezone.utc) - updated_at > timedelta(seconds=STALE_SECONDS)
+
+    async def _running_job(self, db, profile: str) -> Optional[Dict]:
+        job = await db.config_replication_jobs.find_one(
+            {"profile": profile, "status": "running"},
+            {"_id": 0},
+            sort=[("created_at", -1)]
+        )
+        if job and (job["id"] in self._tasks or not self._is_stale(job)):
+            return job
+        return None
+
+    async def start(self, db, profile: str, started_by: Optional[str] = None, force: bool = False) -> Dict:
+        """
+        Cria o job e agenda a execução em background
+        Retorna o job existente se já houver um rodando para o mesmo perfil
+        """
+        running = await self._running_job(db, profile)
+        if running:
+            return running
+
+        total = await db.resellers.count_documents({})
+        job = {
+            "id": str(uuid.uuid4()),
+            "profile": profile,
+            "force": force,
+            "status": "running",
+            "started_by": started_by,
+            "total": total,
+            "processed": 0,
+            "replicated": 0,
+            "skipped": 0,
+            "failed": 0,
+            "failed_ids": [],
+            "last_id": None,
+            "errors": [],
+            "created_at": _now(),
+            "updated_at": _now(),
+            "finished_at": None
+        }
+        await db.config_replication_jobs.insert_one(dict(job))
+        self._spawn(db, job["id"])
+        logger.info(f"🔄 [REPLICAÇÃO] Job {job['id']} ({profile}) iniciado para {total} revendas")
+        return job
+
+    async def resume(self, db, job_id: str) -> Optional[Dict]:
+        """Reprocessa falhas e continua do cursor; None se o job não existir"""
+        job = await db.config_replication_jobs.find_one({"id": job_id}, {"_id": 0})
+        if not job:
+            return None
+        if job["status"] == "completed" or job_id in self._tasks:
+            return job
+        if job["status"] == "running" and not self._is_stale(job):
+            return job
+
+        await db.config_replication_jobs.update_one(
+            {"id": job_id},
+            {"$set": {"status": "running", "updated_at": _now(), "finished_at": None}}
+        )
+        job["status"] = "running"
+        self._spawn(db, job_id)
+        logger.info(f"🔄 [REPLICAÇÃO] Job {job_id} retomado ({len(job.get('failed_ids', []))} falhas, cursor {job.get('last_id')})")
+        return job
+
+    async def get_job(self, db, job_id: str) -> Optional[Dict]:
+        job = await db.config_replication_jobs.find_one({"id": job_id}, {"_id": 0, "failed_ids": 0})
+        if job:
+            job["progress"] = round(100 * job["processed"] / job["total"], 1) if job["total"] else 100.0
+        return job
+
+    async def list_jobs(self, db, limit: int = 20) -> List[Dict]:
+        return await db.config_replication_jobs.find(
+            {}, {"_id": 0, "failed_ids": 0}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+
+    def _spawn(self, db, job_id: str):
+        task = asyncio.create_task(self._run(db, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, db, job_id: str):
+        job = await db.config_replication_jobs.find_one({"id": job_id}, {"_id": 0})
+        try:
+            source = await self._load_source(db, job["profile"])
+            if source is None:
+                await self._finish(db, job_id, "failed", error="Configuração do admin não encontrada")
+                return
+
+            # 1. Falhas de execuções anteriores
+            retry_ids = job.get("failed_ids") or []
+            if retry_ids:
+                await db.config_replication_jobs.update_one(
+                    {"id": job_id},
+                    {"$set": {"failed_ids": []}, "$inc": {"failed": -len(retry_ids), "processed": -len(retry_ids)}}
+                )
+                for i in range(0, len(retry_ids), BATCH_SIZE):
+                    await self._process_batch(db, job, source, retry_ids[i:i + BATCH_SIZE], advance_cursor=False)
+
+            # 2. Continua do cursor
+            last_id = job.get("last_id")
+            while True:
+                query = {"id": {"$gt": last_id}} if last_id else {}
+                batch = await db.resellers.find(query, {"_id": 0, "id": 1}).sort("id", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+                if not batch:
+                    break
+                reseller_ids = [r["id"] for r in batch]
+                await self._process_batch(db, job, source, reseller_ids, advance_cursor=True)
+                last_id = reseller_ids[-1]
+
+            final = await db.config_replication_jobs.find_one({"id": job_id}, {"_id": 0, "failed": 1, "replicated": 1, "skipped": 1})
+            status = "completed_with_errors" if final.get("failed") else "completed"
+            await self._finish(db, job_id, status)
+            logger.info(
+                f"🎉 [REPLICAÇÃO] Job {job_id}: {final.get('replicated', 0)} replicadas, "
+                f"{final.get('skipped', 0)} sem alteração, {final.get('failed', 0)} falhas"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ [REPLICAÇÃO] Erro crítico no job {job_id}: {e}")
+            await self._finish(db, job_id, "failed", error=str(e))
+
+    async def _finish(self, db, job_id: str, status: str, error: Optional[str] = None):
+        update = {"$set": {"status": status, "updated_at": _now(), "finished_at": _now()}}
+        if error:
+            update["$push"] = {"errors": {"$each": [error], "$slice": -MAX_ERRORS_KEPT}}
+        await db.config_replication_jobs.update_one({"id": job_id}, update)
+
+    # ------------------------------------------------------------------
+    # Lote
+    # ------------------------------------------------------------------
+
+    async def _process_batch(self, db, job: Dict, source: Dict, reseller_ids: List[str], advance_cursor: bool):
+        changed: List[str] = []
+        progress = {"$inc": {"processed": len(reseller_ids)}, "$set": {"updated_at": _now()}}
+        try:
+            changed = await self._replicate_batch(db, source, reseller_ids, force=job.get("force", False))
+            progress["$inc"].update({"replicated": len(changed), "skipped": len(reseller_ids) - len(changed)})
+        except Exception as e:
+            logger.error(f"❌ [REPLICAÇÃO] Erro no lote {reseller_ids[0]}..{reseller_ids[-1]}: {e}")
+            progress["$inc"]["failed"] = len(reseller_ids)
+            progress["$push"] = {
+                "failed_ids": {"$each": reseller_ids},
+                "errors": {"$each": [str(e)], "$slice": -MAX_ERRORS_KEPT}
+            }
+        if advance_cursor:
+            progress["$set"]["last_id"] = reseller_ids[-1]
+        await db.config_replication_jobs.update_one({"id": job["id"]}, progress)
+
+        if changed:
+            await self._emit(changed, job["profile"])
+
+    async def _replicate_batch(self, db, source: Dict, reseller_ids: List[str], force: bool) -> List[str]:
+        """Diff + bulk_write de um lote; retorna as revendas alteradas"""
+        changed = set()
+
+        # Configurações gerais
+        config = source["config"]
+        current_configs = {
+            doc["reseller_id"]: doc
+            for doc in await db.reseller_configs.find(
+                {"reseller_id": {"$in": reseller_ids}},
+                {"_id": 0, "reseller_id": 1, **{field: 1 for field in config}}
+            ).to_list(None)
+        }
+        config_ops = []
+        for reseller_id in reseller_ids:
+            current = current_configs.get(reseller_id, {})
+            if force or any(current.get(field) != value for field, value in config.items()):
+                config_ops.append(UpdateOne({"reseller_id": reseller_id}, {"$set": config}, upsert=True))
+                changed.add(reseller_id)
+
+        # Documentos clonados (auto-respostas, tutoriais, apps)
+        clone_ops: Dict[str, list] = {}
+        for collection, admin_docs in source["clones"].items():
+            base_filter = CLONED_COLLECTIONS[collection]
+            expected = _clone_fingerprint(admin_docs)
+            by_reseller: Dict[str, List[Dict]] = {reseller_id: [] for reseller_id in reseller_ids}
+            async for doc in db[collection].find({**base_filter, "reseller_id": {"$in": reseller_ids}}, {"_id": 0}):
+                by_reseller[doc["reseller_id"]].append(doc)
+
+            stale = [rid for rid, docs in by_reseller.items() if force or _clone_fingerprint(docs) != expected]
+            if not stale:
+                continue
+            operations = [DeleteMany({**base_filter, "reseller_id": {"$in": stale}})]
+            for reseller_id in stale:
+                for doc in admin_docs:
+                    operations.append(InsertOne({**doc, "id": str(uuid.uuid4()), "reseller_id": reseller_id}))
+            clone_ops[collection] = operations
+            changed.update(stale)
+
+        # Ordenado: DeleteMany antes dos InsertOne do mesmo lote
+        for collection, operations in clone_ops.items():
+            await db[collection].bulk_write(operations, ordered=True)
+        if config_ops:
+            await db.reseller_configs.bulk_write(config_ops, ordered=False)
+
+        return [rid for rid in reseller_ids if rid in changed]
+
+    async def _emit(self, reseller_ids: List[str], profile: str):
+        for listener in self._listeners:
+            try:
+                await listener(reseller_ids, profile)
+            except Exception as e:
+                logger.warning(f"⚠️ [REPLICAÇÃO] Erro no listener de invalidação: {e}")
+
+    async def ensure_indexes(self, db):
+        try:
+            await db.config_replication_jobs.create_index([("id", 1)], unique=True)
+            await db.config_replication_jobs.create_index([("profile", 1), ("status", 1), ("created_at", -1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de config_replication_jobs: {e}")
+
+
+# Instância global
+config_replication = ConfigReplicationService()
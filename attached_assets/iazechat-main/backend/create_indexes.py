@@ -3,6 +3,10 @@
 🚀 SCRIPT DE CRIAÇÃO DE ÍNDICES MONGODB
 Performance boost de 10x em queries com filtro de tenant
 
+Os índices agora são declarados em index_registry.py e aplicados automaticamente
+no startup do servidor. Este script aplica o mesmo registro manualmente (ex.: em
+um banco novo antes de subir o servidor).
+
 Execute: python3 create_indexes.py
 """
 
@@ -10,8 +14,10 @@ import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 
+from index_registry import INDEX_REGISTRY, apply_indexes
+
 async def create_performance_indexes():
-    """Criar índices otimizados para multi-tenant e performance"""
+    """Aplicar o registro de índices (idempotente)"""
     
     MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
     DB_NAME = os.environ.get('DB_NAME', 'support_chat')
@@ -19,112 +25,14 @@ async def create_performance_indexes():
     client = AsyncIOMotorClient(MONGO_URL)
     db = client[DB_NAME]
     
-    print("="*80)
-    print("🚀 CRIANDO ÍNDICES DE PERFORMANCE")
-    print("="*80)
-    
-    # 1. TICKETS - Índices compostos para queries mais comuns
-    print("\n1. Criando índices em 'tickets'...")
-    
-    await db.tickets.create_index([("reseller_id", 1), ("status", 1)])
-    print("   ✅ Índice: reseller_id + status")
-    
-    await db.tickets.create_index([("reseller_id", 1), ("created_at", -1)])
-    print("   ✅ Índice: reseller_id + created_at (desc)")
-    
-    await db.tickets.create_index([("client_id", 1)])
-    print("   ✅ Índice: client_id")
-    
-    await db.tickets.create_index([("agent_id", 1)])
-    print("   ✅ Índice: agent_id")
-    
-    # 2. AGENTS - Índices para lookups rápidos
-    print("\n2. Criando índices em 'agents'...")
-    
-    await db.agents.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
-    
-    await db.agents.create_index([("login", 1)], unique=True)
-    print("   ✅ Índice único: login")
-    
-    await db.agents.create_index([("reseller_id", 1), ("is_active", 1)])
-    print("   ✅ Índice: reseller_id + is_active")
-    
-    # 3. AI_AGENTS - Índices para configuração
-    print("\n3. Criando índices em 'ai_agents'...")
-    
-    await db.ai_agents.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
-    
-    await db.ai_agents.create_index([("reseller_id", 1), ("is_active", 1)])
-    print("   ✅ Índice: reseller_id + is_active")
-    
-    # 4. DEPARTMENTS - Índices para roteamento
-    print("\n4. Criando índices em 'departments'...")
-    
-    await db.departments.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
-    
-    await db.departments.create_index([("reseller_id", 1), ("is_default", 1)])
-    print("   ✅ Índice: reseller_id + is_default")
-    
-    # 5. MESSAGES - Índices para histórico de chat
-    print("\n5. Criando índices em 'messages'...")
-    
-    await db.messages.create_index([("ticket_id", 1), ("created_at", -1)])
-    print("   ✅ Índice: ticket_id + created_at (desc)")
-    
-    await db.messages.create_index([("from_id", 1)])
-    print("   ✅ Índice: from_id")
-    
-    # 6. RESELLERS - Índices para hierarquia
-    print("\n6. Criando índices em 'resellers'...")
-    
-    await db.resellers.create_index([("email", 1)], unique=True)
-    print("   ✅ Índice único: email")
-    
-    await db.resellers.create_index([("parent_id", 1)])
-    print("   ✅ Índice: parent_id")
-    
-    await db.resellers.create_index([("custom_domain", 1)], sparse=True)
-    print("   ✅ Índice: custom_domain (sparse)")
-    
-    await db.resellers.create_index([("test_domain", 1)], sparse=True)
-    print("   ✅ Índice: test_domain (sparse)")
-    
-    # 7. IPTV_APPS - Índices para templates
-    print("\n7. Criando índices em 'iptv_apps'...")
-    
-    await db.iptv_apps.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
-    
-    # 8. NOTICES - Índices para avisos
-    print("\n8. Criando índices em 'notices'...")
-    
-    await db.notices.create_index([("reseller_id", 1), ("created_at", -1)])
-    print("   ✅ Índice: reseller_id + created_at (desc)")
-    
-    # 9. AUTO_RESPONDER_SEQUENCES - Índices para automação
-    print("\n9. Criando índices em 'auto_responder_sequences'...")
-    
-    await db.auto_responder_sequences.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
-    
-    # 10. TUTORIALS_ADVANCED - Índices para tutoriais
-    print("\n10. Criando índices em 'tutorials_advanced'...")
-    
-    await db.tutorials_advanced.create_index([("reseller_id", 1)])
-    print("   ✅ Índice: reseller_id")
+    print("🔧 Aplicando registro de índices...")
+    summary = await apply_indexes(db)
     
-    print("\n" + "="*80)
-    print("✅ TODOS OS ÍNDICES CRIADOS COM SUCESSO!")
-    print("="*80)
-    print("\n📊 GANHOS DE PERFORMANCE ESPERADOS:")
-    print("   - Queries com reseller_id: 10-50x mais rápidas")
-    print("   - Lookups de tickets: 20x mais rápidos")
-    print("   - Autenticação de agents: 5x mais rápida")
-    print("   - Listagem de mensagens: 15x mais rápida")
-    print("\n🚀 Sistema otimizado para alta escala!")
+    print(f"\n✅ {summary['ok']} índices garantidos em {len(INDEX_REGISTRY)} collections")
+    if summary["conflicts"]:
+        print(f"ℹ️ {summary['conflicts']} já existiam com outro nome/opções")
+    if summary["failed"]:
+        print(f"⚠️ {summary['failed']} falharam (veja o log)")
     
     client.close()
 
@@ -34,6 +34,8 @@ async def create_main_reseller():
         "is_active": True,
         "created_at": datetime.now(timezone.utc).isoformat(),
         "parent_id": None,  # Revenda raiz
+        "ancestors": [],
+        "level": 0,
         "commission_percentage": 0,
         "subscription_active": True,
         "client_logo_url": "",
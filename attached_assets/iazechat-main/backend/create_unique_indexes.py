@@ -23,7 +23,8 @@ async def create_unique_indexes():
             await db.users.create_index(
                 [("username", 1), ("reseller_id", 1)],
                 unique=True,
-                name="unique_username_per_reseller"
+                name="unique_username_per_reseller",
+                partialFilterExpression={"username": {"$type": "string"}}
             )
             print("✅ Índice criado: unique_username_per_reseller")
         except Exception as e:
@@ -47,7 +48,8 @@ async def create_unique_indexes():
             await db.resellers.create_index(
                 [("email", 1)],
                 unique=True,
-                name="unique_reseller_email"
+                name="unique_reseller_email",
+                partialFilterExpression={"email": {"$type": "string"}}
             )
             print("✅ Índice criado: unique_reseller_email")
         except Exception as e:
@@ -71,7 +73,8 @@ async def create_unique_indexes():
             await db.clients.create_index(
                 [("phone", 1), ("reseller_id", 1)],
                 unique=True,
-                name="unique_phone_per_reseller"
+                name="unique_phone_per_reseller",
+                partialFilterExpression={"phone": {"$type": "string"}}
             )
             print("✅ Índice criado: unique_phone_per_reseller")
         except Exception as e:
@@ -119,7 +122,8 @@ async def create_unique_indexes():
             await db.whatsapp_connections.create_index(
                 [("instance_name", 1)],
                 unique=True,
-                name="unique_instance_name"
+                name="unique_instance_name",
+                partialFilterExpression={"instance_name": {"$type": "string"}}
             )
             print("✅ Índice criado: unique_instance_name")
         except Exception as e:
@@ -2,14 +2,155 @@
 Rotas do Dashboard - Estatísticas e métricas em tempo real
 """
 from fastapi import APIRouter, Depends, HTTPException, Request
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from typing import List, Dict, Optional
+import asyncio
 import logging
+import os
+from ticket_counters import ticket_counters
+from single_flight_cache import SingleFlightCache
+from presence_service import presence_service
+from timestamps import since_filter, HIDDEN_TYPED_FIELDS
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Resultados de dashboard por tenant: alguns segundos de cache + single-flight,
+# um "refresh storm" de painéis custa uma agregação em vez de centenas de counts
+dashboard_cache = SingleFlightCache(ttl=float(os.environ.get("DASHBOARD_CACHE_TTL", "5")))
+
+
+def _today_start() -> datetime:
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _facet_count(row: Dict, name: str) -> int:
+    values = row.get(name) or []
+    return values[0]["n"] if values else 0
+
+
+async def _message_stats_today(db, reseller_id: Optional[str]) -> Dict[str, int]:
+    """
+    Mensagens de hoje (total e da IA) em UMA agregação $facet, cacheada por tenant
+    """
+    today_start = _today_start()
+
+    async def compute():
+        # created_at_dt (índice reseller_id + created_at_dt); docs ainda não migrados
+        # caem na comparação de ISO string de created_at/timestamp
+        match = since_filter("created_at", today_start, legacy_fields=("timestamp",))
+        if reseller_id:
+            match["reseller_id"] = reseller_id
+        rows = await db.messages.aggregate([
+            {"$match": match},
+            {"$facet": {
+                "total": [{"$count": "n"}],
+                "ai": [{"$match": {"sender_type": "ai"}}, {"$count": "n"}]
+            }}
+        ]).to_list(1)
+        row = rows[0] if rows else {}
+        return {"total": _facet_count(row, "total"), "ai": _facet_count(row, "ai")}
+
+    return await dashboard_cache.get_or_compute(
+        ("messages_today", reseller_id, today_start.date().isoformat()), compute
+    )
+
+
+async def _ticket_stats(db, reseller_id: Optional[str]) -> Dict[str, int]:
+    """Números de tickets do dashboard a partir de ticket_counters"""
+    status_counts = await ticket_counters.status_counts(db, reseller_id)
+    # Entrada = open sem agente / Atendimento = open com agente
+    tickets_entrada, tickets_atendimento = await ticket_counters.assignment_counts(db, "open", reseller_id)
+    return {
+        "total_tickets": sum(status_counts.values()),
+        "tickets_entrada": tickets_entrada,
+        "tickets_atendimento": tickets_atendimento,
+        "tickets_finalizadas_hoje": await ticket_counters.closed_today(db, reseller_id)
+    }
+
+
+async def _dashboard_stats(db, reseller_id: Optional[str]) -> Dict:
+    async def compute():
+        tickets = await _ticket_stats(db, reseller_id)
+        messages = await _message_stats_today(db, reseller_id)
+        return {
+            **tickets,
+            "mensagens_hoje": messages["total"],
+            "tempo_medio_resposta": "< 5min"  # Placeholder
+        }
+
+    return await dashboard_cache.get_or_compute(("stats", reseller_id), compute)
+
+
+async def _important_alerts(db, reseller_id: Optional[str]) -> List[Dict]:
+    """
+    Avisos importantes (WhatsApp, IA, manutenção) - consultas em paralelo, cacheadas por tenant
+    """
+    async def compute():
+        connections_match = {"reseller_id": reseller_id} if reseller_id else {}
+        if reseller_id:
+            config_query = db.reseller_configs.find_one({"reseller_id": reseller_id}, {"_id": 0, "ai_agent": 1})
+            notices_match = {
+                "active": True,
+                "$or": [
+                    {"target": "all"},
+                    {"target": "resellers"},
+                    {"target_reseller_id": reseller_id}
+                ]
+            }
+        else:
+            config_query = db.config.find_one({"id": "global_config"}, {"_id": 0, "ai_agent": 1})
+            notices_match = {"active": True, "target": "all"}
+
+        connection_rows, config, system_notices = await asyncio.gather(
+            db.whatsapp_connections.aggregate([
+                {"$match": connections_match},
+                {"$facet": {"disconnected": [{"$match": {"status": {"$ne": "connected"}}}, {"$count": "n"}]}}
+            ]).to_list(1),
+            config_query,
+            db.system_notices.find(notices_match, {"_id": 0}).sort("created_at", -1).limit(5).to_list(5)
+        )
+
+        alerts = []
+
+        # 1. Verificar WhatsApp desconectado
+        disconnected_count = _facet_count(connection_rows[0] if connection_rows else {}, "disconnected")
+        if disconnected_count > 0:
+            alerts.append({
+                "type": "whatsapp",
+                "severity": "warning",
+                "title": "WhatsApp Desconectado",
+                "message": f"{disconnected_count} conexão(ões) WhatsApp desconectada(s)",
+                "icon": "📱"
+            })
+
+        # 2. Verificar IA parada
+        if config and config.get("ai_agent"):
+            ai_enabled = config["ai_agent"].get("enabled", False)
+            if not ai_enabled:
+                alerts.append({
+                    "type": "ai",
+                    "severity": "info",
+                    "title": "IA Desativada",
+                    "message": "Agente de IA está desativado no seu sistema" if reseller_id else "Agente de IA está desativado no sistema",
+                    "icon": "🤖"
+                })
+
+        # 3. Avisos de manutenção do Admin (collection system_notices)
+        for notice in system_notices:
+            alerts.append({
+                "type": "maintenance",
+                "severity": notice.get("severity", "info"),
+                "title": notice.get("title", "Aviso de Manutenção"),
+                "message": notice.get("message", ""),
+                "icon": "🔧"
+            })
+
+        return alerts
+
+    return await dashboard_cache.get_or_compute(("alerts", reseller_id), compute)
+
 def get_db_dep():
     from server import db
     return db
@@ -32,51 +173,15 @@ async def get_dashboard_stats(
         raise HTTPException(status_code=403, detail="Apenas admin")
     
     db = get_db_dep()
-    now = datetime.now(timezone.utc)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     
     # Determinar filtro baseado no domínio ou parâmetro
     tenant = get_request_tenant(request)
     filter_reseller_id = reseller_id or tenant.reseller_id
     
-    # Construir query base
-    query = {}
-    if filter_reseller_id:
-        query["reseller_id"] = filter_reseller_id
-    
-    # Total de tickets/conversas
-    total_tickets = await db.tickets.count_documents(query)
-    
-    # Tickets em entrada (status: open, não atribuído)
-    entrada_query = {**query, "status": "open", "agent_id": {"$exists": False}}
-    tickets_entrada = await db.tickets.count_documents(entrada_query)
-    
-    # Em atendimento (status: open, com agente)
-    atendimento_query = {**query, "status": "open", "agent_id": {"$exists": True}}
-    tickets_atendimento = await db.tickets.count_documents(atendimento_query)
-    
-    # Finalizadas hoje
-    finalizadas_query = {
-        **query,
-        "status": "closed",
-        "updated_at": {"$gte": today_start.isoformat()}
-    }
-    tickets_finalizadas_hoje = await db.tickets.count_documents(finalizadas_query)
-    
-    # Total de mensagens hoje
-    msg_query = {**query, "timestamp": {"$gte": today_start.isoformat()}}
-    mensagens_hoje = await db.messages.count_documents(msg_query)
-    
-    # Tempo médio de resposta (simplificado)
-    tempo_medio = "< 5min"  # Placeholder
+    stats = await _dashboard_stats(db, filter_reseller_id)
     
     return {
-        "total_tickets": total_tickets,
-        "tickets_entrada": tickets_entrada,
-        "tickets_atendimento": tickets_atendimento,
-        "tickets_finalizadas_hoje": tickets_finalizadas_hoje,
-        "mensagens_hoje": mensagens_hoje,
-        "tempo_medio_resposta": tempo_medio,
+        **stats,
         "filtered_by_reseller": filter_reseller_id
     }
 
@@ -109,27 +214,18 @@ async def get_agents_online(
         {"_id": 0, "id": 1, "name": 1, "email": 1, "last_seen": 1, "reseller_id": 1}
     ).to_list(None)
     
-    now = datetime.now(timezone.utc)
-    five_min_ago = now - timedelta(minutes=5)
+    online = presence_service.online_agents(filter_reseller_id)
+    
+    # Tickets ativos por agente (ticket_counters - uma leitura para todos os agentes)
+    active_by_agent = await ticket_counters.agent_counts(db, "open", filter_reseller_id)
     
     agents_with_status = []
     for agent in agents:
-        last_seen = agent.get("last_seen")
-        is_online = False
+        # Online = WebSocket conectado em algum worker (presence_service)
+        is_online = agent["id"] in online
+        last_seen = online[agent["id"]].isoformat() if is_online and online[agent["id"]] else agent.get("last_seen")
         
-        if last_seen:
-            try:
-                last_seen_dt = datetime.fromisoformat(last_seen.replace('Z', '+00:00'))
-                is_online = last_seen_dt > five_min_ago
-            except:
-                is_online = False
-        
-        # Contar tickets ativos do agente
-        ticket_query = {"agent_id": agent["id"], "status": "open"}
-        if filter_reseller_id:
-            ticket_query["reseller_id"] = filter_reseller_id
-        
-        active_tickets = await db.tickets.count_documents(ticket_query)
+        active_tickets = active_by_agent.get(agent["id"], 0)
         
         agents_with_status.append({
             "id": agent["id"],
@@ -176,14 +272,14 @@ async def monitor_agent(
     # Buscar tickets ativos do agente
     active_tickets = await db.tickets.find(
         {"agent_id": agent_id, "status": "open"},
-        {"_id": 0}
+        {"_id": 0, **HIDDEN_TYPED_FIELDS}
     ).sort("updated_at", -1).to_list(10)  # Últimos 10
     
     # Para cada ticket, buscar última mensagem
     for ticket in active_tickets:
         last_msg = await db.messages.find_one(
             {"ticket_id": ticket["id"]},
-            {"_id": 0},
+            {"_id": 0, **HIDDEN_TYPED_FIELDS},
             sort=[("created_at", -1)]
         )
         ticket["last_message"] = last_msg
@@ -194,17 +290,21 @@ async def monitor_agent(
         if client:
             ticket["client_name"] = client.get("display_name") or client.get("name", "Desconhecido")
     
-    # Estatísticas do agente
-    total_tickets_today = await db.tickets.count_documents({
-        "agent_id": agent_id,
-        "created_at": {"$gte": datetime.now(timezone.utc).replace(hour=0, minute=0, second=0).isoformat()}
-    })
-    
-    closed_today = await db.tickets.count_documents({
-        "agent_id": agent_id,
-        "status": "closed",
-        "updated_at": {"$gte": datetime.now(timezone.utc).replace(hour=0, minute=0, second=0).isoformat()}
-    })
+    # Estatísticas do agente (uma agregação $facet)
+    today_start = _today_start()
+    rows = await db.tickets.aggregate([
+        {"$match": {"agent_id": agent_id}},
+        {"$facet": {
+            "total_today": [{"$match": since_filter("created_at", today_start)}, {"$count": "n"}],
+            "closed_today": [
+                {"$match": {"status": "closed", **since_filter("updated_at", today_start)}},
+                {"$count": "n"}
+            ]
+        }}
+    ]).to_list(1)
+    row = rows[0] if rows else {}
+    total_tickets_today = _facet_count(row, "total_today")
+    closed_today = _facet_count(row, "closed_today")
     
     return {
         "agent": agent,
@@ -237,12 +337,7 @@ async def get_ai_agents_status(current_user: dict = Depends(get_current_user)):
         
         if enabled:
             # Contar interações de IA hoje
-            today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            ai_messages_today = await db.messages.count_documents({
-                "sender_type": "ai",
-                "timestamp": {"$gte": today_start.isoformat()}
-            })
+            ai_messages_today = (await _message_stats_today(db, None))["ai"]
             
             ai_agents.append({
                 "name": "Agente IA Principal",
@@ -292,45 +387,9 @@ async def get_reseller_dashboard_stats(current_user: dict = Depends(get_current_
         raise HTTPException(status_code=400, detail="Reseller ID não encontrado")
     
     db = get_db_dep()
-    now = datetime.now(timezone.utc)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # ISOLAMENTO: apenas tickets deste reseller
-    total_tickets = await db.tickets.count_documents({"reseller_id": reseller_id})
-    
-    tickets_entrada = await db.tickets.count_documents({
-        "reseller_id": reseller_id,
-        "status": "open",
-        "agent_id": {"$exists": False}
-    })
     
-    tickets_atendimento = await db.tickets.count_documents({
-        "reseller_id": reseller_id,
-        "status": "open",
-        "agent_id": {"$exists": True}
-    })
-    
-    tickets_finalizadas_hoje = await db.tickets.count_documents({
-        "reseller_id": reseller_id,
-        "status": "closed",
-        "updated_at": {"$gte": today_start.isoformat()}
-    })
-    
-    mensagens_hoje = await db.messages.count_documents({
-        "reseller_id": reseller_id,
-        "timestamp": {"$gte": today_start.isoformat()}
-    })
-    
-    tempo_medio = "< 5min"
-    
-    return {
-        "total_tickets": total_tickets,
-        "tickets_entrada": tickets_entrada,
-        "tickets_atendimento": tickets_atendimento,
-        "tickets_finalizadas_hoje": tickets_finalizadas_hoje,
-        "mensagens_hoje": mensagens_hoje,
-        "tempo_medio_resposta": tempo_medio
-    }
+    # ISOLAMENTO: apenas tickets/mensagens deste reseller
+    return await _dashboard_stats(db, reseller_id)
 
 
 @router.get("/reseller/dashboard/agents-online")
@@ -351,27 +410,19 @@ async def get_reseller_agents_online(current_user: dict = Depends(get_current_us
         {"_id": 0, "id": 1, "name": 1, "email": 1, "last_seen": 1}
     ).to_list(None)
     
-    now = datetime.now(timezone.utc)
-    five_min_ago = now - timedelta(minutes=5)
+    # ISOLAMENTO: presença apenas dos agentes deste reseller
+    online = presence_service.online_agents(reseller_id)
+    
+    # ISOLAMENTO: contar apenas tickets deste reseller (ticket_counters)
+    active_by_agent = await ticket_counters.agent_counts(db, "open", reseller_id)
     
     agents_with_status = []
     for agent in agents:
-        last_seen = agent.get("last_seen")
-        is_online = False
+        # Online = WebSocket conectado em algum worker (presence_service)
+        is_online = agent["id"] in online
+        last_seen = online[agent["id"]].isoformat() if is_online and online[agent["id"]] else agent.get("last_seen")
         
-        if last_seen:
-            try:
-                last_seen_dt = datetime.fromisoformat(last_seen.replace('Z', '+00:00'))
-                is_online = last_seen_dt > five_min_ago
-            except:
-                is_online = False
-        
-        # ISOLAMENTO: contar apenas tickets deste reseller
-        active_tickets = await db.tickets.count_documents({
-            "reseller_id": reseller_id,
-            "agent_id": agent["id"],
-            "status": "open"
-        })
+        active_tickets = active_by_agent.get(agent["id"], 0)
         
         agents_with_status.append({
             "id": agent["id"],
@@ -416,14 +467,8 @@ async def get_reseller_ai_agents_status(current_user: dict = Depends(get_current
         enabled = ai_config.get("enabled", False)
         
         if enabled:
-            today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-            
             # ISOLAMENTO: contar apenas mensagens de IA deste reseller
-            ai_messages_today = await db.messages.count_documents({
-                "reseller_id": reseller_id,
-                "sender_type": "ai",
-                "timestamp": {"$gte": today_start.isoformat()}
-            })
+            ai_messages_today = (await _message_stats_today(db, reseller_id))["ai"]
             
             ai_agents.append({
                 "name": "Agente IA Principal",
@@ -469,48 +514,7 @@ async def get_admin_important_alerts(current_user: dict = Depends(get_current_us
         raise HTTPException(status_code=403, detail="Apenas admin")
     
     db = get_db_dep()
-    alerts = []
-    
-    # 1. Verificar WhatsApp desconectado (todas as conexões)
-    whatsapp_connections = await db.whatsapp_connections.find({}, {"_id": 0}).to_list(None)
-    disconnected_count = sum(1 for conn in whatsapp_connections if conn.get("status") != "connected")
-    
-    if disconnected_count > 0:
-        alerts.append({
-            "type": "whatsapp",
-            "severity": "warning",
-            "title": "WhatsApp Desconectado",
-            "message": f"{disconnected_count} conexão(ões) WhatsApp desconectada(s)",
-            "icon": "📱"
-        })
-    
-    # 2. Verificar IA parada (global)
-    config = await db.config.find_one({"id": "global_config"}, {"_id": 0})
-    if config and config.get("ai_agent"):
-        ai_enabled = config["ai_agent"].get("enabled", False)
-        if not ai_enabled:
-            alerts.append({
-                "type": "ai",
-                "severity": "info",
-                "title": "IA Desativada",
-                "message": "Agente de IA está desativado no sistema",
-                "icon": "🤖"
-            })
-    
-    # 3. Avisos de manutenção do Admin (collection system_notices)
-    system_notices = await db.system_notices.find(
-        {"active": True, "target": "all"},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(5).to_list(5)
-    
-    for notice in system_notices:
-        alerts.append({
-            "type": "maintenance",
-            "severity": notice.get("severity", "info"),
-            "title": notice.get("title", "Aviso de Manutenção"),
-            "message": notice.get("message", ""),
-            "icon": "🔧"
-        })
+    alerts = await _important_alerts(db, None)
     
     return {"alerts": alerts, "total": len(alerts)}
 
@@ -526,58 +530,8 @@ async def get_reseller_important_alerts(current_user: dict = Depends(get_current
         raise HTTPException(status_code=400, detail="Reseller ID não encontrado")
     
     db = get_db_dep()
-    alerts = []
-    
-    # 1. Verificar WhatsApp desconectado (ISOLAMENTO: apenas deste reseller)
-    whatsapp_connections = await db.whatsapp_connections.find(
-        {"reseller_id": reseller_id},
-        {"_id": 0}
-    ).to_list(None)
-    
-    disconnected_count = sum(1 for conn in whatsapp_connections if conn.get("status") != "connected")
-    
-    if disconnected_count > 0:
-        alerts.append({
-            "type": "whatsapp",
-            "severity": "warning",
-            "title": "WhatsApp Desconectado",
-            "message": f"{disconnected_count} conexão(ões) WhatsApp desconectada(s)",
-            "icon": "📱"
-        })
     
-    # 2. Verificar IA parada (ISOLAMENTO: config deste reseller)
-    config = await db.reseller_configs.find_one({"reseller_id": reseller_id}, {"_id": 0})
-    if config and config.get("ai_agent"):
-        ai_enabled = config["ai_agent"].get("enabled", False)
-        if not ai_enabled:
-            alerts.append({
-                "type": "ai",
-                "severity": "info",
-                "title": "IA Desativada",
-                "message": "Agente de IA está desativado no seu sistema",
-                "icon": "🤖"
-            })
-    
-    # 3. Avisos de manutenção do Admin (enviados para resellers)
-    system_notices = await db.system_notices.find(
-        {
-            "active": True,
-            "$or": [
-                {"target": "all"},
-                {"target": "resellers"},
-                {"target_reseller_id": reseller_id}
-            ]
-        },
-        {"_id": 0}
-    ).sort("created_at", -1).limit(5).to_list(5)
-    
-    for notice in system_notices:
-        alerts.append({
-            "type": "maintenance",
-            "severity": notice.get("severity", "info"),
-            "title": notice.get("title", "Aviso de Manutenção"),
-            "message": notice.get("message", ""),
-            "icon": "🔧"
-        })
+    # ISOLAMENTO: conexões, config e avisos deste reseller
+    alerts = await _important_alerts(db, reseller_id)
     
     return {"alerts": alerts, "total": len(alerts)}
@@ -0,0 +1,56 @@
+"""
+Conexão MongoDB única do processo
+
+Cada AsyncIOMotorClient abre o próprio pool de conexões e as próprias threads de
+monitoramento. Vários módulos de rotas/serviços criavam o seu no import (e o
+vendas_ai_service um por chamada), multiplicando conexões por worker e deixando
+esses comandos fora do query_profiler e das métricas. Aqui o cliente é criado uma
+vez, na primeira chamada, com os listeners do driver já registrados:
+
+    from database import get_db
+    db = get_db()
+
+O Motor só conecta na primeira operação: chamar get_db() no import do módulo
+não custa nada no startup.
+"""
+import os
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+DEFAULT_MONGO_URL = "mongodb://localhost:27017"
+DEFAULT_DB_NAME = "support_chat"
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        # Mesmo se chamado por um módulo importado antes do load_dotenv do server.py
+        load_dotenv(Path(__file__).parent / ".env")
+
+        from query_profiler import query_profiler
+        from metrics import mongo_listener
+
+        # QUERY_PROFILER=1 (dev): formatos de consulta para auditoria com explain
+        # metrics.mongo_listener: duração por collection/operação (GET /metrics)
+        _client = AsyncIOMotorClient(
+            os.environ.get("MONGO_URL", DEFAULT_MONGO_URL),
+            event_listeners=query_profiler.listeners() + mongo_listener.listeners()
+        )
+    return _client
+
+
+def get_db() -> AsyncIOMotorDatabase:
+    return get_client()[os.environ.get("DB_NAME", DEFAULT_DB_NAME)]
+
+
+def close_client():
+    """Shutdown do servidor"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
@@ -3,7 +3,6 @@ Dependências compartilhadas para evitar circular imports
 """
 from fastapi import Depends, HTTPException, Header
 from typing import Optional
-import jwt
 import os
 
 # Variáveis globais que serão definidas pelo server.py
@@ -23,38 +22,39 @@ def set_secret_key(key):
 async def get_current_user(authorization: Optional[str] = Header(None)):
     """
     Dependência para obter o usuário atual a partir do token JWT
+    (documento vem do cache de principal - sem find_one por requisição)
     """
     if not authorization:
         raise HTTPException(status_code=401, detail="Token não fornecido")
     
+    from principal_cache import principal_cache
+    
     try:
         # Extrair token do header "Bearer <token>"
         token = authorization.replace("Bearer ", "")
         
-        # Decodificar token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        user_id = payload.get("user_id")
-        user_type = payload.get("user_type")
-        
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Token inválido")
-        
-        # Buscar usuário no banco
-        # Todos os usuários (admin, agent, client) estão na collection 'users'
-        user = await db.users.find_one({"id": user_id})
-        
-        if not user:
-            raise HTTPException(status_code=401, detail="Usuário não encontrado")
+        # Claims + documento do usuário (todos em 'users', exceto revendas)
+        principal = await principal_cache.resolve(token)
+        user = principal["user"]
         
         # Verificar se o tipo de usuário bate (opcional, mas boa prática)
-        if user_type and user.get("user_type") != user_type:
+        if principal.get("user_type") and user.get("user_type") != principal["user_type"]:
             raise HTTPException(status_code=401, detail="Tipo de usuário inválido")
         
         return user
         
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expirado")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Token inválido")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Erro na autenticação: {str(e)}")
+
+async def get_current_principal(authorization: Optional[str] = Header(None)):
+    """
+    Claims do token (user_id, user_type, reseller_id) + "user" (documento em cache),
+    mesmo formato do get_current_user do server.py - para checagens de tenant
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Token não fornecido")
+    
+    from principal_cache import principal_cache
+    return await principal_cache.resolve(authorization.split(" ")[1])
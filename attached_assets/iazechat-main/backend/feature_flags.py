@@ -0,0 +1,35 @@
+"""
+Subsistemas opcionais ligados/desligados por variável de ambiente
+
+    FEATURE_OFFICE=false           rotas do Office (gestor.my), sync agendado e busca de credenciais
+    FEATURE_XUI=false              rotas do painel XUI
+    FEATURE_IPTV_AUTOMATION=false  automação de apps IPTV com Playwright
+    FEATURE_MEDIA_AI=true          rotas de mídia e pipeline de transcrição/análise (Whisper/GPT-4o)
+
+Desligado, o subsistema não é importado: as rotas não são montadas (router_registry)
+e schedulers/workers não iniciam. Padrão: o comportamento de antes - Office, XUI e
+automação IPTV ligados; mídia desligada (as rotas de mídia não eram montadas).
+"""
+import os
+from typing import Dict
+
+FALSE_VALUES = ("0", "false", "no", "off")
+
+
+def _flag(name: str, default: bool = True) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in FALSE_VALUES
+
+
+FEATURES: Dict[str, bool] = {
+    "office": _flag("FEATURE_OFFICE"),
+    "xui": _flag("FEATURE_XUI"),
+    "iptv_automation": _flag("FEATURE_IPTV_AUTOMATION"),
+    "media_ai": _flag("FEATURE_MEDIA_AI", default=False),
+}
+
+
+def is_enabled(feature: str) -> bool:
+    return FEATURES.get(feature, True)
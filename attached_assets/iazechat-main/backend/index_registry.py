@@ -0,0 +1,194 @@
+"""
+Registro declarativo de índices MongoDB, aplicado no startup
+
+Antes os índices viviam em scripts avulsos (create_indexes.py,
+create_unique_indexes.py, optimize_mongodb_indexes.py) que alguém precisava
+rodar na mão, e consultas quentes ficavam sem índice garantido. Aqui cada
+collection declara seus índices uma vez; apply_indexes() cria o que falta.
+
+- Idempotente: create_index com a mesma especificação é no-op no Mongo.
+- Índice que já existe com outro nome/opções, ou único com duplicatas no banco,
+  só gera aviso no log - o startup nunca falha por causa de índice.
+- Únicos sobre campos opcionais (username, phone, email...) são parciais
+  (_string_only): documentos sem o campo - ex. clientes em users, que só têm
+  whatsapp - não colidem entre si como null.
+- Índices com TTL ou de serviços próprios (memória da IA, revogação de tokens,
+  mídia, lembretes...) continuam no ensure_indexes de cada serviço.
+
+Para adicionar um índice: inclua o IndexModel em INDEX_REGISTRY, junto com a
+consulta que ele atende.
+"""
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING as ASC, DESCENDING as DESC, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Códigos do Mongo para "já existe índice equivalente com outro nome/opções"
+INDEX_CONFLICT_CODES = {85, 86}
+
+
+def _string_only(*fields: str) -> Dict:
+    """partialFilterExpression: só indexa documentos em que os campos são strings"""
+    return {field: {"$type": "string"} for field in fields}
+
+
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "tickets": [
+        IndexModel([("id", ASC)], unique=True, name="unique_ticket_id"),
+        # Lista de tickets por tenant/status (list_tickets, dashboard)
+        IndexModel([("reseller_id", ASC), ("status", ASC)]),
+        IndexModel([("reseller_id", ASC), ("created_at", DESC)]),
+        # Ticket aberto do cliente na revenda (envio de mensagem, webhooks)
+        IndexModel([("client_id", ASC), ("reseller_id", ASC)]),
+        IndexModel([("agent_id", ASC), ("status", ASC)]),
+        # Filtros de período com datas tipadas (timestamps.since_filter)
+        IndexModel([("reseller_id", ASC), ("updated_at_dt", DESC)]),
+        IndexModel([("status", ASC), ("updated_at_dt", DESC)]),
+        IndexModel([("created_at_dt", DESC)]),
+    ],
+    "messages": [
+        # Histórico paginado por cursor (message_history)
+        IndexModel([("ticket_id", ASC), ("created_at", DESC), ("id", DESC)], name="ticket_history"),
+        # Não lidas do cliente por ticket (list_tickets)
+        IndexModel([("ticket_id", ASC), ("sender_type", ASC), ("read", ASC)]),
+        IndexModel([("id", ASC)]),
+        IndexModel([("from_id", ASC)]),
+        # Mensagens do dia por revenda (dashboard)
+        IndexModel([("reseller_id", ASC), ("created_at_dt", DESC)]),
+        IndexModel([("created_at_dt", DESC)]),
+    ],
+    "users": [
+        IndexModel([("id", ASC)], unique=True, name="unique_user_id"),
+        # Só atendentes/revendas têm username; clientes (client_login) não
+        IndexModel(
+            [("username", ASC), ("reseller_id", ASC)],
+            unique=True,
+            name="unique_username_per_reseller",
+            partialFilterExpression=_string_only("username")
+        ),
+        # Login de atendente (username + user_type) e de cliente (whatsapp)
+        IndexModel([("username", ASC), ("user_type", ASC)]),
+        IndexModel([("whatsapp", ASC)]),
+        IndexModel([("reseller_id", ASC), ("user_type", ASC)]),
+    ],
+    "clients": [
+        IndexModel([("id", ASC)], unique=True, name="unique_client_id"),
+        IndexModel(
+            [("phone", ASC), ("reseller_id", ASC)],
+            unique=True,
+            name="unique_phone_per_reseller",
+            partialFilterExpression=_string_only("phone")
+        ),
+    ],
+    "resellers": [
+        IndexModel([("id", ASC)], unique=True, name="unique_reseller_id"),
+        IndexModel(
+            [("email", ASC)],
+            unique=True,
+            name="unique_reseller_email",
+            partialFilterExpression=_string_only("email")
+        ),
+        IndexModel([("parent_id", ASC)]),
+        # Resolução do tenant pelo domínio acessado
+        IndexModel([("custom_domain", ASC)], sparse=True),
+        IndexModel([("test_domain", ASC)], sparse=True),
+    ],
+    "departments": [
+        IndexModel([("id", ASC)], unique=True, name="unique_department_id"),
+        IndexModel([("reseller_id", ASC), ("is_default", ASC)]),
+    ],
+    "office_clients": [
+        # Upsert do sync do Office (office_sync_service)
+        IndexModel([("usuario", ASC), ("office_account", ASC)]),
+        # Busca de credenciais pelo telefone (auto_response_service)
+        IndexModel([("telefone_normalized", ASC)]),
+        IndexModel([("status_type", ASC)]),
+    ],
+    "whatsapp_connections": [
+        IndexModel(
+            [("instance_name", ASC)],
+            unique=True,
+            name="unique_instance_name",
+            partialFilterExpression=_string_only("instance_name")
+        ),
+        IndexModel([("reseller_id", ASC), ("status", ASC)]),
+    ],
+    "push_subscriptions": [
+        IndexModel([("client_id", ASC), ("is_active", ASC)]),
+        IndexModel([("id", ASC)]),
+    ],
+    "ai_agents": [
+        IndexModel([("reseller_id", ASC), ("is_active", ASC)]),
+    ],
+    "iptv_apps": [
+        IndexModel([("reseller_id", ASC)]),
+    ],
+    "notices": [
+        IndexModel([("reseller_id", ASC), ("created_at", DESC)]),
+    ],
+    "auto_responder_sequences": [
+        IndexModel([("reseller_id", ASC)]),
+    ],
+    "tutorials_advanced": [
+        IndexModel([("reseller_id", ASC)]),
+    ],
+}
+
+
+def _describe(model: IndexModel) -> str:
+    return model.document.get("name") or str(list(model.document["key"].items()))
+
+
+async def _replace_non_partial(collection, model: IndexModel) -> bool:
+    """
+    Único parcial do registro que já existe com o mesmo nome mas SEM filtro
+    (criado por versão anterior ou pelo create_unique_indexes.py): esse índice
+    faz documentos sem o campo colidirem como null, então é recriado
+    """
+    spec = model.document
+    if not spec.get("unique") or "partialFilterExpression" not in spec:
+        return False
+    try:
+        existing = (await collection.index_information()).get(spec.get("name"))
+        if not existing or "partialFilterExpression" in existing:
+            return False
+        await collection.drop_index(spec["name"])
+        await collection.create_indexes([model])
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao recriar índice {collection.name}.{spec['name']} como parcial: {e}")
+        return False
+    logger.warning(f"⚠️ Índice {collection.name}.{spec['name']} recriado como parcial")
+    return True
+
+
+async def apply_indexes(db, registry: Dict[str, List[IndexModel]] = INDEX_REGISTRY) -> Dict[str, int]:
+    """
+    Cria os índices do registro que ainda não existem
+
+    Returns:
+        {"ok": n, "conflicts": n, "failed": n}
+    """
+    summary = {"ok": 0, "conflicts": 0, "failed": 0}
+    for collection, models in registry.items():
+        for model in models:
+            # Um por vez: conflito em um índice não impede os outros
+            try:
+                await db[collection].create_indexes([model])
+                summary["ok"] += 1
+            except OperationFailure as e:
+                if e.code in INDEX_CONFLICT_CODES and await _replace_non_partial(db[collection], model):
+                    summary["ok"] += 1
+                elif e.code in INDEX_CONFLICT_CODES:
+                    summary["conflicts"] += 1
+                    logger.info(f"ℹ️ Índice {collection}.{_describe(model)} já existe com outro nome/opções")
+                else:
+                    summary["failed"] += 1
+                    logger.warning(f"⚠️ Erro ao criar índice {collection}.{_describe(model)}: {e}")
+            except Exception as e:
+                summary["failed"] += 1
+                logger.warning(f"⚠️ Erro ao criar índice {collection}.{_describe(model)}: {e}")
+    logger.info(f"🗂️ Registro de índices aplicado: {summary}")
+    return summary
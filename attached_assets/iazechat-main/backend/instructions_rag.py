@@ -1,195 +1,426 @@
 """
 Sistema de RAG (Retrieval Augmented Generation) para Instruções Grandes
 Divide o arquivo em chunks e busca apenas partes relevantes
+
+Busca feita com índice invertido + BM25, com normalização de acentos e
+stemming leve para português. O índice é construído uma vez por versão do
+arquivo (mtime + tamanho) e reconstruído automaticamente quando o arquivo muda.
+
+Chunks + índice compilados são persistidos em disco como artefato JSON
+identificado pelo hash SHA-256 do conteúdo. Após um restart, cada worker
+carrega o artefato sob demanda em vez de re-dividir e re-indexar o arquivo.
+Quando o conteúdo de um arquivo muda (ou ele é removido), o artefato da versão
+anterior é apagado - o diretório não acumula um JSON por edição.
 """
 import os
 import re
-from typing import List, Dict
+import json
+import math
+import heapq
+import hashlib
+import tempfile
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Diretório dos artefatos compilados (compartilhado entre workers)
+INDEX_DIR = os.environ.get('INSTRUCTIONS_INDEX_DIR', '/app/instructions/.index')
+# Versão do formato do artefato (mudou tokenização/chunking → recompilar)
+ARTIFACT_VERSION = 1
+
+# Palavras sem valor para busca
+STOPWORDS = {
+    "a", "o", "as", "os", "um", "uma", "uns", "umas", "de", "do", "da", "dos", "das",
+    "em", "no", "na", "nos", "nas", "por", "pelo", "pela", "para", "pra", "pro", "com",
+    "sem", "e", "ou", "que", "se", "eu", "voce", "vc", "ele", "ela", "me", "te", "meu",
+    "minha", "seu", "sua", "isso", "esse", "essa", "este", "esta", "ao", "aos", "ja",
+    "nao", "sim", "mais", "muito", "como", "qual", "quais", "quando", "onde", "tem",
+    "ter", "ser", "estou", "to", "ta", "oi", "ola", "bom", "dia", "boa", "tarde", "noite"
+}
+
+# Sufixos de plural (RSLP - etapa de redução de plural)
+PLURAL_SUFFIXES = [
+    ("oes", "ao"), ("aes", "ao"), ("ais", "al"), ("eis", "el"), ("ois", "ol"),
+    ("is", "il"), ("ns", "m"), ("res", "r"), ("les", "l"), ("zes", "z"), ("s", "")
+]
+
+# Sufixos derivacionais/verbais mais comuns (stemming leve)
+DERIVATION_SUFFIXES = [
+    "amente", "mente", "acoes", "acao", "icoes", "icao", "mento", "ando", "endo", "indo",
+    "ador", "adora", "ados", "adas", "ado", "ada", "idos", "idas", "ido", "ida",
+    "ar", "er", "ir", "a", "o", "e"
+]
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculas e sem acentos"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def stem(token: str) -> str:
+    """Stemming leve para português (plural + sufixos comuns)"""
+    if len(token) <= 3 or token.isdigit():
+        return token
+
+    for suffix, replacement in PLURAL_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)] + replacement
+            break
+
+    for suffix in DERIVATION_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 4:
+            return token[:-len(suffix)]
+
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tokeniza texto para o índice:
+    termos normalizados e com stemming, mais junções de palavras vizinhas
+    ("fire stick" também gera "firestick", "tv box" gera "tvbox")
+    """
+    words = re.findall(r"[a-z0-9]+", normalize_text(text))
+    terms = [stem(w) for w in words if w not in STOPWORDS and len(w) > 1]
+
+    # Junções de palavras vizinhas (antes do stemming) para variações de escrita
+    for first, second in zip(words, words[1:]):
+        if len(first) <= 6 and len(second) <= 6 and first not in STOPWORDS and second not in STOPWORDS:
+            terms.append(stem(first + second))
+
+    return terms
+
+
+class BM25Index:
+    """
+    Índice invertido com ranqueamento BM25
+    """
+
+    def __init__(self, chunks: List[Dict], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        # termo → [(posição do chunk, frequência do termo)]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.idf: Dict[str, float] = {}
+        self.doc_norms: List[float] = []
+
+        doc_lengths = []
+        for position, chunk in enumerate(chunks):
+            term_counts = Counter(tokenize(chunk["content"]))
+            doc_lengths.append(sum(term_counts.values()))
+            for term, tf in term_counts.items():
+                self.postings.setdefault(term, []).append((position, tf))
+
+        total_docs = len(chunks)
+        avg_length = (sum(doc_lengths) / total_docs) if total_docs else 0.0
+
+        for term, posting in self.postings.items():
+            df = len(posting)
+            self.idf[term] = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+
+        # Pré-calcula k1 * (1 - b + b * |d| / avgdl) por documento
+        self.doc_norms = [
+            k1 * (1 - b + b * (length / avg_length)) if avg_length else k1
+            for length in doc_lengths
+        ]
+
+    def to_dict(self) -> Dict:
+        """Serializa o índice (sem os chunks) para o artefato"""
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "postings": self.postings,
+            "idf": self.idf,
+            "doc_norms": self.doc_norms
+        }
+
+    @classmethod
+    def from_dict(cls, chunks: List[Dict], data: Dict) -> "BM25Index":
+        """Reconstrói o índice a partir do artefato, sem re-tokenizar"""
+        index = cls.__new__(cls)
+        index.chunks = chunks
+        index.k1 = data["k1"]
+        index.b = data["b"]
+        index.postings = {term: [tuple(p) for p in posting] for term, posting in data["postings"].items()}
+        index.idf = data["idf"]
+        index.doc_norms = data["doc_norms"]
+        return index
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[float, Dict]]:
+        """Retorna os top_k chunks (score, chunk) para a query"""
+        scores: Dict[int, float] = {}
+
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf[term]
+            for position, tf in posting:
+                scores[position] = scores.get(position, 0.0) + idf * (tf * (self.k1 + 1)) / (tf + self.doc_norms[position])
+
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunks[position]) for position, score in best]
+
+
 class InstructionsRAG:
     """
     Sistema de busca inteligente para instruções grandes
     """
-    
+
     def __init__(self):
+        # filepath → chunks da versão atual do arquivo
         self.chunks_cache = {}
-    
+        # filepath → (versão, BM25Index)
+        self.index_cache = {}
+        # filepath → hash do conteúdo cujo artefato está em disco
+        self.artifact_hashes: Dict[str, str] = {}
+
     def split_into_chunks(self, text: str, chunk_size: int = 2000) -> List[Dict]:
         """
-        Divide texto em chunks menores com overlap
+        Divide texto em chunks menores
+        Seções maiores que chunk_size são quebradas por parágrafos/linhas
         """
         chunks = []
-        
+
         # Dividir por seções (usando separadores)
         sections = re.split(r'═{3,}|─{3,}|\n\n\n+', text)
-        
+
         current_chunk = ""
-        chunk_id = 0
-        
+
         for section in sections:
             section = section.strip()
             if not section:
                 continue
-            
-            # Se seção é pequena, adiciona ao chunk atual
-            if len(current_chunk) + len(section) < chunk_size:
-                current_chunk += "\n\n" + section
-            else:
-                # Salvar chunk atual
-                if current_chunk:
-                    chunks.append({
-                        "id": chunk_id,
-                        "content": current_chunk.strip(),
-                        "keywords": self._extract_keywords(current_chunk)
-                    })
-                    chunk_id += 1
-                
-                # Iniciar novo chunk
-                current_chunk = section
-        
+
+            for piece in self._split_oversized(section, chunk_size):
+                # Se seção é pequena, adiciona ao chunk atual
+                if len(current_chunk) + len(piece) < chunk_size:
+                    current_chunk += "\n\n" + piece
+                else:
+                    # Salvar chunk atual
+                    if current_chunk.strip():
+                        chunks.append({"id": len(chunks), "content": current_chunk.strip()})
+
+                    # Iniciar novo chunk
+                    current_chunk = piece
+
         # Adicionar último chunk
-        if current_chunk:
-            chunks.append({
-                "id": chunk_id,
-                "content": current_chunk.strip(),
-                "keywords": self._extract_keywords(current_chunk)
-            })
-        
+        if current_chunk.strip():
+            chunks.append({"id": len(chunks), "content": current_chunk.strip()})
+
         logger.info(f"✅ Arquivo dividido em {len(chunks)} chunks")
         return chunks
-    
-    def _extract_keywords(self, text: str) -> List[str]:
-        """
-        Extrai palavras-chave importantes do texto
-        """
-        # Palavras comuns em instruções de IPTV
-        keywords = []
-        
-        text_lower = text.lower()
-        
-        # Aparelhos
-        if any(word in text_lower for word in ['tv box', 'tvbox', 'box']):
-            keywords.append('tv_box')
-        if any(word in text_lower for word in ['smart tv', 'smarttv', 'smart']):
-            keywords.append('smart_tv')
-        if any(word in text_lower for word in ['fire stick', 'firestick', 'fire']):
-            keywords.append('fire_stick')
-        if 'celular' in text_lower or 'mobile' in text_lower or 'android' in text_lower:
-            keywords.append('celular')
-        
-        # Ações
-        if any(word in text_lower for word in ['teste', 'test', 'gratis', 'gratuito']):
-            keywords.append('teste_gratis')
-        if 'instala' in text_lower or 'baixar' in text_lower or 'download' in text_lower:
-            keywords.append('instalacao')
-        if 'usuário' in text_lower or 'usuario' in text_lower or 'senha' in text_lower:
-            keywords.append('login')
-        if 'erro' in text_lower or 'problema' in text_lower or 'não funciona' in text_lower:
-            keywords.append('suporte')
-        
-        # Apps
-        if 'assist plus' in text_lower or 'assistplus' in text_lower:
-            keywords.append('assist_plus')
-        if 'lazer play' in text_lower or 'lazerplay' in text_lower:
-            keywords.append('lazer_play')
-        if 'hades' in text_lower:
-            keywords.append('hades_play')
-        
-        return keywords
-    
+
+    def _split_oversized(self, section: str, chunk_size: int) -> List[str]:
+        """Quebra uma seção grande em pedaços de até chunk_size (parágrafos, depois linhas)"""
+        if len(section) <= chunk_size:
+            return [section]
+
+        pieces = []
+        current = ""
+        for line in re.split(r'\n+', section):
+            line = line.strip()
+            if not line:
+                continue
+            while len(line) > chunk_size:
+                pieces.append(line[:chunk_size])
+                line = line[chunk_size:]
+            if len(current) + len(line) + 1 > chunk_size and current:
+                pieces.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            pieces.append(current)
+        return pieces
+
     def search_relevant_chunks(self, chunks: List[Dict], query: str, max_chunks: int = 1) -> List[Dict]:
         """
-        Busca chunks mais relevantes para a query
+        Busca chunks mais relevantes para a query (BM25)
+        Para arquivos carregados via load_and_prepare o índice em cache é reutilizado
         """
-        query_lower = query.lower()
-        scored_chunks = []
-        
-        for chunk in chunks:
-            score = 0
-            
-            # Pontuação por palavras-chave
-            for keyword in chunk['keywords']:
-                keyword_text = keyword.replace('_', ' ')
-                if keyword_text in query_lower:
-                    score += 10
-            
-            # Pontuação por palavras da query presentes no chunk
-            query_words = query_lower.split()
-            content_lower = chunk['content'].lower()
-            
-            for word in query_words:
-                if len(word) > 3:  # Ignorar palavras muito curtas
-                    if word in content_lower:
-                        score += 1
-            
-            if score > 0:
-                scored_chunks.append((score, chunk))
-        
-        # Ordenar por score e pegar os top N
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        top_chunks = [chunk for score, chunk in scored_chunks[:max_chunks]]
-        
+        index = None
+        for _version, cached_index in self.index_cache.values():
+            if cached_index.chunks is chunks:
+                index = cached_index
+                break
+        if index is None:
+            index = BM25Index(chunks)
+
+        top_chunks = [chunk for score, chunk in index.search(query, top_k=max_chunks)]
+
         logger.info(f"🔍 Busca: '{query[:50]}...' → {len(top_chunks)} chunks relevantes")
-        
+
         return top_chunks
-    
+
+    def _file_version(self, filepath: str) -> Optional[Tuple[int, int]]:
+        """Versão do arquivo (mtime em ns + tamanho) ou None se não existir"""
+        try:
+            stat = os.stat(filepath)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def invalidate(self, filepath: str, drop_artifact: bool = False):
+        """
+        Descarta chunks e índice de um arquivo
+        drop_artifact=True (antes de sobrescrever/remover o arquivo): apaga também o
+        artefato do conteúdo atual
+        """
+        self.chunks_cache.pop(filepath, None)
+        self.index_cache.pop(filepath, None)
+        if drop_artifact:
+            content_hash = self.artifact_hashes.pop(filepath, None) or self._hash_file(filepath)
+            if content_hash:
+                self._discard_artifact(content_hash)
+        logger.info(f"🗑️ Índice de instruções invalidado: {filepath}")
+
+    def _hash_file(self, filepath: str) -> Optional[str]:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                return hashlib.sha256(f.read().encode('utf-8')).hexdigest()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def _discard_artifact(self, content_hash: str):
+        """Apaga o artefato de um conteúdo que nenhuma outra fonte carregada usa"""
+        if content_hash in self.artifact_hashes.values():
+            return
+        try:
+            os.remove(self._artifact_path(content_hash))
+            logger.info(f"🧹 Artefato de índice antigo removido: {content_hash[:12]}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"⚠️ Não foi possível remover artefato de índice: {e}")
+
+    def _artifact_path(self, content_hash: str) -> str:
+        return os.path.join(INDEX_DIR, f"{content_hash}.json")
+
+    def _load_artifact(self, content_hash: str) -> Optional[Tuple[List[Dict], BM25Index]]:
+        """Carrega chunks + índice compilados para este conteúdo (se existirem)"""
+        path = self._artifact_path(content_hash)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("artifact_version") != ARTIFACT_VERSION:
+                return None
+            chunks = data["chunks"]
+            return chunks, BM25Index.from_dict(chunks, data["index"])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Artefato de índice inválido ({path}): {e}")
+            return None
+
+    def _save_artifact(self, content_hash: str, chunks: List[Dict], index: BM25Index):
+        """Grava o artefato de forma atômica (tmp + rename) para ser lido por outros workers"""
+        try:
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=INDEX_DIR, suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "artifact_version": ARTIFACT_VERSION,
+                    "content_hash": content_hash,
+                    "chunks": chunks,
+                    "index": index.to_dict()
+                }, f, ensure_ascii=False)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self._artifact_path(content_hash))
+            logger.info(f"💾 Artefato de índice salvo: {content_hash[:12]}")
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível salvar artefato de índice: {e}")
+
+    def prepare_content(self, source_key: str, content: str, version=None) -> List[Dict]:
+        """
+        Prepara chunks + índice para um conteúdo (arquivo ou URL)
+        Reutiliza o artefato em disco quando o mesmo conteúdo já foi compilado
+        """
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+        artifact = self._load_artifact(content_hash)
+        if artifact:
+            chunks, index = artifact
+            logger.info(f"📦 Índice carregado do artefato: {len(chunks)} chunks | {source_key}")
+        else:
+            chunks = self.split_into_chunks(content)
+            index = BM25Index(chunks)
+            self._save_artifact(content_hash, chunks, index)
+            logger.info(f"✅ Conteúdo indexado: {len(chunks)} chunks | {source_key}")
+
+        self.chunks_cache[source_key] = chunks
+        self.index_cache[source_key] = (version if version is not None else content_hash, index)
+
+        # Conteúdo mudou desde a última carga: o artefato anterior não serve mais
+        previous_hash = self.artifact_hashes.get(source_key)
+        self.artifact_hashes[source_key] = content_hash
+        if previous_hash and previous_hash != content_hash:
+            self._discard_artifact(previous_hash)
+        return chunks
+
     def load_and_prepare(self, filepath: str) -> bool:
         """
-        Carrega arquivo e prepara chunks
+        Carrega arquivo, prepara chunks e constrói o índice BM25
+        Reconstrói apenas se o arquivo mudou desde a última carga
         """
         try:
-            if filepath in self.chunks_cache:
-                logger.info(f"📦 Usando chunks em cache: {filepath}")
-                return True
-            
-            if not os.path.exists(filepath):
+            version = self._file_version(filepath)
+
+            if version is None:
                 logger.error(f"❌ Arquivo não encontrado: {filepath}")
+                self.invalidate(filepath)
                 return False
-            
+
+            cached = self.index_cache.get(filepath)
+            if cached and cached[0] == version and filepath in self.chunks_cache:
+                return True
+
             with open(filepath, 'r', encoding='utf-8') as f:
                 content = f.read()
-            
-            chunks = self.split_into_chunks(content)
-            self.chunks_cache[filepath] = chunks
-            
-            logger.info(f"✅ Arquivo preparado: {len(chunks)} chunks | {filepath}")
+
+            self.prepare_content(filepath, content, version=version)
             return True
-            
+
         except Exception as e:
             logger.error(f"❌ Erro ao preparar arquivo: {e}")
             return False
-    
-    def get_relevant_instructions(self, filepath: str, user_message: str) -> str:
+
+    def get_relevant_chunks(self, filepath: str, user_message: str, max_chunks: int = 3) -> List[str]:
         """
-        Retorna apenas as instruções relevantes para a mensagem do usuário
+        Retorna o conteúdo dos chunks relevantes para a mensagem, em ordem de relevância
         """
         try:
-            # Preparar chunks se necessário
-            if filepath not in self.chunks_cache:
-                if not self.load_and_prepare(filepath):
-                    return ""
-            
+            # Preparar chunks/índice se necessário (ou se o arquivo mudou)
+            if not self.load_and_prepare(filepath):
+                return []
+
             chunks = self.chunks_cache[filepath]
-            relevant_chunks = self.search_relevant_chunks(chunks, user_message, max_chunks=3)
-            
+            relevant_chunks = self.search_relevant_chunks(chunks, user_message, max_chunks=max_chunks)
+
             if not relevant_chunks:
                 # Se não achou nada específico, retorna chunk inicial (geralmente tem contexto geral)
                 relevant_chunks = chunks[:2]
                 logger.warning("⚠️ Nenhum chunk específico encontrado, usando chunks iniciais")
-            
-            # Combinar chunks relevantes
-            combined = "\n\n═══════════════════════════════════════════\n\n".join(
-                chunk['content'] for chunk in relevant_chunks
-            )
-            
-            return combined
-            
+
+            return [chunk['content'] for chunk in relevant_chunks]
+
         except Exception as e:
             logger.error(f"❌ Erro ao buscar instruções relevantes: {e}")
-            return ""
+            return []
+
+    def get_relevant_instructions(self, filepath: str, user_message: str) -> str:
+        """
+        Retorna apenas as instruções relevantes para a mensagem do usuário
+        """
+        # Combinar chunks relevantes
+        return "\n\n═══════════════════════════════════════════\n\n".join(
+            self.get_relevant_chunks(filepath, user_message, max_chunks=3)
+        )
 
 # Instância global
 instructions_rag = InstructionsRAG()
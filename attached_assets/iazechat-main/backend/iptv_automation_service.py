@@ -4,9 +4,12 @@ Suporta automação via Playwright com retry, validação e fallback manual
 """
 import asyncio
 import traceback
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 from datetime import datetime
-from playwright.async_api import async_playwright, Page, Browser
+from metrics import track_playwright
+
+if TYPE_CHECKING:
+    from playwright.async_api import Page, Browser
 
 
 class AutomationResult:
@@ -50,8 +53,8 @@ class IPTVAutomationBase:
         self.app_data = app_data
         self.form_data = form_data
         self.result = AutomationResult()
-        self.page: Optional[Page] = None
-        self.browser: Optional[Browser] = None
+        self.page: Optional["Page"] = None
+        self.browser: Optional["Browser"] = None
     
     async def take_screenshot(self, description: str = ""):
         """Tira screenshot e adiciona ao resultado"""
@@ -117,7 +120,10 @@ class IPTVAutomationBase:
     
     async def initialize_browser(self):
         """Inicializa o navegador Playwright"""
-        async with async_playwright() as p:
+        # Playwright só é importado quando uma automação roda (fora do startup)
+        from playwright.async_api import async_playwright
+        
+        async with track_playwright("iptv_automation"), async_playwright() as p:
             self.result.add_log("🚀 Iniciando navegador...")
             
             self.browser = await p.chromium.launch(
@@ -0,0 +1,223 @@
+"""
+Logging estruturado e assíncrono (QueueHandler / QueueListener)
+
+Os caminhos quentes (envio por WebSocket, detecção de tenant, chat de vendas,
+processamento da IA) faziam dezenas de print/logger.info por mensagem, cada um
+formatando e escrevendo no stdout/arquivo dentro do event loop. Aqui:
+
+- Todos os loggers escrevem num QueueHandler (só enfileira). Formatação JSON e I/O
+  (stdout + /var/log/ai_agent.log para o logger "ai_agent") rodam na thread do
+  QueueListener. Fila cheia descarta o registro e conta em get_stats().
+- Nível por módulo: LOG_LEVEL (raiz) e LOG_LEVELS="tenant_middleware=WARNING,ai_agent=DEBUG".
+- Amostragem: logs de depuração por mensagem usam extra=SAMPLED e só saem em
+  LOG_SAMPLE_RATE dos casos (1.0 = todos).
+- Correlação: request_id (header X-Request-ID ou gerado pelo RequestContextMiddleware)
+  e ticket_id (bind_ticket) vão em todo registro do mesmo contexto async.
+- LOG_FORMAT=text para saída legível no desenvolvimento.
+"""
+import os
+import sys
+import copy
+import json
+import uuid
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+AI_LOG_FILE = os.environ.get("AI_LOG_FILE", "/var/log/ai_agent.log")
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+ticket_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("ticket_id", default=None)
+
+# logger.debug(..., extra=SAMPLED): sai só em LOG_SAMPLE_RATE das chamadas
+SAMPLED = {"sampled": True}
+
+
+def bind_ticket(ticket_id: Optional[str]):
+    """Marca os próximos logs deste contexto async com o ticket_id"""
+    ticket_id_var.set(ticket_id)
+
+
+class ContextFilter(logging.Filter):
+    """Copia request_id/ticket_id do contexto async para o registro (thread de quem loga)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        if getattr(record, "ticket_id", None) is None:
+            record.ticket_id = ticket_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Enfileira sem formatar; com a fila cheia descarta em vez de travar o loop"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Só resolve args e traceback (objetos que não podem mudar até o listener rodar);
+        # o JSON/texto final é montado na thread do listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "ticket_id", None):
+            entry["ticket_id"] = record.ticket_id
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        ids = [value for value in (getattr(record, "request_id", None), getattr(record, "ticket_id", None)) if value]
+        return f"{line} [{' '.join(ids)}]" if ids else line
+
+
+class LoggingPipeline:
+    def __init__(self):
+        self.queue: Optional[queue.Queue] = None
+        self.handler: Optional[NonBlockingQueueHandler] = None
+        self.listener: Optional[QueueListener] = None
+
+    def configure(self):
+        """Idempotente: instala o QueueHandler na raiz e inicia o listener"""
+        if self.listener is not None:
+            return
+
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(formatter)
+        outputs = [console]
+
+        try:
+            ai_file = logging.FileHandler(AI_LOG_FILE)
+            ai_file.setFormatter(formatter)
+            # Só o logger "ai_agent" (e filhos) vai para o arquivo da IA
+            ai_file.addFilter(logging.Filter("ai_agent"))
+            outputs.append(ai_file)
+        except OSError as e:
+            print(f"⚠️ Log da IA só no stdout ({AI_LOG_FILE}: {e})")
+
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+        self.handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(self.handler)
+        root.setLevel(LOG_LEVEL)
+
+        for name, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+
+        self.listener = QueueListener(self.queue, *outputs, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Esvazia a fila e para a thread do listener (shutdown do servidor)"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def get_stats(self) -> Dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "dropped": self.handler.dropped if self.handler else 0,
+            "sample_rate": LOG_SAMPLE_RATE
+        }
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """ "modulo=NIVEL,outro=NIVEL" -> {"modulo": "NIVEL", ...} """
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class RequestContextMiddleware:
+    """
+    Middleware ASGI: request_id do header X-Request-ID (ou novo) no contexto dos
+    logs da requisição e devolvido na resposta
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or []).get(b"x-request-id", b"")
+        request_id = incoming.decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+
+# Instância global
+logging_pipeline = LoggingPipeline()
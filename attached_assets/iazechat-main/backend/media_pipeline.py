@@ -0,0 +1,269 @@
+"""
+Pipeline de mídia em background (transcrição de áudio / processamento de vídeo)
+
+A requisição só grava o job e responde na hora; MEDIA_WORKERS tarefas consomem a
+fila e chamam o media_service (Whisper assíncrono, ffmpeg em subprocesso).
+
+- Estado em media_jobs (queued -> processing -> done/failed), consultável por id.
+- Conteúdo fica em arquivo temporário até o job rodar (não segura bytes na fila).
+- Resultado com ticket: grava em messages.media_result (se message_id) e avisa o
+  ticket pelo WebSocket (evento "media_processed") através do notify do servidor.
+- Áudio repetido (encaminhado) sai do cache de transcrições do media_service.
+- Cada job pertence a um processo (worker_id) com lease renovado enquanto ele vive;
+  vários workers do uvicorn compartilham media_jobs, então só jobs com lease
+  vencido (processo morto) são marcados como failed - no startup e periodicamente.
+"""
+import os
+import uuid
+import socket
+import asyncio
+import logging
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+from metrics import loop_tick, registry
+
+logger = logging.getLogger(__name__)
+
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "2"))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", "100"))
+JOB_RETENTION_DAYS = int(os.environ.get("MEDIA_JOB_RETENTION_DAYS", "7"))
+# Sem renovação por esse tempo, o processo dono do job é considerado morto
+JOB_LEASE_SECONDS = int(os.environ.get("MEDIA_JOB_LEASE_SECONDS", "120"))
+
+ACTIVE_STATUSES = ["queued", "processing"]
+
+MEDIA_KINDS = {"audio", "video"}
+
+NotifyFn = Callable[[str, Dict], Awaitable[None]]
+
+
+class MediaQueueFull(Exception):
+    """Fila de mídia cheia (backpressure para a rota)"""
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class MediaPipeline:
+    """Fila de jobs de mídia com workers assíncronos"""
+
+    def __init__(self):
+        self.db = None
+        self.notify: Optional[NotifyFn] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._lease_task: Optional[asyncio.Task] = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def attach(self, db, notify: Optional[NotifyFn] = None):
+        self.db = db
+        self.notify = notify
+
+    async def ensure_indexes(self):
+        try:
+            await self.db.media_jobs.create_index([("id", 1)], unique=True)
+            await self.db.media_jobs.create_index(
+                [("created_at_dt", 1)], expireAfterSeconds=JOB_RETENTION_DAYS * 86400
+            )
+            await self.db.media_jobs.create_index([("status", 1), ("lease_until", 1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de media_jobs: {e}")
+
+    async def start(self):
+        """Índices, limpeza de jobs órfãos e workers (startup do servidor)"""
+        from media_service import media_service
+        media_service.attach(self.db)
+        await media_service.ensure_indexes()
+        await self.ensure_indexes()
+
+        # Arquivos temporários de jobs interrompidos não sobrevivem ao restart
+        await self.fail_orphaned_jobs()
+
+        self.queue = asyncio.Queue(maxsize=MEDIA_QUEUE_SIZE)
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(MEDIA_WORKERS)]
+        self._lease_task = asyncio.create_task(self._lease_loop())
+
+    def _lease_until(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)
+
+    async def fail_orphaned_jobs(self) -> int:
+        """Jobs ativos cujo processo dono parou de renovar o lease (ou de antes do lease)"""
+        result = await self.db.media_jobs.update_many(
+            {
+                "status": {"$in": ACTIVE_STATUSES},
+                "worker_id": {"$ne": self.worker_id},
+                "$or": [
+                    {"lease_until": {"$lt": datetime.now(timezone.utc)}},
+                    {"lease_until": {"$exists": False}}
+                ]
+            },
+            {"$set": {"status": "failed", "error": "Servidor reiniciado durante o processamento", "finished_at": _now_iso()}}
+        )
+        if result.modified_count:
+            logger.warning(f"⚠️ {result.modified_count} job(s) de mídia órfão(s) marcados como failed")
+        return result.modified_count
+
+    async def _lease_loop(self):
+        """Renova o lease dos jobs deste processo e recolhe os de processos mortos"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                async with loop_tick("media_lease"):
+                    await self.db.media_jobs.update_many(
+                        {"worker_id": self.worker_id, "status": {"$in": ACTIVE_STATUSES}},
+                        {"$set": {"lease_until": self._lease_until()}}
+                    )
+                    await self.fail_orphaned_jobs()
+            except Exception as e:
+                logger.error(f"❌ Erro ao renovar lease dos jobs de mídia: {e}")
+
+    async def submit(
+        self,
+        kind: str,
+        data: bytes,
+        filename: str,
+        ticket_id: Optional[str] = None,
+        message_id: Optional[str] = None,
+        options: Optional[Dict] = None,
+        requested_by: Optional[str] = None,
+        reseller_id: Optional[str] = None
+    ) -> Dict:
+        """Grava o job e coloca na fila; retorna o documento do job"""
+        if kind not in MEDIA_KINDS:
+            raise ValueError(f"Tipo de mídia inválido: {kind}")
+        if self.queue is None:
+            raise RuntimeError("Pipeline de mídia não iniciado")
+        if self.queue.full():
+            raise MediaQueueFull("Fila de processamento de mídia cheia")
+
+        fd, path = tempfile.mkstemp(prefix="media_job_", suffix=Path(filename).suffix)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "filename": filename,
+            "size": len(data),
+            "ticket_id": ticket_id,
+            "message_id": message_id,
+            "options": options or {},
+            "requested_by": requested_by,
+            "reseller_id": reseller_id,
+            "status": "queued",
+            "worker_id": self.worker_id,
+            "lease_until": self._lease_until(),
+            "created_at": now.isoformat(),
+            "created_at_dt": now
+        }
+        await self.db.media_jobs.insert_one(job)
+        job.pop("_id", None)
+        self.queue.put_nowait((job, path))
+        return job
+
+    async def get_job(self, job_id: str, filters: Optional[Dict] = None) -> Optional[Dict]:
+        """filters: isolamento do chamador (reseller_id / requested_by)"""
+        return await self.db.media_jobs.find_one(
+            {**(filters or {}), "id": job_id},
+            {"_id": 0, "created_at_dt": 0, "lease_until": 0, "worker_id": 0}
+        )
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+
+    async def _worker(self, index: int):
+        while True:
+            job, path = await self.queue.get()
+            try:
+                async with loop_tick(f"media_{job['kind']}"):
+                    await self._process(job, path)
+            except Exception as e:
+                logger.error(f"❌ Worker de mídia {index}: erro inesperado no job {job['id']}: {e}")
+            finally:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self.queue.task_done()
+
+    async def _run(self, job: Dict, data: bytes) -> Dict:
+        from media_service import media_service
+        options = job["options"]
+        if job["kind"] == "audio":
+            return await media_service.transcribe_audio(
+                audio_data=data,
+                filename=job["filename"],
+                language=options.get("language", "pt")
+            )
+        return await media_service.process_video(
+            video_data=data,
+            filename=job["filename"],
+            extract_audio=options.get("extract_audio", True),
+            analyze_frames=options.get("analyze_frames", False)
+        )
+
+    async def _process(self, job: Dict, path: str):
+        await self.db.media_jobs.update_one(
+            {"id": job["id"]}, {"$set": {"status": "processing", "started_at": _now_iso()}}
+        )
+        data = await asyncio.get_running_loop().run_in_executor(None, Path(path).read_bytes)
+
+        try:
+            result = await self._run(job, data)
+        except Exception as e:
+            logger.error(f"❌ Job de mídia {job['id']} falhou: {e}")
+            await self.db.media_jobs.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "failed", "error": str(e), "finished_at": _now_iso()}}
+            )
+            await self._publish(job, {"status": "failed", "error": str(e)})
+            return
+
+        await self.db.media_jobs.update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "done", "result": result, "finished_at": _now_iso()}}
+        )
+        if job.get("message_id"):
+            await self.db.messages.update_one(
+                {"id": job["message_id"], "ticket_id": job.get("ticket_id")},
+                {"$set": {"media_result": result}}
+            )
+        logger.info(f"🎧 Job de mídia {job['id']} ({job['kind']}) concluído")
+        await self._publish(job, {"status": "done", "result": result})
+
+    async def _publish(self, job: Dict, payload: Dict):
+        if not job.get("ticket_id") or self.notify is None:
+            return
+        try:
+            await self.notify(job["ticket_id"], {
+                "type": "media_processed",
+                "job_id": job["id"],
+                "kind": job["kind"],
+                "ticket_id": job["ticket_id"],
+                "message_id": job.get("message_id"),
+                **payload
+            })
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao avisar ticket {job['ticket_id']} sobre mídia: {e}")
+
+    def get_stats(self) -> Dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "workers": len(self._workers),
+            "worker_id": self.worker_id
+        }
+
+
+# Instância global
+media_pipeline = MediaPipeline()
+
+registry.gauge(
+    "media_queue_depth", "Jobs de mídia aguardando um worker",
+    callback=lambda: media_pipeline.queue.qsize() if media_pipeline.queue else 0
+)
@@ -7,7 +7,13 @@ from typing import Optional
 import logging
 from datetime import datetime, timezone
 
+from bson import ObjectId
+from bson.errors import InvalidId
+
 from media_service import media_service
+from media_pipeline import media_pipeline, MediaQueueFull
+from dependencies import get_current_principal
+from tenant_helpers import get_tenant_filter
 
 logger = logging.getLogger(__name__)
 
@@ -26,13 +32,39 @@ def get_db(request: Request):
     """Dependency injection para obter conexão do banco"""
     return request.app.state.db
 
+async def get_ticket_for_principal(db, request: Request, ticket_id: str, principal: dict) -> dict:
+    """
+    Ticket com o mesmo isolamento das rotas de tickets: filtro de tenant
+    (get_tenant_filter) e, para cliente, apenas o próprio ticket
+    """
+    query = {"id": ticket_id, **get_tenant_filter(request, principal)}
+    if principal.get("user_type") == "client":
+        query["client_id"] = principal["user_id"]
+    
+    ticket = await db.tickets.find_one(query, {"_id": 0, "id": 1, "client_id": 1, "reseller_id": 1})
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Ticket não encontrado")
+    return ticket
+
+def require_staff(principal: dict):
+    """Processamento avulso e base de treinamento: só admin/revenda/atendente (gastam crédito OpenAI)"""
+    if principal.get("user_type") not in ("admin", "reseller", "agent"):
+        raise HTTPException(status_code=403, detail="Não autorizado")
+
+def job_filter_for_principal(request: Request, principal: dict) -> dict:
+    """Jobs visíveis: cliente só os próprios; demais pelo tenant"""
+    if principal.get("user_type") == "client":
+        return {"requested_by": principal["user_id"]}
+    return get_tenant_filter(request, principal)
+
 @router.post("/transcribe-audio")
 async def transcribe_audio_endpoint(
     file: UploadFile = File(...),
     language: str = Form("pt"),
     save_as_training: bool = Form(False),
     agent_id: str = Form(None),
-    request: Request = None
+    request: Request = None,
+    current_user: dict = Depends(get_current_principal)
 ):
     """
     Transcreve áudio para texto
@@ -42,6 +74,7 @@ async def transcribe_audio_endpoint(
     - **save_as_training**: Se True, salva como conhecimento da IA
     - **agent_id**: ID do agente (opcional, para conhecimento individual)
     """
+    require_staff(current_user)
     try:
         # Validar formato
         ext = get_file_extension(file.filename)
@@ -69,18 +102,17 @@ async def transcribe_audio_endpoint(
         )
         
         # Salvar como conhecimento da IA se solicitado
-        if save_as_training and request:
-            db = request.app.state.db if hasattr(request.app.state, 'db') else None
-            if db:
-                knowledge_id = await media_service.save_training_knowledge(
-                    db=db,
-                    content=result['text'],
-                    media_type="audio",
-                    category="treinamento_audio",
-                    agent_id=agent_id
-                )
-                result['knowledge_id'] = knowledge_id
-                result['saved_as_training'] = True
+        if save_as_training:
+            knowledge_id = await media_service.save_training_knowledge(
+                db=get_db(request),
+                content=result['text'],
+                media_type="audio",
+                category="treinamento_audio",
+                agent_id=agent_id,
+                reseller_id=current_user.get("reseller_id")
+            )
+            result['knowledge_id'] = knowledge_id
+            result['saved_as_training'] = True
         
         return {
             "success": True,
@@ -96,7 +128,8 @@ async def transcribe_audio_endpoint(
 @router.post("/analyze-image")
 async def analyze_image_endpoint(
     file: UploadFile = File(...),
-    prompt: str = Form("Descreva esta imagem em detalhes. Se houver texto, transcreva-o.")
+    prompt: str = Form("Descreva esta imagem em detalhes. Se houver texto, transcreva-o."),
+    current_user: dict = Depends(get_current_principal)
 ):
     """
     Analisa imagem usando GPT-4o Vision
@@ -104,6 +137,7 @@ async def analyze_image_endpoint(
     - **file**: Arquivo de imagem (jpg, png, etc.)
     - **prompt**: Pergunta sobre a imagem
     """
+    require_staff(current_user)
     try:
         # Validar formato
         ext = get_file_extension(file.filename)
@@ -144,7 +178,8 @@ async def analyze_image_endpoint(
 async def process_video_endpoint(
     file: UploadFile = File(...),
     extract_audio: bool = Form(True),
-    analyze_frames: bool = Form(True)
+    analyze_frames: bool = Form(True),
+    current_user: dict = Depends(get_current_principal)
 ):
     """
     Processa vídeo: extrai áudio e analisa frames
@@ -153,6 +188,7 @@ async def process_video_endpoint(
     - **extract_audio**: Se deve extrair e transcrever áudio
     - **analyze_frames**: Se deve analisar frames do vídeo
     """
+    require_staff(current_user)
     try:
         # Validar formato
         ext = get_file_extension(file.filename)
@@ -191,23 +227,104 @@ async def process_video_endpoint(
         logger.error(f"Erro ao processar vídeo: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/jobs", status_code=202)
+async def create_media_job(
+    file: UploadFile = File(...),
+    kind: str = Form("audio"),
+    ticket_id: Optional[str] = Form(None),
+    message_id: Optional[str] = Form(None),
+    language: str = Form("pt"),
+    analyze_frames: bool = Form(False),
+    request: Request = None,
+    current_user: dict = Depends(get_current_principal)
+):
+    """
+    Processa áudio/vídeo em background
+    
+    - **kind**: audio ou video
+    - **ticket_id**: se informado, o resultado chega no ticket via WebSocket (media_processed)
+    - **message_id**: se informado, o resultado é gravado na mensagem (media_result);
+      exige ticket_id e precisa ser uma mensagem desse ticket
+    
+    Acompanhe por GET /api/media/jobs/{job_id}
+    """
+    formats = AUDIO_FORMATS if kind == "audio" else VIDEO_FORMATS
+    max_size = 25 * 1024 * 1024 if kind == "audio" else 50 * 1024 * 1024
+    
+    if kind not in ("audio", "video"):
+        raise HTTPException(status_code=400, detail="Tipo deve ser audio ou video")
+    
+    ext = get_file_extension(file.filename)
+    if ext not in formats:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato não suportado. Use: {', '.join(formats)}"
+        )
+    
+    if message_id and not ticket_id:
+        raise HTTPException(status_code=400, detail="message_id exige ticket_id")
+    
+    # Resultado vai para o ticket/mensagem: só quem tem acesso ao ticket
+    db = get_db(request)
+    reseller_id = current_user.get("reseller_id")
+    if ticket_id:
+        ticket = await get_ticket_for_principal(db, request, ticket_id, current_user)
+        reseller_id = ticket.get("reseller_id")
+        if message_id and not await db.messages.find_one(
+            {"id": message_id, "ticket_id": ticket_id}, {"_id": 1}
+        ):
+            raise HTTPException(status_code=404, detail="Mensagem não encontrada neste ticket")
+    
+    data = await file.read()
+    if len(data) > max_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Arquivo muito grande. Máximo: {max_size // (1024 * 1024)}MB"
+        )
+    
+    try:
+        job = await media_pipeline.submit(
+            kind=kind,
+            data=data,
+            filename=file.filename,
+            ticket_id=ticket_id,
+            message_id=message_id,
+            options={"language": language, "analyze_frames": analyze_frames},
+            requested_by=current_user["user_id"],
+            reseller_id=reseller_id
+        )
+    except MediaQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    
+    for field in ("created_at_dt", "lease_until", "worker_id"):
+        job.pop(field, None)
+    return {"success": True, "data": job}
+
+@router.get("/jobs/{job_id}")
+async def get_media_job(job_id: str, request: Request, current_user: dict = Depends(get_current_principal)):
+    """Status e resultado de um job de mídia (mesmo tenant / próprio cliente)"""
+    job = await media_pipeline.get_job(job_id, job_filter_for_principal(request, current_user))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return {"success": True, "data": job}
+
 @router.get("/training-knowledge")
 async def list_training_knowledge(
     skip: int = 0,
     limit: int = 50,
     agent_id: str = None,
-    request: Request = None
+    request: Request = None,
+    current_user: dict = Depends(get_current_principal)
 ):
     """
-    Lista conhecimentos de treinamento salvos
+    Lista conhecimentos de treinamento salvos (do tenant)
     """
+    require_staff(current_user)
     try:
-        db = request.app.state.db if request and hasattr(request.app.state, 'db') else None
-        if not db:
-            raise HTTPException(status_code=500, detail="Banco de dados não disponível")
+        db = get_db(request)
         
         # Filtro por agente se fornecido
-        filter_query = {"category": "treinamento_audio", "active": True}
+        filter_query = {"category": "treinamento_audio", "active": True, **get_tenant_filter(request, current_user)}
         if agent_id:
             filter_query["agent_id"] = agent_id
         
@@ -238,17 +355,26 @@ async def list_training_knowledge(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/training-knowledge/{knowledge_id}")
-async def delete_training_knowledge(knowledge_id: str, request: Request = None):
+async def delete_training_knowledge(
+    knowledge_id: str,
+    request: Request,
+    current_user: dict = Depends(get_current_principal)
+):
     """
-    Desativa um conhecimento de treinamento
+    Desativa um conhecimento de treinamento (do tenant)
     """
+    require_staff(current_user)
     try:
-        db = request.app.state.db if request and hasattr(request.app.state, 'db') else None
-        if not db:
-            raise HTTPException(status_code=500, detail="Banco de dados não disponível")
+        db = get_db(request)
+        
+        # list_training_knowledge devolve o ObjectId como string
+        try:
+            knowledge_oid = ObjectId(knowledge_id)
+        except InvalidId:
+            raise HTTPException(status_code=404, detail="Conhecimento não encontrado")
         
         result = await db.ai_knowledge_base.update_one(
-            {"_id": knowledge_id},
+            {"_id": knowledge_oid, **get_tenant_filter(request, current_user)},
             {"$set": {"active": False}}
         )
         
@@ -267,7 +393,7 @@ async def delete_training_knowledge(knowledge_id: str, request: Request = None):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/supported-formats")
-async def get_supported_formats():
+async def get_supported_formats(current_user: dict = Depends(get_current_principal)):
     """Retorna formatos de mídia suportados"""
     return {
         "audio": AUDIO_FORMATS,
@@ -1,42 +1,119 @@
 """
 Serviço de Processamento Multimodal
 Áudio, Imagem e Vídeo → Texto
+
+- Whisper chamado com o cliente assíncrono (AsyncOpenAI): nada bloqueia o event loop.
+- FFmpeg via asyncio.create_subprocess_exec com timeout (processo é morto ao estourar).
+- Transcrições em cache por hash SHA-256 do conteúdo (collection media_transcripts):
+  áudio encaminhado várias vezes é transcrito uma vez só. O cache é usado quando o
+  serviço recebe a conexão do banco (attach).
+- SDKs (openai, emergentintegrations) importados no primeiro uso: importar este
+  módulo (ex.: save_media_file nos uploads) não carrega nenhum deles.
 """
 import os
 import logging
 import io
 import base64
-import subprocess
+import shutil
+import asyncio
+import hashlib
 import tempfile
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
 load_dotenv()
 
-from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-from openai import OpenAI
+from metrics import track_llm
 
 logger = logging.getLogger(__name__)
 
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", "120"))
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+async def run_ffmpeg(args: List[str], timeout: int = FFMPEG_TIMEOUT):
+    """Executa ffmpeg sem bloquear o event loop; mata o processo no timeout"""
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise ValueError(f"FFmpeg excedeu o tempo limite de {timeout}s")
+    if process.returncode != 0:
+        raise ValueError(f"FFmpeg falhou: {stderr.decode(errors='ignore')[-300:]}")
+
+
 class MediaService:
     """Serviço para processar áudio, imagem e vídeo"""
     
     def __init__(self):
         """Inicializa o serviço"""
         self.api_key = os.getenv("EMERGENT_LLM_KEY")
+        self._openai_client = None
+        self.db = None
+    
+    def _require_api_key(self) -> str:
         if not self.api_key:
             raise ValueError("EMERGENT_LLM_KEY não encontrada nas variáveis de ambiente")
-        
-        # Cliente OpenAI para Whisper (áudio)
-        self.openai_client = OpenAI(api_key=self.api_key)
-        
-        logger.info("MediaService inicializado com sucesso")
+        return self.api_key
+    
+    @property
+    def openai_client(self):
+        """Cliente OpenAI assíncrono para Whisper (áudio), criado no primeiro uso"""
+        if self._openai_client is None:
+            from openai import AsyncOpenAI
+            self._openai_client = AsyncOpenAI(api_key=self._require_api_key())
+            logger.info("MediaService: cliente OpenAI inicializado")
+        return self._openai_client
+    
+    def attach(self, db):
+        """Conexão do servidor - habilita o cache de transcrições"""
+        self.db = db
+    
+    async def ensure_indexes(self):
+        try:
+            await self.db.media_transcripts.create_index([("content_hash", 1), ("language", 1)], unique=True)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índice de media_transcripts: {e}")
+    
+    async def _cached_transcript(self, digest: str, language: str) -> Optional[dict]:
+        if self.db is None:
+            return None
+        cached = await self.db.media_transcripts.find_one(
+            {"content_hash": digest, "language": language}, {"_id": 0, "result": 1}
+        )
+        return cached["result"] if cached else None
+    
+    async def _store_transcript(self, digest: str, language: str, result: dict):
+        if self.db is None:
+            return
+        try:
+            await self.db.media_transcripts.update_one(
+                {"content_hash": digest, "language": language},
+                {"$setOnInsert": {
+                    "content_hash": digest,
+                    "language": language,
+                    "result": result,
+                    "created_at": datetime.now(timezone.utc).isoformat()
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao guardar transcrição em cache: {e}")
     
     async def transcribe_audio(
-        self, 
+        self,
         audio_data: bytes,
         filename: str,
         language: str = "pt"
@@ -48,47 +125,41 @@ class MediaService:
             audio_data: Dados binários do áudio
             filename: Nome do arquivo
             language: Idioma (default: pt - português)
-            
+        
         Returns:
             dict com texto transcrito e metadados
         """
         try:
+            digest = content_hash(audio_data)
+            cached = await self._cached_transcript(digest, language)
+            if cached:
+                logger.info(f"♻️ Transcrição em cache: {filename}")
+                return {**cached, "cached": True}
+            
             logger.info(f"Iniciando transcrição de áudio: {filename}")
             
-            # Criar arquivo temporário
-            with tempfile.NamedTemporaryFile(
-                delete=False, 
-                suffix=Path(filename).suffix
-            ) as temp_file:
-                temp_file.write(audio_data)
-                temp_file_path = temp_file.name
+            # Transcrever usando Whisper (arquivo em memória, sem temporário em disco)
+            async with track_llm("openai", "whisper-1"):
+                transcript = await self.openai_client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(Path(filename).name, audio_data),
+                    language=language,
+                    response_format="verbose_json"
+                )
             
-            try:
-                # Transcrever usando Whisper
-                with open(temp_file_path, 'rb') as audio_file:
-                    transcript = self.openai_client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language=language,
-                        response_format="verbose_json"
-                    )
-                
-                result = {
-                    "text": transcript.text,
-                    "language": transcript.language if hasattr(transcript, 'language') else language,
-                    "duration": transcript.duration if hasattr(transcript, 'duration') else None,
-                    "type": "audio_transcription",
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }
-                
-                logger.info(f"Transcrição concluída: {len(result['text'])} caracteres")
-                return result
-                
-            finally:
-                # Limpar arquivo temporário
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-                    
+            result = {
+                "text": transcript.text,
+                "language": transcript.language if hasattr(transcript, 'language') else language,
+                "duration": transcript.duration if hasattr(transcript, 'duration') else None,
+                "type": "audio_transcription",
+                "content_hash": digest,
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            }
+            
+            await self._store_transcript(digest, language, result)
+            logger.info(f"Transcrição concluída: {len(result['text'])} caracteres")
+            return result
+        
         except Exception as e:
             logger.error(f"Erro ao transcrever áudio: {str(e)}")
             raise ValueError(f"Falha na transcrição: {str(e)}")
@@ -104,7 +175,7 @@ class MediaService:
         Args:
             image_data: Dados binários da imagem
             prompt: Pergunta sobre a imagem
-            
+        
         Returns:
             dict com análise da imagem
         """
@@ -114,9 +185,11 @@ class MediaService:
             # Converter imagem para base64
             image_base64 = base64.b64encode(image_data).decode('utf-8')
             
+            from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+            
             # Criar chat com GPT-4o Vision
             chat = LlmChat(
-                api_key=self.api_key,
+                api_key=self._require_api_key(),
                 session_id=f"image_analysis_{datetime.now().timestamp()}",
                 system_message="Você é um assistente especializado em análise de imagens. Descreva tudo que vê em português, incluindo textos, objetos, pessoas e contexto."
             ).with_model("openai", "gpt-4o")
@@ -129,7 +202,8 @@ class MediaService:
             )
             
             # Enviar e obter resposta
-            response = await chat.send_message(message)
+            async with track_llm("openai", "gpt-4o"):
+                response = await chat.send_message(message)
             
             result = {
                 "text": response,
@@ -140,7 +214,7 @@ class MediaService:
             
             logger.info(f"Análise de imagem concluída: {len(response)} caracteres")
             return result
-            
+        
         except Exception as e:
             logger.error(f"Erro ao analisar imagem: {str(e)}")
             raise ValueError(f"Falha na análise de imagem: {str(e)}")
@@ -154,47 +228,6 @@ class MediaService:
         frame_interval: int = 60  # Apenas 1 frame por minuto
     ) -> dict:
         """
-        Placeholder function
-        """
-        return {"success": False, "error": "Not implemented"}
-
-
-async def save_media_file(file_content: bytes, filename: str, content_type: str) -> str:
-    """
-    Salva arquivo de mídia localmente
-    
-    Args:
-        file_content: Conteúdo do arquivo em bytes
-        filename: Nome do arquivo
-        content_type: Tipo MIME (image/jpeg, video/mp4, etc)
-    
-    Returns:
-        URL do arquivo salvo
-    """
-    try:
-        # Criar diretório de uploads se não existir
-        uploads_dir = "/app/uploads"
-        os.makedirs(uploads_dir, exist_ok=True)
-        
-        # Gerar nome único
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(uploads_dir, safe_filename)
-        
-        # Salvar arquivo
-        with open(filepath, 'wb') as f:
-            f.write(file_content)
-        
-        # Retornar URL (assumindo que /app/uploads é servido em /api/uploads/)
-        media_url = f"/api/uploads/{safe_filename}"
-        
-        logger.info(f"✅ Mídia salva: {media_url} ({len(file_content)} bytes)")
-        return media_url
-        
-    except Exception as e:
-        logger.error(f"❌ Erro ao salvar mídia: {e}")
-        raise
-
         Processa vídeo: extrai áudio e analisa frames (OTIMIZADO)
         
         Args:
@@ -203,20 +236,17 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
             extract_audio: Se deve extrair e transcrever áudio
             analyze_frames: Se deve analisar frames (desabilitado por padrão)
             frame_interval: Intervalo entre frames (segundos)
-            
+        
         Returns:
             dict com transcrição do áudio e análise dos frames
         """
         try:
             logger.info(f"Iniciando processamento RÁPIDO de vídeo: {filename}")
             
-            # Criar arquivo temporário para o vídeo
-            with tempfile.NamedTemporaryFile(
-                delete=False, 
-                suffix=Path(filename).suffix
-            ) as temp_video:
+            work_dir = tempfile.mkdtemp(prefix="media_")
+            video_path = os.path.join(work_dir, "video" + Path(filename).suffix)
+            with open(video_path, 'wb') as temp_video:
                 temp_video.write(video_data)
-                video_path = temp_video.name
             
             result = {
                 "type": "video_processing",
@@ -226,11 +256,11 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
             try:
                 # 1. Extrair e transcrever áudio (OTIMIZADO)
                 if extract_audio:
-                    audio_path = video_path + "_audio.mp3"
+                    audio_path = os.path.join(work_dir, "audio.mp3")
                     
                     # Extrair áudio com FFmpeg OTIMIZADO (baixa qualidade, mais rápido)
-                    subprocess.run([
-                        'ffmpeg', '-i', video_path,
+                    await run_ffmpeg([
+                        '-i', video_path,
                         '-vn',  # Sem vídeo
                         '-acodec', 'libmp3lame',
                         '-ab', '64k',  # Qualidade reduzida (era 128k)
@@ -238,58 +268,46 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
                         '-ac', '1',  # Mono (era estéreo)
                         '-y',  # Sobrescrever
                         audio_path
-                    ], check=True, capture_output=True, timeout=30)  # Timeout de 30s
+                    ])
                     
                     # Transcrever áudio
                     with open(audio_path, 'rb') as audio_file:
                         audio_data = audio_file.read()
-                        transcription = await self.transcribe_audio(
-                            audio_data,
-                            "video_audio.mp3"
-                        )
+                    transcription = await self.transcribe_audio(
+                        audio_data,
+                        "video_audio.mp3"
+                    )
                     
                     result['audio_transcription'] = transcription['text']
                     result['audio_language'] = transcription['language']
-                    
-                    # Limpar arquivo de áudio
-                    os.unlink(audio_path)
                 
                 # 2. Extrair e analisar frames
                 if analyze_frames:
-                    frames_dir = tempfile.mkdtemp()
-                    frame_pattern = os.path.join(frames_dir, 'frame_%04d.jpg')
+                    frame_pattern = os.path.join(work_dir, 'frame_%04d.jpg')
                     
                     # Extrair frames com FFmpeg
-                    subprocess.run([
-                        'ffmpeg', '-i', video_path,
+                    await run_ffmpeg([
+                        '-i', video_path,
                         '-vf', f'fps=1/{frame_interval}',  # 1 frame a cada N segundos
                         '-q:v', '2',  # Qualidade alta
                         '-y',
                         frame_pattern
-                    ], check=True, capture_output=True)
-                    
-                    # Analisar frames (máximo 5 para não sobrecarregar)
-                    frame_files = sorted(Path(frames_dir).glob('frame_*.jpg'))[:5]
-                    frame_analyses = []
-                    
-                    for i, frame_path in enumerate(frame_files):
-                        with open(frame_path, 'rb') as f:
-                            frame_data = f.read()
-                            analysis = await self.analyze_image(
-                                frame_data,
-                                f"Descreva o que está acontecendo neste frame do vídeo (frame {i+1})."
-                            )
-                            frame_analyses.append({
-                                "frame_number": i + 1,
-                                "analysis": analysis['text']
-                            })
+                    ])
                     
-                    result['frames_analysis'] = frame_analyses
+                    # Analisar frames (máximo 5 para não sobrecarregar) em paralelo
+                    frame_files = sorted(Path(work_dir).glob('frame_*.jpg'))[:5]
+                    analyses = await asyncio.gather(*(
+                        self.analyze_image(
+                            frame_path.read_bytes(),
+                            f"Descreva o que está acontecendo neste frame do vídeo (frame {i+1})."
+                        )
+                        for i, frame_path in enumerate(frame_files)
+                    ))
                     
-                    # Limpar frames
-                    for frame_file in Path(frames_dir).glob('*'):
-                        frame_file.unlink()
-                    os.rmdir(frames_dir)
+                    result['frames_analysis'] = [
+                        {"frame_number": i + 1, "analysis": analysis['text']}
+                        for i, analysis in enumerate(analyses)
+                    ]
                 
                 # 3. Gerar resumo combinado
                 if extract_audio or analyze_frames:
@@ -306,12 +324,11 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
                 
                 logger.info(f"Processamento de vídeo concluído")
                 return result
-                
+            
             finally:
-                # Limpar arquivo de vídeo
-                if os.path.exists(video_path):
-                    os.unlink(video_path)
-                    
+                # Limpar vídeo, áudio e frames
+                shutil.rmtree(work_dir, ignore_errors=True)
+        
         except Exception as e:
             logger.error(f"Erro ao processar vídeo: {str(e)}")
             raise ValueError(f"Falha no processamento de vídeo: {str(e)}")
@@ -322,7 +339,8 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
         content: str,
         media_type: str,
         category: str = "treinamento_audio",
-        agent_id: str = None
+        agent_id: str = None,
+        reseller_id: str = None
     ) -> str:
         """
         Salva conhecimento extraído de mídia na base de dados da IA
@@ -333,7 +351,8 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
             media_type: Tipo de mídia (audio, image, video)
             category: Categoria do conhecimento
             agent_id: ID do agente (opcional, para conhecimento individual)
-            
+            reseller_id: Revenda dona do conhecimento (isolamento multi-tenant)
+        
         Returns:
             ID do conhecimento salvo
         """
@@ -343,6 +362,7 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
                 "media_type": media_type,
                 "category": category,
                 "agent_id": agent_id,
+                "reseller_id": reseller_id,
                 "created_at": datetime.now(timezone.utc),
                 "active": True
             }
@@ -351,11 +371,48 @@ async def save_media_file(file_content: bytes, filename: str, content_type: str)
             logger.info(f"Conhecimento salvo: {result.inserted_id}")
             
             return str(result.inserted_id)
-            
+        
         except Exception as e:
             logger.error(f"Erro ao salvar conhecimento: {str(e)}")
             raise ValueError(f"Falha ao salvar conhecimento: {str(e)}")
 
 
+async def save_media_file(file_content: bytes, filename: str, content_type: str) -> str:
+    """
+    Salva arquivo de mídia localmente
+    
+    Args:
+        file_content: Conteúdo do arquivo em bytes
+        filename: Nome do arquivo
+        content_type: Tipo MIME (image/jpeg, video/mp4, etc)
+    
+    Returns:
+        URL do arquivo salvo
+    """
+    try:
+        # Criar diretório de uploads se não existir
+        uploads_dir = "/app/uploads"
+        os.makedirs(uploads_dir, exist_ok=True)
+        
+        # Gerar nome único
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        safe_filename = f"{timestamp}_{filename}"
+        filepath = os.path.join(uploads_dir, safe_filename)
+        
+        # Salvar arquivo
+        with open(filepath, 'wb') as f:
+            f.write(file_content)
+        
+        # Retornar URL (assumindo que /app/uploads é servido em /api/uploads/)
+        media_url = f"/api/uploads/{safe_filename}"
+        
+        logger.info(f"✅ Mídia salva: {media_url} ({len(file_content)} bytes)")
+        return media_url
+    
+    except Exception as e:
+        logger.error(f"❌ Erro ao salvar mídia: {e}")
+        raise
+
+
 # Instância global do serviço
 media_service = MediaService()
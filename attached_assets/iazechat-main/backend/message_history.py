@@ -0,0 +1,143 @@
+"""
+Histórico de mensagens do ticket com paginação por cursor (keyset)
+
+skip(offset) obriga o Mongo a percorrer todas as mensagens puladas: quanto mais o
+atendente rola para trás num histórico longo de WhatsApp, mais lento fica. Aqui a
+página é ancorada no par (created_at, id) da última mensagem vista:
+
+- before=<cursor>: mensagens mais antigas que o cursor (rolar para cima)
+- after=<cursor>: mensagens mais novas que o cursor (polling de novas)
+- sem cursor: as `limit` mais recentes
+
+O cursor é opaco para o frontend (base64 de "created_at|id"). O índice composto
+(ticket_id, created_at, id) do index_registry atende o filtro e a ordenação sem
+COLLSCAN nem sort em memória. A visão "compact" devolve só os campos que a lista
+do chat renderiza.
+"""
+import json
+import base64
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from timestamps import HIDDEN_TYPED_FIELDS
+
+MAX_PAGE_SIZE = 200
+
+# Campos usados pela lista de mensagens (AgentDashboard / ClientChat), incluindo
+# os nomes antigos das mensagens que chegam pelo WhatsApp
+COMPACT_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "ticket_id": 1,
+    "from_type": 1,
+    "sender_type": 1,
+    "from_id": 1,
+    "from_name": 1,
+    "to_type": 1,
+    "to_id": 1,
+    "kind": 1,
+    "type": 1,
+    "text": 1,
+    "message": 1,
+    "whatsapp": 1,
+    "file_url": 1,
+    "attachment_url": 1,
+    "media_expired": 1,
+    "pix_key": 1,
+    "buttons": 1,
+    "status": 1,
+    "read": 1,
+    "is_scheduled": 1,
+    "created_at": 1,
+    "timestamp": 1,
+    "media_result.text": 1
+}
+
+FULL_PROJECTION = {"_id": 0, **HIDDEN_TYPED_FIELDS}
+
+
+class InvalidCursor(ValueError):
+    """Cursor malformado enviado pelo cliente"""
+
+
+def encode_cursor(message: Dict) -> Optional[str]:
+    created_at = message.get("created_at")
+    if not created_at or not message.get("id"):
+        return None
+    raw = f"{created_at}|{message['id']}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, message_id = base64.urlsafe_b64decode(padded).decode("utf-8").split("|", 1)
+    except Exception:
+        raise InvalidCursor("Cursor inválido")
+    if not created_at or not message_id:
+        raise InvalidCursor("Cursor inválido")
+    return created_at, message_id
+
+
+def _keyset_filter(ticket_id: str, cursor: Tuple[str, str], op: str) -> Dict:
+    created_at, message_id = cursor
+    return {
+        "ticket_id": ticket_id,
+        "$or": [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "id": {op: message_id}}
+        ]
+    }
+
+
+async def fetch_page(
+    db,
+    ticket_id: str,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    offset: int = 0,
+    compact: bool = True
+) -> Dict:
+    """
+    Uma página do histórico em ordem cronológica (mais antiga primeiro)
+
+    Returns:
+        {"messages": [...], "before": cursor|None, "after": cursor|None, "has_more": bool}
+        has_more indica que existem mais mensagens na direção pedida
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    projection = COMPACT_PROJECTION if compact else FULL_PROJECTION
+
+    if after:
+        # Polling: mais novas que o cursor, já em ordem crescente
+        query = _keyset_filter(ticket_id, decode_cursor(after), "$gt")
+        cursor = db.messages.find(query, projection).sort([("created_at", 1), ("id", 1)])
+        messages = await cursor.limit(limit + 1).to_list(None)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        query = _keyset_filter(ticket_id, decode_cursor(before), "$lt") if before else {"ticket_id": ticket_id}
+        cursor = db.messages.find(query, projection).sort([("created_at", -1), ("id", -1)])
+        if offset and not before:
+            # Compatibilidade com clientes antigos que ainda paginam por offset
+            cursor = cursor.skip(offset)
+        messages = await cursor.limit(limit + 1).to_list(None)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        messages.reverse()
+
+    return {
+        "messages": messages,
+        "before": encode_cursor(messages[0]) if messages else before,
+        "after": encode_cursor(messages[-1]) if messages else after,
+        "has_more": has_more
+    }
+
+
+def page_etag(messages: List[Dict]) -> str:
+    """ETag fraco da página: muda com mensagem nova, editada, lida ou com mídia processada"""
+    digest = hashlib.sha1(
+        json.dumps(messages, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    return f'W/"{digest}"'
@@ -0,0 +1,468 @@
+"""
+Métricas no formato Prometheus (texto 0.0.4) + visão JSON para o painel admin
+
+O /api/health e o /test-system só dizem "está no ar ou não". Aqui cada caminho
+quente mede onde o tempo vai:
+
+- http_request_duration_seconds{method,route,status}: MetricsMiddleware (rota
+  pelo template, ex. /api/tickets/{ticket_id}, para não explodir cardinalidade)
+- mongo_command_duration_seconds{collection,command}: listener de comandos do driver
+- llm_request_duration_seconds{provider,model,status} e llm_tokens_total{provider,model,direction}
+- websocket_* / media_queue_* / log_queue_*: gauges lidos na hora da coleta
+- playwright_session_duration_seconds{operation,status}
+- background_loop_tick_seconds{loop,status}
+
+Expostas em GET /metrics (texto, para o Prometheus; METRICS_TOKEN opcional como
+Bearer) e GET /api/admin/metrics (JSON). Sem dependência nova: o registro é
+thread-safe porque o listener do Mongo roda nas threads do driver.
+"""
+import os
+import re
+import time
+import asyncio
+import threading
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Segundos: de consultas rápidas no Mongo até chamadas longas de LLM/Playwright
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = _NAME_RE.sub("_", name)
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [{**dict(zip(self.labelnames, key)), "value": value} for key, value in items]
+
+
+class Gauge(_Metric):
+    """Valor atual; com callback, é lido na hora da coleta (sem custo no caminho quente)"""
+    kind = "gauge"
+
+    def __init__(self, *args, callback: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_callback(self, callback: Callable[[], float]):
+        self._callback = callback
+
+    def _items(self) -> List[Tuple[Tuple[str, ...], float]]:
+        if self._callback is not None:
+            try:
+                return [((), float(self._callback()))]
+            except Exception as e:
+                logger.debug(f"⚠️ Gauge {self.name}: erro no callback: {e}")
+                return []
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._items()
+        ]
+
+    def snapshot(self) -> List[Dict]:
+        return [{**dict(zip(self.labelnames, key)), "value": value} for key, value in self._items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # chave -> [contagem por bucket..., soma, total]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _copy(self) -> List[Tuple[Tuple[str, ...], List[float]]]:
+        with self._lock:
+            return sorted((key, list(series)) for key, series in self._series.items())
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, series in self._copy():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {_format_value(series[-1])}")
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{plain} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{plain} {_format_value(series[-1])}")
+        return lines
+
+    def _quantile(self, series: List[float], q: float) -> Optional[float]:
+        """Estimativa pelo limite superior do bucket (como histogram_quantile, sem interpolar)"""
+        total = series[-1]
+        if not total:
+            return None
+        target = q * total
+        cumulative = 0.0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return None  # acima do maior bucket
+
+    def snapshot(self) -> List[Dict]:
+        result = []
+        for key, series in self._copy():
+            count = series[-1]
+            result.append({
+                **dict(zip(self.labelnames, key)),
+                "count": int(count),
+                "sum": round(series[-2], 6),
+                "avg": round(series[-2] / count, 6) if count else None,
+                "p50": self._quantile(series, 0.5),
+                "p95": self._quantile(series, 0.95),
+                "p99": self._quantile(series, 0.99)
+            })
+        result.sort(key=lambda s: -s["sum"])
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), callback=None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        """Exposição no formato texto do Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Mesmas séries em JSON (histogramas resumidos em count/avg/p50/p95/p99)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {"type": metric.kind, "help": metric.documentation, "series": metric.snapshot()}
+            for metric in metrics
+        }
+
+
+# Instância global
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Latência das requisições HTTP por rota", ("method", "route", "status")
+)
+http_requests_in_progress = registry.gauge(
+    "http_requests_in_progress", "Requisições HTTP em andamento"
+)
+mongo_command_duration = registry.histogram(
+    "mongo_command_duration_seconds", "Duração dos comandos MongoDB por collection e operação",
+    ("collection", "command"),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+mongo_command_failures = registry.counter(
+    "mongo_command_failures_total", "Comandos MongoDB que falharam", ("collection", "command")
+)
+llm_request_duration = registry.histogram(
+    "llm_request_duration_seconds", "Latência das chamadas de LLM", ("provider", "model", "status")
+)
+llm_tokens = registry.counter(
+    "llm_tokens_total", "Tokens de LLM (prompt estimado pelo context_builder, completion da resposta)",
+    ("provider", "model", "direction")
+)
+playwright_session_duration = registry.histogram(
+    "playwright_session_duration_seconds", "Duração das sessões do Playwright", ("operation", "status"),
+    buckets=(1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+)
+background_loop_tick = registry.histogram(
+    "background_loop_tick_seconds", "Duração de cada iteração dos loops de background", ("loop", "status")
+)
+websocket_messages_sent = registry.counter(
+    "websocket_messages_sent_total", "Mensagens enviadas por WebSocket", ("status",)
+)
+
+
+# ----------------------------------------------------------------------
+# HTTP
+# ----------------------------------------------------------------------
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: latência por (método, rota, status). A rota é o template do
+    FastAPI (scope["route"], preenchido no roteamento); sem rota casada vira "unmatched"
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_progress.dec()
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                method=scope.get("method", ""),
+                route=getattr(route, "path", None) or "unmatched",
+                status=status["code"]
+            )
+
+
+# ----------------------------------------------------------------------
+# MongoDB
+# ----------------------------------------------------------------------
+
+# Comandos de handshake/sessão que só poluiriam as séries
+IGNORED_COMMANDS = {"hello", "isMaster", "ismaster", "ping", "endSessions", "saslStart", "saslContinue", "buildInfo"}
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Listener de comandos do driver: duração por collection/operação"""
+
+    def __init__(self):
+        self._pending: Dict[int, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = "-"
+        with self._lock:
+            self._pending[event.request_id] = (collection, event.command_name)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            labels = self._pending.pop(event.request_id, None)
+        if labels is None:
+            return
+        collection, command = labels
+        mongo_command_duration.observe(event.duration_micros / 1_000_000, collection=collection, command=command)
+        if failed:
+            mongo_command_failures.inc(collection=collection, command=command)
+
+    def listeners(self) -> List[monitoring.CommandListener]:
+        """Para AsyncIOMotorClient(event_listeners=...); vazio com METRICS_ENABLED=false"""
+        return [self] if METRICS_ENABLED else []
+
+
+# Instância global
+mongo_listener = MongoMetricsListener()
+
+
+# ----------------------------------------------------------------------
+# LLM / Playwright / loops
+# ----------------------------------------------------------------------
+
+def record_llm_call(
+    provider: str,
+    model: str,
+    seconds: float,
+    status: str = "ok",
+    prompt_tokens: int = 0,
+    completion_tokens: int = 0
+):
+    llm_request_duration.observe(seconds, provider=provider, model=model, status=status)
+    if prompt_tokens:
+        llm_tokens.inc(prompt_tokens, provider=provider, model=model, direction="prompt")
+    if completion_tokens:
+        llm_tokens.inc(completion_tokens, provider=provider, model=model, direction="completion")
+
+
+@asynccontextmanager
+async def track_llm(provider: str, model: str, prompt_tokens: int = 0):
+    """
+    async with track_llm("openai", "gpt-4o-mini", prompt_tokens=n) as call:
+        response = await chat.send_message(...)
+        call["completion_tokens"] = ...
+    """
+    call = {"prompt_tokens": prompt_tokens, "completion_tokens": 0}
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield call
+    except asyncio.TimeoutError:
+        status = "timeout"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record_llm_call(
+            provider, model, time.perf_counter() - started, status,
+            call["prompt_tokens"], call["completion_tokens"]
+        )
+
+
+@asynccontextmanager
+async def track_playwright(operation: str):
+    """async with track_playwright("extract_credentials"): ... (status=error se levantar)"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        playwright_session_duration.observe(time.perf_counter() - started, operation=operation, status=status)
+
+
+@asynccontextmanager
+async def loop_tick(loop: str):
+    """Mede uma iteração de loop de background (sem incluir o sleep entre iterações)"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        background_loop_tick.observe(time.perf_counter() - started, loop=loop, status=status)
+
+
+def check_token(authorization: Optional[str]) -> bool:
+    """GET /metrics: aberto sem METRICS_TOKEN; com ele exige 'Bearer <token>'"""
+    if not METRICS_TOKEN:
+        return True
+    return authorization == f"Bearer {METRICS_TOKEN}"
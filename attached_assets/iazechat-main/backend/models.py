@@ -287,7 +287,8 @@ class ResellerBase(BaseModel):
     custom_domain: Optional[str] = ""  # Domínio customizado (ex: ajuda.vip)
     is_active: bool = True
     parent_id: Optional[str] = None  # ID do revendedor pai (hierarquia)
-    level: int = 1  # Nível na hierarquia (1 = raiz, 2 = filho, 3 = neto, etc)
+    ancestors: List[str] = []  # Caminho materializado até a raiz (raiz primeiro, pai por último)
+    level: int = 0  # Nível na hierarquia = len(ancestors) (0 = raiz, 1 = filho, 2 = neto, etc)
     client_logo_url: Optional[str] = ""  # Logo personalizado para o cliente ver
 
 class ResellerCreate(BaseModel):
@@ -366,6 +367,7 @@ class AIAgentUpdate(BaseModel):
     knowledge_restriction: Optional[bool] = None
     timezone: Optional[str] = None
     linked_agents: Optional[List[str]] = None
+    response_cache_enabled: Optional[bool] = None  # Cache de respostas para perguntas repetidas
 
 class AIAgentFull(BaseModel):
     id: str
@@ -395,6 +397,7 @@ class AIAgentFull(BaseModel):
     knowledge_restriction: Optional[bool] = False
     timezone: Optional[str] = "America/Sao_Paulo"
     linked_agents: Optional[List[str]] = []
+    response_cache_enabled: Optional[bool] = True
     reseller_id: Optional[str] = None
     created_at: datetime
     updated_at: Optional[datetime] = None
\ No newline at end of file
@@ -2,7 +2,7 @@
 Serviço de integração com Office (gestor.my) usando Playwright
 Faz scraping automático com navegador real
 """
-from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
+from metrics import track_playwright
 import logging
 import re
 from typing import Optional, Dict
@@ -50,7 +50,10 @@ class OfficeServicePlaywright:
         
         logger.info(f"🔍 Iniciando busca com Playwright: {search_term}")
         
-        async with async_playwright() as p:
+        # Playwright só é importado quando uma busca roda (fora do startup)
+        from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
+        
+        async with track_playwright("office_buscar_cliente"), async_playwright() as p:
             try:
                 # Lançar navegador
                 browser = await p.chromium.launch(
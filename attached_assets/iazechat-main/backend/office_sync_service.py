@@ -3,10 +3,11 @@ Serviço de Sincronização Office - Download de TODOS os clientes
 Mantém banco de dados local atualizado automaticamente
 """
 import asyncio
-from playwright.async_api import async_playwright
+from metrics import track_playwright
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from datetime import datetime, timezone
 from typing import List, Dict, Optional
+from reminder_service import parse_vencimento
 import logging
 import os
 
@@ -39,7 +40,10 @@ class OfficeSyncService:
         
         results_by_account = {}
         
-        async with async_playwright() as p:
+        # Playwright só é importado quando a sincronização roda (fora do startup)
+        from playwright.async_api import async_playwright
+        
+        async with track_playwright("office_sync"), async_playwright() as p:
             browser = await p.chromium.launch(headless=True)
             
             for account in self.accounts:
@@ -242,6 +246,8 @@ class OfficeSyncService:
                         "status": cell_data[7] if len(cell_data) > 7 else "",
                         "extracted_at": datetime.now(timezone.utc).isoformat()
                     }
+                    # Data BSON para consultas por vencimento (lembretes)
+                    client["vencimento_at"] = parse_vencimento(client["vencimento"])
                     
                     # Normalizar telefone
                     if client["telefone"]:
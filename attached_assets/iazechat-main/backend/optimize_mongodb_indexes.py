@@ -50,6 +50,7 @@ async def create_indexes():
     created += await create_index_safe(db.messages, [("from_id", 1)])
     created += await create_index_safe(db.messages, [("to_id", 1)])
     created += await create_index_safe(db.messages, [("ticket_id", 1), ("timestamp", -1)])
+    created += await create_index_safe(db.messages, [("ticket_id", 1), ("created_at", -1), ("id", -1)])
     print(f"✅ {created} novos índices criados")
     
     # 3. USERS - Login e busca por revenda
@@ -77,6 +78,7 @@ async def create_indexes():
     created += await create_index_safe(db.resellers, [("email", 1)], unique=True)
     created += await create_index_safe(db.resellers, [("custom_domain", 1)])
     created += await create_index_safe(db.resellers, [("parent_id", 1)])
+    created += await create_index_safe(db.resellers, [("ancestors", 1)])
     print(f"✅ {created} novos índices criados")
     
     # 6. WHATSAPP INSTANCES - Busca rápida
@@ -105,6 +107,17 @@ async def create_indexes():
     created += await create_index_safe(db.vendas_simple_config, [("is_active", 1)])
     print(f"✅ {created} novos índices criados")
     
+    # 8.1 MEMÓRIA DA IA (buckets por sessão)
+    print("\n🧠 Memória da IA...")
+    created = 0
+    created += await create_index_safe(db.ai_conversation_memory, [("session_id", 1), ("_id", -1)])
+    created += await create_index_safe(db.ai_conversation_memory, [("session_id", 1), ("count", 1)])
+    created += await create_index_safe(db.ai_conversation_memory, [("department_id", 1)])
+    created += await create_index_safe(db.ai_conversation_memory, [("expire_at", 1)], expireAfterSeconds=0)
+    created += await create_index_safe(db.ai_conversation_sessions, [("session_id", 1)], unique=True)
+    created += await create_index_safe(db.ai_conversation_sessions, [("expire_at", 1)], expireAfterSeconds=0)
+    print(f"✅ {created} novos índices criados")
+    
     # 9. SUBSCRIPTIONS - Pagamentos
     print("\n💳 Subscriptions...")
     created = 0
@@ -0,0 +1,144 @@
+"""
+🔐 Hash de senhas/PINs fora do event loop
+
+bcrypt.checkpw/hashpw levam ~100-300ms de CPU. Chamados direto em handlers async
+travam o servidor inteiro (WebSockets, webhooks) durante um pico de logins.
+
+- Execução em ThreadPoolExecutor limitado (AUTH_HASH_WORKERS). O bcrypt libera
+  o GIL durante o cálculo, então as threads rodam em paralelo de verdade; um
+  semáforo limita quantas verificações ficam na fila do pool.
+- Rehash no login: hashes com custo diferente de BCRYPT_ROUNDS são regerados com
+  a senha que acabou de ser validada (verify_and_update).
+- Cache de verificação de PIN: PINs de 2 dígitos são checados a cada login do
+  cliente. Verificações bem-sucedidas ficam em memória por PIN_CACHE_TTL
+  segundos, indexadas por HMAC (segredo aleatório do processo) de hash + PIN -
+  nada reversível fica guardado e trocar o PIN invalida a entrada.
+"""
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+MAX_PENDING = int(os.environ.get("AUTH_HASH_MAX_PENDING", "64"))
+PIN_CACHE_TTL = int(os.environ.get("PIN_CACHE_TTL", "600"))
+PIN_CACHE_SIZE = int(os.environ.get("PIN_CACHE_SIZE", "10000"))
+
+
+def hash_rounds(hashed: str) -> Optional[int]:
+    """Custo de um hash bcrypt ($2b$12$...) ou None se não for bcrypt"""
+    parts = hashed.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+class PasswordHasher:
+    """bcrypt em pool de threads limitado + cache de PIN"""
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, workers: int = HASH_WORKERS):
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bcrypt")
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._secret = secrets.token_bytes(32)
+        self._pin_cache: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = {"verify": 0, "hash": 0, "rehash": 0, "pin_cache_hits": 0}
+
+    @property
+    def pending(self) -> asyncio.Semaphore:
+        # Criado sob demanda para ficar no event loop do servidor
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(MAX_PENDING)
+        return self._pending
+
+    async def _run(self, fn, *args):
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # ------------------------------------------------------------------
+    # bcrypt
+    # ------------------------------------------------------------------
+
+    def _hash_sync(self, plain: str) -> str:
+        return bcrypt.hashpw(plain.encode("utf-8"), bcrypt.gensalt(self.rounds)).decode("utf-8")
+
+    @staticmethod
+    def _verify_sync(plain: str, hashed: str) -> bool:
+        try:
+            return bcrypt.checkpw(plain.encode("utf-8"), hashed.encode("utf-8"))
+        except ValueError:
+            # Hash corrompido/formato desconhecido
+            return False
+
+    async def hash(self, plain: str) -> str:
+        self.stats["hash"] += 1
+        return await self._run(self._hash_sync, plain)
+
+    async def verify(self, plain: str, hashed: str) -> bool:
+        if not plain or not hashed:
+            return False
+        self.stats["verify"] += 1
+        return await self._run(self._verify_sync, plain, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return hash_rounds(hashed) != self.rounds
+
+    async def verify_and_update(self, plain: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """
+        (valid, new_hash) - new_hash vem preenchido quando a senha confere mas o
+        hash usa outro custo; quem chamou grava o novo hash no documento
+        """
+        if not await self.verify(plain, hashed):
+            return False, None
+        if self.needs_rehash(hashed):
+            self.stats["rehash"] += 1
+            return True, await self.hash(plain)
+        return True, None
+
+    # ------------------------------------------------------------------
+    # PIN
+    # ------------------------------------------------------------------
+
+    def _pin_key(self, pin: str, pin_hash: str) -> str:
+        return hmac.new(self._secret, f"{pin_hash}\x00{pin}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    async def verify_pin(self, pin: str, pin_hash: str) -> bool:
+        """verify com cache das verificações bem-sucedidas"""
+        key = self._pin_key(pin, pin_hash)
+        now = time.monotonic()
+        expires = self._pin_cache.get(key)
+        if expires is not None:
+            if expires > now:
+                self._pin_cache.move_to_end(key)
+                self.stats["pin_cache_hits"] += 1
+                return True
+            self._pin_cache.pop(key, None)
+
+        if not await self.verify(pin, pin_hash):
+            return False
+
+        self._pin_cache[key] = now + PIN_CACHE_TTL
+        while len(self._pin_cache) > PIN_CACHE_SIZE:
+            self._pin_cache.popitem(last=False)
+        return True
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pin_cache_size": len(self._pin_cache), "rounds": self.rounds}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+# Instância global
+password_hasher = PasswordHasher()
@@ -0,0 +1,272 @@
+"""
+Presença de atendentes baseada no estado real dos WebSockets
+
+- ConnectionManager.connect/disconnect atualizam o conjunto de agentes online
+  por revenda (em memória) e o documento do worker em "presence".
+- Pings do keepalive (/ws) atualizam o last_seen do agente em memória.
+- Replicação entre workers: cada worker grava seus usuários conectados em
+  "presence" (um doc por worker+usuário, com TTL) e a cada SYNC_SECONDS lê o
+  estado de todos os workers. "Quem está online na revenda X" vem da memória.
+- Diferenças (entrou/saiu) são enviadas por WebSocket para admins/revendas
+  conectados, então os painéis não precisam fazer polling.
+"""
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set
+
+from pymongo import DeleteOne, UpdateOne
+
+from metrics import loop_tick
+
+logger = logging.getLogger(__name__)
+
+SYNC_SECONDS = float(os.environ.get("PRESENCE_SYNC_SECONDS", "5"))
+# Documento de worker sem atualização por mais que isso = worker morto
+STALE_SECONDS = float(os.environ.get("PRESENCE_STALE_SECONDS", "60"))
+
+# Tipos de usuário que recebem as diferenças de presença
+SUBSCRIBER_TYPES = ("admin", "reseller")
+MASTER_SCOPE = "*"
+
+
+class PresenceService:
+    """Agentes online por revenda, replicado entre workers via collection presence"""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = None
+        self.manager = None
+        # Usuários conectados NESTE worker: user_id -> {user_type, reseller_id, name, connected_at, last_seen}
+        self.local: Dict[str, Dict] = {}
+        # Visão global (todos os workers): reseller_id -> {agent_id: last_seen}
+        self.online: Dict[str, Dict[str, datetime]] = {}
+        # Inscritos locais em diferenças: user_id -> escopo (reseller_id ou MASTER_SCOPE)
+        self.subscribers: Dict[str, str] = {}
+        self._dirty: Set[str] = set()
+        self._removed: Set[str] = set()
+
+    def attach(self, db, manager):
+        self.db = db
+        self.manager = manager
+
+    # ------------------------------------------------------------------
+    # Eventos do ConnectionManager
+    # ------------------------------------------------------------------
+
+    async def _lookup(self, user_id: str) -> Optional[Dict]:
+        user = await self.db.users.find_one(
+            {"id": user_id},
+            {"_id": 0, "user_type": 1, "reseller_id": 1, "name": 1}
+        )
+        if user:
+            return user
+        reseller = await self.db.resellers.find_one({"id": user_id}, {"_id": 0, "id": 1, "name": 1})
+        if reseller:
+            return {"user_type": "reseller", "reseller_id": reseller["id"], "name": reseller.get("name")}
+        return None
+
+    async def on_connect(self, user_id: str):
+        """Chamado quando o usuário abre um WebSocket neste worker"""
+        if self.db is None:
+            return
+        try:
+            identity = await self._lookup(user_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Presença: erro ao identificar {user_id}: {e}")
+            return
+        if not identity:
+            return
+
+        user_type = identity.get("user_type")
+        reseller_id = identity.get("reseller_id") or ""
+        now = datetime.now(timezone.utc)
+
+        if user_type in SUBSCRIBER_TYPES:
+            scope = MASTER_SCOPE if user_type == "admin" and not reseller_id else reseller_id
+            self.subscribers[user_id] = scope
+            await self._send_snapshot(user_id, scope)
+            return
+
+        if user_type != "agent":
+            return
+
+        self.local[user_id] = {
+            "user_type": user_type,
+            "reseller_id": reseller_id,
+            "name": identity.get("name"),
+            "connected_at": now,
+            "last_seen": now
+        }
+        self._removed.discard(user_id)
+        self._dirty.add(user_id)
+        await self._apply_local_change(reseller_id, joined=[user_id], left=[])
+        await self.flush()
+
+    async def on_disconnect(self, user_id: str):
+        """Chamado quando a ÚLTIMA conexão do usuário neste worker fecha"""
+        self.subscribers.pop(user_id, None)
+        info = self.local.pop(user_id, None)
+        if not info:
+            return
+        self._dirty.discard(user_id)
+        self._removed.add(user_id)
+        await self._apply_local_change(info["reseller_id"], joined=[], left=[user_id])
+        await self.flush()
+
+    def heartbeat(self, user_id: str):
+        """Ping do keepalive - só memória, gravado no próximo flush"""
+        info = self.local.get(user_id)
+        if info:
+            info["last_seen"] = datetime.now(timezone.utc)
+            self._dirty.add(user_id)
+
+    # ------------------------------------------------------------------
+    # Consultas (memória)
+    # ------------------------------------------------------------------
+
+    def online_agents(self, reseller_id: Optional[str] = None) -> Dict[str, datetime]:
+        """agent_id -> last_seen dos agentes online (reseller_id=None = todas as revendas)"""
+        if reseller_id is None:
+            merged: Dict[str, datetime] = {}
+            for agents in self.online.values():
+                merged.update(agents)
+            return merged
+        return dict(self.online.get(reseller_id, {}))
+
+    def is_online(self, agent_id: str, reseller_id: Optional[str] = None) -> bool:
+        return agent_id in self.online_agents(reseller_id)
+
+    # ------------------------------------------------------------------
+    # Replicação
+    # ------------------------------------------------------------------
+
+    async def flush(self):
+        """Grava no Mongo os usuários locais alterados (uma bulk_write)"""
+        if self.db is None or not (self._dirty or self._removed):
+            return
+        now = datetime.now(timezone.utc)
+        operations = []
+        for user_id in list(self._dirty):
+            info = self.local.get(user_id)
+            if not info:
+                continue
+            operations.append(UpdateOne(
+                {"_id": f"{self.worker_id}|{user_id}"},
+                {"$set": {
+                    "user_id": user_id,
+                    "reseller_id": info["reseller_id"],
+                    "worker_id": self.worker_id,
+                    "last_seen": info["last_seen"],
+                    "heartbeat_at": now,
+                    "expire_at": now + timedelta(seconds=STALE_SECONDS)
+                }},
+                upsert=True
+            ))
+        for user_id in list(self._removed):
+            operations.append(DeleteOne({"_id": f"{self.worker_id}|{user_id}"}))
+        self._dirty.clear()
+        self._removed.clear()
+        if operations:
+            try:
+                await self.db.presence.bulk_write(operations, ordered=False)
+            except Exception as e:
+                logger.warning(f"⚠️ Presença: erro ao gravar estado do worker: {e}")
+
+    async def sync(self):
+        """Renova os docs deste worker e recarrega a visão global"""
+        # Renovar todos os locais (mantém heartbeat_at/expire_at vivos)
+        self._dirty.update(self.local.keys())
+        await self.flush()
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=STALE_SECONDS)
+        docs = await self.db.presence.find(
+            {"heartbeat_at": {"$gte": cutoff}},
+            {"_id": 0, "user_id": 1, "reseller_id": 1, "last_seen": 1}
+        ).to_list(length=None)
+
+        online: Dict[str, Dict[str, datetime]] = {}
+        for doc in docs:
+            agents = online.setdefault(doc.get("reseller_id") or "", {})
+            last_seen = doc.get("last_seen")
+            if last_seen and last_seen.tzinfo is None:
+                last_seen = last_seen.replace(tzinfo=timezone.utc)
+            if doc["user_id"] not in agents or (last_seen and last_seen > agents[doc["user_id"]]):
+                agents[doc["user_id"]] = last_seen
+
+        previous = self.online
+        self.online = online
+        for reseller_id in set(previous) | set(online):
+            before = set(previous.get(reseller_id, {}))
+            after = set(online.get(reseller_id, {}))
+            if before != after:
+                await self._push_diff(reseller_id, sorted(after - before), sorted(before - after))
+
+    async def _apply_local_change(self, reseller_id: str, joined: List[str], left: List[str]):
+        agents = self.online.setdefault(reseller_id, {})
+        really_joined = [a for a in joined if a not in agents]
+        for agent_id in joined:
+            agents[agent_id] = self.local[agent_id]["last_seen"]
+        really_left = []
+        for agent_id in left:
+            # Pode continuar online por outro worker - o sync confirma
+            if agent_id in agents:
+                agents.pop(agent_id, None)
+                really_left.append(agent_id)
+        if really_joined or really_left:
+            await self._push_diff(reseller_id, really_joined, really_left)
+
+    async def _push_diff(self, reseller_id: str, joined: List[str], left: List[str]):
+        if self.manager is None or not (joined or left):
+            return
+        payload = {
+            "type": "presence_diff",
+            "reseller_id": reseller_id or None,
+            "online": joined,
+            "offline": left,
+            "online_count": len(self.online.get(reseller_id, {}))
+        }
+        for user_id, scope in list(self.subscribers.items()):
+            if scope == MASTER_SCOPE or scope == reseller_id:
+                await self.manager.send_to_user(user_id, payload)
+
+    async def _send_snapshot(self, user_id: str, scope: str):
+        if self.manager is None:
+            return
+        agents = self.online_agents(None if scope == MASTER_SCOPE else scope)
+        await self.manager.send_to_user(user_id, {
+            "type": "presence_snapshot",
+            "reseller_id": None if scope == MASTER_SCOPE else scope or None,
+            "online": sorted(agents),
+            "online_count": len(agents)
+        })
+
+    async def run(self):
+        """Loop de sincronização (iniciado no startup do servidor)"""
+        try:
+            await self.db.presence.create_index([("expire_at", 1)], expireAfterSeconds=0)
+            await self.db.presence.create_index([("heartbeat_at", 1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Presença: erro ao criar índices: {e}")
+        while True:
+            try:
+                async with loop_tick("presence_sync"):
+                    await self.sync()
+            except Exception as e:
+                logger.error(f"❌ Presença: erro na sincronização: {e}")
+            await asyncio.sleep(SYNC_SECONDS)
+
+    async def shutdown(self):
+        """Remove os docs deste worker para os outros verem a saída imediatamente"""
+        if self.db is None:
+            return
+        try:
+            await self.db.presence.delete_many({"worker_id": self.worker_id})
+        except Exception as e:
+            logger.warning(f"⚠️ Presença: erro ao limpar worker: {e}")
+
+
+# Instância global
+presence_service = PresenceService()
@@ -0,0 +1,165 @@
+"""
+Principal autenticado com cache (token JWT -> claims + documento do usuário)
+
+Antes cada requisição decodificava o JWT e vários handlers buscavam de novo o
+documento do usuário (users.find_one) só para saber departamentos, revenda e
+status. Aqui:
+
+- Claims verificadas ficam em cache por hash SHA-256 do token (CLAIMS_TTL, nunca
+  além do exp). No miss o token é conferido na lista de revogação (revoked_tokens,
+  TTL até o exp do token).
+- Documento do usuário (sem hashes de senha/PIN) em cache por USER_TTL segundos;
+  admin/agent/client em users, reseller em resellers. Requisições concorrentes do
+  mesmo usuário compartilham uma única leitura (SingleFlightCache).
+- Revogação por usuário: tokens_valid_after (epoch) no documento; tokens com iat
+  anterior são recusados. Usado quando o admin troca a senha do atendente.
+- invalidate_user() após update/delete de agente e troca de senha/PIN. O cache é
+  por worker: em outros workers a mudança vale em até USER_TTL segundos.
+
+get_current_user devolve as claims de sempre (user_id, user_type, reseller_id) e
+mais "user" com o documento já carregado.
+"""
+import os
+import time
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import jwt
+from fastapi import HTTPException
+
+from single_flight_cache import SingleFlightCache
+
+logger = logging.getLogger(__name__)
+
+CLAIMS_TTL = float(os.environ.get("AUTH_CLAIMS_CACHE_TTL", "300"))
+USER_TTL = float(os.environ.get("AUTH_USER_CACHE_TTL", "30"))
+CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "20000"))
+
+USER_PROJECTION = {"_id": 0, "pass_hash": 0, "pin_hash": 0, "password": 0}
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class PrincipalCache:
+    """Resolve token -> principal com cache de claims e de documento"""
+
+    def __init__(self):
+        self.db = None
+        self.secret = None
+        self.claims = SingleFlightCache(ttl=CLAIMS_TTL, max_entries=CACHE_SIZE)
+        self.users = SingleFlightCache(ttl=USER_TTL, max_entries=CACHE_SIZE)
+
+    def attach(self, db, secret: str):
+        self.db = db
+        self.secret = secret
+
+    async def ensure_indexes(self):
+        try:
+            await self.db.revoked_tokens.create_index([("token_hash", 1)], unique=True)
+            await self.db.revoked_tokens.create_index([("expire_at", 1)], expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de revoked_tokens: {e}")
+
+    # ------------------------------------------------------------------
+    # Claims
+    # ------------------------------------------------------------------
+
+    def _decode(self, token: str) -> Dict:
+        try:
+            return jwt.decode(token, self.secret, algorithms=["HS256"])
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token expirado")
+        except jwt.InvalidTokenError as e:
+            logger.error(f"Token inválido: {str(e)}")
+            raise HTTPException(status_code=401, detail="Token inválido")
+
+    async def get_claims(self, token: str) -> Dict:
+        key = token_hash(token)
+
+        async def load():
+            payload = self._decode(token)
+            if await self.db.revoked_tokens.find_one({"token_hash": key}, {"_id": 1}):
+                raise HTTPException(status_code=401, detail="Sessão encerrada")
+            return payload
+
+        payload = await self.claims.get_or_compute(key, load)
+        if payload.get("exp") and payload["exp"] <= time.time():
+            self.claims.invalidate(key)
+            raise HTTPException(status_code=401, detail="Token expirado")
+        return payload
+
+    # ------------------------------------------------------------------
+    # Documento do usuário
+    # ------------------------------------------------------------------
+
+    async def get_user(self, user_id: str, user_type: Optional[str]) -> Optional[Dict]:
+        async def load():
+            if user_type == "reseller":
+                return await self.db.resellers.find_one({"id": user_id}, USER_PROJECTION)
+            return await self.db.users.find_one({"id": user_id}, USER_PROJECTION)
+
+        # Não guarda "não encontrado": usuário recém-criado em outro worker
+        user = await self.users.get_or_compute(user_id, load)
+        if user is None:
+            self.users.invalidate(user_id)
+        return user
+
+    def invalidate_user(self, user_id: str):
+        self.users.invalidate(user_id)
+
+    # ------------------------------------------------------------------
+    # Principal
+    # ------------------------------------------------------------------
+
+    async def resolve(self, token: str) -> Dict:
+        payload = await self.get_claims(token)
+        user_id = payload.get("user_id")
+        if not user_id:
+            raise HTTPException(status_code=401, detail="Token inválido")
+
+        user = await self.get_user(user_id, payload.get("user_type"))
+        if not user:
+            raise HTTPException(status_code=401, detail="Usuário não encontrado")
+        if user.get("user_type") and payload.get("user_type") and user["user_type"] != payload["user_type"]:
+            raise HTTPException(status_code=401, detail="Tipo de usuário inválido")
+        if payload.get("iat", 0) < user.get("tokens_valid_after", 0):
+            raise HTTPException(status_code=401, detail="Sessão encerrada")
+        if user.get("is_active", True) is False:
+            raise HTTPException(status_code=401, detail="Conta desativada")
+
+        # Cópia rasa: handler que altera o documento não mexe no cache
+        return {**payload, "user": dict(user)}
+
+    # ------------------------------------------------------------------
+    # Revogação
+    # ------------------------------------------------------------------
+
+    async def revoke_user(self, user_id: str, user_type: Optional[str] = None):
+        """Recusa todos os tokens emitidos até agora para o usuário"""
+        collection = self.db.resellers if user_type == "reseller" else self.db.users
+        # iat é inteiro (segundos): tokens emitidos no mesmo segundo continuam válidos
+        await collection.update_one({"id": user_id}, {"$set": {"tokens_valid_after": int(time.time())}})
+        self.invalidate_user(user_id)
+
+    async def revoke_token(self, token: str):
+        """Coloca um token na lista de revogação (logout)"""
+        key = token_hash(token)
+        payload = self._decode(token)
+        expire_at = datetime.fromtimestamp(payload.get("exp", time.time()), tz=timezone.utc)
+        await self.db.revoked_tokens.update_one(
+            {"token_hash": key},
+            {"$set": {"token_hash": key, "user_id": payload.get("user_id"), "expire_at": expire_at}},
+            upsert=True
+        )
+        self.claims.invalidate(key)
+
+    def get_stats(self) -> Dict:
+        return {"claims": self.claims.get_stats(), "users": self.users.get_stats()}
+
+
+# Instância global
+principal_cache = PrincipalCache()
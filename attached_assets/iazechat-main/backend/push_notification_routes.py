@@ -2,8 +2,7 @@
 Rotas para Push Notifications
 """
 from fastapi import APIRouter, Depends, HTTPException, Request
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
+from database import get_db
 from datetime import datetime, timezone
 import logging
 
@@ -19,11 +18,8 @@ logger = logging.getLogger(__name__)
 # Router
 push_router = APIRouter(prefix="/push", tags=["push-notifications"])
 
-# MongoDB
-MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
-DB_NAME = os.environ.get("DB_NAME", "support_chat")
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
+# MongoDB (conexão compartilhada - database.py)
+db = get_db()
 
 
 @push_router.get("/vapid-public-key")
@@ -32,6 +28,12 @@ async def get_vapid_public_key():
     return {"publicKey": push_service.get_public_key()}
 
 
+@push_router.get("/stats")
+async def get_push_stats():
+    """Métricas de entrega (contadores e latência por envio)"""
+    return push_service.get_stats()
+
+
 @push_router.post("/subscribe")
 async def subscribe_push(subscription: PushSubscription):
     """Registra uma nova subscription de push para um cliente"""
@@ -97,7 +99,7 @@ async def send_notification_to_client(data: SendNotificationToClient):
         subscriptions = await db.push_subscriptions.find({
             "client_id": data.client_id,
             "is_active": True
-        }).to_list(length=None)
+        }, {"_id": 0, "id": 1, "subscription_data": 1}).to_list(length=None)
         
         if not subscriptions:
             logger.warning(f"⚠️ Nenhuma subscription ativa para cliente {data.client_id}")
@@ -116,38 +118,15 @@ async def send_notification_to_client(data: SendNotificationToClient):
             "timestamp": datetime.now(timezone.utc).timestamp() * 1000
         }
         
-        # Enviar para todas as subscriptions do cliente
-        sent_count = 0
-        failed_subscriptions = []
-        
-        for sub in subscriptions:
-            success = await push_service.send_notification(
-                subscription_info=sub["subscription_data"],
-                notification_data=notification_payload
-            )
-            
-            if success:
-                sent_count += 1
-                # Atualizar last_used
-                await db.push_subscriptions.update_one(
-                    {"id": sub["id"]},
-                    {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
-                )
-            else:
-                failed_subscriptions.append(sub["id"])
-        
-        # Desativar subscriptions que falharam
-        if failed_subscriptions:
-            await db.push_subscriptions.update_many(
-                {"id": {"$in": failed_subscriptions}},
-                {"$set": {"is_active": False}}
-            )
+        # Enviar para todos os devices do cliente em paralelo (mortos são removidos)
+        result = await push_service.send_to_subscriptions(db, subscriptions, notification_payload)
         
-        logger.info(f"✅ Notificação enviada para {sent_count}/{len(subscriptions)} devices do cliente {data.client_id}")
+        logger.info(f"✅ Notificação enviada para {result['sent']}/{len(subscriptions)} devices do cliente {data.client_id}")
         return {
             "message": "Notificação enviada",
-            "sent": sent_count,
-            "failed": len(failed_subscriptions)
+            "sent": result["sent"],
+            "failed": result["failed"],
+            "removed": result["removed"]
         }
         
     except Exception as e:
@@ -163,7 +142,7 @@ async def broadcast_notification(reseller_id: str, notification: PushNotificatio
         subscriptions = await db.push_subscriptions.find({
             "reseller_id": reseller_id,
             "is_active": True
-        }).to_list(length=None)
+        }, {"_id": 0, "id": 1, "subscription_data": 1}).to_list(length=None)
         
         if not subscriptions:
             logger.warning(f"⚠️ Nenhuma subscription ativa para revenda {reseller_id}")
@@ -182,33 +161,15 @@ async def broadcast_notification(reseller_id: str, notification: PushNotificatio
             "timestamp": datetime.now(timezone.utc).timestamp() * 1000
         }
         
-        # Enviar para todas as subscriptions
-        sent_count = 0
-        failed_subscriptions = []
-        
-        for sub in subscriptions:
-            success = await push_service.send_notification(
-                subscription_info=sub["subscription_data"],
-                notification_data=notification_payload
-            )
-            
-            if success:
-                sent_count += 1
-            else:
-                failed_subscriptions.append(sub["id"])
-        
-        # Desativar subscriptions que falharam
-        if failed_subscriptions:
-            await db.push_subscriptions.update_many(
-                {"id": {"$in": failed_subscriptions}},
-                {"$set": {"is_active": False}}
-            )
+        # Enviar para todas as subscriptions em paralelo (concorrência limitada no serviço)
+        result = await push_service.send_to_subscriptions(db, subscriptions, notification_payload)
         
-        logger.info(f"✅ Broadcast enviado para {sent_count}/{len(subscriptions)} devices da revenda {reseller_id}")
+        logger.info(f"✅ Broadcast enviado para {result['sent']}/{len(subscriptions)} devices da revenda {reseller_id}")
         return {
             "message": "Broadcast enviado",
-            "sent": sent_count,
-            "failed": len(failed_subscriptions),
+            "sent": result["sent"],
+            "failed": result["failed"],
+            "removed": result["removed"],
             "total": len(subscriptions)
         }
         
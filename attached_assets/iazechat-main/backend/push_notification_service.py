@@ -1,10 +1,31 @@
 """
 Serviço de Push Notifications usando Web Push Protocol
+
+Entrega sem travar o event loop:
+- pywebpush é síncrono (criptografia + HTTP): cada envio roda em um
+  ThreadPoolExecutor (PUSH_WORKERS) com uma requests.Session compartilhada
+  (keep-alive por serviço de push). Um semáforo limita os envios simultâneos.
+- Assinatura VAPID em cache por audience (origem do endpoint: FCM, Mozilla,
+  Apple...): o JWT vale VAPID_EXP_SECONDS e é reaproveitado até faltar
+  VAPID_REFRESH_MARGIN para expirar. A chave privada é carregada uma vez só.
+- Todos os devices do cliente recebem em paralelo (send_to_subscriptions).
+- Subscriptions mortas (404/410) são removidas do banco automaticamente; last_used
+  dos envios bem-sucedidos é atualizado com um único update_many.
+- Métricas de latência (p50/p95/máx) e contadores em get_stats().
 """
-from pywebpush import webpush, WebPushException
+from pywebpush import WebPusher, WebPushException
+from py_vapid import Vapid
 import json
+import time
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Tuple
+from urllib.parse import urlparse
 import os
 
 logger = logging.getLogger(__name__)
@@ -15,15 +36,115 @@ VAPID_PRIVATE_KEY = os.environ.get("VAPID_PRIVATE_KEY", "")
 VAPID_CLAIMS = {
     "sub": "mailto:suporte@iaze.com.br"
 }
+VAPID_EXP_SECONDS = 12 * 60 * 60  # Máximo permitido pelos serviços de push: 24h
+VAPID_REFRESH_MARGIN = 60 * 60
+
+PUSH_WORKERS = int(os.environ.get("PUSH_WORKERS", "8"))
+PUSH_CONCURRENCY = int(os.environ.get("PUSH_CONCURRENCY", "32"))
+PUSH_TIMEOUT = float(os.environ.get("PUSH_TIMEOUT", "10"))
+PUSH_TTL = int(os.environ.get("PUSH_TTL", "0"))
+LATENCY_SAMPLES = 1000
+
+# Status que indicam subscription que não existe mais no serviço de push
+DEAD_SUBSCRIPTION_STATUS = {404, 410}
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
 
 class PushNotificationService:
     """Serviço para envio de push notifications"""
-    
+
     def __init__(self):
         self.vapid_public_key = VAPID_PUBLIC_KEY
         self.vapid_private_key = VAPID_PRIVATE_KEY
         self.vapid_claims = VAPID_CLAIMS
-    
+        self.executor = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="webpush")
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=PUSH_WORKERS))
+        self._vapid: Optional[Vapid] = None
+        self._vapid_headers: Dict[str, Tuple[Dict[str, str], float]] = {}  # audience -> (headers, renovar_em)
+        self._concurrency: Optional[asyncio.Semaphore] = None
+        self.latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = {"sent": 0, "failed": 0, "removed": 0, "vapid_signatures": 0}
+
+    @property
+    def concurrency(self) -> asyncio.Semaphore:
+        # Criado sob demanda para ficar no event loop do servidor
+        if self._concurrency is None:
+            self._concurrency = asyncio.Semaphore(PUSH_CONCURRENCY)
+        return self._concurrency
+
+    # ------------------------------------------------------------------
+    # VAPID
+    # ------------------------------------------------------------------
+
+    def _vapid_headers_for(self, endpoint: str) -> Dict[str, str]:
+        """Cabeçalho Authorization VAPID da origem do endpoint (em cache)"""
+        url = urlparse(endpoint)
+        audience = f"{url.scheme}://{url.netloc}"
+        now = time.time()
+
+        cached = self._vapid_headers.get(audience)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        if self._vapid is None:
+            self._vapid = Vapid.from_string(private_key=self.vapid_private_key)
+
+        exp = int(now) + VAPID_EXP_SECONDS
+        headers = self._vapid.sign({**self.vapid_claims, "aud": audience, "exp": exp})
+        self._vapid_headers[audience] = (headers, exp - VAPID_REFRESH_MARGIN)
+        self.stats["vapid_signatures"] += 1
+        return headers
+
+    # ------------------------------------------------------------------
+    # Envio
+    # ------------------------------------------------------------------
+
+    def _send_sync(self, subscription_info: Dict[str, Any], payload: str) -> int:
+        """Roda no pool de threads; retorna o status HTTP do serviço de push"""
+        headers = dict(self._vapid_headers_for(subscription_info["endpoint"]))
+        response = WebPusher(subscription_info, requests_session=self.session).send(
+            data=payload,
+            headers=headers,
+            ttl=PUSH_TTL,
+            content_encoding="aes128gcm",
+            timeout=PUSH_TIMEOUT
+        )
+        if response.status_code > 202:
+            raise WebPushException(
+                f"Push failed: {response.status_code} {response.reason}", response=response
+            )
+        return response.status_code
+
+    async def _deliver(self, subscription_info: Dict[str, Any], payload: str) -> str:
+        """'sent', 'dead' (404/410) ou 'failed'"""
+        start = time.perf_counter()
+        try:
+            async with self.concurrency:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._send_sync, subscription_info, payload
+                )
+            self.stats["sent"] += 1
+            return "sent"
+        except WebPushException as e:
+            status = e.response.status_code if e.response is not None else None
+            if status in DEAD_SUBSCRIPTION_STATUS:
+                logger.warning(f"⚠️ Subscription expirou ({status}) - será removida")
+                return "dead"
+            logger.error(f"❌ Erro ao enviar push notification: {e}")
+        except Exception as e:
+            logger.error(f"❌ Erro inesperado ao enviar push: {e}")
+        finally:
+            self.latencies.append((time.perf_counter() - start) * 1000)
+        self.stats["failed"] += 1
+        return "failed"
+
     async def send_notification(
         self,
         subscription_info: Dict[str, Any],
@@ -31,45 +152,76 @@ class PushNotificationService:
     ) -> bool:
         """
         Envia uma push notification para uma subscription
-        
+
         Args:
             subscription_info: Dados da subscription (endpoint, keys)
             notification_data: Dados da notificação (title, body, etc)
-        
+
         Returns:
             bool: True se enviado com sucesso, False caso contrário
         """
-        try:
-            # Preparar payload
-            payload = json.dumps(notification_data)
-            
-            logger.info(f"📲 Enviando push notification para {subscription_info.get('endpoint', 'N/A')[:50]}...")
-            
-            # Enviar via Web Push
-            response = webpush(
-                subscription_info=subscription_info,
-                data=payload,
-                vapid_private_key=self.vapid_private_key,
-                vapid_claims=self.vapid_claims
+        return await self._deliver(subscription_info, json.dumps(notification_data)) == "sent"
+
+    async def send_to_subscriptions(
+        self,
+        db,
+        subscriptions: List[Dict[str, Any]],
+        notification_data: Dict[str, Any]
+    ) -> Dict[str, int]:
+        """
+        Envia para várias subscriptions em paralelo e faz a manutenção no banco:
+        remove as mortas e atualiza last_used das entregues
+        """
+        if not subscriptions:
+            return {"sent": 0, "failed": 0, "removed": 0}
+
+        payload = json.dumps(notification_data)
+        outcomes = await asyncio.gather(
+            *(self._deliver(sub["subscription_data"], payload) for sub in subscriptions)
+        )
+
+        sent_ids = [sub["id"] for sub, outcome in zip(subscriptions, outcomes) if outcome == "sent"]
+        dead_ids = [sub["id"] for sub, outcome in zip(subscriptions, outcomes) if outcome == "dead"]
+
+        if sent_ids:
+            await db.push_subscriptions.update_many(
+                {"id": {"$in": sent_ids}},
+                {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
             )
-            
-            logger.info(f"✅ Push notification enviada com sucesso! Status: {response.status_code}")
-            return True
-            
-        except WebPushException as e:
-            logger.error(f"❌ Erro ao enviar push notification: {e}")
-            
-            # Se a subscription expirou (410 Gone), marcar como inativa
-            if e.response and e.response.status_code == 410:
-                logger.warning("⚠️ Subscription expirou (410 Gone)")
-                return False
-            
-            return False
-            
-        except Exception as e:
-            logger.error(f"❌ Erro inesperado ao enviar push: {e}")
-            return False
-    
+        if dead_ids:
+            await db.push_subscriptions.delete_many({"id": {"$in": dead_ids}})
+            self.stats["removed"] += len(dead_ids)
+            logger.info(f"🧹 {len(dead_ids)} subscriptions expiradas removidas")
+
+        return {
+            "sent": len(sent_ids),
+            "failed": len(subscriptions) - len(sent_ids) - len(dead_ids),
+            "removed": len(dead_ids)
+        }
+
+    async def send_to_client(self, db, client_id: str, notification_data: Dict[str, Any]) -> Dict[str, int]:
+        """Envia para todos os devices ativos do cliente"""
+        subscriptions = await db.push_subscriptions.find(
+            {"client_id": client_id, "is_active": True},
+            {"_id": 0, "id": 1, "subscription_data": 1}
+        ).to_list(length=None)
+        result = await self.send_to_subscriptions(db, subscriptions, notification_data)
+        result["total"] = len(subscriptions)
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        samples = list(self.latencies)
+        return {
+            **self.stats,
+            "latency_ms": {
+                "p50": round(_percentile(samples, 0.50), 1),
+                "p95": round(_percentile(samples, 0.95), 1),
+                "max": round(max(samples), 1) if samples else 0.0,
+                "samples": len(samples)
+            },
+            "vapid_audiences": len(self._vapid_headers)
+        }
+
     def get_public_key(self) -> str:
         """Retorna a chave pública VAPID para o frontend"""
         return self.vapid_public_key
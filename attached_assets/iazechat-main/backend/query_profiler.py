@@ -0,0 +1,204 @@
+"""
+Profiler de consultas para desenvolvimento (QUERY_PROFILER=1)
+
+Registra o "formato" de cada consulta que o servidor manda ao MongoDB (collection,
+comando, campos do filtro - valores viram o nome do tipo - e a ordenação) e, sob
+demanda, roda explain("executionStats") de uma amostra de cada formato. Formatos
+cujo plano tem COLLSCAN examinando mais de QUERY_PROFILER_COLLSCAN_MIN_DOCS
+documentos são sinalizados.
+
+Uso em desenvolvimento / testes:
+    QUERY_PROFILER=1 uvicorn server:app ...
+    (rodar os scripts test_*.py / navegar pelo painel)
+    GET /api/admin/query-profile   -> relatório (também vai para o log no shutdown)
+
+Desligado (padrão) não registra listener nenhum no Motor: custo zero em produção.
+"""
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("QUERY_PROFILER", "").lower() in ("1", "true", "yes")
+COLLSCAN_MIN_DOCS = int(os.environ.get("QUERY_PROFILER_COLLSCAN_MIN_DOCS", "100"))
+MAX_SHAPES = int(os.environ.get("QUERY_PROFILER_MAX_SHAPES", "500"))
+
+# comando -> campo com o filtro (None = pipeline do aggregate)
+PROFILED_COMMANDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": None,
+    "update": "updates",
+    "delete": "deletes",
+}
+
+# Campos de sessão/transação que o explain não aceita
+SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "writeConcern", "readConcern"}
+
+
+def _shape(value: Any) -> Any:
+    """Estrutura da consulta sem os valores (operadores e campos preservados)"""
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_shape(value[0])] if value else []
+    return type(value).__name__
+
+
+def _filter_of(command_name: str, command: Dict) -> Any:
+    field = PROFILED_COMMANDS[command_name]
+    if field is None:
+        return command.get("pipeline", [])
+    if field in ("updates", "deletes"):
+        statements = command.get(field) or [{}]
+        return statements[0].get("q", {})
+    return command.get(field, {})
+
+
+def _explainable(command_name: str, command: Dict) -> Dict:
+    """Cópia do comando pronta para explain (um statement só, sem campos de sessão)"""
+    cmd = {k: v for k, v in command.items() if not k.startswith("$") and k not in SESSION_FIELDS}
+    if command_name in ("update", "delete"):
+        field = PROFILED_COMMANDS[command_name]
+        cmd[field] = list(cmd.get(field) or [])[:1]
+    return cmd
+
+
+def _scan_plan(node: Any, found: Dict):
+    """Percorre o explain procurando estágios COLLSCAN e docs examinados"""
+    if isinstance(node, dict):
+        if node.get("stage") == "COLLSCAN":
+            found["collscan"] = True
+        for key in ("totalDocsExamined", "docsExamined"):
+            if isinstance(node.get(key), int):
+                found["docs_examined"] = max(found["docs_examined"], node[key])
+        for value in node.values():
+            _scan_plan(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            _scan_plan(value, found)
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """Listener de comandos do driver + auditoria com explain"""
+
+    def __init__(self, enabled: bool = ENABLED, collscan_min_docs: int = COLLSCAN_MIN_DOCS):
+        self.enabled = enabled
+        self.collscan_min_docs = collscan_min_docs
+        self.shapes: Dict[str, Dict] = {}
+        self._pending: Dict[int, str] = {}
+        # Eventos chegam das threads do driver
+        self._lock = threading.Lock()
+
+    def listeners(self) -> List[monitoring.CommandListener]:
+        """Para AsyncIOMotorClient(event_listeners=...); vazio quando desligado"""
+        return [self] if self.enabled else []
+
+    # ------------------------------------------------------------------
+    # Eventos do driver
+    # ------------------------------------------------------------------
+
+    def started(self, event):
+        if event.command_name not in PROFILED_COMMANDS:
+            return
+        command = event.command
+        collection = command.get(event.command_name)
+        shape = {
+            "db": event.database_name,
+            "collection": collection,
+            "command": event.command_name,
+            "filter": _shape(_filter_of(event.command_name, command)),
+            "sort": dict(command.get("sort") or {})
+        }
+        key = json.dumps(shape, sort_keys=True, default=str)
+        with self._lock:
+            entry = self.shapes.get(key)
+            if entry is None:
+                if len(self.shapes) >= MAX_SHAPES:
+                    return
+                entry = self.shapes[key] = {
+                    **shape,
+                    "sample": _explainable(event.command_name, dict(command)),
+                    "count": 0,
+                    "max_ms": 0.0
+                }
+            entry["count"] += 1
+            self._pending[event.request_id] = key
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        with self._lock:
+            key = self._pending.pop(event.request_id, None)
+            if key is None:
+                return
+            entry = self.shapes[key]
+            entry["max_ms"] = max(entry["max_ms"], event.duration_micros / 1000)
+
+    # ------------------------------------------------------------------
+    # Auditoria
+    # ------------------------------------------------------------------
+
+    async def audit(self, client) -> List[Dict]:
+        """explain de cada formato registrado; COLLSCAN acima do limite vem com flagged=True"""
+        with self._lock:
+            entries = list(self.shapes.values())
+
+        report = []
+        for entry in entries:
+            found = {"collscan": False, "docs_examined": 0}
+            error: Optional[str] = None
+            try:
+                explain = await client[entry["db"]].command(
+                    {"explain": entry["sample"], "verbosity": "executionStats"}
+                )
+                _scan_plan(explain, found)
+            except Exception as e:
+                error = str(e)[:200]
+            report.append({
+                "collection": entry["collection"],
+                "command": entry["command"],
+                "filter": entry["filter"],
+                "sort": entry["sort"],
+                "count": entry["count"],
+                "max_ms": round(entry["max_ms"], 1),
+                "collscan": found["collscan"],
+                "docs_examined": found["docs_examined"],
+                "flagged": found["collscan"] and found["docs_examined"] >= self.collscan_min_docs,
+                "error": error
+            })
+
+        report.sort(key=lambda r: (not r["flagged"], -r["docs_examined"]))
+        return report
+
+    async def log_report(self, client):
+        report = await self.audit(client)
+        flagged = [r for r in report if r["flagged"]]
+        logger.info(f"🔎 Query profiler: {len(report)} formatos de consulta, {len(flagged)} com COLLSCAN")
+        for r in flagged:
+            logger.warning(
+                f"⚠️ COLLSCAN em {r['collection']}.{r['command']} "
+                f"filtro={json.dumps(r['filter'])} sort={json.dumps(r['sort'])} "
+                f"({r['docs_examined']} docs examinados, {r['count']}x, máx {r['max_ms']}ms)"
+            )
+        return report
+
+    def reset(self):
+        with self._lock:
+            self.shapes.clear()
+            self._pending.clear()
+
+
+# Instância global
+query_profiler = QueryProfiler()
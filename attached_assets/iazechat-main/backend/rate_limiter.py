@@ -4,28 +4,174 @@ Proteção contra abuso e ataques DDoS
 
 Limites por tipo de usuário:
 - Admin: 1000 req/min
-- Reseller: 500 req/min  
+- Reseller: 500 req/min
 - Agent: 200 req/min
 - Client: 100 req/min
+
+Algoritmo GCRA (equivalente a token bucket com capacidade = limite/min): cada
+chave guarda só um float, o TAT (theoretical arrival time). Sem listas de
+timestamps e sem lock global:
+
+- LocalRateLimitBackend: slots em memória divididos em shards; leitura e escrita
+  acontecem sem await no meio, então são atômicas no event loop. A limpeza
+  remove chaves ociosas (TAT no passado = balde cheio) um shard por vez.
+- MongoRateLimitBackend: mesmo cálculo em um find_one_and_update atômico na
+  collection rate_limits, para o limite valer entre workers. Chaves ociosas
+  expiram por índice TTL.
+
+Backend escolhido no startup via RATE_LIMIT_BACKEND=memory|mongo.
+
+IP do cliente (limite de login e requisições sem token): X-Forwarded-For só é
+considerado quando a conexão vem de um proxy listado em TRUSTED_PROXIES
+(IPs/CIDRs separados por vírgula, ex. "127.0.0.1,10.0.0.0/8"); do contrário o
+header é do próprio cliente e trocar o valor burlaria o limite. O padrão confia
+em loopback e nas faixas privadas (nginx no host + rede bridge do Docker, como
+no install-vps.sh) - sem isso todos os logins cairiam no balde do proxy.
 """
 
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional
+import os
+import re
+import math
+import ipaddress
+import time
 import asyncio
-from collections import defaultdict
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import jwt
+from fastapi import Request, HTTPException, status
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument
+
+from metrics import loop_tick
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+SHARD_COUNT = int(os.environ.get("RATE_LIMIT_SHARDS", "16"))
+EVICTION_INTERVAL = int(os.environ.get("RATE_LIMIT_EVICTION_SECONDS", "30"))
+
+
+def _parse_networks(value: str) -> List:
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning(f"⚠️ TRUSTED_PROXIES: valor inválido ignorado: {item}")
+    return networks
+
+
+# Loopback + faixas privadas (IPv4 e IPv6): nginx local e redes do Docker
+DEFAULT_TRUSTED_PROXIES = "127.0.0.0/8,::1,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,fc00::/7"
+TRUSTED_PROXIES = _parse_networks(os.environ.get("TRUSTED_PROXIES", DEFAULT_TRUSTED_PROXIES))
+
+
+class LocalRateLimitBackend:
+    """Slots GCRA em memória (por worker) - também serve de backend para testes"""
+
+    def __init__(self, shards: int = SHARD_COUNT):
+        self.shards: List[Dict[str, float]] = [{} for _ in range(max(1, shards))]
+
+    def _shard(self, key: str) -> Dict[str, float]:
+        return self.shards[hash(key) % len(self.shards)]
+
+    async def acquire(self, key: str, interval: float, window: float, now: float) -> Tuple[bool, float]:
+        """(allowed, retry_after_seconds) - sem await entre ler e gravar o slot"""
+        shard = self._shard(key)
+        tat = max(shard.get(key, now), now)
+        new_tat = tat + interval
+        allow_at = new_tat - window
+        if allow_at > now:
+            return False, allow_at - now
+        shard[key] = new_tat
+        return True, 0.0
+
+    async def peek(self, key: str, now: float) -> float:
+        return max(self._shard(key).get(key, now), now)
+
+    async def reset(self, identity: str):
+        for shard in self.shards:
+            for key in [k for k in shard if k.endswith(f"|{identity}")]:
+                shard.pop(key, None)
+
+    async def evict(self, now: float) -> int:
+        """Remove chaves com balde cheio (TAT no passado), um shard por vez"""
+        removed = 0
+        for shard in self.shards:
+            idle = [key for key, tat in shard.items() if tat <= now]
+            for key in idle:
+                shard.pop(key, None)
+            removed += len(idle)
+            await asyncio.sleep(0)
+        return removed
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+class MongoRateLimitBackend:
+    """Slots GCRA na collection rate_limits (compartilhado entre workers)"""
+
+    def __init__(self, db, collection: str = "rate_limits"):
+        self.collection = db[collection]
+
+    async def ensure_indexes(self):
+        try:
+            await self.collection.create_index([("expire_at", 1)], expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índice TTL de rate_limits: {e}")
+
+    async def acquire(self, key: str, interval: float, window: float, now: float) -> Tuple[bool, float]:
+        new_tat = {"$add": [{"$max": [{"$ifNull": ["$tat", now]}, now]}, interval]}
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"_id": key},
+                [
+                    {"$set": {"allowed": {"$lte": [new_tat, now + window]}}},
+                    {"$set": {"tat": {"$cond": ["$allowed", new_tat, "$tat"]}}},
+                    # Quando o TAT passa o balde está cheio de novo - o TTL remove a chave
+                    {"$set": {"expire_at": {"$add": [EPOCH, {"$multiply": ["$tat", 1000]}]}}}
+                ],
+                projection={"_id": 0, "tat": 1, "allowed": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            # Banco indisponível não derruba a API: libera a requisição
+            logger.warning(f"⚠️ Rate limit indisponível ({key}): {e}")
+            return True, 0.0
+        if doc["allowed"]:
+            return True, 0.0
+        return False, doc["tat"] + interval - window - now
+
+    async def peek(self, key: str, now: float) -> float:
+        doc = await self.collection.find_one({"_id": key}, {"_id": 0, "tat": 1})
+        return max((doc or {}).get("tat", now), now)
+
+    async def reset(self, identity: str):
+        await self.collection.delete_many({"_id": {"$regex": f"\\|{re.escape(identity)}$"}})
+
+    async def evict(self, now: float) -> int:
+        return 0  # índice TTL
+
 
 class RateLimiter:
     """
-    Rate limiter in-memory com sliding window
-    
-    Para produção, considere usar Redis para distribuição
+    Rate limiter GCRA com backend plugável
+
+    Chave = "<escopo>|<identidade>", onde escopo é a ação (login, send_message...)
+    ou o tipo de usuário para o limite geral.
     """
-    
-    def __init__(self):
-        # Estrutura: {user_id: [(timestamp, count), ...]}
-        self.requests: Dict[str, list] = defaultdict(list)
-        self.lock = asyncio.Lock()
-        
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalRateLimitBackend()
+
         # Limites por tipo de usuário (requests por minuto)
         self.limits = {
             "admin": 1000,
@@ -33,14 +179,22 @@ class RateLimiter:
             "agent": 200,
             "client": 100
         }
-        
+
         # Limites especiais para ações específicas
         self.action_limits = {
             "login": 10,  # 10 tentativas de login por minuto
             "create_ticket": 30,  # 30 tickets por minuto
             "send_message": 60  # 60 mensagens por minuto
         }
-    
+
+    def use_backend(self, backend):
+        self.backend = backend
+
+    def _scope(self, user_type: str, action: Optional[str]) -> Tuple[str, int]:
+        if action and action in self.action_limits:
+            return action, self.action_limits[action]
+        return user_type, self.limits.get(user_type, 100)
+
     async def check_rate_limit(
         self,
         user_id: str,
@@ -49,152 +203,160 @@ class RateLimiter:
     ) -> tuple[bool, Optional[int]]:
         """
         Verifica se o usuário está dentro do rate limit
-        
+
         Returns:
             (allowed, retry_after_seconds)
             - allowed: True se pode prosseguir
             - retry_after_seconds: Segundos até poder tentar novamente (se blocked)
         """
-        
-        async with self.lock:
-            now = datetime.now(timezone.utc)
-            one_minute_ago = now - timedelta(minutes=1)
-            
-            # Limpar requisições antigas
-            if user_id in self.requests:
-                self.requests[user_id] = [
-                    (ts, count) for ts, count in self.requests[user_id]
-                    if ts > one_minute_ago
-                ]
-            
-            # Contar requisições no último minuto
-            request_count = sum(count for ts, count in self.requests[user_id])
-            
-            # Determinar limite aplicável
-            if action and action in self.action_limits:
-                limit = self.action_limits[action]
-            else:
-                limit = self.limits.get(user_type, 100)
-            
-            # Verificar se excedeu o limite
-            if request_count >= limit:
-                # Calcular quando poderá tentar novamente
-                oldest_request = min(ts for ts, _ in self.requests[user_id])
-                retry_after = int((oldest_request + timedelta(minutes=1) - now).total_seconds())
-                return False, max(retry_after, 1)
-            
-            # Adicionar esta requisição
-            self.requests[user_id].append((now, 1))
+        scope, limit = self._scope(user_type, action)
+        allowed, retry_after = await self.backend.acquire(
+            f"{scope}|{user_id}",
+            WINDOW_SECONDS / limit,
+            WINDOW_SECONDS,
+            time.time()
+        )
+        if allowed:
             return True, None
-    
+        return False, max(1, math.ceil(retry_after))
+
     async def get_remaining_requests(
         self,
         user_id: str,
         user_type: str
     ) -> int:
         """Retorna quantas requisições restam no minuto atual"""
-        
-        async with self.lock:
-            now = datetime.now(timezone.utc)
-            one_minute_ago = now - timedelta(minutes=1)
-            
-            # Limpar requisições antigas
-            if user_id in self.requests:
-                self.requests[user_id] = [
-                    (ts, count) for ts, count in self.requests[user_id]
-                    if ts > one_minute_ago
-                ]
-            
-            request_count = sum(count for ts, count in self.requests[user_id])
-            limit = self.limits.get(user_type, 100)
-            
-            return max(0, limit - request_count)
-    
+        scope, limit = self._scope(user_type, None)
+        now = time.time()
+        tat = await self.backend.peek(f"{scope}|{user_id}", now)
+        used = math.ceil((tat - now) / (WINDOW_SECONDS / limit))
+        return max(0, limit - used)
+
     async def reset_user_limits(self, user_id: str):
         """Reseta os limites de um usuário específico"""
-        async with self.lock:
-            if user_id in self.requests:
-                del self.requests[user_id]
-    
-    async def cleanup_old_entries(self):
-        """Remove entradas antigas (executar periodicamente)"""
-        async with self.lock:
-            now = datetime.now(timezone.utc)
-            one_hour_ago = now - timedelta(hours=1)
-            
-            users_to_remove = []
-            
-            for user_id, requests in self.requests.items():
-                # Filtrar requisições antigas
-                self.requests[user_id] = [
-                    (ts, count) for ts, count in requests
-                    if ts > one_hour_ago
-                ]
-                
-                # Marcar para remoção se vazio
-                if not self.requests[user_id]:
-                    users_to_remove.append(user_id)
-            
-            # Remover usuários sem requisições recentes
-            for user_id in users_to_remove:
-                del self.requests[user_id]
+        await self.backend.reset(user_id)
+
+    async def cleanup_old_entries(self) -> int:
+        """Remove chaves ociosas (executar periodicamente)"""
+        return await self.backend.evict(time.time())
+
+    async def run_eviction(self):
+        """Loop de limpeza (iniciado no startup do servidor)"""
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL)
+            try:
+                async with loop_tick("rate_limit_eviction"):
+                    removed = await self.cleanup_old_entries()
+                if removed:
+                    logger.debug(f"🧹 Rate limit: {removed} chaves ociosas removidas")
+            except Exception as e:
+                logger.error(f"❌ Erro na limpeza do rate limit: {e}")
 
 # Instância global
 rate_limiter = RateLimiter()
 
 
-# Middleware para FastAPI
-from fastapi import Request, HTTPException, status
-from fastapi.responses import JSONResponse
+def configure_rate_limiter(db):
+    """Seleciona o backend conforme RATE_LIMIT_BACKEND (memory|mongo)"""
+    if os.environ.get("RATE_LIMIT_BACKEND", "memory").lower() == "mongo":
+        rate_limiter.use_backend(MongoRateLimitBackend(db))
+    return rate_limiter.backend
+
+
+# Integração com FastAPI
+
+def _is_trusted_proxy(host: str, trusted: List) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted)
+
+
+def _client_ip(request: Request, trusted: Optional[List] = None) -> str:
+    """
+    IP do cliente: o peer da conexão, ou - se o peer é um proxy confiável - o
+    primeiro hop não confiável do X-Forwarded-For, lido da direita para a
+    esquerda (cada proxy acrescenta o IP que o conectou no fim da lista)
+    """
+    trusted = TRUSTED_PROXIES if trusted is None else trusted
+    peer = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("X-Forwarded-For")
+    if not forwarded or not _is_trusted_proxy(peer, trusted):
+        return peer
+
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop, trusted):
+            return hop
+    return hops[0] if hops else peer
+
+
+def client_ip(request: Request) -> str:
+    """IP do cliente pela mesma regra do limite de login (ex. para o audit log)"""
+    return _client_ip(request)
+
+
+def _identity(request: Request) -> Tuple[str, str]:
+    """(identidade, user_type) a partir do token; sem token válido usa o IP"""
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        from dependencies import SECRET_KEY
+        try:
+            payload = jwt.decode(auth_header.split(" ", 1)[1], SECRET_KEY, algorithms=["HS256"])
+            if payload.get("user_id"):
+                return payload["user_id"], payload.get("user_type") or "client"
+        except jwt.InvalidTokenError:
+            pass
+    return f"ip:{_client_ip(request)}", "client"
+
+
+def rate_limit(action: Optional[str] = None):
+    """
+    Dependência FastAPI para os limites por ação:
+
+        @api_router.post("/messages", dependencies=[Depends(rate_limit("send_message"))])
+
+    Login é limitado por IP (ainda não há usuário autenticado).
+    """
+    async def dependency(request: Request):
+        if action == "login":
+            identity, user_type = f"ip:{_client_ip(request)}", "client"
+        else:
+            identity, user_type = _identity(request)
+        allowed, retry_after = await rate_limiter.check_rate_limit(identity, user_type, action)
+        if not allowed:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Muitas requisições. Tente novamente em instantes.",
+                headers={"Retry-After": str(retry_after)}
+            )
+    return dependency
+
 
 async def rate_limit_middleware(request: Request, call_next):
     """
-    Middleware de rate limiting para FastAPI
-    
+    Middleware de rate limiting geral (limite por tipo de usuário)
+
     Adicione ao app:
     app.middleware("http")(rate_limit_middleware)
     """
-    
-    # Extrair user info do token (se presente)
     auth_header = request.headers.get("Authorization")
-    
+
     if auth_header and auth_header.startswith("Bearer "):
-        try:
-            # Verificar token e extrair user_id e user_type
-            # (implementação depende do sistema de auth)
-            user_id = "extracted_from_token"
-            user_type = "extracted_from_token"
-            
-            # Determinar action baseado no endpoint
-            action = None
-            if "/auth/" in request.url.path:
-                action = "login"
-            elif "/tickets" in request.url.path and request.method == "POST":
-                action = "create_ticket"
-            elif "/messages" in request.url.path and request.method == "POST":
-                action = "send_message"
-            
-            # Verificar rate limit
-            allowed, retry_after = await rate_limiter.check_rate_limit(
-                user_id=user_id,
-                user_type=user_type,
-                action=action
+        identity, user_type = _identity(request)
+        allowed, retry_after = await rate_limiter.check_rate_limit(identity, user_type)
+
+        if not allowed:
+            return JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={
+                    "detail": "Rate limit exceeded",
+                    "retry_after": retry_after
+                },
+                headers={"Retry-After": str(retry_after)}
             )
-            
-            if not allowed:
-                return JSONResponse(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    content={
-                        "detail": "Rate limit exceeded",
-                        "retry_after": retry_after
-                    },
-                    headers={"Retry-After": str(retry_after)}
-                )
-        
-        except Exception:
-            # Se houver erro na verificação, permitir request
-            pass
-    
+
     # Processar request normalmente
     response = await call_next(request)
     return response
@@ -4,7 +4,6 @@ Rotas para Sistema de Lembretes de Vencimento
 from fastapi import APIRouter, HTTPException, Depends, Request
 from reminder_models import AddClientEmailRequest, ReminderConfigUpdate, ClientEmail
 from reminder_service import reminder_service
-from office_service_playwright import office_service_playwright
 from datetime import datetime, timezone, timedelta
 import uuid
 import logging
@@ -197,139 +196,19 @@ async def process_reminders(db=Depends(get_db)):
                 "sent": 0
             }
         
-        # Pegar todos os clientes com email
-        client_emails = await db.client_emails.find(
-            {"active": True}
-        ).to_list(length=None)
+        # Vencimentos do banco local (office_clients), envio em paralelo com SMTP em pool
+        result = await reminder_service.process_due_reminders(db, config)
         
-        if not client_emails:
+        if not result["processed"]:
             return {
                 "success": True,
                 "message": "Nenhum cliente com email cadastrado",
                 "sent": 0
             }
         
-        # Pegar credenciais do Office
-        office_credentials = await db.office_credentials.find(
-            {"active": True}
-        ).to_list(length=None)
-        
-        sent_count = 0
-        errors = []
-        
-        # Para cada cliente com email
-        for client_email in client_emails:
-            try:
-                usuario = client_email["usuario"]
-                
-                # Buscar dados no Office
-                client_data = None
-                for cred in office_credentials:
-                    result = await office_service_playwright.buscar_cliente(
-                        {
-                            "username": cred["username"],
-                            "password": cred["password"]
-                        },
-                        usuario
-                    )
-                    
-                    if result and result.get("success"):
-                        client_data = result
-                        break
-                
-                if not client_data:
-                    logger.warning(f"⚠️ Cliente {usuario} não encontrado no Office")
-                    continue
-                
-                # Verificar vencimento
-                vencimento_str = client_data.get("vencimento")
-                
-                if not vencimento_str or vencimento_str in ["NUNCA", "ILIMITADO"]:
-                    continue  # Cliente ilimitado
-                
-                # Parsear data de vencimento
-                try:
-                    vencimento = datetime.fromisoformat(vencimento_str.replace(' ', 'T'))
-                except:
-                    # Tentar outros formatos
-                    try:
-                        vencimento = datetime.strptime(vencimento_str, "%Y-%m-%d %H:%M:%S")
-                    except:
-                        logger.warning(f"⚠️ Data inválida para {usuario}: {vencimento_str}")
-                        continue
-                
-                # Calcular dias até vencimento
-                days_until = (vencimento.date() - datetime.now(timezone.utc).date()).days
-                
-                # Verificar se deve enviar
-                should_send = False
-                
-                if days_until in config.get("days_before", [3, 2, 1]):
-                    should_send = True
-                elif days_until < 0 and config.get("send_expired", True):
-                    should_send = True
-                
-                if should_send:
-                    # Gerar email
-                    client_data_with_name = {
-                        **client_data,
-                        "nome": client_email.get("nome", "Cliente")
-                    }
-                    
-                    html = reminder_service.generate_reminder_email(
-                        client_data_with_name,
-                        days_until
-                    )
-                    
-                    # Definir assunto
-                    if days_until > 0:
-                        subject = f"⚠️ Sua assinatura vence em {days_until} dia(s)"
-                    elif days_until == 0:
-                        subject = "🚨 Sua assinatura vence HOJE!"
-                    else:
-                        subject = f"❌ Sua assinatura venceu há {abs(days_until)} dia(s)"
-                    
-                    # Enviar email
-                    smtp_config = {
-                        "smtp_host": config["smtp_host"],
-                        "smtp_port": config["smtp_port"],
-                        "smtp_user": config["smtp_user"],
-                        "smtp_password": config["smtp_password"],
-                        "from_email": config["from_email"],
-                        "from_name": config["from_name"]
-                    }
-                    
-                    success = reminder_service.send_email(
-                        smtp_config,
-                        client_email["email"],
-                        subject,
-                        html
-                    )
-                    
-                    if success:
-                        sent_count += 1
-                        
-                        # Salvar log
-                        await db.reminder_logs.insert_one({
-                            "id": str(uuid.uuid4()),
-                            "usuario": usuario,
-                            "email": client_email["email"],
-                            "days_until": days_until,
-                            "sent_at": datetime.now(timezone.utc).isoformat(),
-                            "status": "sent"
-                        })
-                    else:
-                        errors.append(f"Falha ao enviar para {usuario}")
-                
-            except Exception as e:
-                logger.error(f"❌ Erro ao processar {client_email.get('usuario')}: {e}")
-                errors.append(str(e))
-        
         return {
             "success": True,
-            "sent": sent_count,
-            "processed": len(client_emails),
-            "errors": errors
+            **result
         }
         
     except Exception as e:
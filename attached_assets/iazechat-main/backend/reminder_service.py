@@ -1,15 +1,142 @@
 """
 Serviço de Envio de Lembretes de Vencimento
+
+Processamento (process_due_reminders):
+- Vencimento lido de office_clients.vencimento_at (data BSON gravada pela
+  sincronização do Office) - sem abrir navegador por cliente.
+- Clientes devidos selecionados com UMA consulta indexada em vencimento_at
+  (faixas de dias configuradas + vencidos recentes).
+- Envio em paralelo (limite REMINDER_CONCURRENCY) por um pool de conexões
+  SMTP persistentes rodando em threads (smtplib é bloqueante).
+- reminder_logs.dedup_key (usuario|vencimento|dias) com índice único evita
+  envio duplicado, inclusive entre execuções concorrentes. Reservas que
+  ficaram em "sending" (processo morreu no meio do envio) expiram após
+  REMINDER_SENDING_TIMEOUT_SECONDS e voltam a ser enviadas.
 """
+import os
+import queue
+import asyncio
 import logging
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Dict, List
-from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from datetime import datetime, timezone, timedelta
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 logger = logging.getLogger(__name__)
 
+SMTP_POOL_SIZE = int(os.environ.get("REMINDER_SMTP_POOL_SIZE", "4"))
+CONCURRENCY = int(os.environ.get("REMINDER_CONCURRENCY", "8"))
+# Vencidos há mais que isso não recebem mais lembretes
+EXPIRED_LOOKBACK_DAYS = int(os.environ.get("REMINDER_EXPIRED_LOOKBACK_DAYS", "30"))
+# Reserva "sending" mais antiga que isso é considerada abandonada
+SENDING_TIMEOUT_SECONDS = int(os.environ.get("REMINDER_SENDING_TIMEOUT_SECONDS", "900"))
+
+UNLIMITED_VALUES = ("", "NUNCA", "ILIMITADO")
+VENCIMENTO_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y")
+
+
+def parse_vencimento(vencimento_str: Optional[str]) -> Optional[datetime]:
+    """Data de vencimento do Office -> datetime UTC (None se ilimitado/inválido)"""
+    if not vencimento_str or vencimento_str.strip().upper() in UNLIMITED_VALUES:
+        return None
+    text = vencimento_str.strip()
+    try:
+        parsed = datetime.fromisoformat(text.replace(' ', 'T'))
+    except ValueError:
+        parsed = None
+        for fmt in VENCIMENTO_FORMATS:
+            try:
+                parsed = datetime.strptime(text, fmt)
+                break
+            except ValueError:
+                continue
+    if parsed is None:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def reminder_subject(days_until: int) -> str:
+    if days_until > 0:
+        return f"⚠️ Sua assinatura vence em {days_until} dia(s)"
+    if days_until == 0:
+        return "🚨 Sua assinatura vence HOJE!"
+    return f"❌ Sua assinatura venceu há {abs(days_until)} dia(s)"
+
+
+def build_message(smtp_config: Dict, to_email: str, subject: str, html_content: str) -> MIMEMultipart:
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = f"{smtp_config['from_name']} <{smtp_config['from_email']}>"
+    msg['To'] = to_email
+    msg.attach(MIMEText(html_content, 'html', 'utf-8'))
+    return msg
+
+
+class SMTPPool:
+    """
+    Conexões SMTP persistentes (login uma vez por conexão) usadas por um
+    ThreadPoolExecutor do mesmo tamanho - o event loop nunca bloqueia
+    """
+
+    def __init__(self, smtp_config: Dict, size: int = SMTP_POOL_SIZE):
+        self.smtp_config = smtp_config
+        self.size = max(1, size)
+        self._idle: "queue.Queue[smtplib.SMTP]" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="smtp")
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.smtp_config['smtp_host'], self.smtp_config['smtp_port'], timeout=30)
+        server.starttls()
+        server.login(self.smtp_config['smtp_user'], self.smtp_config['smtp_password'])
+        return server
+
+    def _send_sync(self, msg: MIMEMultipart):
+        try:
+            server = self._idle.get_nowait()
+        except queue.Empty:
+            server = self._connect()
+        try:
+            server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Conexão caiu (timeout do servidor) - reconecta uma vez
+            server = self._connect()
+            server.send_message(msg)
+        except Exception:
+            try:
+                server.quit()
+            except Exception:
+                pass
+            raise
+        self._idle.put(server)
+
+    async def send(self, msg: MIMEMultipart):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._send_sync, msg)
+
+    def _close_sync(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+
 class ReminderService:
     """Serviço para enviar lembretes de vencimento"""
     
@@ -31,14 +158,7 @@ class ReminderService:
         """
         try:
             # Criar mensagem
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = f"{smtp_config['from_name']} <{smtp_config['from_email']}>"
-            msg['To'] = to_email
-            
-            # Adicionar conteúdo HTML
-            part = MIMEText(html_content, 'html', 'utf-8')
-            msg.attach(part)
+            msg = build_message(smtp_config, to_email, subject, html_content)
             
             # Conectar ao servidor SMTP
             with smtplib.SMTP(smtp_config['smtp_host'], smtp_config['smtp_port']) as server:
@@ -172,5 +292,183 @@ class ReminderService:
         
         return html
 
+    # ------------------------------------------------------------------
+    # Processamento em lote
+    # ------------------------------------------------------------------
+
+    async def ensure_indexes(self, db):
+        try:
+            await db.office_clients.create_index([("vencimento_at", 1), ("usuario", 1)])
+            await db.reminder_logs.create_index(
+                [("dedup_key", 1)],
+                unique=True,
+                partialFilterExpression={"dedup_key": {"$type": "string"}}
+            )
+            await db.reminder_logs.create_index([("sent_at", -1)])
+            await db.reminder_logs.create_index([("status", 1), ("reserved_at", 1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de lembretes: {e}")
+
+    async def backfill_vencimento_at(self, db) -> int:
+        """Materializa vencimento_at em clientes sincronizados antes do campo existir"""
+        docs = await db.office_clients.find(
+            {"vencimento_at": {"$exists": False}},
+            {"_id": 1, "vencimento": 1}
+        ).to_list(length=None)
+        if not docs:
+            return 0
+        await db.office_clients.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"vencimento_at": parse_vencimento(doc.get("vencimento"))}})
+            for doc in docs
+        ], ordered=False)
+        logger.info(f"📅 vencimento_at materializado em {len(docs)} clientes do Office")
+        return len(docs)
+
+    async def release_stale_reservations(self, db) -> int:
+        """Apaga reservas "sending" abandonadas para que o envio seja refeito"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=SENDING_TIMEOUT_SECONDS)
+        result = await db.reminder_logs.delete_many({
+            "status": "sending",
+            "$or": [
+                {"reserved_at": {"$lt": cutoff}},
+                # Reservas gravadas antes de reserved_at existir
+                {"reserved_at": {"$exists": False}, "sent_at": {"$lt": cutoff.isoformat()}}
+            ]
+        })
+        if result.deleted_count:
+            logger.warning(f"⚠️ {result.deleted_count} reservas de lembrete abandonadas liberadas")
+        return result.deleted_count
+
+    async def _due_clients(self, db, config: Dict, client_emails: List[Dict], office_accounts: List[str]) -> List[Dict]:
+        """
+        Uma consulta em office_clients (índice vencimento_at) para todos os
+        clientes com email que vencem em um dos dias configurados ou já venceram,
+        apenas das contas do Office ativas
+        """
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        ranges = [
+            {"vencimento_at": {"$gte": today + timedelta(days=d), "$lt": today + timedelta(days=d + 1)}}
+            for d in sorted(set(config.get("days_before", [3, 2, 1])))
+        ]
+        if config.get("send_expired", True):
+            ranges.append({"vencimento_at": {"$gte": today - timedelta(days=EXPIRED_LOOKBACK_DAYS), "$lt": today}})
+        if not ranges:
+            return []
+
+        usuarios = list({ce["usuario"] for ce in client_emails})
+        return await db.office_clients.find(
+            {"$or": ranges, "usuario": {"$in": usuarios}, "office_account": {"$in": office_accounts}},
+            {"_id": 0, "usuario": 1, "senha": 1, "vencimento": 1, "vencimento_at": 1, "office_account": 1}
+        ).to_list(length=None)
+
+    async def process_due_reminders(self, db, config: Dict) -> Dict:
+        """Seleciona os clientes devidos, deduplica e envia em paralelo"""
+        await self.backfill_vencimento_at(db)
+
+        client_emails = await db.client_emails.find({"active": True}, {"_id": 0}).to_list(length=None)
+        if not client_emails:
+            return {"sent": 0, "processed": 0, "skipped": 0, "errors": []}
+
+        # office_credential_id -> conta do Office (para desempatar usuário repetido entre painéis)
+        credentials = await db.office_credentials.find(
+            {"active": True},
+            {"_id": 0, "id": 1, "username": 1}
+        ).to_list(length=None)
+        account_by_credential = {c.get("id"): c.get("username") for c in credentials}
+
+        office_by_usuario: Dict[str, List[Dict]] = {}
+        office_accounts = [c.get("username") for c in credentials]
+        for client in await self._due_clients(db, config, client_emails, office_accounts):
+            office_by_usuario.setdefault(client["usuario"], []).append(client)
+
+        today = datetime.now(timezone.utc).date()
+        candidates = []
+        for client_email in client_emails:
+            matches = office_by_usuario.get(client_email["usuario"])
+            if not matches:
+                continue
+            preferred = account_by_credential.get(client_email.get("office_credential_id"))
+            client_data = next((m for m in matches if m.get("office_account") == preferred), matches[0])
+            days_until = (client_data["vencimento_at"].date() - today).days
+            dedup_key = f"{client_email['usuario']}|{client_data['vencimento_at'].date().isoformat()}|{days_until}"
+            candidates.append((client_email, client_data, days_until, dedup_key))
+
+        # Já enviados (uma consulta) - o índice único cobre a corrida entre execuções
+        await self.release_stale_reservations(db)
+        already_sent = {
+            log["dedup_key"]
+            for log in await db.reminder_logs.find(
+                {"dedup_key": {"$in": [c[3] for c in candidates]}},
+                {"_id": 0, "dedup_key": 1}
+            ).to_list(length=None)
+        }
+        pending = [c for c in candidates if c[3] not in already_sent]
+
+        smtp_config = {
+            "smtp_host": config["smtp_host"],
+            "smtp_port": config["smtp_port"],
+            "smtp_user": config["smtp_user"],
+            "smtp_password": config["smtp_password"],
+            "from_email": config["from_email"],
+            "from_name": config["from_name"]
+        }
+        pool = SMTPPool(smtp_config)
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        errors: List[str] = []
+
+        async def send_one(client_email: Dict, client_data: Dict, days_until: int, dedup_key: str) -> bool:
+            usuario = client_email["usuario"]
+            async with semaphore:
+                # Reserva o envio: se outra execução já reservou, pula
+                log_id = str(uuid.uuid4())
+                try:
+                    await db.reminder_logs.insert_one({
+                        "id": log_id,
+                        "dedup_key": dedup_key,
+                        "usuario": usuario,
+                        "email": client_email["email"],
+                        "days_until": days_until,
+                        "sent_at": datetime.now(timezone.utc).isoformat(),
+                        "reserved_at": datetime.now(timezone.utc),
+                        "status": "sending"
+                    })
+                except DuplicateKeyError:
+                    return False
+
+                html = self.generate_reminder_email(
+                    {**client_data, "nome": client_email.get("nome") or "Cliente"},
+                    days_until
+                )
+                msg = build_message(smtp_config, client_email["email"], reminder_subject(days_until), html)
+                try:
+                    await pool.send(msg)
+                except Exception as e:
+                    logger.error(f"❌ Erro ao enviar email para {client_email['email']}: {e}")
+                    errors.append(f"Falha ao enviar para {usuario}")
+                    # Libera a reserva para a próxima execução tentar de novo
+                    await db.reminder_logs.delete_one({"id": log_id})
+                    return False
+
+                await db.reminder_logs.update_one(
+                    {"id": log_id},
+                    {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc).isoformat()}}
+                )
+                logger.info(f"✅ Email enviado para: {client_email['email']}")
+                return True
+
+        try:
+            results = await asyncio.gather(*(send_one(*c) for c in pending))
+        finally:
+            await pool.close()
+
+        sent_count = sum(1 for r in results if r)
+        return {
+            "sent": sent_count,
+            "processed": len(client_emails),
+            "due": len(candidates),
+            "skipped": len(candidates) - len(pending),
+            "errors": errors
+        }
+
 # Instância global
 reminder_service = ReminderService()
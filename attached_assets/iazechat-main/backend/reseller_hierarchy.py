@@ -0,0 +1,163 @@
+"""
+Hierarquia de revendas materializada (caminho de ancestrais)
+
+Cada documento de resellers guarda o caminho completo até a raiz:
+
+    {id, parent_id, ancestors: [raiz, ..., pai], level: len(ancestors)}
+
+- Leitura de sub-árvore: UMA consulta indexada ({"ancestors": id}) montada em memória,
+  em vez de um find por nó.
+- Transferência: UM update_many (pipeline) reescreve o prefixo do caminho e o nível
+  da revenda movida e de todas as descendentes.
+- Documentos antigos (sem ancestors) são preenchidos por backfill_paths no startup.
+"""
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+TREE_PROJECTION = {"_id": 0, "pass_hash": 0}
+
+
+class HierarchyError(ValueError):
+    """Movimento inválido na hierarquia (pai inexistente, ciclo etc)"""
+
+
+async def ancestry_for(db, parent_id: Optional[str]) -> Optional[Tuple[List[str], int]]:
+    """
+    (ancestors, level) de uma revenda nova sob parent_id
+    Retorna None se o pai não existir
+    """
+    if not parent_id:
+        return [], 0
+
+    parent = await db.resellers.find_one({"id": parent_id}, {"_id": 0, "id": 1, "ancestors": 1})
+    if not parent:
+        return None
+
+    parent_ancestors = parent.get("ancestors")
+    if parent_ancestors is None:
+        # Pai ainda não migrado - materializa a árvore e tenta de novo
+        await backfill_paths(db)
+        parent = await db.resellers.find_one({"id": parent_id}, {"_id": 0, "ancestors": 1})
+        parent_ancestors = (parent or {}).get("ancestors") or []
+
+    ancestors = parent_ancestors + [parent_id]
+    return ancestors, len(ancestors)
+
+
+def build_tree(resellers: List[Dict], root_parent_id: Optional[str] = None) -> List[Dict]:
+    """Monta a árvore (children/children_count) a partir de uma lista plana"""
+    by_parent: Dict[Optional[str], List[Dict]] = {}
+    for reseller in resellers:
+        by_parent.setdefault(reseller.get("parent_id"), []).append(reseller)
+
+    for reseller in resellers:
+        reseller["children"] = by_parent.get(reseller["id"], [])
+        reseller["children_count"] = len(reseller["children"])
+
+    return by_parent.get(root_parent_id, [])
+
+
+async def full_tree(db) -> List[Dict]:
+    """Árvore completa (admin) - uma consulta"""
+    resellers = await db.resellers.find({}, TREE_PROJECTION).to_list(None)
+    return build_tree(resellers, None)
+
+
+async def subtree(db, root_id: str) -> Optional[Dict]:
+    """Revenda root_id com todas as descendentes - uma consulta indexada"""
+    resellers = await db.resellers.find(
+        {"$or": [{"id": root_id}, {"ancestors": root_id}]},
+        TREE_PROJECTION
+    ).to_list(None)
+
+    root = next((r for r in resellers if r["id"] == root_id), None)
+    if root is None:
+        return None
+    build_tree(resellers)
+    return root
+
+
+async def move_subtree(db, reseller_id: str, new_parent_id: Optional[str]) -> int:
+    """
+    Move reseller_id (e descendentes) para baixo de new_parent_id com um único update_many
+    Retorna o novo nível da revenda movida
+    """
+    if new_parent_id == reseller_id:
+        raise HierarchyError("Revenda não pode ser filha de si mesma")
+
+    ancestry = await ancestry_for(db, new_parent_id)
+    if ancestry is None:
+        raise HierarchyError("Nova revenda pai não encontrada")
+    new_ancestors, new_level = ancestry
+
+    if reseller_id in new_ancestors:
+        raise HierarchyError("Revenda não pode ser movida para dentro da própria sub-árvore")
+
+    # Descendente: novo prefixo + trecho do caminho a partir da revenda movida
+    descendant_path = {"$concatArrays": [
+        new_ancestors,
+        {"$slice": [
+            "$ancestors",
+            {"$indexOfArray": ["$ancestors", reseller_id]},
+            {"$size": "$ancestors"}
+        ]}
+    ]}
+    is_root = {"$eq": ["$id", reseller_id]}
+
+    await db.resellers.update_many(
+        {"$or": [{"id": reseller_id}, {"ancestors": reseller_id}]},
+        [
+            {"$set": {
+                "ancestors": {"$cond": [is_root, new_ancestors, descendant_path]},
+                "parent_id": {"$cond": [is_root, new_parent_id, "$parent_id"]}
+            }},
+            {"$set": {"level": {"$size": "$ancestors"}}}
+        ]
+    )
+    return new_level
+
+
+async def backfill_paths(db) -> int:
+    """
+    Preenche ancestors/level de todas as revendas a partir de parent_id
+    (uma leitura + uma bulk_write só com os documentos divergentes)
+    """
+    docs = await db.resellers.find(
+        {}, {"_id": 0, "id": 1, "parent_id": 1, "ancestors": 1, "level": 1}
+    ).to_list(None)
+    parents = {doc["id"]: doc.get("parent_id") for doc in docs}
+
+    operations = []
+    for doc in docs:
+        path: List[str] = []
+        seen = {doc["id"]}
+        current = doc.get("parent_id")
+        while current and current in parents and current not in seen:
+            path.append(current)
+            seen.add(current)
+            current = parents[current]
+        path.reverse()
+
+        if doc.get("ancestors") != path or doc.get("level") != len(path):
+            operations.append(UpdateOne(
+                {"id": doc["id"]},
+                {"$set": {"ancestors": path, "level": len(path)}}
+            ))
+
+    if operations:
+        await db.resellers.bulk_write(operations, ordered=False)
+        logger.info(f"🌳 Hierarquia de revendas materializada: {len(operations)} revendas atualizadas")
+    return len(operations)
+
+
+async def ensure_hierarchy(db):
+    """Índice do caminho + backfill (chamado no startup do servidor)"""
+    try:
+        await db.resellers.create_index([("ancestors", 1)])
+        await backfill_paths(db)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao materializar hierarquia de revendas: {e}")
@@ -6,8 +6,13 @@ from fastapi import APIRouter, HTTPException, Depends, Header, Request
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import bcrypt
+from password_hasher import password_hasher
 from models import *
+from config_replication import config_replication
+from reseller_hierarchy import ancestry_for, full_tree, move_subtree, HierarchyError
+from ticket_counters import ticket_counters
+from audit_logger import audit_logger
+from rate_limiter import client_ip
 import jwt
 import logging
 import re
@@ -23,6 +28,7 @@ def create_token(user_id: str, user_type: str, reseller_id: Optional[str] = None
         "user_id": user_id,
         "user_type": user_type,
         "reseller_id": reseller_id,
+        "iat": datetime.now(timezone.utc),
         "exp": datetime.now(timezone.utc) + timedelta(days=365)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -44,17 +50,14 @@ def get_db_dep():
     from server import db
     return db
 
-# Helper: calcular nível hierárquico
-async def calculate_level(parent_id: Optional[str], db) -> int:
-    """Calcula o nível baseado no parent_id"""
-    if not parent_id:
-        return 0  # Nível raiz
-    
-    parent = await db.resellers.find_one({"id": parent_id})
-    if not parent:
+# Helper: calcular caminho e nível hierárquico
+async def calculate_ancestry(parent_id: Optional[str], db) -> tuple[list, int]:
+    """Calcula (ancestors, level) baseado no parent_id"""
+    ancestry = await ancestry_for(db, parent_id)
+    if ancestry is None:
         raise HTTPException(status_code=404, detail="Revenda pai não encontrada")
     
-    return parent.get("level", 0) + 1
+    return ancestry
 
 # Helper: contar filhos
 async def count_children(reseller_id: str, db) -> int:
@@ -106,8 +109,15 @@ async def reseller_login(data: ResellerLogin, request: Request):
     
     logger.info(f"Reseller found: {reseller is not None}")
     
-    if not reseller or not bcrypt.checkpw(data.password.encode(), reseller["pass_hash"].encode()):
+    if not reseller:
+        await audit_logger.log_login(data.email, "reseller", tenant_ctx.reseller_id, ip_address=client_ip(request), success=False)
+        raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+    password_valid, new_hash = await password_hasher.verify_and_update(data.password, reseller["pass_hash"])
+    if not password_valid:
+        await audit_logger.log_login(reseller["id"], "reseller", reseller["id"], ip_address=client_ip(request), success=False)
         raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+    if new_hash:
+        await db.resellers.update_one({"id": reseller["id"]}, {"$set": {"pass_hash": new_hash}})
     
     if not reseller.get("is_active", True):
         raise HTTPException(status_code=403, detail="Revenda desativada")
@@ -124,6 +134,7 @@ async def reseller_login(data: ResellerLogin, request: Request):
         logger.info(f"✅ Login authorized - Subscription active for reseller: {reseller['id']}")
     
     token = create_token(reseller["id"], "reseller", reseller["id"])
+    await audit_logger.log_login(reseller["id"], "reseller", reseller["id"], ip_address=client_ip(request))
     
     return TokenResponse(
         token=token,
@@ -177,7 +188,7 @@ async def register_reseller_trial(data: dict):
             detail="Erro ao gerar ID único. Tente novamente."
         )
     
-    pass_hash = bcrypt.hashpw(data["password"].encode(), bcrypt.gensalt()).decode()
+    pass_hash = await password_hasher.hash(data["password"])
     
     reseller = {
         "id": reseller_id,
@@ -190,6 +201,7 @@ async def register_reseller_trial(data: dict):
         "test_domain_active": True,
         "is_active": True,
         "parent_id": None,
+        "ancestors": [],
         "level": 0,
         "client_logo_url": "https://customer-assets.emergentagent.com/job_535f0fc0-1515-4938-9910-2bc0af524212/artifacts/qwn9iyvo_image.png",
         "created_at": datetime.now(timezone.utc).isoformat()
@@ -287,23 +299,7 @@ async def get_hierarchy(current_user: dict = Depends(get_current_user)):
     
     db = get_db_dep()
     
-    async def build_tree(parent_id: Optional[str] = None) -> List[dict]:
-        """Constrói árvore hierárquica recursivamente"""
-        resellers = await db.resellers.find(
-            {"parent_id": parent_id},
-            {"_id": 0, "pass_hash": 0}
-        ).to_list(None)
-        
-        tree = []
-        for reseller in resellers:
-            reseller["children"] = await build_tree(reseller["id"])
-            reseller["children_count"] = len(reseller["children"])
-            tree.append(reseller)
-        
-        return tree
-    
-    # Começar da raiz (parent_id = None)
-    hierarchy = await build_tree(None)
+    hierarchy = await full_tree(db)
     return {"hierarchy": hierarchy}
 
 # Get single reseller details
@@ -353,8 +349,8 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
     if existing:
         raise HTTPException(status_code=400, detail="Email já cadastrado")
     
-    # Calcular nível
-    level = await calculate_level(parent_id, db)
+    # Calcular caminho e nível
+    ancestors, level = await calculate_ancestry(parent_id, db)
     
     reseller_id = str(uuid.uuid4())
     
@@ -369,7 +365,7 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
         # Gerar automaticamente: {nome_revenda}.suporte.help
         test_domain = f"{subdomain_slug}.suporte.help"
     
-    pass_hash = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt()).decode()
+    pass_hash = await password_hasher.hash(data.password)
     
     reseller = {
         "id": reseller_id,
@@ -382,6 +378,7 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
         "test_domain_active": True,
         "is_active": True,
         "parent_id": parent_id,
+        "ancestors": ancestors,
         "level": level,
         "first_login": True,
         "created_at": datetime.now(timezone.utc).isoformat()
@@ -440,7 +437,7 @@ async def update_reseller(reseller_id: str, data: dict, current_user: dict = Dep
     if "is_active" in data and current_user["user_type"] == "admin":
         update_data["is_active"] = data["is_active"]
     if "password" in data and data["password"]:
-        update_data["pass_hash"] = bcrypt.hashpw(data["password"].encode(), bcrypt.gensalt()).decode()
+        update_data["pass_hash"] = await password_hasher.hash(data["password"])
     if "client_logo_url" in data:
         update_data["client_logo_url"] = data["client_logo_url"]
     
@@ -464,38 +461,15 @@ async def transfer_reseller(data: ResellerTransfer, current_user: dict = Depends
     
     # Validar novo pai (se não for None)
     if data.new_parent_id:
-        new_parent = await db.resellers.find_one({"id": data.new_parent_id})
+        new_parent = await db.resellers.find_one({"id": data.new_parent_id}, {"_id": 0, "id": 1})
         if not new_parent:
             raise HTTPException(status_code=404, detail="Nova revenda pai não encontrada")
-        
-        # Não pode ser filha de si mesma
-        if data.new_parent_id == data.reseller_id:
-            raise HTTPException(status_code=400, detail="Revenda não pode ser filha de si mesma")
     
-    # Calcular novo nível
-    new_level = await calculate_level(data.new_parent_id, db)
-    
-    # Atualizar revenda
-    await db.resellers.update_one(
-        {"id": data.reseller_id},
-        {"$set": {
-            "parent_id": data.new_parent_id,
-            "level": new_level
-        }}
-    )
-    
-    # Atualizar níveis de todas as sub-revendas recursivamente
-    async def update_children_levels(parent_id: str, base_level: int):
-        children = await db.resellers.find({"parent_id": parent_id}).to_list(None)
-        for child in children:
-            new_child_level = base_level + 1
-            await db.resellers.update_one(
-                {"id": child["id"]},
-                {"$set": {"level": new_child_level}}
-            )
-            await update_children_levels(child["id"], new_child_level)
-    
-    await update_children_levels(data.reseller_id, new_level)
+    # Mover revenda e sub-revendas (caminho + nível) em um único update_many
+    try:
+        await move_subtree(db, data.reseller_id, data.new_parent_id)
+    except HierarchyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     logger.info(f"Reseller transferred: {reseller['name']} -> New Parent: {data.new_parent_id}")
     
@@ -522,6 +496,7 @@ async def delete_reseller(reseller_id: str, current_user: dict = Depends(get_cur
     await db.agents.delete_many({"reseller_id": reseller_id})
     await db.users.delete_many({"reseller_id": reseller_id})
     await db.tickets.delete_many({"reseller_id": reseller_id})
+    await ticket_counters.drop_tenant(db, reseller_id)
     await db.messages.delete_many({"reseller_id": reseller_id})
     await db.notices.delete_many({"reseller_id": reseller_id})
     
@@ -581,26 +556,22 @@ async def replicate_config_to_resellers(current_user: dict = Depends(get_current
     db = get_db_dep()
     
     # Get main config
-    main_config = await db.config.find_one({"id": "config"})
+    main_config = await db.config.find_one({"id": "config"}, {"_id": 0, "id": 1})
     if not main_config:
         return {"ok": False, "message": "Configuração principal não encontrada"}
     
-    # Get all resellers
-    resellers = await db.resellers.find({}, {"id": 1}).to_list(None)
-    
-    updated_count = 0
-    for reseller in resellers:
-        await db.reseller_configs.update_one(
-            {"reseller_id": reseller["id"]},
-            {"$set": {
-                "quick_blocks": main_config.get("quick_blocks", []),
-                "auto_reply": main_config.get("auto_reply", []),
-                "apps": main_config.get("apps", [])
-            }},
-            upsert=True
-        )
-        updated_count += 1
+    # Replicação em lotes em background (revendas já iguais são puladas)
+    job = await config_replication.start(db, "basic", started_by=current_user["user_id"])
+    await audit_logger.log_config_change(
+        current_user["user_id"], "admin", None, "replication_basic",
+        old_value=None, new_value={"job_id": job["id"], "total": job["total"]}
+    )
     
-    logger.info(f"Config replicated to {updated_count} resellers")
+    logger.info(f"Config replication job {job['id']} started for {job['total']} resellers")
     
-    return {"ok": True, "updated": updated_count, "message": f"Configuração replicada para {updated_count} revenda(s)"}
+    return {
+        "ok": True,
+        "job_id": job["id"],
+        "status": job["status"],
+        "message": f"Replicação iniciada para {job['total']} revenda(s)"
+    }
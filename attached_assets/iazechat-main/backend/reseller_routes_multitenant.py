@@ -6,8 +6,11 @@ from fastapi import APIRouter, HTTPException, Depends, Header, Request
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import bcrypt
+from password_hasher import password_hasher
 from models import *
+from config_replication import config_replication
+from reseller_hierarchy import ancestry_for, full_tree, subtree, move_subtree, HierarchyError
+from ticket_counters import ticket_counters
 import jwt
 import logging
 import re
@@ -23,6 +26,7 @@ def create_token(user_id: str, user_type: str, reseller_id: Optional[str] = None
         "user_id": user_id,
         "user_type": user_type,
         "reseller_id": reseller_id,
+        "iat": datetime.now(timezone.utc),
         "exp": datetime.now(timezone.utc) + timedelta(days=365)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -44,17 +48,14 @@ def get_db_dep():
     from server import db
     return db
 
-# Helper: calcular nível hierárquico
-async def calculate_level(parent_id: Optional[str], db) -> int:
-    """Calcula o nível baseado no parent_id"""
-    if not parent_id:
-        return 0  # Nível raiz
-    
-    parent = await db.resellers.find_one({"id": parent_id})
-    if not parent:
+# Helper: calcular caminho e nível hierárquico
+async def calculate_ancestry(parent_id: Optional[str], db) -> tuple[list, int]:
+    """Calcula (ancestors, level) baseado no parent_id"""
+    ancestry = await ancestry_for(db, parent_id)
+    if ancestry is None:
         raise HTTPException(status_code=404, detail="Revenda pai não encontrada")
     
-    return parent.get("level", 0) + 1
+    return ancestry
 
 # Helper: contar filhos
 async def count_children(reseller_id: str, db) -> int:
@@ -74,8 +75,13 @@ async def can_delete_reseller(reseller_id: str, db) -> tuple[bool, str]:
 async def reseller_login(data: ResellerLogin):
     db = get_db_dep()
     reseller = await db.resellers.find_one({"email": data.email})
-    if not reseller or not bcrypt.checkpw(data.password.encode(), reseller["pass_hash"].encode()):
+    if not reseller:
+        raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+    password_valid, new_hash = await password_hasher.verify_and_update(data.password, reseller["pass_hash"])
+    if not password_valid:
         raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+    if new_hash:
+        await db.resellers.update_one({"id": reseller["id"]}, {"$set": {"pass_hash": new_hash}})
     
     if not reseller.get("is_active", True):
         raise HTTPException(status_code=403, detail="Revenda desativada")
@@ -116,11 +122,11 @@ async def change_password(data: dict, current_user: dict = Depends(get_current_u
     
     # Se first_login, não precisa validar senha antiga
     if not reseller.get("first_login", False):
-        if not old_password or not bcrypt.checkpw(old_password.encode(), reseller["pass_hash"].encode()):
+        if not old_password or not await password_hasher.verify(old_password, reseller["pass_hash"]):
             raise HTTPException(status_code=401, detail="Senha atual incorreta")
     
     # Atualizar senha
-    new_pass_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
+    new_pass_hash = await password_hasher.hash(new_password)
     
     await db.resellers.update_one(
         {"id": current_user["user_id"]},
@@ -157,31 +163,20 @@ async def list_resellers(current_user: dict = Depends(get_current_user)):
     
     return resellers
 
-# Get reseller hierarchy tree (admin only)
+# Get reseller hierarchy tree (admin: completa, reseller: sub-árvore)
 @reseller_router.get("/hierarchy")
 async def get_hierarchy(current_user: dict = Depends(get_current_user)):
-    if current_user["user_type"] != "admin":
-        raise HTTPException(status_code=403, detail="Não autorizado")
-    
     db = get_db_dep()
     
-    async def build_tree(parent_id: Optional[str] = None) -> List[dict]:
-        """Constrói árvore hierárquica recursivamente"""
-        resellers = await db.resellers.find(
-            {"parent_id": parent_id},
-            {"_id": 0, "pass_hash": 0}
-        ).to_list(None)
-        
-        tree = []
-        for reseller in resellers:
-            reseller["children"] = await build_tree(reseller["id"])
-            reseller["children_count"] = len(reseller["children"])
-            tree.append(reseller)
-        
-        return tree
-    
-    # Começar da raiz (parent_id = None)
-    hierarchy = await build_tree(None)
+    # Admin vê a árvore inteira; revenda vê a própria sub-árvore
+    if current_user["user_type"] == "admin":
+        hierarchy = await full_tree(db)
+    elif current_user["user_type"] == "reseller":
+        root = await subtree(db, current_user["user_id"])
+        hierarchy = [root] if root else []
+    else:
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
     return {"hierarchy": hierarchy}
 
 # Get single reseller details
@@ -231,8 +226,8 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
     if existing:
         raise HTTPException(status_code=400, detail="Email já cadastrado")
     
-    # Calcular nível
-    level = await calculate_level(parent_id, db)
+    # Calcular caminho e nível
+    ancestors, level = await calculate_ancestry(parent_id, db)
     
     reseller_id = str(uuid.uuid4())
     
@@ -248,7 +243,7 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
     
     # Usar senha fornecida ou senha padrão
     password = data.password if hasattr(data, 'password') and data.password else "admin123"
-    pass_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    pass_hash = await password_hasher.hash(password)
     
     reseller = {
         "id": reseller_id,
@@ -261,6 +256,7 @@ async def create_reseller(data: ResellerCreate, current_user: dict = Depends(get
         "test_domain_active": True,
         "is_active": True,
         "parent_id": parent_id,
+        "ancestors": ancestors,
         "level": level,
         "first_login": True,  # Forçar troca de senha no primeiro acesso
         "created_at": datetime.now(timezone.utc).isoformat()
@@ -324,7 +320,7 @@ async def update_reseller(reseller_id: str, data: dict, current_user: dict = Dep
     if "is_active" in data and current_user["user_type"] == "admin":
         update_data["is_active"] = data["is_active"]
     if "password" in data and data["password"]:
-        update_data["pass_hash"] = bcrypt.hashpw(data["password"].encode(), bcrypt.gensalt()).decode()
+        update_data["pass_hash"] = await password_hasher.hash(data["password"])
     
     if update_data:
         await db.resellers.update_one({"id": reseller_id}, {"$set": update_data})
@@ -346,38 +342,15 @@ async def transfer_reseller(data: ResellerTransfer, current_user: dict = Depends
     
     # Validar novo pai (se não for None)
     if data.new_parent_id:
-        new_parent = await db.resellers.find_one({"id": data.new_parent_id})
+        new_parent = await db.resellers.find_one({"id": data.new_parent_id}, {"_id": 0, "id": 1})
         if not new_parent:
             raise HTTPException(status_code=404, detail="Nova revenda pai não encontrada")
-        
-        # Não pode ser filha de si mesma
-        if data.new_parent_id == data.reseller_id:
-            raise HTTPException(status_code=400, detail="Revenda não pode ser filha de si mesma")
     
-    # Calcular novo nível
-    new_level = await calculate_level(data.new_parent_id, db)
-    
-    # Atualizar revenda
-    await db.resellers.update_one(
-        {"id": data.reseller_id},
-        {"$set": {
-            "parent_id": data.new_parent_id,
-            "level": new_level
-        }}
-    )
-    
-    # Atualizar níveis de todas as sub-revendas recursivamente
-    async def update_children_levels(parent_id: str, base_level: int):
-        children = await db.resellers.find({"parent_id": parent_id}).to_list(None)
-        for child in children:
-            new_child_level = base_level + 1
-            await db.resellers.update_one(
-                {"id": child["id"]},
-                {"$set": {"level": new_child_level}}
-            )
-            await update_children_levels(child["id"], new_child_level)
-    
-    await update_children_levels(data.reseller_id, new_level)
+    # Mover revenda e sub-revendas (caminho + nível) em um único update_many
+    try:
+        await move_subtree(db, data.reseller_id, data.new_parent_id)
+    except HierarchyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     logger.info(f"Reseller transferred: {reseller['name']} -> New Parent: {data.new_parent_id}")
     
@@ -404,6 +377,7 @@ async def delete_reseller(reseller_id: str, current_user: dict = Depends(get_cur
     await db.agents.delete_many({"reseller_id": reseller_id})
     await db.users.delete_many({"reseller_id": reseller_id})
     await db.tickets.delete_many({"reseller_id": reseller_id})
+    await ticket_counters.drop_tenant(db, reseller_id)
     await db.messages.delete_many({"reseller_id": reseller_id})
     await db.notices.delete_many({"reseller_id": reseller_id})
     
@@ -463,26 +437,18 @@ async def replicate_config_to_resellers(current_user: dict = Depends(get_current
     db = get_db_dep()
     
     # Get main config
-    main_config = await db.config.find_one({"id": "config"})
+    main_config = await db.config.find_one({"id": "config"}, {"_id": 0, "id": 1})
     if not main_config:
         return {"ok": False, "message": "Configuração principal não encontrada"}
     
-    # Get all resellers
-    resellers = await db.resellers.find({}, {"id": 1}).to_list(None)
+    # Replicação em lotes em background (revendas já iguais são puladas)
+    job = await config_replication.start(db, "basic", started_by=current_user["user_id"])
     
-    updated_count = 0
-    for reseller in resellers:
-        await db.reseller_configs.update_one(
-            {"reseller_id": reseller["id"]},
-            {"$set": {
-                "quick_blocks": main_config.get("quick_blocks", []),
-                "auto_reply": main_config.get("auto_reply", []),
-                "apps": main_config.get("apps", [])
-            }},
-            upsert=True
-        )
-        updated_count += 1
-    
-    logger.info(f"Config replicated to {updated_count} resellers")
-    
-    return {"ok": True, "updated": updated_count, "message": f"Configuração replicada para {updated_count} revenda(s)"}
+    logger.info(f"Config replication job {job['id']} started for {job['total']} resellers")
+    
+    return {
+        "ok": True,
+        "job_id": job["id"],
+        "status": job["status"],
+        "message": f"Replicação iniciada para {job['total']} revenda(s)"
+    }
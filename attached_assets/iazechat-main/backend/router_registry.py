@@ -0,0 +1,99 @@
+"""
+Registro declarativo dos routers montados pelo server.py
+
+Antes eram ~25 blocos try/except no fim do server.py, todos importados sempre.
+Aqui cada router é uma linha; include_routers() importa e monta em ordem:
+
+- feature desligada (feature_flags) -> o módulo nem é importado
+- falha no import de um router não derruba o servidor (log com traceback)
+- o tempo de import + montagem de cada um vai para o startup_profile
+
+Para adicionar um router: inclua o RouterSpec na posição desejada (a ordem é a
+ordem de montagem, que decide qual rota casa primeiro em caminhos iguais).
+"""
+import importlib
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+from feature_flags import is_enabled
+from startup_profile import startup_profile
+
+logger = logging.getLogger(__name__)
+
+
+class RouterSpec(NamedTuple):
+    module: str
+    attr: str = "router"
+    prefix: str = ""
+    tags: Optional[List[str]] = None
+    feature: Optional[str] = None
+
+
+ROUTER_REGISTRY: List[RouterSpec] = [
+    RouterSpec("reseller_routes", "reseller_router"),
+    RouterSpec("ai_agent_routes", "ai_router", prefix="/api"),
+    RouterSpec("whatsapp_routes", prefix="/api/whatsapp"),
+    RouterSpec("whatsapp_webhook_handler", prefix="/api"),
+    RouterSpec("push_notification_routes", "push_router", prefix="/api"),
+    RouterSpec("payment_routes", prefix="/api"),
+    RouterSpec("webhook_routes", prefix="/api"),
+    RouterSpec("admin_payment_routes", prefix="/api"),
+    RouterSpec("dashboard_routes", prefix="/api"),
+    # Sistema de Vendas CyberTV
+    RouterSpec("vendas_routes_new"),
+    # Office (gestor.my): busca, sincronização e credenciais
+    RouterSpec("office_routes", prefix="/api", tags=["office"], feature="office"),
+    RouterSpec("office_sync_routes", feature="office"),
+    RouterSpec("office_credentials_routes", feature="office"),
+    # XUI (IPTV)
+    RouterSpec("xui_routes", feature="xui"),
+    RouterSpec("scheduled_messages_routes", prefix="/api", tags=["scheduled_messages"]),
+    RouterSpec("reminder_routes", prefix="/api", tags=["reminders"]),
+    RouterSpec("credential_auto_search_routes", prefix="/api", tags=["credential_search"], feature="office"),
+    RouterSpec("client_name_routes"),
+    RouterSpec("ai_memory_routes"),
+    RouterSpec("vendas_bot_config_routes"),
+    # IPTV, Planos WhatsApp, Mercado Pago, etc
+    RouterSpec("admin_extensions_routes", prefix="/api"),
+    RouterSpec("vendas_simple_config_routes_v2"),
+    RouterSpec("correct_wrong_knowledge"),
+    RouterSpec("ai_learning_routes"),
+    # Áudio, imagem e vídeo (Whisper / GPT-4o)
+    RouterSpec("media_routes", feature="media_ai"),
+    RouterSpec("backup_routes", prefix="/api"),
+    # Botões interativos WA Site (admin + página pública)
+    RouterSpec("vendas_buttons_routes"),
+    RouterSpec("vendas_buttons_routes", "public_router"),
+    RouterSpec("simple_download", prefix="/api"),
+]
+
+
+def include_routers(app, registry: List[RouterSpec] = ROUTER_REGISTRY) -> Dict[str, List[str]]:
+    """
+    Importa e monta os routers habilitados
+
+    Returns:
+        {"loaded": [...], "skipped": [...], "failed": [...]} (module.attr)
+    """
+    summary = {"loaded": [], "skipped": [], "failed": []}
+    for spec in registry:
+        name = f"{spec.module}.{spec.attr}"
+        if spec.feature and not is_enabled(spec.feature):
+            summary["skipped"].append(name)
+            continue
+        try:
+            with startup_profile.measure(f"router:{name}", "router"):
+                router = getattr(importlib.import_module(spec.module), spec.attr)
+                app.include_router(router, prefix=spec.prefix, tags=spec.tags)
+            summary["loaded"].append(name)
+        except Exception as e:
+            summary["failed"].append(name)
+            logger.error(f"❌ Failed to load {name}: {e}", exc_info=True)
+
+    logger.info(
+        f"✅ Routers: {len(summary['loaded'])} carregados, "
+        f"{len(summary['skipped'])} desligados por feature flag, {len(summary['failed'])} com erro"
+    )
+    if summary["skipped"]:
+        logger.info(f"⏸️ Routers desligados: {', '.join(summary['skipped'])}")
+    return summary
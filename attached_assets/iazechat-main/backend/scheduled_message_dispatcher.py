@@ -0,0 +1,229 @@
+"""
+Dispatcher de mensagens agendadas (em processo, seguro com vários workers)
+
+- A cada POLL_SECONDS cada worker "reivindica" mensagens vencidas com
+  find_one_and_update: status pending -> sending + lease (lease_owner/lease_until).
+  Só um worker ganha cada mensagem; lease expirado (worker morreu no meio) volta
+  a ser reivindicável.
+- Lotes de até BATCH_SIZE: tickets carregados com UMA consulta ($in) e entregas
+  em paralelo pelo mesmo caminho das respostas de atendente (deliver_agent_message:
+  WebSocket, WhatsApp e push do PWA).
+- Falha na entrega: volta para pending com retry_at (backoff exponencial) até
+  MAX_ATTEMPTS; depois fica como failed. A mensagem no chat é gravada uma vez só
+  (message_id guardado no agendamento) mesmo com novas tentativas.
+- Canais já entregues ficam em delivered_channels: nova tentativa repete só o
+  WhatsApp, sem reenviar o evento do WebSocket nem o push do PWA.
+"""
+import os
+import socket
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+from timestamps import HIDDEN_TYPED_FIELDS, stamp
+from metrics import loop_tick
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = float(os.environ.get("SCHEDULED_MESSAGES_POLL_SECONDS", "15"))
+BATCH_SIZE = int(os.environ.get("SCHEDULED_MESSAGES_BATCH_SIZE", "20"))
+LEASE_SECONDS = int(os.environ.get("SCHEDULED_MESSAGES_LEASE_SECONDS", "120"))
+MAX_ATTEMPTS = int(os.environ.get("SCHEDULED_MESSAGES_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE_SECONDS = int(os.environ.get("SCHEDULED_MESSAGES_BACKOFF_SECONDS", "30"))
+
+DeliverFn = Callable[..., Awaitable[Dict]]
+
+
+class DeliveryError(Exception):
+    """Entrega falhou em um canal externo (vale nova tentativa)"""
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ScheduledMessageDispatcher:
+    """Reivindica e entrega mensagens agendadas vencidas"""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = None
+        self.deliver: Optional[DeliverFn] = None
+
+    def attach(self, db, deliver: DeliverFn):
+        self.db = db
+        self.deliver = deliver
+
+    async def ensure_indexes(self):
+        try:
+            await self.db.scheduled_messages.create_index([("status", 1), ("scheduled_datetime", 1)])
+            await self.db.scheduled_messages.create_index([("status", 1), ("lease_until", 1)])
+            await self.db.scheduled_messages.create_index([("id", 1)])
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de scheduled_messages: {e}")
+
+    # ------------------------------------------------------------------
+    # Reivindicação
+    # ------------------------------------------------------------------
+
+    async def _claim_one(self) -> Optional[Dict]:
+        now = datetime.now(timezone.utc)
+        now_iso = now.isoformat()
+        return await self.db.scheduled_messages.find_one_and_update(
+            {"$or": [
+                {
+                    "status": "pending",
+                    "scheduled_datetime": {"$lte": now_iso},
+                    "retry_at": {"$not": {"$gt": now_iso}}
+                },
+                # Lease expirado: worker caiu durante a entrega
+                {"status": "sending", "lease_until": {"$lt": now_iso}}
+            ]},
+            {"$set": {
+                "status": "sending",
+                "lease_owner": self.worker_id,
+                "lease_until": (now + timedelta(seconds=LEASE_SECONDS)).isoformat()
+            }},
+            sort=[("scheduled_datetime", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def claim_batch(self) -> List[Dict]:
+        batch = []
+        while len(batch) < BATCH_SIZE:
+            msg = await self._claim_one()
+            if not msg:
+                break
+            batch.append(msg)
+        return batch
+
+    # ------------------------------------------------------------------
+    # Entrega
+    # ------------------------------------------------------------------
+
+    async def _deliver_one(self, msg: Dict, ticket: Optional[Dict]) -> bool:
+        owned = {"id": msg["id"], "lease_owner": self.worker_id, "status": "sending"}
+
+        if not ticket:
+            logger.warning(f"⚠️ Ticket {msg['ticket_id']} não encontrado")
+            await self.db.scheduled_messages.update_one(
+                owned,
+                {"$set": {"status": "failed", "error": "Ticket não encontrado"},
+                 "$unset": {"lease_owner": "", "lease_until": ""}}
+            )
+            return False
+
+        delivered = set(msg.get("delivered_channels") or [])
+        try:
+            message = await self._chat_message(msg, ticket)
+            channels = {"websocket": "websocket" not in delivered, "push": "push" not in delivered}
+            result = await self.deliver(message, ticket=ticket, **channels)
+            
+            # WebSocket e push são melhor esforço: uma vez chamados, não se repetem
+            done = [name for name, sent in channels.items() if sent]
+            if result.get("whatsapp"):
+                done.append("whatsapp")
+            if done:
+                await self.db.scheduled_messages.update_one(
+                    {"id": msg["id"]}, {"$addToSet": {"delivered_channels": {"$each": done}}}
+                )
+            
+            if result.get("whatsapp") is False:
+                raise DeliveryError(result.get("whatsapp_error") or "Falha ao enviar via WhatsApp")
+        except Exception as e:
+            await self._schedule_retry(msg, str(e))
+            return False
+
+        await self.db.scheduled_messages.update_one(
+            owned,
+            {"$set": {"status": "sent", "sent_at": _now_iso()},
+             "$unset": {"lease_owner": "", "lease_until": "", "retry_at": ""}}
+        )
+        logger.info(f"✅ Mensagem agendada enviada: {msg['id']}")
+        return True
+
+    async def _chat_message(self, msg: Dict, ticket: Dict) -> Dict:
+        """Grava a mensagem no chat (uma vez só, mesmo com novas tentativas)"""
+        if msg.get("message_id"):
+            # Sem os campos BSON tipados: a mensagem vai para o WebSocket (send_json)
+            existing = await self.db.messages.find_one({"id": msg["message_id"]}, {"_id": 0, **HIDDEN_TYPED_FIELDS})
+            if existing:
+                return existing
+
+        message = {
+            "id": str(uuid.uuid4()),
+            "ticket_id": msg["ticket_id"],
+            "from_type": "agent",
+            "from_id": msg.get("agent_id") or ticket.get("agent_id") or "scheduler",
+            "from_name": "Sistema (Agendado)",
+            "to_type": "client",
+            "to_id": ticket.get("client_id"),
+            "kind": "text",
+            "text": msg["message"],
+            "file_url": "",
+            "reseller_id": ticket.get("reseller_id"),
+            "read": True,
+            "created_at": _now_iso(),
+            "is_scheduled": True,
+            "scheduled_message_id": msg["id"]
+        }
+        await self.db.messages.insert_one(stamp(message))
+        await self.db.scheduled_messages.update_one({"id": msg["id"]}, {"$set": {"message_id": message["id"]}})
+        message.pop("_id", None)
+        return message
+
+    async def _schedule_retry(self, msg: Dict, error: str):
+        attempts = msg.get("attempts", 0) + 1
+        update = {"$set": {"attempts": attempts, "error": error}, "$unset": {"lease_owner": "", "lease_until": ""}}
+        if attempts >= MAX_ATTEMPTS:
+            update["$set"]["status"] = "failed"
+            logger.error(f"❌ Mensagem agendada {msg['id']} falhou após {attempts} tentativas: {error}")
+        else:
+            delay = BACKOFF_BASE_SECONDS * (2 ** (attempts - 1))
+            update["$set"]["status"] = "pending"
+            update["$set"]["retry_at"] = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+            logger.warning(f"⚠️ Mensagem agendada {msg['id']} falhou ({error}); nova tentativa em {delay}s")
+        await self.db.scheduled_messages.update_one(
+            {"id": msg["id"], "lease_owner": self.worker_id, "status": "sending"},
+            update
+        )
+
+    async def dispatch_due(self) -> Dict:
+        """Processa todos os lotes vencidos agora; retorna contagem"""
+        processed = sent = 0
+        while True:
+            batch = await self.claim_batch()
+            if not batch:
+                break
+            ticket_ids = list({msg["ticket_id"] for msg in batch})
+            tickets = {
+                t["id"]: t
+                for t in await self.db.tickets.find({"id": {"$in": ticket_ids}}, {"_id": 0}).to_list(None)
+            }
+            results = await asyncio.gather(
+                *(self._deliver_one(msg, tickets.get(msg["ticket_id"])) for msg in batch)
+            )
+            processed += len(batch)
+            sent += sum(1 for r in results if r)
+        return {"processed": processed, "sent": sent}
+
+    async def run(self):
+        """Loop do dispatcher (iniciado no startup do servidor)"""
+        await self.ensure_indexes()
+        while True:
+            try:
+                async with loop_tick("scheduled_dispatcher"):
+                    result = await self.dispatch_due()
+                if result["processed"]:
+                    logger.info(f"📨 Mensagens agendadas: {result['sent']}/{result['processed']} enviadas")
+            except Exception as e:
+                logger.error(f"❌ Erro no dispatcher de mensagens agendadas: {e}")
+            await asyncio.sleep(POLL_SECONDS)
+
+
+# Instância global
+scheduled_dispatcher = ScheduledMessageDispatcher()
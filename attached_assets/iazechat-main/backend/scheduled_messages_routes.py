@@ -3,6 +3,7 @@ Rotas para Agendamento de Mensagens
 """
 from fastapi import APIRouter, HTTPException, Depends, Request, BackgroundTasks
 from scheduled_messages_models import ScheduleMessageRequest, ScheduledMessage
+from scheduled_message_dispatcher import scheduled_dispatcher
 from datetime import datetime, timezone, timedelta
 import uuid
 import logging
@@ -153,72 +154,15 @@ async def cancel_scheduled_message(message_id: str, db=Depends(get_db)):
 @router.post("/send-scheduled-messages")
 async def process_scheduled_messages(db=Depends(get_db)):
     """
-    Processa e envia mensagens agendadas que já passaram do horário
-    (Chamado por cron/scheduler a cada minuto)
+    Processa e envia agora as mensagens agendadas que já passaram do horário
+    (o dispatcher em background já faz isso a cada poucos segundos; esta rota força uma rodada)
     """
     try:
-        now = datetime.now(timezone.utc)
-        
-        # Buscar mensagens pendentes que já passaram do horário
-        messages = await db.scheduled_messages.find({
-            "status": "pending",
-            "scheduled_datetime": {"$lte": now.isoformat()}
-        }).to_list(length=50)
-        
-        sent_count = 0
-        
-        for msg in messages:
-            try:
-                # Buscar ticket
-                ticket = await db.tickets.find_one({"id": msg["ticket_id"]})
-                
-                if not ticket:
-                    logger.warning(f"⚠️ Ticket {msg['ticket_id']} não encontrado")
-                    await db.scheduled_messages.update_one(
-                        {"id": msg["id"]},
-                        {"$set": {"status": "failed", "error": "Ticket não encontrado"}}
-                    )
-                    continue
-                
-                # Criar mensagem no ticket
-                message_doc = {
-                    "message_id": str(uuid.uuid4()),
-                    "ticket_id": msg["ticket_id"],
-                    "from_type": "agent",
-                    "from_name": "Sistema (Agendado)",
-                    "text": msg["message"],
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "is_scheduled": True
-                }
-                
-                await db.messages.insert_one(message_doc)
-                
-                # Atualizar status da mensagem agendada
-                await db.scheduled_messages.update_one(
-                    {"id": msg["id"]},
-                    {"$set": {
-                        "status": "sent",
-                        "sent_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                sent_count += 1
-                logger.info(f"✅ Mensagem agendada enviada: {msg['id']}")
-                
-                # TODO: Integrar com WhatsApp Evolution ou WA Suporte PWA se necessário
-                # Por enquanto, apenas cria a mensagem no IAZE
-                
-            except Exception as e:
-                logger.error(f"❌ Erro ao enviar mensagem agendada {msg['id']}: {e}")
-                await db.scheduled_messages.update_one(
-                    {"id": msg["id"]},
-                    {"$set": {"status": "failed", "error": str(e)}}
-                )
+        result = await scheduled_dispatcher.dispatch_due()
         
         return {
             "success": True,
-            "processed": len(messages),
-            "sent": sent_count
+            **result
         }
         
     except Exception as e:
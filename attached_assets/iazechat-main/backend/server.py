@@ -1,10 +1,11 @@
+# Primeiro import: o perfil de startup mede o import do server.py a partir daqui
+from startup_profile import startup_profile
 from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect, Depends, Header, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import socket
 import logging
@@ -13,32 +14,38 @@ from pathlib import Path
 from typing import List, Optional, Dict, Set, Tuple, Any
 import uuid
 from datetime import datetime, timezone, timedelta
-import bcrypt
 import jwt
 import aiofiles
 from models import *
 from tenant_middleware import detect_tenant, get_current_tenant, apply_tenant_filter, TenantContext, tenant_context as global_tenant_context
 from tenant_helpers import get_tenant_filter, get_request_tenant, Tenant
 from ai_service import ai_service
+from ai_context_builder import context_builder, messages_to_history
+from ticket_counters import ticket_counters
+from presence_service import presence_service
+from config_replication import config_replication
+from audit_logger import audit_logger
+from password_hasher import password_hasher
+from principal_cache import principal_cache
+from scheduled_message_dispatcher import scheduled_dispatcher
+from timestamps import stamp, typed_value, HIDDEN_TYPED_FIELDS
+from query_profiler import query_profiler
+from database import get_client, get_db, close_client
+from feature_flags import FEATURES, is_enabled
+from router_registry import include_routers
+import metrics
+from metrics import MetricsMiddleware, loop_tick
+from logging_setup import logging_pipeline, RequestContextMiddleware, SAMPLED, bind_ticket
+from rate_limiter import rate_limiter, rate_limit, rate_limit_middleware, configure_rate_limiter, client_ip
 import mimetypes
 import re
 
-# Logger dedicado para IA (compartilhado com ai_service.py)
+# Logging em fila (formatação e I/O fora do event loop); "ai_agent" também vai
+# para /var/log/ai_agent.log - ver logging_setup.py
+logging_pipeline.configure()
 ai_logger = logging.getLogger("ai_agent")
-ai_logger.setLevel(logging.INFO)
-
-# Se não tiver handlers ainda, adicionar
-if not ai_logger.handlers:
-    file_handler = logging.FileHandler("/var/log/ai_agent.log")
-    file_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    file_handler.setFormatter(formatter)
-    ai_logger.addHandler(file_handler)
-    
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(formatter)
-    ai_logger.addHandler(console_handler)
+ws_logger = logging.getLogger("websocket")
+startup_profile.mark("server_imports", "import")
 
 # Função auxiliar para detectar formato de Usuário/Senha
 def extract_credentials_from_message(text: str) -> Tuple[Optional[str], Optional[str]]:
@@ -88,10 +95,10 @@ load_dotenv(ROOT_DIR / '.env')
 # Import external storage AFTER loading .env
 from external_storage_service import external_storage
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'support_chat')]
+# MongoDB connection: cliente único do processo, compartilhado com os módulos de
+# rotas/serviços (database.get_db) - ver database.py
+client = get_client()
+db = get_db()
 
 # JWT Secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'sua-chave-secreta-super-segura-aqui')
@@ -100,6 +107,7 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'sua-chave-secreta-super-segura-aqui')
 import dependencies
 dependencies.set_db(db)
 dependencies.set_secret_key(JWT_SECRET)
+principal_cache.attach(db, JWT_SECRET)
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
 
 # Uploads directory - PERSISTENTE com fallback
@@ -128,9 +136,15 @@ app.state.db = db
 @app.on_event("startup")
 async def startup_event():
     """Inicia background tasks ao iniciar o servidor"""
+    startup_profile.mark("uvicorn_boot", "import")
     asyncio.create_task(check_department_timeouts())
     asyncio.create_task(reactivate_ai_after_timeout())
-    print("✅ Background tasks iniciadas: timeout de departamentos e reativação de IA")
+    asyncio.create_task(ticket_counters.run_reconciler(db))
+    presence_service.attach(db, manager)
+    asyncio.create_task(presence_service.run())
+    scheduled_dispatcher.attach(db, deliver_agent_message)
+    asyncio.create_task(scheduled_dispatcher.run())
+    print("✅ Background tasks iniciadas: timeout de departamentos, reativação de IA, reconciliação de contadores e mensagens agendadas")
     
     # Iniciar scheduler de backup automático
     try:
@@ -139,14 +153,71 @@ async def startup_event():
         print("✅ Scheduler de backup automático iniciado")
     except Exception as e:
         print(f"❌ Erro ao iniciar scheduler de backup: {e}")
+    startup_profile.mark("background_tasks")
+    
+    # Memória da IA expira via índice TTL (expire_at) - sem scheduler de limpeza
+    try:
+        from ai_conversation_memory import conversation_memory
+        await conversation_memory.ensure_indexes(db)
+        print("✅ Índices TTL da memória da IA garantidos")
+        
+        # Conversas gravadas antes do TTL não têm expire_at: backfill em background
+        from ai_memory_cleanup_service import ai_memory_cleanup_service
+        asyncio.create_task(ai_memory_cleanup_service.cleanup_old_conversations(only_missing=True))
+    except Exception as e:
+        print(f"❌ Erro ao criar índices da memória da IA: {e}")
+    startup_profile.mark("ai_memory_indexes")
+    
+    # Rate limit: backend (memória/Mongo) + limpeza de chaves ociosas
+    backend = configure_rate_limiter(db)
+    if hasattr(backend, "ensure_indexes"):
+        await backend.ensure_indexes()
+    asyncio.create_task(rate_limiter.run_eviction())
+    startup_profile.mark("rate_limiter")
+    
+    # Lembretes de vencimento: índices de vencimento_at e dedup de reminder_logs
+    from reminder_service import reminder_service
+    await reminder_service.ensure_indexes(db)
+    
+    # Audit log em buffer (insert_many em lote) usando a conexão do servidor
+    await audit_logger.start(db)
+    startup_profile.mark("reminders_audit")
+    
+    # Pipeline de mídia: transcrição/vídeo em background, resultado via WebSocket
+    if is_enabled("media_ai"):
+        try:
+            from media_pipeline import media_pipeline
+            media_pipeline.attach(db, notify_media_processed)
+            await media_pipeline.start()
+            print("✅ Pipeline de mídia iniciado")
+        except Exception as e:
+            print(f"❌ Erro ao iniciar pipeline de mídia: {e}")
+        startup_profile.mark("media_pipeline")
+    
+    # Índices declarados no index_registry (idempotente)
+    from index_registry import apply_indexes
+    await apply_indexes(db)
+    startup_profile.mark("index_registry")
+    
+    # Timestamps tipados: migração das datas ISO para <campo>_dt em background
+    from timestamps import migrate_timestamps
+    asyncio.create_task(migrate_timestamps(db))
+    
+    # Principal autenticado: índices da lista de revogação de tokens
+    await principal_cache.ensure_indexes()
     
-    # Iniciar scheduler de limpeza de memória da IA
+    # Replicação de config: índices dos jobs + invalidação por revenda
+    await config_replication.ensure_indexes(db)
+    config_replication.add_listener(notify_config_replicated)
+    
+    # Hierarquia de revendas: índice do caminho + backfill de documentos antigos
     try:
-        from ai_memory_cleanup_scheduler import ai_memory_cleanup_scheduler
-        ai_memory_cleanup_scheduler.start()
-        print("✅ Scheduler de limpeza de memória da IA iniciado")
+        from reseller_hierarchy import ensure_hierarchy
+        await ensure_hierarchy(db)
+        print("✅ Hierarquia de revendas materializada")
     except Exception as e:
-        print(f"❌ Erro ao iniciar scheduler de limpeza de memória: {e}")
+        print(f"❌ Erro ao materializar hierarquia de revendas: {e}")
+    startup_profile.mark("auth_replication_hierarchy")
     
     # ⚡ DESATIVADO: WhatsApp Polling (conflito com WPPConnect)
     # try:
@@ -165,6 +236,10 @@ async def startup_event():
     # except Exception as e:
     #     print(f"❌ Erro ao iniciar Health Monitor: {e}")
     print("⚡ Health Monitor DESATIVADO para melhor performance")
+    
+    # Perfil de inicialização: fases mais lentas no log (completo em /api/admin/startup-profile)
+    startup_profile.finish()
+    startup_profile.log_report()
 
 
 # WebSocket connection manager
@@ -182,11 +257,15 @@ class ConnectionManager:
             print(f"   ⚠️ Nova sessão detectada para {user_id}, desconectando sessão antiga")
             await self.disconnect_user(user_id)
         
-        if user_id not in self.active_connections:
+        first_connection = user_id not in self.active_connections
+        if first_connection:
             self.active_connections[user_id] = set()
         self.active_connections[user_id].add(websocket)
         self.user_sessions[user_id] = session_id
         print(f"   ✅ Total de conexões ativas agora: {len(self.active_connections)}")
+        
+        if first_connection:
+            await presence_service.on_connect(user_id)
     
     async def disconnect_user(self, user_id: str):
         if user_id in self.active_connections:
@@ -206,23 +285,24 @@ class ConnectionManager:
                 del self.active_connections[user_id]
                 if user_id in self.user_sessions:
                     del self.user_sessions[user_id]
+                asyncio.create_task(presence_service.on_disconnect(user_id))
                 print(f"   ✅ User {user_id} completamente desconectado")
             print(f"   Total de conexões ativas agora: {len(self.active_connections)}")
     
     async def send_to_user(self, user_id: str, message: dict):
-        print(f"📤 [send_to_user] Tentando enviar para user_id: {user_id}")
-        print(f"   Active connections: {list(self.active_connections.keys())}")
+        connections = self.active_connections.get(user_id)
+        if not connections:
+            ws_logger.debug(f"📤 User {user_id} sem conexão WebSocket ativa", extra=SAMPLED)
+            return
         
-        if user_id in self.active_connections:
-            print(f"   ✅ User encontrado! Conexões ativas: {len(self.active_connections[user_id])}")
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                    print(f"   ✅ Mensagem enviada com sucesso via WebSocket para {user_id}")
-                except Exception as e:
-                    print(f"   ❌ ERRO ao enviar via WebSocket para {user_id}: {e}")
-        else:
-            print(f"   ⚠️ User {user_id} NÃO está em active_connections!")
+        for connection in list(connections):
+            try:
+                await connection.send_json(message)
+                metrics.websocket_messages_sent.inc(status="ok")
+            except Exception as e:
+                metrics.websocket_messages_sent.inc(status="error")
+                ws_logger.warning(f"❌ Erro ao enviar via WebSocket para {user_id}: {e}")
+        ws_logger.debug(f"📤 {message.get('type')} enviado para {user_id} ({len(connections)} conexões)", extra=SAMPLED)
     
     async def broadcast_to_agents(self, message: dict):
         agents = await db.agents.find({}, {"id": 1}).to_list(None)
@@ -231,6 +311,24 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Gauges lidos na hora da coleta do /metrics
+metrics.registry.gauge(
+    "websocket_connected_users", "Usuários com WebSocket aberto neste worker",
+    callback=lambda: len(manager.active_connections)
+)
+metrics.registry.gauge(
+    "websocket_connections", "WebSockets abertos neste worker",
+    callback=lambda: sum(len(conns) for conns in manager.active_connections.values())
+)
+metrics.registry.gauge(
+    "log_queue_depth", "Registros aguardando o QueueListener",
+    callback=lambda: logging_pipeline.get_stats()["queued"]
+)
+metrics.registry.gauge(
+    "log_records_dropped", "Registros de log descartados com a fila cheia",
+    callback=lambda: logging_pipeline.get_stats()["dropped"]
+)
+
 # Health check endpoint para deploy (SEM autenticação)
 health_router = APIRouter(tags=["Health"])
 
@@ -322,7 +420,7 @@ async def send_department_selection(ticket_id: str, client_id: str, reseller_id:
             "reseller_id": reseller_id
         }
         
-        await db.messages.insert_one(message)
+        await db.messages.insert_one(stamp(message))
         
         # Enviar via WebSocket para o cliente (remover _id do MongoDB)
         message_to_send = {k: v for k, v in message.items() if k != '_id'}
@@ -356,7 +454,7 @@ async def send_department_selection(ticket_id: str, client_id: str, reseller_id:
         "reseller_id": reseller_id
     }
     
-    await db.messages.insert_one(message)
+    await db.messages.insert_one(stamp(message))
     
     # Enviar via WebSocket para o cliente (remover _id do MongoDB)
     message_to_send = {k: v for k, v in message.items() if k != '_id'}
@@ -409,12 +507,12 @@ async def redirect_to_suporte_department(ticket_id: str, reseller_id: str, ticke
     # Atualizar ticket
     await db.tickets.update_one(
         {"id": ticket_id},
-        {"$set": {
+        {"$set": stamp({
             "department_id": suporte_dept["id"],
             "department_name": suporte_dept["name"],
             "ai_disabled_until": (datetime.now(timezone.utc) + timedelta(hours=24)).isoformat(),
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        })}
     )
     
     logger.info(f"✅ Ticket redirecionado para departamento SUPORTE ({suporte_dept['name']})")
@@ -429,7 +527,7 @@ async def redirect_to_suporte_department(ticket_id: str, reseller_id: str, ticke
         "created_at": datetime.now(timezone.utc).isoformat(),
         "reseller_id": reseller_id
     }
-    await db.messages.insert_one(message)
+    await db.messages.insert_one(stamp(message))
     
     # Notificar cliente via WebSocket (remover _id do MongoDB)
     message_to_send = {k: v for k, v in message.items() if k != '_id'}
@@ -472,7 +570,8 @@ async def handle_ai_failure_fallback(ticket: Dict, reason: str, reseller_id: str
         now = datetime.now(timezone.utc)
         ai_disabled_until = now + timedelta(hours=24)  # 24 horas (efetivamente permanente até atendente reativar)
         
-        await db.tickets.update_one(
+        await ticket_counters.update_ticket(
+            db,
             {"id": ticket["id"]},
             {
                 "$set": {
@@ -508,7 +607,7 @@ async def handle_ai_failure_fallback(ticket: Dict, reason: str, reseller_id: str
             "is_ai_failure_notice": True
         }
         
-        await db.messages.insert_one(fallback_message)
+        await db.messages.insert_one(stamp(fallback_message))
         ai_logger.info(f"   ✅ Mensagem de transferência enviada ao cliente")
         
         # 4. Enviar via WebSocket
@@ -541,16 +640,12 @@ async def handle_ai_failure_fallback(ticket: Dict, reason: str, reseller_id: str
 
 async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id: str):
     """Processa mensagem e gera resposta da IA se houver agente vinculado"""
-    ai_logger.info("🟢 " + "="*80)
-    ai_logger.info(f"🔍 NOVA MENSAGEM RECEBIDA PARA PROCESSAMENTO IA")
-    ai_logger.info(f"📋 Ticket ID: {ticket.get('id')}")
-    ai_logger.info(f"👤 Cliente: {ticket.get('client_name', 'N/A')}")
-    ai_logger.info(f"🏢 Reseller ID: {reseller_id}")
-    ai_logger.info(f"💬 Mensagem: {message_text[:100]}...")
+    bind_ticket(ticket.get("id"))
+    ai_logger.debug(f"🔍 Nova mensagem para IA (cliente {ticket.get('client_name', 'N/A')}, revenda {reseller_id}): {message_text[:100]}", extra=SAMPLED)
     
     try:
         # 🆕 VERIFICAR CONTROLE GLOBAL/INDIVIDUAL DA IA
-        ai_logger.info(f"🔍 Verificando controle de IA...")
+        ai_logger.debug(f"🔍 Verificando controle de IA...", extra=SAMPLED)
         
         # Buscar config global
         if reseller_id:
@@ -559,16 +654,16 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
             config = await db.config.find_one({"id": "config"}) or {}
         
         ai_globally_enabled = config.get("ai_globally_enabled", True)  # Default: ativado
-        ai_logger.info(f"   🌍 IA Global: {'ATIVADA' if ai_globally_enabled else 'DESATIVADA'}")
+        ai_logger.debug(f"   🌍 IA Global: {'ATIVADA' if ai_globally_enabled else 'DESATIVADA'}", extra=SAMPLED)
         
         # Verificar controle individual do ticket
         ticket_ai_enabled = ticket.get("ai_enabled")  # null, true ou false
         ticket_ai_manually_controlled = ticket.get("ai_manually_controlled", False)
         
         if ticket_ai_manually_controlled:
-            ai_logger.info(f"   🎯 Controle Manual: {'ATIVADA' if ticket_ai_enabled else 'DESATIVADA'}")
+            ai_logger.debug(f"   🎯 Controle Manual: {'ATIVADA' if ticket_ai_enabled else 'DESATIVADA'}", extra=SAMPLED)
         else:
-            ai_logger.info(f"   🎯 Controle Manual: Não configurado (segue global)")
+            ai_logger.debug(f"   🎯 Controle Manual: Não configurado (segue global)", extra=SAMPLED)
         
         # Decidir se IA deve responder
         should_ai_respond = ai_globally_enabled  # Padrão: seguir global
@@ -579,11 +674,10 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
         
         if not should_ai_respond:
             ai_logger.info(f"❌ IA DESATIVADA para este ticket")
-            ai_logger.info(f"   Motivo: {'Controle manual' if ticket_ai_manually_controlled else 'Configuração global'}")
-            ai_logger.info("🔴 " + "="*80)
+            ai_logger.debug(f"   Motivo: {'Controle manual' if ticket_ai_manually_controlled else 'Configuração global'}", extra=SAMPLED)
             return
         
-        ai_logger.info(f"✅ IA ATIVADA - Processando mensagem...")
+        ai_logger.debug(f"✅ IA ATIVADA - Processando mensagem...", extra=SAMPLED)
         
         # Verificar se IA foi desativada manualmente (compatibilidade com código antigo)
         ai_disabled_until = ticket.get("ai_disabled_until")
@@ -592,45 +686,41 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
                 disabled_until = datetime.fromisoformat(ai_disabled_until)
                 if datetime.now(timezone.utc) < disabled_until:
                     ai_logger.info(f"❌ IA DESATIVADA TEMPORARIAMENTE para ticket {ticket['id']} até {disabled_until}")
-                    ai_logger.info("🔴 " + "="*80)
                     return
                 else:
-                    ai_logger.info(f"✅ Tempo de desativação expirou, IA pode responder novamente")
+                    ai_logger.debug(f"✅ Tempo de desativação expirou, IA pode responder novamente", extra=SAMPLED)
             except Exception as e:
                 ai_logger.warning(f"⚠️ Erro ao verificar ai_disabled_until: {e}")
         
         # Verificar se o ticket tem departamento
         department_id = ticket.get("department_id")
-        ai_logger.info(f"📂 Verificando departamento...")
-        ai_logger.info(f"   Department ID: {department_id}")
+        ai_logger.debug(f"📂 Verificando departamento...", extra=SAMPLED)
+        ai_logger.debug(f"   Department ID: {department_id}", extra=SAMPLED)
         
         if not department_id:
             ai_logger.info(f"❌ BLOQUEIO: Ticket {ticket['id']} sem departamento atribuído")
-            ai_logger.info(f"💡 Ação necessária: Cliente deve selecionar um departamento")
-            ai_logger.info("🔴 " + "="*80)
+            ai_logger.debug(f"💡 Ação necessária: Cliente deve selecionar um departamento", extra=SAMPLED)
             return
         
         # Buscar departamento
-        ai_logger.info(f"🔎 Buscando departamento no banco de dados...")
+        ai_logger.debug(f"🔎 Buscando departamento no banco de dados...", extra=SAMPLED)
         department = await db.departments.find_one({"id": department_id, "reseller_id": reseller_id})
         
         if not department:
             ai_logger.error(f"💥 ERRO: Departamento {department_id} não encontrado no banco!")
-            ai_logger.info("🔴 " + "="*80)
             return
         
-        ai_logger.info(f"✅ Departamento encontrado:")
-        ai_logger.info(f"   Nome: {department.get('name')}")
-        ai_logger.info(f"   AI Agent ID: {department.get('ai_agent_id', 'NENHUM')}")
+        ai_logger.debug(f"✅ Departamento encontrado:", extra=SAMPLED)
+        ai_logger.debug(f"   Nome: {department.get('name')}", extra=SAMPLED)
+        ai_logger.debug(f"   AI Agent ID: {department.get('ai_agent_id', 'NENHUM')}", extra=SAMPLED)
         
         if not department.get("ai_agent_id"):
             ai_logger.info(f"❌ BLOQUEIO: Departamento '{department.get('name')}' sem IA vinculada")
-            ai_logger.info(f"💡 Ação necessária: Vincular um agente IA ao departamento")
-            ai_logger.info("🔴 " + "="*80)
+            ai_logger.debug(f"💡 Ação necessária: Vincular um agente IA ao departamento", extra=SAMPLED)
             return
         
         # Buscar agente IA
-        ai_logger.info(f"🔎 Buscando agente IA no banco de dados...")
+        ai_logger.debug(f"🔎 Buscando agente IA no banco de dados...", extra=SAMPLED)
         ai_agent = await db.ai_agents.find_one({
             "id": department["ai_agent_id"],
             "reseller_id": reseller_id,
@@ -639,49 +729,46 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
         
         if not ai_agent:
             ai_logger.error(f"💥 ERRO: Agente IA {department['ai_agent_id']} não encontrado ou inativo!")
-            ai_logger.info(f"💡 Ação necessária: Verificar se agente IA existe e está ativo")
-            ai_logger.info("🔴 " + "="*80)
+            ai_logger.debug(f"💡 Ação necessária: Verificar se agente IA existe e está ativo", extra=SAMPLED)
             return
         
-        ai_logger.info(f"✅ Agente IA encontrado:")
-        ai_logger.info(f"   Nome: {ai_agent.get('name')}")
-        ai_logger.info(f"   ID: {ai_agent.get('id')}")
-        ai_logger.info(f"   Ativo: {ai_agent.get('is_active')}")
-        ai_logger.info(f"   Modelo: {ai_agent.get('llm_provider', 'N/A')}/{ai_agent.get('llm_model', 'N/A')}")
+        ai_logger.debug(f"✅ Agente IA encontrado:", extra=SAMPLED)
+        ai_logger.debug(f"   Nome: {ai_agent.get('name')}", extra=SAMPLED)
+        ai_logger.debug(f"   ID: {ai_agent.get('id')}", extra=SAMPLED)
+        ai_logger.debug(f"   Ativo: {ai_agent.get('is_active')}", extra=SAMPLED)
+        ai_logger.debug(f"   Modelo: {ai_agent.get('llm_provider', 'N/A')}/{ai_agent.get('llm_model', 'N/A')}", extra=SAMPLED)
         
         # REMOVIDO: Verificação de linked_agents e assigned_agent_id
         # IA responde SEMPRE que o departamento tem IA configurada e ativa
         
-        ai_logger.info(f"🎉 TODAS AS VERIFICAÇÕES PASSARAM!")
-        ai_logger.info(f"🤖 IA '{ai_agent.get('name', 'Sem nome')}' vai processar QUALQUER mensagem do cliente")
-        
-        # Buscar histórico de mensagens do ticket (LIMITADO a últimas 10 para evitar Context Window Exceeded)
-        ai_logger.info(f"📚 Carregando histórico de mensagens (últimas 10)...")
-        all_messages = await db.messages.find({"ticket_id": ticket["id"]}).sort("created_at", -1).limit(10).to_list(10)
+        ai_logger.debug(f"🎉 TODAS AS VERIFICAÇÕES PASSARAM!", extra=SAMPLED)
+        ai_logger.debug(f"🤖 IA '{ai_agent.get('name', 'Sem nome')}' vai processar QUALQUER mensagem do cliente", extra=SAMPLED)
+        
+        # Buscar histórico recente do ticket; o context_builder decide quanto cabe no
+        # orçamento de tokens do modelo e resume o que ficar de fora
+        history_fetch = context_builder.max_history_messages * 2
+        ai_logger.debug(f"📚 Carregando histórico de mensagens (últimas {history_fetch})...", extra=SAMPLED)
+        all_messages = await db.messages.find(
+            {"ticket_id": ticket["id"]},
+            {"_id": 0, "from_type": 1, "text": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(history_fetch).to_list(history_fetch)
         # Reverter ordem (mais antigas primeiro)
-        messages = list(reversed(all_messages))
-        ai_logger.info(f"   {len(messages)} mensagens carregadas")
-        
-        # Truncar mensagens muito longas para economizar tokens
-        for msg in messages:
-            if msg.get("text") and len(msg["text"]) > 500:
-                original_len = len(msg["text"])
-                msg["text"] = msg["text"][:500] + "..."
-                ai_logger.info(f"   ⚠️ Mensagem truncada: {original_len} → 500 caracteres")
+        messages = messages_to_history(list(reversed(all_messages)))
+        ai_logger.debug(f"   {len(messages)} mensagens carregadas", extra=SAMPLED)
         
         # Buscar dados do cliente (para credenciais se permitido)
-        ai_logger.info(f"👤 Buscando dados do cliente...")
+        ai_logger.debug(f"👤 Buscando dados do cliente...", extra=SAMPLED)
         client = await db.users.find_one({"id": ticket["client_id"], "reseller_id": reseller_id})
         client_data = {
             "pinned_user": client.get("pinned_user") if client else None,
             "pinned_pass": client.get("pinned_pass") if client else None
         }
-        ai_logger.info(f"   Cliente: {client.get('name', 'N/A') if client else 'N/A'}")
-        ai_logger.info(f"   Credenciais disponíveis: {bool(client_data['pinned_user'] or client_data['pinned_pass'])}")
+        ai_logger.debug(f"   Cliente: {client.get('name', 'N/A') if client else 'N/A'}", extra=SAMPLED)
+        ai_logger.debug(f"   Credenciais disponíveis: {bool(client_data['pinned_user'] or client_data['pinned_pass'])}", extra=SAMPLED)
         
         # Gerar resposta da IA com TIMEOUT de 2 minutos
-        ai_logger.info(f"🚀 Chamando serviço de IA para gerar resposta...")
-        ai_logger.info(f"⏱️ Timeout configurado: 120 segundos (2 minutos)")
+        ai_logger.debug(f"🚀 Chamando serviço de IA para gerar resposta...", extra=SAMPLED)
+        ai_logger.debug(f"⏱️ Timeout configurado: 120 segundos (2 minutos)", extra=SAMPLED)
         
         try:
             # Adicionar timeout de 2 minutos (120 segundos)
@@ -690,7 +777,9 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
                     agent_config=ai_agent,
                     message=message_text,
                     conversation_history=messages,
-                    client_data=client_data
+                    client_data=client_data,
+                    db=db,
+                    conversation_id=ticket["id"]
                 ),
                 timeout=120.0  # 2 minutos
             )
@@ -703,7 +792,6 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
                     reason="IA retornou resposta vazia",
                     reseller_id=reseller_id
                 )
-                ai_logger.info("🔴 " + "="*80)
                 return
                 
         except asyncio.TimeoutError:
@@ -714,7 +802,6 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
                 reason="Timeout de 2 minutos - IA não respondeu a tempo",
                 reseller_id=reseller_id
             )
-            ai_logger.info("🔴 " + "="*80)
             return
             
         except Exception as e:
@@ -727,17 +814,16 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
                 reason=f"Erro na IA: {str(e)}",
                 reseller_id=reseller_id
             )
-            ai_logger.info("🔴 " + "="*80)
             return
         
         # Aguardar tempo de resposta para humanização (response_delay_seconds)
         delay_seconds = ai_agent.get("response_delay_seconds", 3)
         if delay_seconds > 0:
-            ai_logger.info(f"⏱️ Aguardando {delay_seconds} segundos para humanizar resposta...")
+            ai_logger.debug(f"⏱️ Aguardando {delay_seconds} segundos para humanizar resposta...", extra=SAMPLED)
             await asyncio.sleep(delay_seconds)
         
         # Criar mensagem de resposta da IA
-        ai_logger.info(f"💾 Salvando resposta da IA no banco de dados...")
+        ai_logger.debug(f"💾 Salvando resposta da IA no banco de dados...", extra=SAMPLED)
         ai_message = {
             "id": str(uuid.uuid4()),
             "ticket_id": ticket["id"],
@@ -748,36 +834,35 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
             "reseller_id": reseller_id
         }
         
-        await db.messages.insert_one(ai_message)
-        ai_logger.info(f"✅ Mensagem da IA salva com sucesso (ID: {ai_message['id']})")
+        await db.messages.insert_one(stamp(ai_message))
+        ai_logger.debug(f"✅ Mensagem da IA salva com sucesso (ID: {ai_message['id']})", extra=SAMPLED)
         
         # Atualizar última mensagem do ticket
         await db.tickets.update_one(
             {"id": ticket["id"]},
-            {"$set": {
+            {"$set": stamp({
                 "last_message": {
                     "text": ai_response[:100],
                     "from_type": "ai",
                     "created_at": ai_message["created_at"]
                 },
                 "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+            })}
         )
         
-        ai_logger.info(f"✅ Ticket atualizado com última mensagem da IA")
-        ai_logger.info(f"🎉 PROCESSO COMPLETO! IA respondeu com sucesso")
-        ai_logger.info("🟢 " + "="*80)
+        ai_logger.debug(f"✅ Ticket atualizado com última mensagem da IA", extra=SAMPLED)
+        ai_logger.debug(f"🎉 PROCESSO COMPLETO! IA respondeu com sucesso", extra=SAMPLED)
         
         # Enviar via WebSocket para cliente e atendentes (remover _id do MongoDB)
-        ai_logger.info(f"📡 Enviando mensagem via WebSocket...")
-        ai_logger.info(f"   Cliente ID: {ticket['client_id']}")
+        ai_logger.debug(f"📡 Enviando mensagem via WebSocket...", extra=SAMPLED)
+        ai_logger.debug(f"   Cliente ID: {ticket['client_id']}", extra=SAMPLED)
         
         ai_message_to_send = {k: v for k, v in ai_message.items() if k != '_id'}
         await manager.send_to_user(ticket["client_id"], {
             "type": "new_message",
             "message": ai_message_to_send
         })
-        ai_logger.info(f"   ✅ Enviado para cliente")
+        ai_logger.debug(f"   ✅ Enviado para cliente", extra=SAMPLED)
         
         # Enviar para atendentes do departamento
         agents_in_dept = await db.agents.find({
@@ -785,26 +870,24 @@ async def process_message_with_ai(ticket: Dict, message_text: str, reseller_id:
             "departments": department_id
         }).to_list(None)
         
-        ai_logger.info(f"   👥 Atendentes no departamento: {len(agents_in_dept)}")
+        ai_logger.debug(f"   👥 Atendentes no departamento: {len(agents_in_dept)}", extra=SAMPLED)
         
         for agent in agents_in_dept:
             await manager.send_to_user(agent["id"], {
                 "type": "new_message",
                 "message": ai_message_to_send  # ✅ Usar versão sem _id
             })
-            ai_logger.info(f"   ✅ Enviado para atendente: {agent.get('name', agent['id'][:10])}")
+            ai_logger.debug(f"   ✅ Enviado para atendente: {agent.get('name', agent['id'][:10])}", extra=SAMPLED)
         
-        ai_logger.info(f"📡 Todas mensagens WebSocket enviadas com sucesso!")
+        ai_logger.debug(f"📡 Todas mensagens WebSocket enviadas com sucesso!", extra=SAMPLED)
         ai_logger.info(f"✅ IA respondeu no ticket {ticket['id']}")
         
     except Exception as e:
-        ai_logger.error("💥 " + "="*80)
         ai_logger.error(f"💥 ERRO CRÍTICO ao processar mensagem com IA!")
         ai_logger.error(f"   Tipo: {type(e).__name__}")
         ai_logger.error(f"   Mensagem: {str(e)}")
         import traceback
         ai_logger.error(f"   Traceback:\n{traceback.format_exc()}")
-        ai_logger.error("💥 " + "="*80)
         
         # **FALLBACK: Redirecionar para SUPORTE da mesma origem**
         try:
@@ -853,57 +936,58 @@ async def check_department_timeouts():
         try:
             await asyncio.sleep(30)  # Verificar a cada 30 segundos
             
-            # Buscar tickets aguardando escolha de departamento
-            tickets = await db.tickets.find({
-                "awaiting_department_choice": True,
-                "department_choice_sent_at": {"$exists": True, "$ne": None}
-            }).to_list(None)
-            
-            now = datetime.now(timezone.utc)
-            
-            for ticket in tickets:
-                sent_at = datetime.fromisoformat(ticket["department_choice_sent_at"])
-                elapsed = (now - sent_at).total_seconds()
-                
-                # Buscar timeout do departamento padrão ou usar 120s
-                default_dept = await db.departments.find_one({
-                    "is_default": True,
-                    "reseller_id": ticket.get("reseller_id")
-                })
+            async with loop_tick("department_timeouts"):
+                # Buscar tickets aguardando escolha de departamento
+                tickets = await db.tickets.find({
+                    "awaiting_department_choice": True,
+                    "department_choice_sent_at": {"$exists": True, "$ne": None}
+                }).to_list(None)
                 
-                timeout = default_dept.get("timeout_seconds", 120) if default_dept else 120
+                now = datetime.now(timezone.utc)
                 
-                if elapsed >= timeout:
-                    # Timeout! Mover para departamento padrão
-                    if default_dept:
-                        await db.tickets.update_one(
-                            {"id": ticket["id"]},
-                            {"$set": {
-                                "department_id": default_dept["id"],
-                                "awaiting_department_choice": False,
-                                "updated_at": datetime.now(timezone.utc).isoformat()
-                            }}
-                        )
-                        
-                        # Enviar mensagem de notificação
-                        message = {
-                            "id": str(uuid.uuid4()),
-                            "ticket_id": ticket["id"],
-                            "from_type": "system",
-                            "kind": "text",
-                            "text": f"⏱️ Tempo esgotado. Você foi direcionado automaticamente para: {default_dept['name']}",
-                            "created_at": datetime.now(timezone.utc).isoformat(),
-                            "reseller_id": ticket.get("reseller_id")
-                        }
-                        
-                        await db.messages.insert_one(message)
-                        
-                        # Enviar via WebSocket (remover _id do MongoDB)
-                        message_to_send = {k: v for k, v in message.items() if k != '_id'}
-                        await manager.send_to_user(ticket["client_id"], {
-                            "type": "new_message",
-                            "message": message_to_send
-                        })
+                for ticket in tickets:
+                    sent_at = datetime.fromisoformat(ticket["department_choice_sent_at"])
+                    elapsed = (now - sent_at).total_seconds()
+                    
+                    # Buscar timeout do departamento padrão ou usar 120s
+                    default_dept = await db.departments.find_one({
+                        "is_default": True,
+                        "reseller_id": ticket.get("reseller_id")
+                    })
+                    
+                    timeout = default_dept.get("timeout_seconds", 120) if default_dept else 120
+                    
+                    if elapsed >= timeout:
+                        # Timeout! Mover para departamento padrão
+                        if default_dept:
+                            await db.tickets.update_one(
+                                {"id": ticket["id"]},
+                                {"$set": stamp({
+                                    "department_id": default_dept["id"],
+                                    "awaiting_department_choice": False,
+                                    "updated_at": datetime.now(timezone.utc).isoformat()
+                                })}
+                            )
+                            
+                            # Enviar mensagem de notificação
+                            message = {
+                                "id": str(uuid.uuid4()),
+                                "ticket_id": ticket["id"],
+                                "from_type": "system",
+                                "kind": "text",
+                                "text": f"⏱️ Tempo esgotado. Você foi direcionado automaticamente para: {default_dept['name']}",
+                                "created_at": datetime.now(timezone.utc).isoformat(),
+                                "reseller_id": ticket.get("reseller_id")
+                            }
+                            
+                            await db.messages.insert_one(stamp(message))
+                            
+                            # Enviar via WebSocket (remover _id do MongoDB)
+                            message_to_send = {k: v for k, v in message.items() if k != '_id'}
+                            await manager.send_to_user(ticket["client_id"], {
+                                "type": "new_message",
+                                "message": message_to_send
+                            })
         except Exception as e:
             print(f"Error in timeout checker: {e}")
 
@@ -913,35 +997,36 @@ async def reactivate_ai_after_timeout():
         try:
             await asyncio.sleep(60)  # Verificar a cada 60 segundos
             
-            # Buscar tickets com IA desativada
-            tickets = await db.tickets.find({
-                "ai_disabled_until": {"$exists": True, "$ne": None}
-            }).to_list(None)
-            
-            now = datetime.now(timezone.utc)
-            
-            for ticket in tickets:
-                try:
-                    disabled_until = datetime.fromisoformat(ticket["ai_disabled_until"])
-                    
-                    if now >= disabled_until:
-                        # Tempo expirou, reativar IA
-                        await db.tickets.update_one(
-                            {"id": ticket["id"]},
-                            {
-                                "$unset": {"ai_disabled_until": "", "ai_disabled_by": ""},
-                                "$set": {"updated_at": now.isoformat()}
-                            }
-                        )
-                        
-                        logger.info(f"✅ IA reativada automaticamente para ticket {ticket['id']}")
+            async with loop_tick("ai_reactivation"):
+                # Buscar tickets com IA desativada
+                tickets = await db.tickets.find({
+                    "ai_disabled_until": {"$exists": True, "$ne": None}
+                }).to_list(None)
+                
+                now = datetime.now(timezone.utc)
+                
+                for ticket in tickets:
+                    try:
+                        disabled_until = datetime.fromisoformat(ticket["ai_disabled_until"])
                         
-                        # Opcional: Enviar mensagem ao atendente informando
-                        # (não enviar ao cliente para não poluir conversa)
+                        if now >= disabled_until:
+                            # Tempo expirou, reativar IA
+                            await db.tickets.update_one(
+                                {"id": ticket["id"]},
+                                {
+                                    "$unset": {"ai_disabled_until": "", "ai_disabled_by": ""},
+                                    "$set": stamp({"updated_at": now.isoformat()})
+                                }
+                            )
+                            
+                            logger.info(f"✅ IA reativada automaticamente para ticket {ticket['id']}")
+                            
+                            # Opcional: Enviar mensagem ao atendente informando
+                            # (não enviar ao cliente para não poluir conversa)
+                            
+                    except Exception as e:
+                        logger.error(f"Erro ao processar ticket {ticket.get('id')}: {e}")
                         
-                except Exception as e:
-                    logger.error(f"Erro ao processar ticket {ticket.get('id')}: {e}")
-                    
         except Exception as e:
             logger.error(f"Erro na task de reativação de IA: {e}")
 
@@ -953,6 +1038,7 @@ def create_token(user_id: str, user_type: str, reseller_id: Optional[str] = None
         "user_id": user_id,
         "user_type": user_type,
         "reseller_id": reseller_id,
+        "iat": datetime.now(timezone.utc),
         "exp": datetime.now(timezone.utc) + timedelta(days=365)  # Token válido por 1 ano
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -975,10 +1061,11 @@ def verify_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail="Erro ao verificar token")
 
 async def get_current_user(authorization: Optional[str] = Header(None)):
+    """Principal autenticado: claims do token + "user" (documento em cache)"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = authorization.split(" ")[1]
-    return verify_token(token)
+    return await principal_cache.resolve(token)
 
 # Validation helpers
 def validate_user_password_format(text: str) -> bool:
@@ -1061,8 +1148,8 @@ async def validate_sensitive_data(text: str, config: dict) -> Optional[str]:
     return None
 
 # Auth routes
-@api_router.post("/auth/admin/login")
-async def admin_login(data: AdminLogin):
+@api_router.post("/auth/admin/login", dependencies=[Depends(rate_limit("login"))])
+async def admin_login(data: AdminLogin, request: Request):
     logging.info(f"🔍 Admin login attempt - password received: {data.password[:5]}...")
     
     # Buscar admin no MongoDB (user_type='admin')
@@ -1074,13 +1161,18 @@ async def admin_login(data: AdminLogin):
     
     logging.info(f"📊 Admin found - email: {admin_user.get('email')}, hash exists: {bool(admin_user.get('pass_hash'))}")
     
-    # Verificar senha com bcrypt
-    if not bcrypt.checkpw(data.password.encode('utf-8'), admin_user['pass_hash'].encode('utf-8')):
+    # Verificar senha com bcrypt (pool de threads - não trava o event loop)
+    password_valid, new_hash = await password_hasher.verify_and_update(data.password, admin_user['pass_hash'])
+    if not password_valid:
         logging.error(f"❌ Invalid password for admin: {admin_user.get('email', 'unknown')}")
         logging.error(f"❌ Password tried: {data.password}, Hash in DB: {admin_user['pass_hash'][:30]}...")
+        await audit_logger.log_login(admin_user['id'], "admin", None, ip_address=client_ip(request), success=False)
         raise HTTPException(status_code=401, detail="Senha incorreta")
+    if new_hash:
+        await db.users.update_one({"id": admin_user['id']}, {"$set": {"pass_hash": new_hash}})
     
     logging.info(f"✅ Admin login successful: {admin_user.get('email', 'unknown')}")
+    await audit_logger.log_login(admin_user['id'], "admin", None, ip_address=client_ip(request))
     
     token = create_token(admin_user['id'], "admin")
     return TokenResponse(
@@ -1218,7 +1310,7 @@ async def test_system():
     
     return HTMLResponse(content=html_content)
 
-@api_router.post("/auth/agent-login-v2")
+@api_router.post("/auth/agent-login-v2", dependencies=[Depends(rate_limit("login"))])
 async def agent_login_v2(data: AgentLogin, request: Request):
     """Login de atendente/agent - VERSÃO CORRIGIDA"""
     # Procurar em users com user_type='agent' (collection agents NÃO é usada)
@@ -1228,23 +1320,28 @@ async def agent_login_v2(data: AgentLogin, request: Request):
     })
     
     if not agent:
+        await audit_logger.log_login(data.login, "agent", None, ip_address=client_ip(request), success=False)
         raise HTTPException(status_code=401, detail="Agent não encontrado")
     
     # Validar senha (pode ser hash ou plain text)
     password_valid = False
     if agent.get("pass_hash"):
-        password_valid = bcrypt.checkpw(data.password.encode(), agent["pass_hash"].encode())
+        password_valid, new_hash = await password_hasher.verify_and_update(data.password, agent["pass_hash"])
+        if new_hash:
+            await db.users.update_one({"id": agent["id"]}, {"$set": {"pass_hash": new_hash}})
     elif agent.get("password"):
         # Se senha não tem hash, comparar diretamente (para testes)
         password_valid = (data.password == agent["password"])
     
     if not password_valid:
+        await audit_logger.log_login(agent["id"], "agent", agent.get("reseller_id"), ip_address=client_ip(request), success=False)
         raise HTTPException(status_code=401, detail="Senha incorreta")
     
     if not agent.get("is_active", True):
         raise HTTPException(status_code=403, detail="Conta desativada")
     
     token = create_token(agent["id"], "agent", agent.get("reseller_id"))
+    await audit_logger.log_login(agent["id"], "agent", agent.get("reseller_id"), ip_address=client_ip(request))
     
     return TokenResponse(
         token=token, 
@@ -1257,12 +1354,12 @@ async def agent_login_v2(data: AgentLogin, request: Request):
         reseller_id=agent.get("reseller_id")
     )
 
-@api_router.post("/auth/agent/login")
+@api_router.post("/auth/agent/login", dependencies=[Depends(rate_limit("login"))])
 async def agent_login(data: AgentLogin, request: Request):
     """Login de atendente/agent - REDIRECIONAR PARA V2"""
     return await agent_login_v2(data, request)
 
-@api_router.post("/auth/client/login")
+@api_router.post("/auth/client/login", dependencies=[Depends(rate_limit("login"))])
 async def client_login(data: UserLogin, request: Request):
     tenant = get_request_tenant(request)
     reseller_id = tenant.reseller_id
@@ -1283,7 +1380,7 @@ async def client_login(data: UserLogin, request: Request):
             raise HTTPException(status_code=400, detail="PIN deve ter 2 dígitos")
         
         user_id = str(uuid.uuid4())
-        pin_hash = bcrypt.hashpw(data.pin.encode(), bcrypt.gensalt()).decode()
+        pin_hash = await password_hasher.hash(data.pin)
         new_user = {
             "id": user_id,
             "whatsapp": data.whatsapp,
@@ -1302,17 +1399,19 @@ async def client_login(data: UserLogin, request: Request):
     else:
         # Existing user
         if user.get("pin_hash"):
-            if not bcrypt.checkpw(data.pin.encode(), user["pin_hash"].encode()):
+            if not await password_hasher.verify_pin(data.pin, user["pin_hash"]):
+                await audit_logger.log_login(user["id"], "client", reseller_id, ip_address=client_ip(request), success=False)
                 raise HTTPException(status_code=401, detail="PIN incorreto")
         else:
             # Set PIN
             if len(data.pin) != 2 or not data.pin.isdigit():
                 raise HTTPException(status_code=400, detail="Crie PIN com 2 dígitos")
-            pin_hash = bcrypt.hashpw(data.pin.encode(), bcrypt.gensalt()).decode()
+            pin_hash = await password_hasher.hash(data.pin)
             await db.users.update_one({"id": user["id"]}, {"$set": {"pin_hash": pin_hash}})
             user["pin_hash"] = pin_hash
     
     token = create_token(user["id"], "client", reseller_id)
+    await audit_logger.log_login(user["id"], "client", reseller_id, ip_address=client_ip(request))
     return TokenResponse(token=token, user_type="client", user_data={
         "id": user["id"],
         "whatsapp": user["whatsapp"],
@@ -1322,6 +1421,12 @@ async def client_login(data: UserLogin, request: Request):
         "pinned_pass": user.get("pinned_pass", "")
     }, reseller_id=reseller_id)
 
+@api_router.post("/auth/logout")
+async def logout(authorization: Optional[str] = Header(None), current_user: dict = Depends(get_current_user)):
+    """Encerra a sessão: o token entra na lista de revogação até expirar"""
+    await principal_cache.revoke_token(authorization.split(" ")[1])
+    return {"ok": True}
+
 # User routes
 @api_router.get("/users/me", response_model=UserMeResponse)
 async def get_current_user_info(current_user: dict = Depends(get_current_user), response: Response = None):
@@ -1373,6 +1478,7 @@ async def update_user(data: dict, current_user: dict = Depends(get_current_user)
     
     if update_data:
         await db.users.update_one({"id": current_user["user_id"]}, {"$set": update_data})
+        principal_cache.invalidate_user(current_user["user_id"])
     return {"ok": True}
 
 @api_router.put("/users/me/pin")
@@ -1382,8 +1488,9 @@ async def update_user_pin(data: dict, current_user: dict = Depends(get_current_u
     if not pin or len(pin) != 2 or not pin.isdigit():
         raise HTTPException(status_code=400, detail="PIN deve ter exatamente 2 dígitos")
     
-    pin_hash = bcrypt.hashpw(pin.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    pin_hash = await password_hasher.hash(pin)
     await db.users.update_one({"id": current_user["user_id"]}, {"$set": {"pin_hash": pin_hash}})
+    principal_cache.invalidate_user(current_user["user_id"])
     return {"ok": True}
 
 @api_router.get("/users/whatsapp-popup-status")
@@ -1427,8 +1534,9 @@ async def update_pin(data: dict, current_user: dict = Depends(get_current_user))
     if len(pin) != 2 or not pin.isdigit():
         raise HTTPException(status_code=400, detail="PIN deve ter 2 dígitos")
     
-    pin_hash = bcrypt.hashpw(pin.encode(), bcrypt.gensalt()).decode()
+    pin_hash = await password_hasher.hash(pin)
     await db.users.update_one({"id": current_user["user_id"]}, {"$set": {"pin_hash": pin_hash}})
+    principal_cache.invalidate_user(current_user["user_id"])
     return {"ok": True}
 
 @api_router.get("/users/name-popup-status")
@@ -1548,9 +1656,7 @@ async def get_current_agent(current_user: dict = Depends(get_current_user)):
     if current_user["user_type"] != "agent":
         raise HTTPException(status_code=403, detail="Apenas agentes podem acessar")
     
-    agent = await db.users.find_one({"id": current_user["user_id"], "user_type": "agent"})
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agente não encontrado")
+    agent = current_user["user"]
     
     return {
         "id": agent["id"],
@@ -1574,21 +1680,8 @@ async def get_online_status(request: Request):
     if config and config.get("manual_away_mode"):
         return {"online": 0, "status": "away", "manual": True}
     
-    # Buscar todos os agentes do reseller que estão conectados via WebSocket
-    online_count = 0
-    connected_user_ids = list(manager.active_connections.keys())
-    
-    if connected_user_ids:
-        # Buscar usuários conectados que são agentes do reseller
-        query = {
-            "id": {"$in": connected_user_ids},
-            "user_type": "agent"
-        }
-        if reseller_id:
-            query["reseller_id"] = reseller_id
-        
-        online_agents = await db.users.find(query).to_list(None)
-        online_count = len(online_agents)
+    # Agentes do reseller conectados via WebSocket (presence_service, em memória)
+    online_count = len(presence_service.online_agents(reseller_id))
     
     return {"online": online_count, "status": "online" if online_count > 0 else "offline", "manual": False}
 
@@ -1630,7 +1723,7 @@ async def create_agent(data: AgentCreate, request: Request, current_user: dict =
             detail="Erro ao gerar ID único. Tente novamente."
         )
     
-    pass_hash = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt()).decode()
+    pass_hash = await password_hasher.hash(data.password)
     
     agent = {
         "id": agent_id,
@@ -1695,7 +1788,7 @@ async def update_agent(agent_id: str, data: dict, request: Request, current_user
     if "name" in data:
         update_data["name"] = data["name"]
     if "password" in data and data["password"]:
-        update_data["pass_hash"] = bcrypt.hashpw(data["password"].encode(), bcrypt.gensalt()).decode()
+        update_data["pass_hash"] = await password_hasher.hash(data["password"])
         update_data["password"] = data["password"]
     if "avatar" in data:
         update_data["avatar"] = data["avatar"]
@@ -1704,6 +1797,11 @@ async def update_agent(agent_id: str, data: dict, request: Request, current_user
     
     try:
         await db.users.update_one(query, {"$set": update_data})
+        if "pass_hash" in update_data:
+            # Senha trocada pelo admin/revenda: sessões antigas do agente caem
+            await principal_cache.revoke_user(agent_id)
+        else:
+            principal_cache.invalidate_user(agent_id)
         logger.info(f"✅ Agente atualizado: {agent_id} - Login: {data.get('login', agent.get('username'))}")
         return {"ok": True}
     except Exception as e:
@@ -1730,6 +1828,7 @@ async def delete_agent(agent_id: str, request: Request, current_user: dict = Dep
         raise HTTPException(status_code=404, detail="Agente não encontrado")
     
     await db.users.delete_one(query)
+    principal_cache.invalidate_user(agent_id)
     return {"ok": True}
 
 @api_router.post("/users/{user_id}/confirm-whatsapp")
@@ -1802,11 +1901,8 @@ async def list_tickets(
         agent_id = current_user["user_id"]
         reseller_id = current_user.get("reseller_id")
         
-        # Buscar informações do agente
-        agent = await db.users.find_one({"id": agent_id, "user_type": "agent"})
-        
-        if not agent:
-            return []
+        # Informações do agente (já carregadas com o token)
+        agent = current_user["user"]
         
         # MÉTODO 1: Verificar se agente tem department_ids (novo sistema)
         agent_dept_ids = agent.get("department_ids", [])
@@ -1855,7 +1951,7 @@ async def list_tickets(
     max_results = limit if limit else None
     
     # Sort por updated_at descendente (mais recentes primeiro)
-    tickets = await db.tickets.find(query, {"_id": 0}).sort("updated_at", -1).to_list(max_results)
+    tickets = await db.tickets.find(query, {"_id": 0, **HIDDEN_TYPED_FIELDS}).sort("updated_at", -1).to_list(max_results)
     
     logger.info(f"📊 Retornando {len(tickets)} tickets para user_type={user_type} (limit={max_results})")
     
@@ -1929,15 +2025,24 @@ async def list_tickets(
             ticket["client_avatar"] = user.get("custom_avatar") or user.get("avatar", "")
         
         last_msg = last_messages.get(ticket["id"])
+        last_at = 0
         if last_msg:
             last_msg.pop("_id", None)
+            # created_at_dt já vem como data BSON (docs antigos: conversão compatível)
+            last_time = typed_value(last_msg)
+            last_at = last_time.timestamp() if last_time else 0
+            for hidden in HIDDEN_TYPED_FIELDS:
+                last_msg.pop(hidden, None)
         ticket["last_message"] = last_msg
+        ticket["_last_at"] = last_at
     
     # Sort: client messages first, then by recent
     tickets.sort(key=lambda t: (
         0 if t.get("last_message") and t.get("last_message", {}).get("from_type") == "client" else 1,
-        -(datetime.fromisoformat(t.get("last_message", {}).get("created_at", "2000-01-01T00:00:00+00:00")).timestamp() if t.get("last_message") and t.get("last_message", {}).get("created_at") else 0)
+        -t["_last_at"]
     ))
+    for ticket in tickets:
+        del ticket["_last_at"]
     
     return tickets
 
@@ -2010,11 +2115,11 @@ async def select_department(ticket_id: str, data: dict, current_user: dict = Dep
     # Atualizar ticket
     await db.tickets.update_one(
         {"id": ticket_id},
-        {"$set": {
+        {"$set": stamp({
             "department_id": department_id,
             "awaiting_department_choice": False,
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        })}
     )
     
     # Criar mensagem de confirmação
@@ -2028,7 +2133,7 @@ async def select_department(ticket_id: str, data: dict, current_user: dict = Dep
         "reseller_id": current_user.get("reseller_id")
     }
     
-    await db.messages.insert_one(message)
+    await db.messages.insert_one(stamp(message))
     
     # Enviar via WebSocket (remover _id do MongoDB)
     message_to_send = {k: v for k, v in message.items() if k != '_id'}
@@ -2049,17 +2154,14 @@ async def get_ticket_counts(request: Request, current_user: dict = Depends(get_c
     # Usar get_tenant_filter para garantir isolamento multi-tenant correto
     tenant_filter = get_tenant_filter(request, current_user)
     
+    # Contadores materializados (ticket_counters) - sem count_documents por polling
+    counts = await ticket_counters.status_counts(db, tenant_filter.get("reseller_id"))
+    
     # EM_ESPERA inclui tanto 'EM_ESPERA' quanto 'open' (para compatibilidade WhatsApp)
-    em_espera = await db.tickets.count_documents({
-        **tenant_filter, 
-        "status": {"$in": ["EM_ESPERA", "open"]}
-    })
-    atendendo = await db.tickets.count_documents({**tenant_filter, "status": "ATENDENDO"})
-    finalizadas = await db.tickets.count_documents({**tenant_filter, "status": "FINALIZADAS"})
     return {
-        "EM_ESPERA": em_espera,
-        "ATENDENDO": atendendo,
-        "FINALIZADAS": finalizadas
+        "EM_ESPERA": counts.get("EM_ESPERA", 0) + counts.get("open", 0),
+        "ATENDENDO": counts.get("ATENDENDO", 0),
+        "FINALIZADAS": counts.get("FINALIZADAS", 0)
     }
 
 @api_router.post("/tickets/{ticket_id}/mark-as-read")
@@ -2101,7 +2203,8 @@ async def update_ticket_status(ticket_id: str, data: dict, current_user: dict =
     if status not in ["EM_ESPERA", "ATENDENDO", "FINALIZADAS"]:
         raise HTTPException(status_code=400, detail="Status inválido")
     
-    await db.tickets.update_one(
+    await ticket_counters.update_ticket(
+        db,
         {"id": ticket_id},
         {"$set": {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
@@ -2138,7 +2241,7 @@ async def toggle_ai_in_ticket(ticket_id: str, data: dict, current_user: dict = D
                 # Ainda desativado, então reativar
                 await db.tickets.update_one(
                     {"id": ticket_id},
-                    {"$unset": {"ai_disabled_until": ""}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+                    {"$unset": {"ai_disabled_until": ""}, "$set": stamp({"updated_at": datetime.now(timezone.utc).isoformat()})}
                 )
                 return {"message": "IA reativada", "ai_enabled": True}
         except:
@@ -2148,11 +2251,11 @@ async def toggle_ai_in_ticket(ticket_id: str, data: dict, current_user: dict = D
     disabled_until = datetime.now(timezone.utc) + timedelta(hours=1)
     await db.tickets.update_one(
         {"id": ticket_id},
-        {"$set": {
+        {"$set": stamp({
             "ai_disabled_until": disabled_until.isoformat(),
             "ai_disabled_by": current_user["user_id"],
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        })}
     )
     
     return {"message": "IA desativada por 1 hora", "ai_enabled": False, "disabled_until": disabled_until.isoformat()}
@@ -2171,28 +2274,158 @@ async def assign_ticket_to_agent(ticket_id: str, data: dict, current_user: dict
     
     await db.tickets.update_one(
         {"id": ticket_id},
-        {"$set": {
+        {"$set": stamp({
             "assigned_agent_id": agent_id,
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+        })}
     )
     
     return {"message": "Ticket atribuído", "assigned_agent_id": agent_id}
 
 # Message routes
 @api_router.get("/messages/{ticket_id}")
-async def get_messages(ticket_id: str, limit: int = 50, offset: int = 0, current_user: dict = Depends(get_current_user)):
-    messages = await db.messages.find(
-        {"ticket_id": ticket_id},
-        {"_id": 0}
-    ).sort("created_at", -1).skip(offset).limit(limit).to_list(None)
-    messages.reverse()
-    return messages
-
-@api_router.post("/messages")
+async def get_messages(
+    ticket_id: str,
+    request: Request,
+    response: Response,
+    limit: int = 50,
+    offset: int = 0,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    view: str = "compact",
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Histórico do ticket paginado por cursor (before/after) em ordem cronológica.
+    Cursores e has_more vão nos headers X-Cursor-Before / X-Cursor-After / X-Has-More;
+    If-None-Match com o ETag da página devolve 304 sem corpo (polling).
+    """
+    from message_history import fetch_page, page_etag, InvalidCursor
+    try:
+        page = await fetch_page(
+            db, ticket_id,
+            limit=limit, before=before, after=after, offset=offset,
+            compact=(view != "full")
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    etag = page_etag(page["messages"])
+    headers = {"ETag": etag, "X-Has-More": "true" if page["has_more"] else "false"}
+    if page["before"]:
+        headers["X-Cursor-Before"] = page["before"]
+    if page["after"]:
+        headers["X-Cursor-After"] = page["after"]
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    return page["messages"]
+
+async def deliver_agent_message(message: dict, ticket: Optional[dict] = None, websocket: bool = True, push: bool = True) -> Dict[str, Any]:
+    """
+    Caminho de saída de uma resposta de atendente já gravada em messages:
+    WebSocket (cliente e atendente), WhatsApp (se o ticket veio do WhatsApp) e push do PWA.
+    Usado pelo POST /messages e pelo dispatcher de mensagens agendadas
+    (websocket/push=False em novas tentativas que só repetem o WhatsApp).
+    
+    Retorna {"whatsapp": None|True|False, "whatsapp_error": str|None, "push": n}
+    """
+    result = {"whatsapp": None, "whatsapp_error": None, "push": 0}
+    message_to_send = {k: v for k, v in message.items() if k != '_id'}
+    ticket_id = message["ticket_id"]
+    text = message.get("text") or ""
+    
+    if websocket:
+        await manager.send_to_user(message.get("to_id"), {
+            "type": "message",
+            "message": message_to_send
+        })
+        if message.get("from_id"):
+            await manager.send_to_user(message["from_id"], {
+                "type": "message",
+                "message": message_to_send
+            })
+    
+    if ticket is None:
+        ticket = await db.tickets.find_one({"id": ticket_id})
+    
+    # **ENVIAR PARA WHATSAPP SE O TICKET VEIO DO WHATSAPP**
+    try:
+        if ticket and ticket.get("whatsapp_instance"):
+            # Ticket veio do WhatsApp, enviar resposta via WhatsApp
+            whatsapp_instance = ticket.get("whatsapp_instance")
+            client_phone = ticket.get("client_whatsapp") or ticket.get("client_phone")
+            
+            if whatsapp_instance and client_phone:
+                logger.info(f"📱 Enviando mensagem para WhatsApp: {whatsapp_instance} -> {client_phone}")
+                
+                # Importar serviço WhatsApp
+                from whatsapp_service import WhatsAppService
+                whatsapp_service = WhatsAppService(db)
+                
+                # Enviar mensagem
+                wa_result = await whatsapp_service.send_message(
+                    instance_name=whatsapp_instance,
+                    to_number=client_phone,
+                    message=text
+                )
+                
+                result["whatsapp"] = bool(wa_result.get("success"))
+                if result["whatsapp"]:
+                    logger.info(f"✅ Mensagem enviada via WhatsApp com sucesso!")
+                else:
+                    result["whatsapp_error"] = wa_result.get("error")
+                    logger.error(f"❌ Erro ao enviar via WhatsApp: {wa_result.get('error')}")
+    except Exception as whatsapp_error:
+        result["whatsapp"] = False
+        result["whatsapp_error"] = str(whatsapp_error)
+        logger.error(f"❌ Erro ao tentar enviar para WhatsApp: {whatsapp_error}")
+    
+    # ENVIAR PUSH NOTIFICATION PARA O CLIENTE
+    if not push:
+        return result
+    
+    try:
+        # Buscar nome do agente
+        agent_info = await principal_cache.get_user(message.get("from_id"), "agent")
+        agent_name = agent_info.get("name", "Atendente") if agent_info else "Atendente"
+        
+        if ticket:
+            client_id = ticket.get("client_id")
+            
+            # Importar serviço de push
+            from push_notification_service import push_service
+            
+            # Preparar notificação
+            notification_payload = {
+                "title": f"💬 {agent_name}",
+                "body": text[:100] if text else "Enviou uma mensagem",
+                "icon": "/logo192.png",
+                "badge": "/badge72.png",
+                "url": "/",
+                "tag": "iaze-message",
+                "vibrate": [200, 100, 200],
+                "requireInteraction": False,
+                "timestamp": datetime.now(timezone.utc).timestamp() * 1000
+            }
+            
+            # Todos os devices do cliente em paralelo (subscriptions mortas são removidas)
+            push_result = await push_service.send_to_client(db, client_id, notification_payload)
+            result["push"] = push_result["sent"]
+            
+            if push_result["total"]:
+                logger.info(f"📲 Push notification enviada para cliente {client_id}")
+    except Exception as e:
+        logger.error(f"❌ Erro ao enviar push notification: {e}")
+    
+    return result
+
+@api_router.post("/messages", dependencies=[Depends(rate_limit("send_message"))])
 async def send_message(data: MessageCreate, request: Request, current_user: dict = Depends(get_current_user)):
     # Log para debug
-    logger.info(f"📥 POST /messages: from_type={data.from_type}, from_id='{data.from_id}', user_type={current_user.get('user_type')}, user_id={current_user.get('user_id')}")
+    logger.debug(f"📥 POST /messages: from_type={data.from_type}, from_id='{data.from_id}', user_type={current_user.get('user_type')}, user_id={current_user.get('user_id')}", extra=SAMPLED)
     
     # Validate sender - APENAS para clientes (admin e atendentes podem enviar por qualquer ID)
     user_type = current_user.get("user_type", "")
@@ -2202,7 +2435,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         logger.error(f"❌ Cliente tentando enviar mensagem sem from_id! user_id do token: {current_user.get('user_id')}")
         # Auto-corrigir usando user_id do token
         data.from_id = current_user.get("user_id")
-        logger.info(f"✅ from_id auto-corrigido para: {data.from_id}")
+        logger.debug(f"✅ from_id auto-corrigido para: {data.from_id}", extra=SAMPLED)
     
     if user_type == "client":
         # Clientes só podem enviar como eles mesmos
@@ -2211,7 +2444,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
             raise HTTPException(status_code=403, detail=f"Não autorizado - ID não corresponde")
     else:
         # Admin e atendentes podem enviar mensagens em nome de qualquer ticket
-        logger.info(f"Message from {user_type}: {data.from_id} (logged as {current_user['user_id']})")
+        logger.debug(f"Message from {user_type}: {data.from_id} (logged as {current_user['user_id']})", extra=SAMPLED)
     
     # Pegar tenant do request ou do token
     tenant = get_request_tenant(request)
@@ -2258,7 +2491,8 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                 "created_at": datetime.now(timezone.utc).isoformat(),
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.tickets.insert_one(ticket)
+            await db.tickets.insert_one(stamp(ticket))
+            await ticket_counters.record_created(db, ticket)
             
             # 🔍 BUSCA AUTOMÁTICA DE NOME DO CLIENTE (DESABILITADA TEMPORARIAMENTE - CAUSA TRAVAMENTO)
             # try:
@@ -2298,7 +2532,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                 # Pegar WhatsApp do cliente
                 client = await db.clients.find_one({"id": data.from_id})
                 if client and client.get("whatsapp"):
-                    logger.info(f"🔍 Iniciando busca automática de credenciais para {client['whatsapp']}")
+                    logger.debug(f"🔍 Iniciando busca automática de credenciais para {client['whatsapp']}", extra=SAMPLED)
                     
                     # Chamar busca em background
                     import httpx
@@ -2312,7 +2546,8 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         else:
             ticket_id = ticket["id"]
             # Update ticket status to open when client sends and increment unread
-            await db.tickets.update_one(
+            await ticket_counters.update_ticket(
+                db,
                 {"id": ticket_id},
                 {
                     "$set": {"status": "open", "updated_at": datetime.now(timezone.utc).isoformat()},  # Status 'open' para compatibilidade
@@ -2338,7 +2573,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                             pass
                     
                     if should_search:
-                        logger.info(f"🔍 Primeira mensagem do dia - Buscando credenciais para {client['whatsapp']}")
+                        logger.debug(f"🔍 Primeira mensagem do dia - Buscando credenciais para {client['whatsapp']}", extra=SAMPLED)
                         
                         asyncio.create_task(
                             call_auto_search(ticket_id, client["whatsapp"], "wa_suporte_pwa")
@@ -2360,8 +2595,11 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         
         auto_response = AutoResponseService(db)
         
-        # Buscar cliente para pegar telefone
-        client = await db.users.find_one({"id": data.from_id})
+        # Buscar cliente para pegar telefone (o próprio usuário logado: já carregado)
+        if user_type == "client":
+            client = current_user["user"]
+        else:
+            client = await db.users.find_one({"id": data.from_id})
         if not client:
             client = await db.clients.find_one({"id": data.from_id})
         
@@ -2373,7 +2611,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         auto_resp_data = await auto_response.should_auto_respond(data.text, client_phone)
         
         if auto_resp_data and auto_resp_data.get("auto_response"):
-            logger.info(f"🤖 AUTO-RESPOSTA ativada! Tipo: {auto_resp_data['type']}")
+            logger.debug(f"🤖 AUTO-RESPOSTA ativada! Tipo: {auto_resp_data['type']}", extra=SAMPLED)
             
             # Salvar mensagem do cliente
             client_msg_id = str(uuid.uuid4())
@@ -2389,7 +2627,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                 "media_url": None,
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.messages.insert_one(client_message)
+            await db.messages.insert_one(stamp(client_message))
             
             # Enviar resposta automática como se fosse o sistema
             bot_msg_id = str(uuid.uuid4())
@@ -2406,12 +2644,12 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                 "created_at": datetime.now(timezone.utc).isoformat(),
                 "is_auto_response": True
             }
-            await db.messages.insert_one(bot_message)
+            await db.messages.insert_one(stamp(bot_message))
             
             # Enviar via WebSocket
             await manager.send_message(bot_message, ticket_id if 'ticket_id' in locals() else data.ticket_id)
             
-            logger.info(f"✅ Auto-resposta enviada com sucesso!")
+            logger.debug(f"✅ Auto-resposta enviada com sucesso!", extra=SAMPLED)
             
             # Retornar para não processar mais
             return {
@@ -2448,7 +2686,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         if detected_user and detected_pass:
             pinned_user = detected_user
             pinned_pass = detected_pass
-            logger.info(f"✅ Credenciais detectadas automaticamente - User: {pinned_user}, Pass: {pinned_pass}")
+            logger.debug(f"✅ Credenciais detectadas automaticamente - User: {pinned_user}, Pass: {pinned_pass}", extra=SAMPLED)
             
             # Atualizar cliente com as credenciais
             if data.to_type == "client":
@@ -2462,7 +2700,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                         }
                     }
                 )
-                logger.info(f"✅ Credenciais salvas no cliente {data.to_id}")
+                logger.debug(f"✅ Credenciais salvas no cliente {data.to_id}", extra=SAMPLED)
     
     # Create message
     message_id = str(uuid.uuid4())
@@ -2481,7 +2719,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
         "read": False if data.from_type == "client" else True,  # Mensagens do cliente começam como não lidas
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.messages.insert_one(message)
+    await db.messages.insert_one(stamp(message))
     
     # Criar cópia da mensagem SEM _id do MongoDB (ObjectId não é serializável)
     message_to_send = {k: v for k, v in message.items() if k != '_id'}
@@ -2519,7 +2757,7 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                     "reseller_id": reseller_id,
                     "created_at": datetime.now(timezone.utc).isoformat()
                 }
-                await db.messages.insert_one(away_reply)
+                await db.messages.insert_one(stamp(away_reply))
                 # Notify client of away message (remover _id do MongoDB)
                 away_reply_to_send = {k: v for k, v in away_reply.items() if k != '_id'}
                 await manager.send_to_user(data.from_id, {
@@ -2556,8 +2794,9 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                             "reseller_id": reseller_id,
                             "created_at": datetime.now(timezone.utc).isoformat()
                         }
-                        await db.messages.insert_one(reply)
-                        await db.tickets.update_one(
+                        await db.messages.insert_one(stamp(reply))
+                        await ticket_counters.update_ticket(
+                            db,
                             {"id": ticket_id},
                             {"$set": {"status": "ATENDENDO"}}
                         )
@@ -2570,28 +2809,28 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
                     break
     
     # Processar com IA se houver agente IA vinculado ao departamento
-    ai_logger.info(f"🟡 Verificando se deve chamar IA: from_type={data.from_type}, kind={data.kind}")
+    ai_logger.debug(f"🟡 Verificando se deve chamar IA: from_type={data.from_type}, kind={data.kind}", extra=SAMPLED)
     if data.from_type == "client" and data.kind == "text":
-        ai_logger.info(f"🟡 Mensagem de cliente detectada! ticket_id={ticket_id}")
+        ai_logger.debug(f"🟡 Mensagem de cliente detectada! ticket_id={ticket_id}", extra=SAMPLED)
         # Buscar ticket atualizado
         ticket = await db.tickets.find_one({"id": ticket_id})
-        ai_logger.info(f"🟡 Ticket encontrado: {ticket.get('id') if ticket else 'None'}, department_id={ticket.get('department_id') if ticket else 'None'}")
+        ai_logger.debug(f"🟡 Ticket encontrado: {ticket.get('id') if ticket else 'None'}, department_id={ticket.get('department_id') if ticket else 'None'}", extra=SAMPLED)
         if ticket and ticket.get("department_id"):
-            ai_logger.info(f"🟡 Chamando process_message_with_ai para ticket {ticket['id']}")
+            ai_logger.debug(f"🟡 Chamando process_message_with_ai para ticket {ticket['id']}", extra=SAMPLED)
             # Chamar IA de forma assíncrona (não bloqueia resposta)
             asyncio.create_task(process_message_with_ai(ticket, text, reseller_id))
         elif ticket and not ticket.get("department_id"):
-            ai_logger.info(f"⚠️ Ticket {ticket['id']} existe mas NÃO TEM department_id definido. IA não será chamada.")
+            ai_logger.debug(f"⚠️ Ticket {ticket['id']} existe mas NÃO TEM department_id definido. IA não será chamada.", extra=SAMPLED)
         elif not ticket:
             ai_logger.error(f"💥 Ticket {ticket_id} não encontrado no banco!")
     else:
-        ai_logger.info(f"⚪ Mensagem não é de cliente ou não é texto: from_type={data.from_type}, kind={data.kind}")
+        ai_logger.debug(f"⚪ Mensagem não é de cliente ou não é texto: from_type={data.from_type}, kind={data.kind}", extra=SAMPLED)
     
     # Send via WebSocket to recipient
-    print(f"💬 [POST /messages] Enviando mensagem:")
-    print(f"   from_id: {data.from_id}, from_type: {data.from_type}")
-    print(f"   to_id: {data.to_id}, to_type: {data.to_type}")
-    print(f"   ticket_id: {ticket_id}")
+    logger.debug(
+        f"💬 [POST /messages] Enviando mensagem: from {data.from_type} {data.from_id} -> {data.to_type} {data.to_id}, ticket_id: {ticket_id}",
+        extra=SAMPLED
+    )
     
     await manager.send_to_user(data.to_id, {
         "type": "message",
@@ -2611,98 +2850,9 @@ async def send_message(data: MessageCreate, request: Request, current_user: dict
             "message": message_to_send
         })
     
-    # If agent sent, make sure client receives it
+    # If agent sent, make sure client receives it (WhatsApp + push do PWA)
     if data.from_type == "agent":
-        await manager.send_to_user(data.to_id, {
-            "type": "message",
-            "message": message_to_send
-        })
-        
-        # **ENVIAR PARA WHATSAPP SE O TICKET VEIO DO WHATSAPP**
-        try:
-            ticket_info = await db.tickets.find_one({"id": ticket_id})
-            if ticket_info and ticket_info.get("whatsapp_instance"):
-                # Ticket veio do WhatsApp, enviar resposta via WhatsApp
-                whatsapp_instance = ticket_info.get("whatsapp_instance")
-                client_phone = ticket_info.get("client_whatsapp") or ticket_info.get("client_phone")
-                
-                if whatsapp_instance and client_phone:
-                    logger.info(f"📱 Enviando mensagem para WhatsApp: {whatsapp_instance} -> {client_phone}")
-                    
-                    # Importar serviço WhatsApp
-                    from whatsapp_service import WhatsAppService
-                    whatsapp_service = WhatsAppService(db)
-                    
-                    # Enviar mensagem
-                    result = await whatsapp_service.send_message(
-                        instance_name=whatsapp_instance,
-                        to_number=client_phone,
-                        message=text
-                    )
-                    
-                    if result.get("success"):
-                        logger.info(f"✅ Mensagem enviada via WhatsApp com sucesso!")
-                    else:
-                        logger.error(f"❌ Erro ao enviar via WhatsApp: {result.get('error')}")
-        except Exception as whatsapp_error:
-            logger.error(f"❌ Erro ao tentar enviar para WhatsApp: {whatsapp_error}")
-        
-        # ENVIAR PUSH NOTIFICATION PARA O CLIENTE
-        try:
-            # Buscar nome do agente
-            agent_info = await db.users.find_one({"id": data.from_id})
-            agent_name = agent_info.get("name", "Atendente") if agent_info else "Atendente"
-            
-            # Buscar client_id do ticket
-            ticket_info = await db.tickets.find_one({"id": ticket_id})
-            if ticket_info:
-                client_id = ticket_info.get("client_id")
-                
-                # Buscar subscriptions ativas do cliente
-                subscriptions = await db.push_subscriptions.find({
-                    "client_id": client_id,
-                    "is_active": True
-                }).to_list(length=None)
-                
-                if subscriptions:
-                    # Importar serviço de push
-                    from push_notification_service import push_service
-                    
-                    # Preparar notificação
-                    notification_payload = {
-                        "title": f"💬 {agent_name}",
-                        "body": text[:100] if text else "Enviou uma mensagem",
-                        "icon": "/logo192.png",
-                        "badge": "/badge72.png",
-                        "url": "/",
-                        "tag": "iaze-message",
-                        "vibrate": [200, 100, 200],
-                        "requireInteraction": False,
-                        "timestamp": datetime.now(timezone.utc).timestamp() * 1000
-                    }
-                    
-                    # Enviar para todas as subscriptions do cliente
-                    for sub in subscriptions:
-                        success = await push_service.send_notification(
-                            subscription_info=sub["subscription_data"],
-                            notification_data=notification_payload
-                        )
-                        
-                        if success:
-                            await db.push_subscriptions.update_one(
-                                {"id": sub["id"]},
-                                {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
-                            )
-                        else:
-                            # Desativar subscription que falhou
-                            await db.push_subscriptions.update_one(
-                                {"id": sub["id"]},
-                                {"$set": {"is_active": False}}
-                            )
-                    
-                    logger.info(f"📲 Push notification enviada para cliente {client_id}")
-        except Exception as e:
-            logger.error(f"❌ Erro ao enviar push notification: {e}")
+        await deliver_agent_message(message_to_send, websocket=False)
     
     return {"ok": True, "message_id": message_id}
 
@@ -2869,6 +3019,13 @@ async def update_config(data: Dict[str, Any], request: Request, current_user: di
                 upsert=True
             )
         
+        # Só os nomes dos campos: a config tem chaves de API e senhas
+        await audit_logger.log_config_change(
+            current_user["user_id"], current_user["user_type"], reseller_id,
+            "reseller_config" if reseller_id else "config",
+            old_value=None, new_value={"fields": sorted(config_data.keys())}
+        )
+        
         return {"ok": True, "message": "Config salva", "saved_fields": list(config_data.keys())[:10]}
     except Exception as e:
         import traceback
@@ -2890,6 +3047,12 @@ async def save_config_new(data: Dict[str, Any], current_user: dict = Depends(get
     else:
         await db.reseller_configs.update_one({"reseller_id": reseller_id}, {"$set": config_data}, upsert=True)
     
+    await audit_logger.log_config_change(
+        current_user["user_id"], current_user["user_type"], reseller_id,
+        "reseller_config" if reseller_id else "config",
+        old_value=None, new_value={"fields": sorted(config_data.keys())}
+    )
+    
     return {"ok": True, "saved": True, "fields": list(config_data.keys())[:15]}
 
 @api_router.post("/config/support-avatar")
@@ -2942,147 +3105,179 @@ async def upload_support_avatar(file: UploadFile = File(...), request: Request =
 
 
 @api_router.post("/admin/replicate-config-to-resellers")
-async def replicate_config_to_resellers(current_user: dict = Depends(get_current_user)):
+async def replicate_config_to_resellers(force: bool = False, current_user: dict = Depends(get_current_user)):
     """
     Replica todas as configurações do admin principal para TODAS as revendas
     Apenas admin principal pode usar esta função
+
+    Roda em background (config_replication): retorna o job_id para acompanhar o progresso.
+    Revendas que já estão iguais ao admin são puladas (force=true reescreve todas).
     """
     # Verificar se é admin principal
     if current_user["user_type"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas o admin principal pode replicar configurações")
     
-    try:
-        print("🔄 [REPLICAÇÃO] Iniciando replicação de configurações...")
-        
-        # 1. Buscar configuração do admin principal
-        admin_config = await db.config.find_one({"id": "config"}, {"_id": 0})
-        if not admin_config:
-            raise HTTPException(status_code=404, detail="Configuração do admin não encontrada")
-        
-        print(f"✅ [REPLICAÇÃO] Config admin principal encontrada")
-        
-        # 2. Buscar todas as revendas
-        resellers = await db.resellers.find({}, {"_id": 0, "id": 1, "login": 1}).to_list(None)
-        total_resellers = len(resellers)
-        
-        if total_resellers == 0:
-            return {"ok": True, "message": "Nenhuma revenda encontrada", "count": 0}
-        
-        print(f"📋 [REPLICAÇÃO] Encontradas {total_resellers} revendas")
-        
-        # 3. Configurações a serem replicadas (EXCLUINDO dados manuais)
-        config_to_replicate = {
-            "support_avatar": admin_config.get("support_avatar"),
-            "pix_key": admin_config.get("pix_key", ""),
-            "allowed_data": admin_config.get("allowed_data", {"cpfs": [], "emails": [], "phones": [], "random_keys": []}),
-            "api_integration": admin_config.get("api_integration", {"api_url": "", "api_token": "", "api_enabled": False}),
-            "ai_agent": admin_config.get("ai_agent", {
-                "name": "Assistente IA",
-                "personality": "",
-                "instructions": "",
-                "llm_provider": "openai",
-                "llm_model": "gpt-4",
-                "api_key": "",
-                "temperature": 0.7,
-                "max_tokens": 500,
-                "mode": "standby",
-                "active_hours": "24/7",
-                "enabled": False,
-                "can_access_credentials": True,
-                "knowledge_base": ""
-            })
-        }
-        
-        # 4. Buscar auto-respostas e tutoriais do admin
-        admin_auto_responses = await db.messages.find(
-            {"type": "auto_response", "reseller_id": None},
-            {"_id": 0}
-        ).to_list(None)
-        
-        admin_tutorials = await db.tutorials.find(
-            {"reseller_id": None},
-            {"_id": 0}
-        ).to_list(None)
-        
-        admin_iptv_apps = await db.iptv_apps.find(
-            {"reseller_id": None},
-            {"_id": 0}
-        ).to_list(None)
-        
-        print(f"📦 [REPLICAÇÃO] Auto-respostas: {len(admin_auto_responses)}, Tutoriais: {len(admin_tutorials)}, Apps IPTV: {len(admin_iptv_apps)}")
-        
-        # 5. Replicar para cada revenda
-        replicated_count = 0
-        
-        for reseller in resellers:
-            reseller_id = reseller["id"]
-            reseller_login = reseller.get("login", "N/A")
-            
-            try:
-                # 5.1 Atualizar configurações gerais da revenda
-                await db.reseller_configs.update_one(
-                    {"reseller_id": reseller_id},
-                    {"$set": config_to_replicate},
-                    upsert=True
-                )
-                
-                # 5.2 Remover auto-respostas antigas da revenda
-                await db.messages.delete_many({
-                    "type": "auto_response",
-                    "reseller_id": reseller_id
-                })
-                
-                # 5.3 Inserir novas auto-respostas (clonar do admin)
-                if admin_auto_responses:
-                    for msg in admin_auto_responses:
-                        new_msg = msg.copy()
-                        new_msg["id"] = str(uuid.uuid4())
-                        new_msg["reseller_id"] = reseller_id
-                        await db.messages.insert_one(new_msg)
-                
-                # 5.4 Remover tutoriais antigos da revenda
-                await db.tutorials.delete_many({"reseller_id": reseller_id})
-                
-                # 5.5 Inserir novos tutoriais (clonar do admin)
-                if admin_tutorials:
-                    for tutorial in admin_tutorials:
-                        new_tutorial = tutorial.copy()
-                        new_tutorial["id"] = str(uuid.uuid4())
-                        new_tutorial["reseller_id"] = reseller_id
-                        await db.tutorials.insert_one(new_tutorial)
-                
-                # 5.6 Remover apps IPTV antigos da revenda
-                await db.iptv_apps.delete_many({"reseller_id": reseller_id})
-                
-                # 5.7 Inserir novos apps IPTV (clonar do admin)
-                if admin_iptv_apps:
-                    for app in admin_iptv_apps:
-                        new_app = app.copy()
-                        new_app["id"] = str(uuid.uuid4())
-                        new_app["reseller_id"] = reseller_id
-                        await db.iptv_apps.insert_one(new_app)
-                
-                replicated_count += 1
-                print(f"✅ [REPLICAÇÃO] Configurações replicadas para revenda: {reseller_login} ({replicated_count}/{total_resellers})")
-                
-            except Exception as e:
-                print(f"❌ [REPLICAÇÃO] Erro ao replicar para revenda {reseller_login}: {e}")
-                continue
-        
-        print(f"🎉 [REPLICAÇÃO] Concluído! {replicated_count}/{total_resellers} revendas atualizadas")
-        
-        return {
-            "ok": True,
-            "message": f"Configurações replicadas com sucesso para {replicated_count} revendas",
-            "total_resellers": total_resellers,
-            "replicated_count": replicated_count
-        }
-        
-    except Exception as e:
-        print(f"❌ [REPLICAÇÃO] Erro crítico: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro ao replicar configurações: {str(e)}")
+    admin_config = await db.config.find_one({"id": "config"}, {"_id": 0, "id": 1})
+    if not admin_config:
+        raise HTTPException(status_code=404, detail="Configuração do admin não encontrada")
+    
+    job = await config_replication.start(db, "full", started_by=current_user["user_id"], force=force)
+    await audit_logger.log_config_change(
+        current_user["user_id"], "admin", None, "replication_full",
+        old_value=None, new_value={"job_id": job["id"], "total": job["total"], "force": force}
+    )
+    
+    return {
+        "ok": True,
+        "message": f"Replicação iniciada para {job['total']} revendas",
+        "job_id": job["id"],
+        "status": job["status"],
+        "total_resellers": job["total"]
+    }
+
+
+@api_router.get("/admin/query-profile")
+async def get_query_profile(reset: bool = False, current_user: dict = Depends(get_current_user)):
+    """
+    Auditoria das consultas registradas pelo query_profiler (QUERY_PROFILER=1):
+    explain de cada formato, COLLSCAN acima do limite vem com flagged=true
+    """
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    if not query_profiler.enabled:
+        raise HTTPException(status_code=404, detail="Query profiler desativado (QUERY_PROFILER=1)")
+    
+    report = await query_profiler.audit(client)
+    if reset:
+        query_profiler.reset()
+    return {
+        "collscan_min_docs": query_profiler.collscan_min_docs,
+        "flagged": sum(1 for r in report if r["flagged"]),
+        "shapes": report
+    }
+
+
+@api_router.get("/admin/startup-profile")
+async def get_startup_profile(current_user: dict = Depends(get_current_user)):
+    """Tempo de cada fase do import/startup deste worker e subsistemas ligados"""
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    return {
+        "features": FEATURES,
+        **startup_profile.report()
+    }
+
+
+@api_router.get("/admin/metrics")
+async def get_metrics_json(current_user: dict = Depends(get_current_user)):
+    """
+    Mesmas métricas do /metrics em JSON para o painel: histogramas resumidos em
+    count/avg/p50/p95/p99 (segundos), ordenados pelo tempo total
+    """
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    return {
+        "enabled": metrics.METRICS_ENABLED,
+        "logging": logging_pipeline.get_stats(),
+        "metrics": metrics.registry.snapshot()
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Exposição no formato texto do Prometheus (METRICS_TOKEN exige 'Bearer <token>')"""
+    if not metrics.check_token(authorization):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@api_router.get("/admin/replicate-config-to-resellers/jobs")
+async def list_replication_jobs(current_user: dict = Depends(get_current_user)):
+    """Últimos jobs de replicação"""
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    return {"jobs": await config_replication.list_jobs(db)}
+
+
+@api_router.get("/admin/replicate-config-to-resellers/jobs/{job_id}")
+async def get_replication_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Progresso de um job de replicação"""
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    job = await config_replication.get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job de replicação não encontrado")
+    return job
+
+
+@api_router.post("/admin/replicate-config-to-resellers/jobs/{job_id}/resume")
+async def resume_replication_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Retoma um job com falhas ou interrompido (reprocessa falhas e continua do cursor)"""
+    if current_user["user_type"] != "admin":
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    
+    job = await config_replication.resume(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job de replicação não encontrado")
+    return {"ok": True, "job_id": job_id, "status": job["status"]}
+
+
+async def notify_config_replicated(reseller_ids: List[str], profile: str):
+    """Invalidação após replicação: avisa as revendas conectadas para recarregar a config"""
+    for reseller_id in reseller_ids:
+        if reseller_id not in manager.active_connections:
+            continue
+        await manager.send_to_user(reseller_id, {
+            "type": "config_updated",
+            "reseller_id": reseller_id,
+            "source": "replication"
+        })
 
 
+async def notify_media_processed(ticket_id: str, event: dict):
+    """
+    Resultado do pipeline de mídia (transcrição pode conter dados do cliente):
+    cliente do ticket + atendente atribuído, ou, sem atribuição, os atendentes
+    online com acesso ao departamento do ticket
+    """
+    ticket = await db.tickets.find_one(
+        {"id": ticket_id},
+        {"_id": 0, "client_id": 1, "reseller_id": 1, "assigned_agent_id": 1, "department_id": 1}
+    )
+    if not ticket:
+        return
+    recipients = set()
+    if ticket.get("client_id"):
+        recipients.add(ticket["client_id"])
+    
+    if ticket.get("assigned_agent_id"):
+        recipients.add(ticket["assigned_agent_id"])
+    elif ticket.get("department_id"):
+        online = list(presence_service.online_agents(ticket.get("reseller_id")))
+        if online:
+            # Mesmas duas fontes do filtro de tickets do agente: department_ids do
+            # agente (novo) e agent_ids do departamento (antigo)
+            department = await db.departments.find_one(
+                {"id": ticket["department_id"]}, {"_id": 0, "agent_ids": 1}
+            ) or {}
+            agent_ids = department.get("agent_ids") or []
+            if isinstance(agent_ids, str):
+                agent_ids = [agent_ids]
+            recipients.update(agent_id for agent_id in online if agent_id in agent_ids)
+            
+            agents = await db.users.find(
+                {"id": {"$in": online}, "department_ids": ticket["department_id"]},
+                {"_id": 0, "id": 1}
+            ).to_list(None)
+            recipients.update(agent["id"] for agent in agents)
+    
+    for user_id in recipients:
+        if user_id in manager.active_connections:
+            await manager.send_to_user(user_id, event)
 
 
 # ====== IPTV Apps Routes ======
@@ -3185,6 +3380,9 @@ async def automate_iptv_config(app_id: str, data: dict, request: Request = None,
     Automatiza a configuração do app IPTV usando sistema robusto com Playwright
     Sistema inteligente com retry, validação, screenshots e fallback para modo manual
     """
+    if not is_enabled("iptv_automation"):
+        raise HTTPException(status_code=503, detail="Automação IPTV desativada (FEATURE_IPTV_AUTOMATION)")
+    
     from iptv_automation_service import automate_iptv_app
     
     tenant = get_request_tenant(request)
@@ -3509,6 +3707,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, session_id: str
             try:
                 message = json.loads(data)
                 if message.get('type') == 'ping':
+                    presence_service.heartbeat(user_id)
                     await websocket.send_text(json.dumps({'type': 'pong'}))
                     print(f"🏓 Pong enviado para user_id: {user_id}")
             except json.JSONDecodeError:
@@ -3736,7 +3935,7 @@ async def change_reseller_password(data: dict, current_user: dict = Depends(get_
         raise HTTPException(status_code=400, detail="Senha deve ter no mínimo 6 caracteres")
     
     # Hash da nova senha
-    pass_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
+    pass_hash = await password_hasher.hash(new_password)
     
     # Atualizar senha e marcar first_login como False
     result = await db.resellers.update_one(
@@ -3750,6 +3949,7 @@ async def change_reseller_password(data: dict, current_user: dict = Depends(get_
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Revenda não encontrada")
+    principal_cache.invalidate_user(reseller_id)
     
     logger.info(f"✅ Senha alterada para revenda {reseller_id} (primeiro login concluído)")
     
@@ -3776,11 +3976,11 @@ async def change_admin_password(data: dict, current_user: dict = Depends(get_cur
         raise HTTPException(status_code=404, detail="Admin não encontrado")
     
     # Verificar senha atual
-    if not bcrypt.checkpw(current_password.encode(), admin["password"].encode()):
+    if not await password_hasher.verify(current_password, admin["password"]):
         raise HTTPException(status_code=401, detail="Senha atual incorreta")
     
     # Hash da nova senha
-    new_pass_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
+    new_pass_hash = await password_hasher.hash(new_password)
     
     # Atualizar senha
     result = await db.users.update_one(
@@ -3793,6 +3993,7 @@ async def change_admin_password(data: dict, current_user: dict = Depends(get_cur
     
     if result.modified_count == 0:
         raise HTTPException(status_code=500, detail="Erro ao atualizar senha")
+    principal_cache.invalidate_user(current_user["user_id"])
     
     logger.info(f"✅ Senha alterada para admin {current_user['user_id']}")
     
@@ -4240,291 +4441,27 @@ async def view_prompt_page():
 
 app.include_router(api_router)
 
-# Include reseller routes
-try:
-    from reseller_routes import reseller_router
-    app.include_router(reseller_router)
-    print("✅ Reseller routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load reseller routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Include AI agent routes
-try:
-    from ai_agent_routes import ai_router
-    app.include_router(ai_router, prefix="/api")
-    print("✅ AI agent routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load AI agent routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Include WhatsApp routes
-# ==================== WHATSAPP TEST ENDPOINT DIRETO ====================
-try:
-    from whatsapp_routes import router as whatsapp_router
-    from whatsapp_webhook_handler import router as webhook_router
-    import sys
-    print("🔧 Loading WhatsApp routes...", flush=True)
-    sys.stdout.flush()
-    app.include_router(whatsapp_router, prefix="/api/whatsapp")
-    app.include_router(webhook_router, prefix="/api")
-    print("✅ WhatsApp routes loaded successfully", flush=True)
-    for route in whatsapp_router.routes:
-        print(f"   - {route.methods} /api/whatsapp{route.path}", flush=True)
-except Exception as e:
-    print(f"❌ Failed to load WhatsApp routes: {e}", flush=True)
-    import traceback
-    traceback.print_exc()
-
-# Push Notification routes
-try:
-    from push_notification_routes import push_router
-    app.include_router(push_router, prefix="/api")
-    print("✅ Push notification routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load push notification routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Payment and Subscription routes
-try:
-    from payment_routes import router as payment_router
-    app.include_router(payment_router, prefix="/api")
-    print("✅ Payment routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Payment routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Webhook routes
-try:
-    from webhook_routes import router as webhook_router
-    app.include_router(webhook_router, prefix="/api")
-    print("✅ Webhook routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Webhook routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Admin Payment Config routes
-try:
-    from admin_payment_routes import router as admin_payment_router
-    app.include_router(admin_payment_router, prefix="/api")
-    print("✅ Admin Payment routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Admin Payment routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Dashboard routes
-try:
-    from dashboard_routes import router as dashboard_router
-    app.include_router(dashboard_router, prefix="/api")
-    print("✅ Dashboard routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Dashboard routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Vendas routes (Sistema de Vendas CyberTV)
-try:
-    from vendas_routes_new import router as vendas_router
-    app.include_router(vendas_router)
-    print("✅ Vendas routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Vendas routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Office routes (gestor.my integration)
-try:
-    from office_routes import router as office_router
-    app.include_router(office_router, prefix="/api", tags=['office'])
-    print("✅ Office routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Office routes: {e}")
-
-# Office Sync routes (sincronização automática de clientes)
-try:
-    from office_sync_routes import router as office_sync_router
-    app.include_router(office_sync_router)
-    print("✅ Office Sync routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Office Sync routes: {e}")
-
-# Office Credentials routes (gerenciamento de credenciais)
-try:
-    from office_credentials_routes import router as office_credentials_router
-    app.include_router(office_credentials_router)
-    print("✅ Office Credentials routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Office Credentials routes: {e}")
+# Routers dos módulos: importados e montados pelo router_registry (subsistemas
+# opcionais - Office, XUI, mídia - desligáveis por feature flag)
+include_routers(app)
 
 # Iniciar scheduler de sincronização automática
-try:
-    from office_sync_service import OfficeSyncService
-    from office_sync_scheduler import OfficeSyncScheduler
-    
-    office_sync_service = OfficeSyncService(db)
-    office_sync_scheduler = OfficeSyncScheduler(office_sync_service)
-    office_sync_scheduler.start()
-    print("✅ Office Sync Scheduler iniciado (sincronização a cada 6 horas)")
-except Exception as e:
-    print(f"❌ Failed to start Office Sync Scheduler: {e}")
-
-# XUI routes (IPTV integration)
-try:
-    from xui_routes import router as xui_router
-    app.include_router(xui_router)
-    print("✅ XUI routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load XUI routes: {e}")
-
-# Scheduled Messages routes
-try:
-    from scheduled_messages_routes import router as scheduled_messages_router
-    app.include_router(scheduled_messages_router, prefix="/api", tags=['scheduled_messages'])
-    print("✅ Scheduled Messages routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Scheduled Messages routes: {e}")
-
-# Reminder routes
-try:
-    from reminder_routes import router as reminder_router
-    app.include_router(reminder_router, prefix="/api", tags=['reminders'])
-    print("✅ Reminder routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Reminder routes: {e}")
-
-# Credential Auto-Search routes
-try:
-    from credential_auto_search_routes import router as credential_search_router
-    app.include_router(credential_search_router, prefix="/api", tags=['credential_search'])
-    print("✅ Credential Auto-Search routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Credential Auto-Search routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Client Name Auto-Update routes
-try:
-    from client_name_routes import router as client_name_router
-    app.include_router(client_name_router)
-    print("✅ Client Name Auto-Update routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Client Name routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# AI Memory Management routes
-try:
-    from ai_memory_routes import router as ai_memory_router
-    app.include_router(ai_memory_router)
-    print("✅ AI Memory Management routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load AI Memory Management routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-
-# Vendas Bot Config routes (Admin)
-try:
-    from vendas_bot_config_routes import router as vendas_bot_config_router
-    app.include_router(vendas_bot_config_router)
-    print("✅ Vendas Bot Config routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Vendas Bot Config routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Admin Extensions routes (IPTV, WhatsApp Plans, Mercado Pago, etc)
-try:
-    from admin_extensions_routes import router as admin_extensions_router
-    app.include_router(admin_extensions_router, prefix="/api")
-    print("✅ Admin Extensions routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Admin Extensions routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-
-# Vendas Simple Config routes (Admin - WA Site)
-try:
-    from vendas_simple_config_routes_v2 import router as vendas_simple_config_router
-    app.include_router(vendas_simple_config_router)
-    print("✅ Vendas Simple Config routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Vendas Simple Config routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Correct/Wrong Knowledge Base routes
-try:
-    from correct_wrong_knowledge import router as correct_wrong_router
-    app.include_router(correct_wrong_router)
-    print("✅ Correct/Wrong Knowledge routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Correct/Wrong Knowledge routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# AI Learning routes (Sistema de Aprendizado)
-try:
-    from ai_learning_routes import router as ai_learning_router
-    app.include_router(ai_learning_router)
-    print("✅ AI Learning routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load AI Learning routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Media Processing routes (Áudio, Imagem e Vídeo) - TEMPORARILY DISABLED DUE TO SYNTAX ERROR
-# try:
-#     from media_routes import router as media_router
-#     app.include_router(media_router)
-#     print("✅ Media Processing routes loaded successfully")
-# except Exception as e:
-#     print(f"❌ Failed to load Media Processing routes: {e}")
-#     import traceback
-#     traceback.print_exc()
-print("⚠️ Media Processing routes temporarily disabled")
-
+if is_enabled("office"):
+    try:
+        from office_sync_service import OfficeSyncService
+        from office_sync_scheduler import OfficeSyncScheduler
+        
+        office_sync_service = OfficeSyncService(db)
+        office_sync_scheduler = OfficeSyncScheduler(office_sync_service)
+        office_sync_scheduler.start()
+        print("✅ Office Sync Scheduler iniciado (sincronização a cada 6 horas)")
+    except Exception as e:
+        print(f"❌ Failed to start Office Sync Scheduler: {e}")
 
 # Health check route (no prefix needed)
 app.include_router(health_router, prefix="/api")
 print("✅ Health check endpoint available at /api/health")
 
-# Backup routes
-try:
-    from backup_routes import router as backup_router
-    app.include_router(backup_router, prefix="/api")
-    
-    # Botões Interativos WA Site
-    try:
-        from vendas_buttons_routes import router as buttons_router, public_router as buttons_public_router
-        app.include_router(buttons_router)
-        app.include_router(buttons_public_router)
-        print("✅ Vendas Buttons routes loaded successfully")
-    except Exception as e:
-        print(f"❌ Error loading vendas buttons routes: {e}")
-        import traceback
-        traceback.print_exc()
-    print("✅ Backup routes loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load Backup routes: {e}")
-    import traceback
-    traceback.print_exc()
-
-# Include Simple Download routes
-try:
-    from simple_download import router as download_router
-    app.include_router(download_router, prefix="/api")
-    print("✅ Simple download routes loaded successfully")
-except Exception as e:
-    print(f"⚠️ Simple download routes not loaded: {e}")
-
 # Export routes for syncing to external server
 # try:
 #     from export_routes import export_router
@@ -4669,6 +4606,16 @@ class TenantMiddleware(BaseHTTPMiddleware):
 # TenantMiddleware reabilitado - suporte.help e 151.243.218.223 configurados como master domains
 app.add_middleware(TenantMiddleware)
 
+# request_id nos logs da requisição (e no header X-Request-ID da resposta)
+app.add_middleware(RequestContextMiddleware)
+
+# Latência por rota (http_request_duration_seconds); por fora de tudo para medir o total
+app.add_middleware(MetricsMiddleware)
+
+# Rate limit geral por tipo de usuário (opcional); limites por ação usam Depends(rate_limit(...))
+if os.environ.get("RATE_LIMIT_GLOBAL", "false").lower() == "true":
+    app.middleware("http")(rate_limit_middleware)
+
 @app.get("/api/debug/tenant")
 async def debug_tenant(request: Request):
     from tenant_middleware import get_current_tenant
@@ -4687,12 +4634,9 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Cursor-Before", "X-Cursor-After", "X-Has-More", "X-Request-ID"],
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 # ==================== DEBUG WHATSAPP ENDPOINT ====================
@@ -4737,4 +4681,12 @@ async def download_recovery_files():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    await presence_service.shutdown()
+    await audit_logger.shutdown()
+    password_hasher.shutdown()
+    if query_profiler.enabled:
+        await query_profiler.log_report(client)
+    close_client()
+    logging_pipeline.stop()
+
+startup_profile.mark("server_module", "import")
@@ -0,0 +1,93 @@
+"""
+Cache de curta duração com single-flight
+
+Resultados caros (dashboards, agregações) ficam em memória por alguns segundos
+e requisições concorrentes para a mesma chave aguardam o MESMO cálculo em vez
+de disparar N consultas iguais ao banco.
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightCache:
+    """Cache TTL em memória onde só um cálculo por chave roda de cada vez"""
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._values: "OrderedDict[Hashable, tuple]" = OrderedDict()  # chave -> (valor, expira_em)
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get_fresh(self, key: Hashable) -> tuple:
+        entry = self._values.get(key)
+        if entry is None:
+            return False, None
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            self._values.pop(key, None)
+            return False, None
+        return True, value
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]], ttl: Optional[float] = None) -> Any:
+        """
+        Retorna o valor em cache ou calcula com compute() - chamadas concorrentes
+        para a mesma chave compartilham um único cálculo
+
+        O cálculo roda numa task própria: cancelar quem o iniciou (cliente
+        desconectou) não cancela as outras requisições aguardando a mesma chave.
+        """
+        found, value = self._get_fresh(key)
+        if found:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._compute(key, compute, self.ttl if ttl is None else ttl))
+            # Evita "Task exception was never retrieved" quando ninguém mais aguarda
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]], ttl: float) -> Any:
+        try:
+            value = await compute()
+            self._store(key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def _store(self, key: Hashable, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+        self._values[key] = (value, time.monotonic() + ttl)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Remove uma chave (ou tudo se key=None)"""
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+    def get_stats(self) -> Dict:
+        return {
+            "entries": len(self._values),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
@@ -0,0 +1,95 @@
+"""
+Perfil de inicialização do servidor (import do server.py + startup_event)
+
+Cold start e reload do worker estavam lentos sem saber por quê: o server.py
+importava todos os módulos de rotas, e com eles Playwright, SDK da OpenAI e
+emergentintegrations. Aqui cada fase registra quanto tempo levou:
+
+- kind="import": blocos de import do server.py
+- kind="router": import + montagem de cada router do router_registry
+- kind="startup": etapas do startup_event (índices, pipelines, schedulers...)
+
+No fim do startup o relatório vai para o log (fases mais lentas + módulos pesados
+carregados) e fica em GET /api/admin/startup-profile.
+
+Deve ser o primeiro import do server.py: o relógio começa no import deste módulo.
+"""
+import sys
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Dependências que só devem ser carregadas sob demanda (primeiro uso). Se aparecem
+# no relatório, algum import no topo de módulo voltou a puxá-las no startup.
+HEAVY_MODULES = (
+    "playwright",
+    "openai",
+    "emergentintegrations",
+    "litellm",
+    "cv2",
+    "PIL",
+)
+
+
+def heavy_modules_loaded() -> List[str]:
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: List[Dict] = []
+        self.finished: Optional[float] = None
+
+    def _record(self, name: str, kind: str, seconds: float):
+        self.phases.append({"phase": name, "kind": kind, "seconds": round(seconds, 4)})
+
+    def mark(self, name: str, kind: str = "startup"):
+        """Fecha a fase `name`: tempo desde o mark anterior"""
+        now = time.perf_counter()
+        self._record(name, kind, now - self._last)
+        self._last = now
+
+    @contextmanager
+    def measure(self, name: str, kind: str):
+        """Fase delimitada (não conta o que veio antes dela)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._record(name, kind, now - started)
+            self._last = now
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def report(self, top: int = 15) -> Dict:
+        end = self.finished or time.perf_counter()
+        totals: Dict[str, float] = {}
+        for phase in self.phases:
+            totals[phase["kind"]] = round(totals.get(phase["kind"], 0.0) + phase["seconds"], 4)
+        return {
+            "total_seconds": round(end - self.started, 4),
+            "complete": self.finished is not None,
+            "by_kind": totals,
+            "slowest": sorted(self.phases, key=lambda p: -p["seconds"])[:top],
+            "phases": self.phases,
+            "heavy_modules_loaded": heavy_modules_loaded()
+        }
+
+    def log_report(self, top: int = 5):
+        report = self.report(top=top)
+        slowest = ", ".join(f"{p['phase']}={p['seconds']:.2f}s" for p in report["slowest"])
+        logger.info(f"⏱️ Startup em {report['total_seconds']:.2f}s {report['by_kind']} | mais lentas: {slowest}")
+        if report["heavy_modules_loaded"]:
+            logger.warning(f"⚠️ Módulos pesados carregados no startup: {', '.join(report['heavy_modules_loaded'])}")
+        return report
+
+
+# Instância global
+startup_profile = StartupProfile()
@@ -6,8 +6,9 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from typing import Optional
 import logging
 
+from logging_setup import SAMPLED
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 class TenantContext:
     """Contexto do tenant atual da requisição"""
@@ -64,9 +65,8 @@ async def detect_tenant(request: Request, db: AsyncIOMotorDatabase) -> TenantCon
     host = request.headers.get("host", "")
     domain = host.split(":")[0]  # Remove porta se existir
     
-    # DEBUG: Force print to see if this is being executed
-    print(f"🔍 TENANT MIDDLEWARE: Detecting tenant for domain: '{domain}'")
-    logger.info(f"🔍 Detecting tenant for domain: {domain}")
+    # Roda em toda requisição: log de depuração amostrado (LOG_LEVELS=tenant_middleware=DEBUG)
+    logger.debug(f"🔍 Detecting tenant for domain: {domain}", extra=SAMPLED)
     
     # Domínios master (admin principal) - APENAS preview/localhost
     master_domains = [
@@ -82,19 +82,17 @@ async def detect_tenant(request: Request, db: AsyncIOMotorDatabase) -> TenantCon
     
     # Verifica se é domínio master
     is_master = False
-    logger.info(f"🔍 Checking domain: '{domain}' against master_domains")
     if any(master == domain for master in master_domains):
         # Domínios master exatos
         is_master = True
-        logger.info(f"✅ Master domain matched: {domain}")
     
     if is_master:
         context.is_master = True
         context.reseller_id = None
-        logger.info("Master domain detected - no tenant restriction")
+        logger.debug(f"✅ Master domain matched: {domain} - no tenant restriction", extra=SAMPLED)
         return context
     else:
-        logger.warning(f"⚠️ Domain '{domain}' NOT recognized as master")
+        logger.debug(f"⚠️ Domain '{domain}' NOT recognized as master", extra=SAMPLED)
     
     # Busca revenda pelo domínio
     reseller = await get_tenant_from_domain(domain, db)
@@ -0,0 +1,297 @@
+"""
+Contadores materializados de tickets (ticket_counters)
+
+Em vez de count_documents a cada polling do painel, os totais ficam em
+documentos pequenos atualizados com $inc a cada transição de ticket:
+
+    {_id: "status|<reseller_id>|<status>|<agent_id>", kind: "status", reseller_id, status, agent_id, count}
+    {_id: "closed_day|<reseller_id>|<YYYY-MM-DD>", kind: "closed_day", reseller_id, day, count, expire_at}
+
+- Criação / mudança de status / mudança de agente / mudança de revenda: $inc -1 na
+  chave antiga e +1 na nova (estado anterior obtido atomicamente com
+  find_one_and_update + ReturnDocument.BEFORE).
+- Leitura: espelho em memória do collection (recarregado a cada MIRROR_TTL segundos,
+  atualizado localmente a cada $inc) - contagem sem ir ao banco.
+- Reconciliação periódica recalcula tudo a partir de tickets e corrige desvios
+  (writes que não passam por aqui, falhas entre o update do ticket e o $inc etc).
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+
+from timestamps import stamp, since_filter
+from metrics import loop_tick
+
+logger = logging.getLogger(__name__)
+
+MIRROR_TTL = float(os.environ.get("TICKET_COUNTERS_MIRROR_TTL", "5"))
+RECONCILE_INTERVAL = int(os.environ.get("TICKET_COUNTERS_RECONCILE_SECONDS", "600"))
+
+# Campos do ticket que definem a chave do contador
+COUNTED_FIELDS = {"_id": 0, "reseller_id": 1, "status": 1, "agent_id": 1}
+
+# Status "finalizado" usado pelo dashboard (finalizadas hoje)
+CLOSED_STATUS = "closed"
+
+StatusKey = Tuple[str, str, str]
+
+
+def _status_key(ticket: Optional[Dict]) -> Optional[StatusKey]:
+    if not ticket:
+        return None
+    return (
+        ticket.get("reseller_id") or "",
+        ticket.get("status") or "",
+        ticket.get("agent_id") or ""
+    )
+
+
+def _status_doc_id(key: StatusKey) -> str:
+    return "status|" + "|".join(key)
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _apply_update(before: Dict, update: Dict) -> Dict:
+    """Estado dos campos contados após aplicar $set/$unset de um update"""
+    after = dict(before)
+    for field, value in (update.get("$set") or {}).items():
+        if field in COUNTED_FIELDS:
+            after[field] = value
+    for field in (update.get("$unset") or {}):
+        after.pop(field, None)
+    return after
+
+
+class TicketCounterStore:
+    """Contadores de tickets por revenda/status/agente com espelho em memória"""
+
+    def __init__(self):
+        self._mirror: Dict[str, Dict] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    # ------------------------------------------------------------------
+    # Escrita (transições)
+    # ------------------------------------------------------------------
+
+    async def _inc(self, db, doc_id: str, fields: Dict, delta: int, expire_at: Optional[datetime] = None):
+        update = {"$inc": {"count": delta}, "$setOnInsert": fields}
+        if expire_at is not None:
+            update["$setOnInsert"] = {**fields, "expire_at": expire_at}
+        await db.ticket_counters.update_one({"_id": doc_id}, update, upsert=True)
+
+        entry = self._mirror.get(doc_id)
+        if entry is None:
+            entry = self._mirror[doc_id] = {**fields, "count": 0}
+        entry["count"] = entry.get("count", 0) + delta
+
+    async def record_transition(self, db, before: Optional[Dict], after: Optional[Dict]):
+        """
+        Ajusta os contadores para um ticket que passou de before para after
+        (before=None: ticket criado; after=None: ticket removido)
+        """
+        old_key = _status_key(before)
+        new_key = _status_key(after)
+        if old_key == new_key:
+            return
+
+        try:
+            if old_key is not None:
+                await self._inc(db, _status_doc_id(old_key), self._status_fields(old_key), -1)
+            if new_key is not None:
+                await self._inc(db, _status_doc_id(new_key), self._status_fields(new_key), 1)
+
+            # Finalizadas hoje: conta entradas no status fechado
+            if new_key is not None and new_key[1] == CLOSED_STATUS and (old_key is None or old_key[1] != CLOSED_STATUS):
+                day = _today()
+                await self._inc(
+                    db,
+                    f"closed_day|{new_key[0]}|{day}",
+                    {"kind": "closed_day", "reseller_id": new_key[0], "day": day},
+                    1,
+                    expire_at=datetime.now(timezone.utc) + timedelta(days=2)
+                )
+        except Exception as e:
+            # Contador nunca bloqueia o fluxo do ticket - a reconciliação corrige
+            logger.warning(f"⚠️ Erro ao atualizar ticket_counters: {e}")
+
+    @staticmethod
+    def _status_fields(key: StatusKey) -> Dict:
+        return {"kind": "status", "reseller_id": key[0], "status": key[1], "agent_id": key[2]}
+
+    async def record_created(self, db, ticket: Dict):
+        """Chamar após db.tickets.insert_one"""
+        await self.record_transition(db, None, ticket)
+
+    async def update_ticket(self, db, filter: Dict, update: Dict, **kwargs) -> Optional[Dict]:
+        """
+        Substitui db.tickets.update_one quando o update pode mudar status, agente ou revenda.
+        Retorna os campos contados do ticket ANTES do update (None se não encontrado).
+        """
+        if "$set" in update:
+            update = {**update, "$set": stamp(update["$set"])}
+        before = await db.tickets.find_one_and_update(
+            filter,
+            update,
+            projection=COUNTED_FIELDS,
+            return_document=ReturnDocument.BEFORE,
+            **kwargs
+        )
+        if before is not None:
+            await self.record_transition(db, before, _apply_update(before, update))
+        return before
+
+    async def drop_tenant(self, db, reseller_id: str):
+        """Chamar após remover todos os tickets de uma revenda"""
+        await db.ticket_counters.delete_many({"reseller_id": reseller_id})
+        for doc_id in [k for k, v in self._mirror.items() if v.get("reseller_id") == reseller_id]:
+            self._mirror.pop(doc_id, None)
+
+    # ------------------------------------------------------------------
+    # Leitura
+    # ------------------------------------------------------------------
+
+    async def _ensure_mirror(self, db):
+        if time.monotonic() - self._loaded_at < MIRROR_TTL:
+            return
+        async with self._lock:
+            if time.monotonic() - self._loaded_at < MIRROR_TTL:
+                return
+            docs = await db.ticket_counters.find({}).to_list(length=None)
+            self._mirror = {doc.pop("_id"): doc for doc in docs}
+            self._loaded_at = time.monotonic()
+
+    def _iter(self, kind: str, reseller_id: Optional[str]) -> Iterable[Dict]:
+        for entry in self._mirror.values():
+            if entry.get("kind") != kind:
+                continue
+            if reseller_id is not None and entry.get("reseller_id") != reseller_id:
+                continue
+            yield entry
+
+    async def status_counts(self, db, reseller_id: Optional[str] = None) -> Dict[str, int]:
+        """Total de tickets por status (reseller_id=None = todas as revendas)"""
+        await self._ensure_mirror(db)
+        counts: Dict[str, int] = {}
+        for entry in self._iter("status", reseller_id):
+            counts[entry["status"]] = counts.get(entry["status"], 0) + entry.get("count", 0)
+        return counts
+
+    async def assignment_counts(self, db, status: str, reseller_id: Optional[str] = None) -> Tuple[int, int]:
+        """(sem agente, com agente) para um status"""
+        await self._ensure_mirror(db)
+        unassigned = assigned = 0
+        for entry in self._iter("status", reseller_id):
+            if entry["status"] != status:
+                continue
+            if entry.get("agent_id"):
+                assigned += entry.get("count", 0)
+            else:
+                unassigned += entry.get("count", 0)
+        return unassigned, assigned
+
+    async def agent_counts(self, db, status: str, reseller_id: Optional[str] = None) -> Dict[str, int]:
+        """Tickets por agente em um status"""
+        await self._ensure_mirror(db)
+        counts: Dict[str, int] = {}
+        for entry in self._iter("status", reseller_id):
+            if entry["status"] == status and entry.get("agent_id"):
+                counts[entry["agent_id"]] = counts.get(entry["agent_id"], 0) + entry.get("count", 0)
+        return counts
+
+    async def closed_today(self, db, reseller_id: Optional[str] = None) -> int:
+        await self._ensure_mirror(db)
+        day = _today()
+        return sum(entry.get("count", 0) for entry in self._iter("closed_day", reseller_id) if entry.get("day") == day)
+
+    # ------------------------------------------------------------------
+    # Reconciliação
+    # ------------------------------------------------------------------
+
+    async def reconcile(self, db) -> int:
+        """
+        Recalcula todos os contadores a partir de tickets e grava só os que divergem
+        Retorna o número de contadores corrigidos
+        """
+        today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        day = _today()
+
+        status_rows = await db.tickets.aggregate([
+            {"$group": {
+                "_id": {
+                    "reseller_id": {"$ifNull": ["$reseller_id", ""]},
+                    "status": {"$ifNull": ["$status", ""]},
+                    "agent_id": {"$ifNull": ["$agent_id", ""]}
+                },
+                "count": {"$sum": 1}
+            }}
+        ]).to_list(length=None)
+        closed_rows = await db.tickets.aggregate([
+            {"$match": {"status": CLOSED_STATUS, **since_filter("updated_at", today_start)}},
+            {"$group": {"_id": {"$ifNull": ["$reseller_id", ""]}, "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+
+        expected: Dict[str, Dict] = {}
+        for row in status_rows:
+            key = (row["_id"]["reseller_id"], row["_id"]["status"], row["_id"]["agent_id"])
+            expected[_status_doc_id(key)] = {**self._status_fields(key), "count": row["count"]}
+        for row in closed_rows:
+            expected[f"closed_day|{row['_id']}|{day}"] = {
+                "kind": "closed_day", "reseller_id": row["_id"], "day": day, "count": row["count"]
+            }
+
+        current = {
+            doc.pop("_id"): doc
+            for doc in await db.ticket_counters.find({}).to_list(length=None)
+        }
+
+        operations = []
+        for doc_id, doc in expected.items():
+            if current.get(doc_id, {}).get("count") != doc["count"]:
+                fields = dict(doc)
+                if doc["kind"] == "closed_day":
+                    fields["expire_at"] = datetime.now(timezone.utc) + timedelta(days=2)
+                operations.append(UpdateOne({"_id": doc_id}, {"$set": fields}, upsert=True))
+        for doc_id, doc in current.items():
+            if doc_id in expected or doc.get("count", 0) == 0:
+                continue
+            if doc.get("kind") == "closed_day" and doc.get("day") != day:
+                continue
+            operations.append(UpdateOne({"_id": doc_id}, {"$set": {"count": 0}}))
+
+        if operations:
+            await db.ticket_counters.bulk_write(operations, ordered=False)
+            logger.info(f"🔁 ticket_counters reconciliado: {len(operations)} contadores corrigidos")
+
+        self._loaded_at = 0.0  # forçar recarga do espelho
+        return len(operations)
+
+    async def ensure_indexes(self, db):
+        try:
+            await db.ticket_counters.create_index([("reseller_id", 1)])
+            await db.ticket_counters.create_index([("expire_at", 1)], expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao criar índices de ticket_counters: {e}")
+
+    async def run_reconciler(self, db):
+        """Loop de reconciliação (iniciado no startup do servidor)"""
+        await self.ensure_indexes(db)
+        while True:
+            try:
+                async with loop_tick("ticket_counters_reconcile"):
+                    await self.reconcile(db)
+            except Exception as e:
+                logger.error(f"❌ Erro na reconciliação de ticket_counters: {e}")
+            await asyncio.sleep(RECONCILE_INTERVAL)
+
+
+# Instância global
+ticket_counters = TicketCounterStore()
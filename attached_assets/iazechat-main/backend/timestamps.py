@@ -0,0 +1,187 @@
+"""
+Timestamps tipados (datas BSON) com escrita dupla e leitura compatível
+
+Tickets, mensagens e memória da IA guardam datas como ISO string, e mensagens do
+WhatsApp usam "timestamp" no lugar de "created_at". Comparar strings não usa bem
+os índices em filtros de período e o Python precisava de fromisoformat linha a
+linha. Aqui:
+
+- Escrita dupla: stamp() grava ao lado de cada campo ISO a versão BSON
+  (<campo>_dt). A API e o WebSocket continuam com as strings de sempre.
+- Nome normalizado: mensagem sem created_at recebe o valor de timestamp.
+- Migração (migrate_timestamps, no startup e via `python timestamps.py`): preenche
+  <campo>_dt no servidor com $dateFromString; o que o Mongo não conseguir
+  interpretar é convertido em Python em lotes (bulk_write).
+- Leitura compatível: as_datetime() aceita datetime, ISO string ou epoch, e
+  since_filter() monta "campo >= data" para docs migrados e antigos.
+- Índices dos campos <campo>_dt ficam no index_registry.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH = int(os.environ.get("TIMESTAMP_MIGRATION_BATCH", "1000"))
+
+DEFAULT_FIELDS = ("created_at", "updated_at")
+
+# collection -> campos ISO que ganham a versão BSON <campo>_dt
+TYPED_FIELDS = {
+    "tickets": ("created_at", "updated_at"),
+    "messages": ("created_at",),
+    "ai_conversation_memory": ("created_at", "updated_at"),
+    "ai_conversation_sessions": ("created_at", "updated_at"),
+}
+
+# Campos internos que não saem nas respostas da API
+HIDDEN_TYPED_FIELDS = {"created_at_dt": 0, "updated_at_dt": 0}
+
+def typed_name(field: str) -> str:
+    return f"{field}_dt"
+
+
+def as_datetime(value: Any) -> Optional[datetime]:
+    """datetime (aware, UTC) a partir de data BSON, ISO string ou epoch (s/ms)"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        # Motor devolve datas BSON sem tzinfo (sempre UTC)
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, (int, float)):
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds, tz=timezone.utc)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def stamp(doc: Dict, fields: Iterable[str] = DEFAULT_FIELDS) -> Dict:
+    """
+    Escrita dupla: cópia do dict (documento novo ou conteúdo de um $set) com
+    <campo>_dt para cada campo de data presente. O original segue sem datas BSON,
+    pronto para ir ao WebSocket / resposta JSON.
+    """
+    doc = dict(doc)
+    if "created_at" in fields and not doc.get("created_at") and doc.get("timestamp"):
+        doc["created_at"] = doc["timestamp"]
+    for field in fields:
+        if field in doc:
+            typed = as_datetime(doc[field])
+            if typed is not None:
+                doc[typed_name(field)] = typed
+    return doc
+
+
+def typed_value(doc: Dict, field: str = "created_at") -> Optional[datetime]:
+    """Leitura compatível: usa <campo>_dt se já existir, senão converte o campo antigo"""
+    typed = doc.get(typed_name(field))
+    if typed is not None:
+        return as_datetime(typed)
+    value = doc.get(field)
+    if value is None and field == "created_at":
+        value = doc.get("timestamp")
+    return as_datetime(value)
+
+
+def since_filter(field: str, since: datetime, legacy_fields: Iterable[str] = ()) -> Dict:
+    """
+    Filtro "campo >= since": usa o índice de <campo>_dt e cobre docs ainda não
+    migrados comparando as strings ISO (do campo e de nomes antigos)
+    """
+    legacy = [{name: {"$gte": since.isoformat()}} for name in (field, *legacy_fields)]
+    return {"$or": [
+        {typed_name(field): {"$gte": since}},
+        {typed_name(field): {"$exists": False}, "$or": legacy},
+    ]}
+
+
+# ----------------------------------------------------------------------
+# Migração
+# ----------------------------------------------------------------------
+
+async def _normalize_message_names(db) -> int:
+    """Mensagens antigas do WhatsApp: created_at <- timestamp"""
+    result = await db.messages.update_many(
+        {"created_at": None, "timestamp": {"$type": "string"}},
+        [{"$set": {"created_at": "$timestamp"}}]
+    )
+    return result.modified_count
+
+
+async def _backfill_field(db, collection: str, field: str) -> int:
+    target = typed_name(field)
+    invalid = f"{target}_invalid"
+
+    # 1. No servidor: ISO string -> data BSON (null quando não interpretável)
+    result = await db[collection].update_many(
+        {target: {"$exists": False}, invalid: {"$exists": False}, field: {"$type": "string"}},
+        [{"$set": {target: {"$dateFromString": {"dateString": f"${field}", "onError": None}}}}]
+    )
+    converted = result.modified_count
+
+    # 2. Em Python, em lotes: formatos que o $dateFromString recusou e campos
+    #    que já não eram string (data BSON / epoch)
+    pending = {
+        invalid: {"$exists": False},
+        "$or": [
+            {target: {"$exists": True, "$eq": None}},
+            {target: {"$exists": False}, field: {"$exists": True, "$ne": None}}
+        ]
+    }
+    while True:
+        docs = await db[collection].find(pending, {"_id": 1, field: 1}).limit(MIGRATION_BATCH).to_list(MIGRATION_BATCH)
+        if not docs:
+            break
+        ops = []
+        for doc in docs:
+            typed = as_datetime(doc.get(field))
+            if typed is None:
+                # Marca para não voltar a tentar; leitura segue pelo campo antigo
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$unset": {target: ""}, "$set": {invalid: True}}))
+            else:
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {target: typed}}))
+        await db[collection].bulk_write(ops, ordered=False)
+        converted += len(ops)
+        await asyncio.sleep(0)
+
+    return converted
+
+
+async def migrate_timestamps(db) -> Dict[str, int]:
+    """Normaliza nomes e preenche os campos <campo>_dt que faltam (idempotente)"""
+    summary = {"messages.created_at<-timestamp": await _normalize_message_names(db)}
+    for collection, fields in TYPED_FIELDS.items():
+        for field in fields:
+            try:
+                summary[f"{collection}.{typed_name(field)}"] = await _backfill_field(db, collection, field)
+            except Exception as e:
+                logger.error(f"❌ Erro migrando {collection}.{field}: {e}")
+    migrated = {key: count for key, count in summary.items() if count}
+    if migrated:
+        logger.info(f"🕒 Timestamps tipados migrados: {migrated}")
+    return summary
+
+
+if __name__ == "__main__":
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from index_registry import apply_indexes
+
+    async def main():
+        client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+        db = client[os.environ.get("DB_NAME", "support_chat")]
+        await apply_indexes(db)
+        summary = await migrate_timestamps(db)
+        for key, count in summary.items():
+            print(f"  {key}: {count}")
+        client.close()
+
+    asyncio.run(main())
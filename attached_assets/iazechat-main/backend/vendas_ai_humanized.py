@@ -7,6 +7,8 @@ import logging
 import os
 from datetime import datetime, timezone
 from typing import Tuple, List, Dict
+from metrics import track_llm
+from ai_conversation_memory import conversation_memory
 
 logger = logging.getLogger(__name__)
 
@@ -145,10 +147,11 @@ class HumanizedVendasAI:
             
             # 🚀 OTIMIZAÇÃO: Adicionar timeout de 15 segundos
             try:
-                response = await asyncio.wait_for(
-                    chat.send_message(message),
-                    timeout=15.0
-                )
+                async with track_llm("openai", "gpt-4o-mini"):
+                    response = await asyncio.wait_for(
+                        chat.send_message(message),
+                        timeout=15.0
+                    )
             except asyncio.TimeoutError:
                 logger.error("⏱️ Timeout ao chamar IA (15s)")
                 return "Desculpe, estou demorando muito para responder. Pode tentar novamente?"
@@ -171,16 +174,20 @@ class HumanizedVendasAI:
             client = AsyncOpenAI(api_key=api_key)
             
             # 🚀 OTIMIZAÇÃO: Reduzir max_tokens para respostas mais rápidas
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.9,
-                max_tokens=300,  # 🚀 Reduzido de 500 para 300 (respostas mais rápidas)
-                timeout=15.0  # 🚀 Timeout de 15 segundos
-            )
+            async with track_llm("openai", "gpt-4o-mini") as call:
+                response = await client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_message}
+                    ],
+                    temperature=0.9,
+                    max_tokens=300,  # 🚀 Reduzido de 500 para 300 (respostas mais rápidas)
+                    timeout=15.0  # 🚀 Timeout de 15 segundos
+                )
+                if response.usage:
+                    call["prompt_tokens"] = response.usage.prompt_tokens
+                    call["completion_tokens"] = response.usage.completion_tokens
             
             return response.choices[0].message.content
             
@@ -189,14 +196,18 @@ class HumanizedVendasAI:
             raise
     
     async def save_message(self, session_id: str, role: str, content: str, db):
-        """Salva mensagem no histórico"""
+        """Salva mensagem no histórico (com expire_at da retenção padrão - removida pelo TTL)"""
         try:
+            now = datetime.now(timezone.utc)
             doc = {
                 "session_id": session_id,
                 "role": role,
                 "content": content,
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": now.isoformat()
             }
+            expire_at = await conversation_memory.expiry_for(db, None, now)
+            if expire_at is not None:
+                doc["expire_at"] = expire_at
             await db.ai_conversation_memory.insert_one(doc)
             logger.info(f"💾 Salvo: {role}")
         except Exception as e:
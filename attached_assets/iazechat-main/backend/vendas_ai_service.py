@@ -3,15 +3,22 @@ Serviço de IA para Sistema de Vendas CyberTV
 Bot inteligente que responde com IA e envia botões interativos
 """
 import re
+import json
+import time
+import hashlib
 import httpx
 import logging
 import os
 import uuid
 from typing import Optional, Dict, Tuple, List
 from datetime import datetime, timezone, timedelta
-from emergentintegrations.llm.chat import LlmChat, UserMessage
 from dotenv import load_dotenv
 from vendas_flow_12 import Flow12Manager
+from ai_response_cache import ai_response_cache, last_assistant_reply
+from ai_context_builder import context_builder
+from metrics import track_llm
+from ai_conversation_memory import conversation_memory
+from ticket_counters import ticket_counters
 
 load_dotenv()
 
@@ -38,33 +45,46 @@ class VendasAIService:
         
         # Cache de instruções carregadas de URLs/arquivos
         self.instructions_cache = {}
+        # Intervalo mínimo entre revalidações (GET condicional) de URLs de instruções
+        self.url_revalidate_seconds = int(os.environ.get('INSTRUCTIONS_URL_REVALIDATE_SECONDS', '300'))
     
     async def load_instructions_from_external(self, instructions_url: str = None, instructions_file: str = None) -> Optional[str]:
         """
         Carrega instruções de arquivo ou URL externa
         Prioridade: ARQUIVO > URL > None
+        
+        - Arquivo: cache invalidado quando o mtime/tamanho do arquivo muda
+        - URL: revalidada com GET condicional (ETag / Last-Modified) a cada
+          INSTRUCTIONS_URL_REVALIDATE_SECONDS; a última versão fica persistida
+          em disco para sobreviver a restarts sem baixar tudo novamente
         """
         try:
             # Tentar carregar de ARQUIVO primeiro (prioridade máxima)
             if instructions_file and instructions_file.strip():
-                # Verificar cache
+                # Caminho do arquivo (assumindo que está em /app/instructions/)
+                file_path = f"/app/instructions/{instructions_file}"
                 cache_key = f"file_{instructions_file}"
-                if cache_key in self.instructions_cache:
+                
+                try:
+                    stat = os.stat(file_path)
+                    file_version = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    file_version = None
+                
+                cached = self.instructions_cache.get(cache_key)
+                if cached and file_version and cached["version"] == file_version:
                     logger.info(f"📦 Usando instruções em cache de arquivo: {instructions_file}")
-                    return self.instructions_cache[cache_key]
+                    return cached["content"]
                 
                 logger.info(f"📄 Carregando instruções de arquivo: {instructions_file}")
                 
-                # Caminho do arquivo (assumindo que está em /app/instructions/)
-                file_path = f"/app/instructions/{instructions_file}"
-                
-                if os.path.exists(file_path):
+                if file_version:
                     with open(file_path, 'r', encoding='utf-8') as f:
                         content = f.read()
                     
                     if content and len(content.strip()) > 10:
                         # Salvar em cache
-                        self.instructions_cache[cache_key] = content
+                        self.instructions_cache[cache_key] = {"content": content, "version": file_version}
                         logger.info(f"✅ Instruções carregadas de ARQUIVO ({len(content)} chars)")
                         return content
                     else:
@@ -74,30 +94,9 @@ class VendasAIService:
             
             # Se não conseguiu carregar de arquivo, tentar URL
             if instructions_url and instructions_url.strip():
-                # Verificar cache
-                cache_key = f"url_{instructions_url}"
-                if cache_key in self.instructions_cache:
-                    logger.info(f"📦 Usando instruções em cache de URL: {instructions_url[:50]}...")
-                    return self.instructions_cache[cache_key]
-                
-                logger.info(f"🌐 Carregando instruções de URL: {instructions_url}")
-                
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    response = await client.get(instructions_url)
-                    
-                    if response.status_code == 200:
-                        content = response.text
-                        
-                        # Validar se não está vazio
-                        if content and len(content.strip()) > 10:
-                            # Salvar em cache
-                            self.instructions_cache[cache_key] = content
-                            logger.info(f"✅ Instruções carregadas de URL ({len(content)} chars)")
-                            return content
-                        else:
-                            logger.warning("⚠️ URL retornou conteúdo vazio ou muito pequeno")
-                    else:
-                        logger.error(f"❌ Erro ao carregar URL: Status {response.status_code}")
+                content = await self._load_instructions_from_url(instructions_url)
+                if content:
+                    return content
             
             return None
             
@@ -105,6 +104,105 @@ class VendasAIService:
             logger.error(f"❌ Erro ao carregar instruções externas: {e}")
             return None
     
+    def _url_cache_path(self, instructions_url: str) -> str:
+        """Arquivo em disco com a última versão conhecida da URL (conteúdo + validadores HTTP)"""
+        from instructions_rag import INDEX_DIR
+        url_hash = hashlib.sha1(instructions_url.encode('utf-8')).hexdigest()
+        return os.path.join(INDEX_DIR, "urls", f"{url_hash}.json")
+    
+    def _read_url_cache(self, instructions_url: str) -> Optional[Dict]:
+        try:
+            with open(self._url_cache_path(instructions_url), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("url") == instructions_url and data.get("content"):
+                # Forçar revalidação após restart
+                data["checked_at"] = 0
+                return data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ Cache de URL inválido para {instructions_url[:50]}: {e}")
+        return None
+    
+    def _write_url_cache(self, instructions_url: str, entry: Dict):
+        path = self._url_cache_path(instructions_url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({k: v for k, v in entry.items() if k != "checked_at"}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível persistir cache da URL: {e}")
+    
+    async def _load_instructions_from_url(self, instructions_url: str) -> Optional[str]:
+        """
+        Carrega instruções de URL com revalidação condicional (ETag / Last-Modified)
+        304 Not Modified → reaproveita o conteúdo já conhecido sem baixar de novo
+        """
+        cache_key = f"url_{instructions_url}"
+        cached = self.instructions_cache.get(cache_key) or self._read_url_cache(instructions_url)
+        now = time.monotonic()
+        
+        if cached and now - cached["checked_at"] < self.url_revalidate_seconds:
+            logger.info(f"📦 Usando instruções em cache de URL: {instructions_url[:50]}...")
+            return cached["content"]
+        
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        
+        logger.info(f"🌐 {'Revalidando' if cached else 'Carregando'} instruções de URL: {instructions_url}")
+        
+        try:
+            async with httpx.AsyncClient(timeout=30.0) as client:
+                response = await client.get(instructions_url, headers=headers)
+        except Exception as e:
+            if cached:
+                # URL fora do ar: manter última versão conhecida
+                logger.warning(f"⚠️ Falha ao revalidar URL, usando última versão: {e}")
+                cached["checked_at"] = now
+                self.instructions_cache[cache_key] = cached
+                return cached["content"]
+            raise
+        
+        if response.status_code == 304 and cached:
+            logger.info(f"✅ Instruções da URL não mudaram (304)")
+            cached["checked_at"] = now
+            self.instructions_cache[cache_key] = cached
+            return cached["content"]
+        
+        if response.status_code == 200:
+            content = response.text
+            
+            # Validar se não está vazio
+            if content and len(content.strip()) > 10:
+                entry = {
+                    "url": instructions_url,
+                    "content": content,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "checked_at": now
+                }
+                # Salvar em cache (memória + disco)
+                self.instructions_cache[cache_key] = entry
+                self._write_url_cache(instructions_url, entry)
+                logger.info(f"✅ Instruções carregadas de URL ({len(content)} chars)")
+                return content
+            else:
+                logger.warning("⚠️ URL retornou conteúdo vazio ou muito pequeno")
+        else:
+            logger.error(f"❌ Erro ao carregar URL: Status {response.status_code}")
+        
+        if cached:
+            cached["checked_at"] = now
+            self.instructions_cache[cache_key] = cached
+            return cached["content"]
+        return None
+    
     # Tools/Functions disponíveis para a IA
     @property
     def tools(self):
@@ -316,16 +414,20 @@ class VendasAIService:
         try:
             logger.info(f"🔍 IA solicitou busca de credenciais: {search_term} (tipo: {search_type})")
             
+            from feature_flags import is_enabled
+            if not is_enabled("office"):
+                return {
+                    "success": False,
+                    "message": "❌ Busca de credenciais indisponível no momento. Entre em contato com o suporte."
+                }
+            
             # Importar serviço aqui para evitar circular import
             from credential_auto_search import credential_auto_search
             from office_service_playwright import office_service_playwright
-            from motor.motor_asyncio import AsyncIOMotorClient
+            from database import get_db
             
-            # Conectar ao MongoDB
-            mongo_url = os.environ.get('MONGO_URL', 'mongodb://mongodb:27017')
-            db_name = os.environ.get('DB_NAME', 'support_chat')
-            client = AsyncIOMotorClient(mongo_url)
-            db = client[db_name]
+            # Conexão compartilhada do servidor (antes: um cliente novo por busca)
+            db = get_db()
             
             # Buscar credenciais do Office
             office_credentials = await db.office_credentials.find(
@@ -537,6 +639,7 @@ class VendasAIService:
                     "vendas_session_id": session_id  # Referência à sessão de vendas
                 }
                 await db.tickets.insert_one(new_ticket)
+                await ticket_counters.record_created(db, new_ticket)
                 logger.info(f"✅ Ticket criado: {ticket_id} ({ticket_number}) para {whatsapp} - Reseller: {reseller_id}")
             else:
                 logger.info(f"ℹ️ Ticket já existe para {whatsapp}: {existing_ticket.get('id')}")
@@ -567,22 +670,15 @@ class VendasAIService:
     async def get_conversation_history(self, session_id: str, db, max_messages: int = 200) -> List[Dict]:
         """
         Recuperar histórico de conversa (últimas N mensagens)
-        Para manter contexto da IA
+        Para manter contexto da IA - lê apenas os buckets finais da sessão
         """
         try:
-            memory = await db.ai_conversation_memory.find_one({"session_id": session_id})
+            messages = await conversation_memory.get_recent(session_id, db, max_messages=max_messages)
             
-            if not memory or "messages" not in memory:
+            if not messages:
                 logger.debug(f"📭 Nenhum histórico encontrado para: {session_id}")
                 return []
             
-            messages = memory.get("messages", [])
-            
-            # Pegar apenas as últimas N mensagens (padrão: 200)
-            if len(messages) > max_messages:
-                messages = messages[-max_messages:]
-                logger.info(f"📚 Histórico limitado a {max_messages} mensagens para: {session_id}")
-            
             logger.info(f"📚 Histórico recuperado: {len(messages)} mensagens para: {session_id}")
             return messages
             
@@ -590,9 +686,10 @@ class VendasAIService:
             logger.error(f"❌ Erro ao recuperar histórico: {e}")
             return []
     
-    async def save_to_memory(self, session_id: str, role: str, content: str, db):
+    async def save_to_memory(self, session_id: str, role: str, content: str, db, department_id: Optional[str] = None):
         """
-        Salvar mensagem na memória de conversa
+        Salvar mensagem na memória de conversa (append no bucket aberto, sem leitura)
+        department_id define a retenção (expire_at) aplicada pelo índice TTL
         """
         try:
             message_data = {
@@ -601,31 +698,7 @@ class VendasAIService:
                 "timestamp": datetime.now(timezone.utc).isoformat()
             }
             
-            # Usar a rota de API internamente
-            from datetime import timedelta
-            
-            memory = await db.ai_conversation_memory.find_one({"session_id": session_id})
-            
-            now = datetime.now(timezone.utc)
-            expires_at = now + timedelta(days=60)
-            
-            if memory:
-                await db.ai_conversation_memory.update_one(
-                    {"session_id": session_id},
-                    {
-                        "$push": {"messages": message_data},
-                        "$set": {"expires_at": expires_at.isoformat()}
-                    }
-                )
-            else:
-                new_memory = {
-                    "session_id": session_id,
-                    "messages": [message_data],
-                    "metadata": {},
-                    "created_at": now.isoformat(),
-                    "expires_at": expires_at.isoformat()
-                }
-                await db.ai_conversation_memory.insert_one(new_memory)
+            await conversation_memory.append(session_id, [message_data], db, department_id=department_id)
             
             logger.debug(f"💾 Mensagem salva na memória: {session_id}")
             
@@ -674,6 +747,9 @@ class VendasAIService:
         Returns: (bot_message, should_show_button, button_action, human_requested, redirect_data, button_text)
         """
         try:
+            # Departamento do agente define a retenção da memória desta conversa
+            memory_department_id = await conversation_memory.department_for_agent(db, agent_config)
+            
             # 0. DETECTAR PALAVRAS-CHAVE PARA BUSCA AUTOMÁTICA DE CREDENCIAIS
             from keyword_credential_search import keyword_detector, format_credential_response
             
@@ -716,8 +792,8 @@ class VendasAIService:
                                 credential_msg = self.format_questions_with_line_breaks(credential_msg)
                                 
                                 # Salvar na memória
-                                await self.save_to_memory(session_id, "user", user_message, db)
-                                await self.save_to_memory(session_id, "assistant", credential_msg, db)
+                                await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                                await self.save_to_memory(session_id, "assistant", credential_msg, db, memory_department_id)
                                 
                                 logger.info(f"✅ Credenciais encontradas e retornadas para: {whatsapp}")
                                 
@@ -734,8 +810,8 @@ class VendasAIService:
                                 # Não encontrou credenciais
                                 error_msg = "❌ Não encontrei suas credenciais no sistema. Por favor, entre em contato com o suporte."
                                 error_msg = self.format_questions_with_line_breaks(error_msg)
-                                await self.save_to_memory(session_id, "user", user_message, db)
-                                await self.save_to_memory(session_id, "assistant", error_msg, db)
+                                await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                                await self.save_to_memory(session_id, "assistant", error_msg, db, memory_department_id)
                                 
                                 logger.warning(f"⚠️ Credenciais não encontradas para: {whatsapp}")
                                 
@@ -744,16 +820,16 @@ class VendasAIService:
                             # Sem credenciais cadastradas
                             no_cred_msg = "❌ Sistema de credenciais não configurado. Entre em contato com o suporte."
                             no_cred_msg = self.format_questions_with_line_breaks(no_cred_msg)
-                            await self.save_to_memory(session_id, "user", user_message, db)
-                            await self.save_to_memory(session_id, "assistant", no_cred_msg, db)
+                            await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                            await self.save_to_memory(session_id, "assistant", no_cred_msg, db, memory_department_id)
                             
                             return (no_cred_msg, False, None, False, None, None)
                     else:
                         # Sem WhatsApp na sessão
                         no_phone_msg = "❌ Não consegui identificar seu WhatsApp. Por favor, inicie uma nova conversa."
                         no_phone_msg = self.format_questions_with_line_breaks(no_phone_msg)
-                        await self.save_to_memory(session_id, "user", user_message, db)
-                        await self.save_to_memory(session_id, "assistant", no_phone_msg, db)
+                        await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                        await self.save_to_memory(session_id, "assistant", no_phone_msg, db, memory_department_id)
                         
                         return (no_phone_msg, False, None, False, None, None)
                         
@@ -764,8 +840,8 @@ class VendasAIService:
                     
                     # Salvar na memória
                     if db is not None:
-                        await self.save_to_memory(session_id, "user", user_message, db)
-                        await self.save_to_memory(session_id, "assistant", error_msg, db)
+                        await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                        await self.save_to_memory(session_id, "assistant", error_msg, db, memory_department_id)
                     
                     return (error_msg, False, None, False, None, None)
             
@@ -816,8 +892,8 @@ class VendasAIService:
                 
                 # Salvar na memória
                 if db is not None:
-                    await self.save_to_memory(session_id, "user", user_message, db)
-                    await self.save_to_memory(session_id, "assistant", redirect_message, db)
+                    await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
+                    await self.save_to_memory(session_id, "assistant", redirect_message, db, memory_department_id)
                 
                 return (
                     redirect_message,
@@ -839,12 +915,13 @@ class VendasAIService:
                 
                 # Salvar na memória que cliente pediu humano
                 if db is not None:
-                    await self.save_to_memory(session_id, "user", user_message, db)
+                    await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
                     await self.save_to_memory(
                         session_id, 
                         "assistant", 
                         human_msg,
-                        db
+                        db,
+                        memory_department_id
                     )
                     
                     # Criar feedback automático de erro (cliente pediu humano = não foi resolvido pela IA)
@@ -870,7 +947,7 @@ class VendasAIService:
             
             # 2. SALVAR MENSAGEM DO USUÁRIO NA MEMÓRIA
             if db is not None:
-                await self.save_to_memory(session_id, "user", user_message, db)
+                await self.save_to_memory(session_id, "user", user_message, db, memory_department_id)
             
             # Usar API key do agente se disponível, senão usar do .env
             api_key_to_use = self.api_key
@@ -884,6 +961,18 @@ class VendasAIService:
                 logger.error("❌ Nenhuma API key disponível!")
                 return ("Erro: API key não configurada.", False, None, False, None, None)
             
+            # 🔥 RECUPERAR HISTÓRICO DE CONVERSA (últimas 200 mensagens)
+            history = await self.get_conversation_history(session_id, db, max_messages=200)
+            
+            # ⚡ CACHE DE RESPOSTAS: pergunta repetida não chama o LLM
+            # (no mesmo ponto da conversa: a chave inclui a última resposta do bot)
+            previous_reply = last_assistant_reply(history)
+            cached_response = ai_response_cache.get(agent_config, user_message, previous_reply)
+            if cached_response:
+                if db is not None:
+                    await self.save_to_memory(session_id, "assistant", cached_response, db, memory_department_id)
+                return self._build_response_tuple(cached_response)
+            
             # Usar configuração do agente se disponível
             if agent_config:
                 logger.info(f"🤖 Usando configuração do agente: {agent_config.get('name', 'Unknown')}")
@@ -928,6 +1017,7 @@ Você é um assistente de IA especializado e focado.
                 
                 # 🔥 CARREGAR INSTRUÇÕES DE URL OU ARQUIVO (PRIORIDADE MÁXIMA)
                 instructions_from_external = None
+                instruction_chunks = None
                 instructions_file = agent_config.get('instructions_file')
                 instructions_url = agent_config.get('instructions_url')
                 
@@ -942,17 +1032,13 @@ Você é um assistente de IA especializado e focado.
                     logger.info(f"🤖 FORÇANDO RAG para arquivo: {instructions_file}")
                     
                     # Buscar apenas partes relevantes para esta mensagem
-                    relevant_instructions = instructions_rag.get_relevant_instructions(filepath, user_message)
+                    # (o context_builder decide quantos trechos cabem no orçamento de tokens)
+                    relevant_chunks = instructions_rag.get_relevant_chunks(filepath, user_message, max_chunks=6)
                     
-                    if relevant_instructions:
-                        # 🔥 LIMITAR TAMANHO (mesmo RAG pode retornar muito)
-                        MAX_RAG_SIZE = 15000  # 15KB - suficiente para contexto relevante
-                        if len(relevant_instructions) > MAX_RAG_SIZE:
-                            logger.warning(f"⚠️ RAG retornou muito ({len(relevant_instructions)} chars), limitando a {MAX_RAG_SIZE}")
-                            relevant_instructions = relevant_instructions[:MAX_RAG_SIZE]
-                        
-                        instructions_from_external = relevant_instructions
-                        logger.info(f"✅ RAG retornou {len(relevant_instructions)} chars de instruções relevantes")
+                    if relevant_chunks:
+                        instruction_chunks = relevant_chunks
+                        instructions_from_external = relevant_chunks[0]
+                        logger.info(f"✅ RAG retornou {len(relevant_chunks)} trechos de instruções relevantes")
                         
                         # NÃO carregar de URL se arquivo funcionou
                         instructions_url = None
@@ -1031,14 +1117,12 @@ PREÇOS DOS PLANOS:
 LEMBRE-SE: Você é INTELIGENTE. Leia a mensagem COMPLETA antes de responder!
 """
                 
-                # 🔥 LIMITAR TAMANHO APENAS SE NECESSÁRIO
-                if len(final_instructions) > 100000:
-                    logger.warning(f"⚠️ Instruções muito grandes ({len(final_instructions)} chars). Truncando para 100000 chars")
-                    final_instructions = final_instructions[:100000]
-                    final_instructions += "\n\n[... restante omitido por tamanho ...]"
+                # 🔥 TAMANHO CONTROLADO PELO ORÇAMENTO DE TOKENS (context_builder)
+                if not instruction_chunks:
+                    instruction_chunks = [final_instructions]
                 
-                system_parts.append(final_instructions)
-                logger.info(f"✅ Instruções carregadas: {len(final_instructions)} chars")
+                system_parts.append("{{INSTRUCTIONS}}")
+                logger.info(f"✅ Instruções carregadas: {sum(len(c) for c in instruction_chunks)} chars em {len(instruction_chunks)} trecho(s)")
                 
                 system_parts.append("""
 ═══════════════════════════════════════════════════════
@@ -1073,10 +1157,8 @@ LEMBRE-SE: Você é INTELIGENTE. Leia a mensagem COMPLETA antes de responder!
                 logger.warning("⚠️ NENHUMA CONFIGURAÇÃO - IA sem instruções específicas")
                 # Deixar IA responder naturalmente sem instruções fixas
                 system_message = f"Você é um assistente virtual da {empresa_nome}. Responda de forma educada e profissional."
+                instruction_chunks = None
 
-            # 🔥 RECUPERAR HISTÓRICO DE CONVERSA (últimas 200 mensagens)
-            history = await self.get_conversation_history(session_id, db, max_messages=200)
-            
             # 🚫 INTERCEPTOR DESABILITADO - DEIXAR IA TRABALHAR NATURALMENTE
             # O interceptor estava causando mais problemas do que soluções:
             # - Ignorava quando usuário já dizia o dispositivo na mensagem
@@ -1088,33 +1170,20 @@ LEMBRE-SE: Você é INTELIGENTE. Leia a mensagem COMPLETA antes de responder!
             
             logger.info("🤖 Interceptor desabilitado - IA processará naturalmente com base nas instruções")
             
-            # Converter histórico para formato do LlmChat
-            initial_messages = []
-            
             # 🔥 FORÇAR IDENTIDADE COM FEW-SHOT LEARNING
             # Adicionar exemplo de conversa que FORÇA a IA a seguir as instruções
+            few_shot_messages = []
             if agent_config:
-                initial_messages.append({
+                few_shot_messages.append({
                     "role": "user",
                     "content": "Quem é você?"
                 })
-                initial_messages.append({
+                few_shot_messages.append({
                     "role": "assistant",
                     "content": f"Sou {agent_config.get('name', 'assistente virtual')} e trabalho seguindo minhas instruções específicas de atendimento."
                 })
                 logger.info(f"🎯 Few-shot learning adicionado para forçar identidade")
             
-            # Carregar histórico existente
-            if history:
-                for msg in history:
-                    initial_messages.append({
-                        "role": msg.get("role"),  # "user" ou "assistant"
-                        "content": msg.get("content", "")
-                    })
-                logger.info(f"📚 Contexto carregado: {len(history)} mensagens anteriores")
-            
-            logger.info(f"📚 Total de mensagens iniciais: {len(initial_messages)}")
-            
             # Criar chat instance
             # 🔥 USAR GPT-4o-MINI para melhor aderência às instruções
             # Research 2025: gpt-4o-mini é mais obediente a system prompts específicos
@@ -1122,6 +1191,30 @@ LEMBRE-SE: Você é INTELIGENTE. Leia a mensagem COMPLETA antes de responder!
             
             logger.info("🎯 Usando GPT-4o-mini para máxima aderência às instruções específicas")
             
+            # 🔥 EMPACOTAR INSTRUÇÕES + HISTÓRICO NO ORÇAMENTO DE TOKENS
+            # Mensagens antigas que não cabem viram um resumo persistido por sessão
+            context = await context_builder.build(
+                agent_config={**(agent_config or {}), "llm_provider": "openai", "llm_model": model_to_use},
+                system_prompt=system_message,
+                history=history or [],
+                current_message=user_message,
+                instruction_chunks=instruction_chunks,
+                prefix_messages=few_shot_messages,
+                db=db,
+                conversation_id=session_id
+            )
+            system_message = context["system_message"]
+            initial_messages = context["messages"]
+            
+            logger.info(
+                f"📚 Contexto: {context['tokens']['history_messages']} msgs de histórico, "
+                f"{context['tokens']['summarized_messages']} resumidas, "
+                f"{context['tokens']['total']}/{context['tokens']['budget']} tokens"
+            )
+            
+            # Import sob demanda (fora do startup do servidor)
+            from emergentintegrations.llm.chat import LlmChat, UserMessage
+            
             # 🔥 NÃO PASSAR temperature no __init__ - emergentintegrations não suporta
             chat = LlmChat(
                 api_key=api_key_to_use,
@@ -1178,15 +1271,17 @@ Mensagem do cliente: {normalized_message}"""
             
             # 🔥 CHAMAR A IA - SEM PREFIXO NEGATIVO
             # Enviar e obter resposta
-            response = await chat.send_message(message)
-            
-            # Extrair texto da resposta
-            if hasattr(response, 'to_text'):
-                response_text = response.to_text()
-            elif hasattr(response, 'text'):
-                response_text = response.text
-            else:
-                response_text = str(response)
+            async with track_llm("openai", model_to_use, prompt_tokens=context["tokens"]["total"]) as call:
+                response = await chat.send_message(message)
+                
+                # Extrair texto da resposta
+                if hasattr(response, 'to_text'):
+                    response_text = response.to_text()
+                elif hasattr(response, 'text'):
+                    response_text = response.text
+                else:
+                    response_text = str(response)
+                call["completion_tokens"] = context_builder.count_tokens(str(response_text), "openai", model_to_use)
             
             logger.info(f"✅ IA respondeu: {response_text[:200]}...")
             
@@ -1202,21 +1297,23 @@ Mensagem do cliente: {normalized_message}"""
             
             # 3. SALVAR RESPOSTA DA IA NA MEMÓRIA
             if db is not None:
-                await self.save_to_memory(session_id, "assistant", response, db)
+                await self.save_to_memory(session_id, "assistant", response, db, memory_department_id)
             
-            # Detectar se deve mostrar botão
-            should_show_button = False
-            button_action = None
-            clean_response = response
-            
-            if "[BUTTON:GERAR_TESTE]" in response:
-                should_show_button = True
-                button_action = "GERAR_TESTE"
-                clean_response = response.replace("[BUTTON:GERAR_TESTE]", "").strip()
-            
-            logger.info(f"✅ IA respondeu: {clean_response[:100]}... | Botão: {should_show_button}")
+            # Dados do cliente da sessão: resposta que os contém não vai para o cache
+            session = await db.vendas_sessions.find_one(
+                {"session_id": session_id},
+                {"_id": 0, "whatsapp": 1, "pin": 1, "iptv_user": 1, "iptv_pass": 1}
+            ) if db is not None else None
+            ai_response_cache.put(
+                agent_config,
+                user_message,
+                response,
+                prompt_tokens=context["tokens"]["total"],
+                client_data=session,
+                previous_reply=previous_reply
+            )
             
-            return (clean_response, should_show_button, button_action, False, None, None)
+            return self._build_response_tuple(response)
             
         except Exception as e:
             error_msg = str(e)
@@ -1248,6 +1345,23 @@ Mensagem do cliente: {normalized_message}"""
                 None
             )
     
+    def _build_response_tuple(self, response: str) -> Tuple[str, bool, Optional[str], bool, Optional[Dict], Optional[str]]:
+        """
+        Detecta marcador de botão na resposta e monta a tupla de retorno de get_ai_response
+        """
+        should_show_button = False
+        button_action = None
+        clean_response = response
+        
+        if "[BUTTON:GERAR_TESTE]" in response:
+            should_show_button = True
+            button_action = "GERAR_TESTE"
+            clean_response = response.replace("[BUTTON:GERAR_TESTE]", "").strip()
+        
+        logger.info(f"✅ IA respondeu: {clean_response[:100]}... | Botão: {should_show_button}")
+        
+        return (clean_response, should_show_button, button_action, False, None, None)
+    
     async def generate_iptv_test(self, api_url: str) -> Dict:
         """
         Gera teste IPTV via API
@@ -1375,7 +1489,8 @@ Mensagem do cliente: {normalized_message}"""
             
             # Salvar na memória
             if db is not None:
-                await self.save_to_memory(session_id, "user", media_text, db)
+                memory_department_id = await conversation_memory.department_for_agent(db, agent_config)
+                await self.save_to_memory(session_id, "user", media_text, db, memory_department_id)
             
             # Obter resposta da IA com o conteúdo da mídia
             ai_response, _, _, _ = await self.get_ai_response(
@@ -4,20 +4,16 @@ Rotas da API para sistema de botões interativos
 from fastapi import APIRouter, HTTPException, Depends, File, UploadFile
 from typing import Optional, Dict, Any
 from vendas_buttons_service import ButtonsService, ButtonConfig, Button
-from motor.motor_asyncio import AsyncIOMotorClient
+from database import get_db
 from datetime import datetime, timezone
-import os
 import shutil
 import uuid
 from pathlib import Path
 
 router = APIRouter(prefix="/api/admin/vendas-bot/buttons", tags=["vendas-buttons"])
 
-# MongoDB
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-DB_NAME = os.environ.get('DB_NAME', 'support_chat')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
+# MongoDB (conexão compartilhada - database.py)
+db = get_db()
 
 buttons_service = ButtonsService(db)
 
@@ -6,6 +6,7 @@ import httpx
 import logging
 import uuid
 from datetime import datetime, timezone
+from ticket_counters import ticket_counters
 
 logger = logging.getLogger(__name__)
 
@@ -328,13 +329,15 @@ Aguarde alguns segundos..."""
             
             # Criar ticket de suporte
             ticket_id = str(uuid.uuid4())
-            await db.tickets.insert_one({
+            support_ticket = {
                 "id": ticket_id,
                 "client_id": user_id,
                 "status": "open",
                 "created_at": datetime.now(timezone.utc).isoformat(),
                 "source": "vendas_flow_12"
-            })
+            }
+            await db.tickets.insert_one(support_ticket)
+            await ticket_counters.record_created(db, support_ticket)
             
             # Transferir mensagens do /vendas para o ticket de suporte
             for msg in messages:
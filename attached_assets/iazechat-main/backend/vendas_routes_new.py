@@ -15,6 +15,9 @@ from vendas_models import (
 from vendas_ai_humanized import humanized_vendas_ai  # 🆕 IA HUMANIZADA REAL
 from vendas_ai_service import vendas_ai_service  # Fallback para Flow 12
 from vendas_buttons_service import ButtonsService  # 🆕 Sistema de Botões
+from ticket_counters import ticket_counters
+from timestamps import stamp
+from logging_setup import SAMPLED
 
 logger = logging.getLogger(__name__)
 
@@ -225,30 +228,19 @@ async def send_vendas_message(
     Enviar mensagem no chat de vendas
     IA responde automaticamente
     """
-    # DEBUG: Gravar em arquivo temporário
-    with open("/tmp/vendas_debug.log", "a") as f:
-        f.write(f"🚀 /MESSAGE CHAMADA! Sessão: {request.session_id}, Texto: {request.text}\n")
-    
-    print(f"🚀🚀🚀 /MESSAGE CHAMADA! Sessão: {request.session_id}, Texto: {request.text}")
-    logger.info(f"🚀 /MESSAGE CHAMADA! Sessão: {request.session_id}, Texto: {request.text}")
+    logger.debug(f"🚀 /message - Sessão: {request.session_id}, Texto: {request.text}", extra=SAMPLED)
     try:
-        print("CHECKPOINT A: Dentro do try")
         # Buscar sessão
-        print("CHECKPOINT B: Antes de buscar sessão")
         session = await db.vendas_sessions.find_one(
             {"session_id": request.session_id},
             {"_id": 0}
         )
         
-        print("CHECKPOINT C: Sessão buscada")
-        
         if not session:
             raise HTTPException(status_code=404, detail="Sessão não encontrada")
         
-        print("CHECKPOINT D: Sessão válida")
         # Buscar config (CORRIGIDO: buscar primeiro documento, não por is_active)
         config = await db.vendas_simple_config.find_one({})
-        print("CHECKPOINT E: Config buscada")
         
         if not config:
             logger.error("❌ NENHUMA CONFIGURAÇÃO ENCONTRADA NO BANCO!")
@@ -259,8 +251,7 @@ async def send_vendas_message(
         custom_instructions = config.get("custom_instructions")
         ia_inline = config.get("ia_inline")  # 🆕 Config inline da IA
         
-        logger.info(f"📋 Config encontrada: _id={config.get('_id')}")
-        logger.info(f"📋 Config vendas: usa_ia={usa_ia}, agent_id={agent_id}, ia_inline={'Sim' if ia_inline else 'Não'}")
+        logger.debug(f"📋 Config vendas: usa_ia={usa_ia}, agent_id={agent_id}, ia_inline={'Sim' if ia_inline else 'Não'}", extra=SAMPLED)
         
         # Buscar configuração do agente de IA
         agent_config = None
@@ -277,15 +268,14 @@ async def send_vendas_message(
                 "llm_model": ia_inline.get('llm_model', 'gpt-4o-mini'),
                 "api_key": ia_inline.get('api_key', '')  # 🔑 API Key inline
             }
-            logger.info(f"✅ Usando IA INLINE: {agent_config.get('name')} - API Key: {'Configurada' if agent_config.get('api_key') else 'FALTANDO'}")
-            logger.info(f"📋 Fontes configuradas - File: {ia_inline.get('instructions_file')}, URL: {ia_inline.get('instructions_url')}")
+            logger.debug(f"✅ Usando IA INLINE: {agent_config.get('name')} - API Key: {'Configurada' if agent_config.get('api_key') else 'FALTANDO'}", extra=SAMPLED)
         
         # PRIORIDADE 2: agent_id (agente criado na aba Agentes IA)
         elif agent_id:
             agent = await db.ai_agents.find_one({"id": agent_id}, {"_id": 0})
             if agent:
                 agent_config = agent
-                logger.info(f"✅ Agente encontrado: {agent.get('name')} - Instruções: {agent.get('instructions')[:100] if agent.get('instructions') else 'Nenhuma'}...")
+                logger.debug(f"✅ Agente encontrado: {agent.get('name')}", extra=SAMPLED)
             else:
                 logger.warning(f"⚠️ Agente {agent_id} não encontrado!")
         
@@ -297,9 +287,9 @@ async def send_vendas_message(
                 "instructions": custom_instructions,
                 "temperature": 0.7
             }
-            logger.info("✅ Usando instruções customizadas do WA Site (legado)")
+            logger.debug("✅ Usando instruções customizadas do WA Site (legado)", extra=SAMPLED)
         else:
-            logger.info("ℹ️ Nenhum agente ou instruções configuradas, usando prompt padrão")
+            logger.debug("ℹ️ Nenhum agente ou instruções configuradas, usando prompt padrão", extra=SAMPLED)
         
         # 🆕 VERIFICAR SISTEMA DE BOTÕES ANTES DE PROCESSAR (VERSÃO SIMPLIFICADA)
         button_config_doc = await db.config.find_one({"id": "config"}, {"button_config": 1})
@@ -313,8 +303,7 @@ async def send_vendas_message(
             button_enabled = btn_cfg.get("is_enabled", False)
             status = btn_cfg.get("mode", "ia")
         
-        print(f"🔘🔘🔘 Button config - Enabled: {button_enabled}, Mode: {status}")
-        logger.info(f"🔘 Button config - Enabled: {button_enabled}, Mode: {status}")
+        logger.debug(f"🔘 Button config - Enabled: {button_enabled}, Mode: {status}", extra=SAMPLED)
         
         # Se modo = "button" (apenas botões), NÃO processar como mensagem de texto normal
         # Espera-se que o frontend envie via /api/vendas/button-click
@@ -410,13 +399,13 @@ async def send_vendas_message(
         
         # Obter resposta da IA HUMANIZADA REAL (APENAS se IA estiver permitida)
         if ia_permitida:
-            logger.info(f"🚀 Usando IA HUMANIZADA - Modo: {status}")
+            logger.debug(f"🚀 Usando IA HUMANIZADA - Modo: {status}", extra=SAMPLED)
             
             # Buscar instruções
             instructions = ""
             if agent_config and agent_config.get('instructions'):
                 instructions = agent_config.get('instructions', '')
-                logger.info(f"✅ Instruções carregadas: {len(instructions)} chars")
+                logger.debug(f"✅ Instruções carregadas: {len(instructions)} chars", extra=SAMPLED)
             else:
                 logger.warning("⚠️ Nenhuma instrução configurada!")
                 instructions = "Você é uma atendente amigável e prestativa."
@@ -853,7 +842,8 @@ async def migrate_vendas_session(
                 "created_at": now.isoformat(),
                 "updated_at": now.isoformat()
             }
-            await db.tickets.insert_one(new_ticket)
+            await db.tickets.insert_one(stamp(new_ticket))
+            await ticket_counters.record_created(db, new_ticket)
             logger.info(f"✅ Novo ticket criado: {ticket_id}")
         
         # Copiar TODAS as mensagens do /vendas para o ticket principal
@@ -877,7 +867,7 @@ async def migrate_vendas_session(
             }
             
             # Inserir na collection de mensagens principais
-            await db.messages.insert_one(main_chat_message)
+            await db.messages.insert_one(stamp(main_chat_message))
             messages_copied += 1
         
         logger.info(f"📨 {messages_copied} mensagens copiadas de /vendas para ticket {ticket_id}")
@@ -988,7 +978,8 @@ async def assume_ai_session(
         if existing_ticket:
             # Atualizar ticket existente
             ticket_id = existing_ticket["id"]
-            await db.tickets.update_one(
+            await ticket_counters.update_ticket(
+                db,
                 {"id": ticket_id},
                 {
                     "$set": {
@@ -1014,7 +1005,8 @@ async def assume_ai_session(
                 "created_at": datetime.now(timezone.utc).isoformat(),
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.tickets.insert_one(new_ticket)
+            await db.tickets.insert_one(stamp(new_ticket))
+            await ticket_counters.record_created(db, new_ticket)
             logger.info(f"✅ Novo ticket criado: {ticket_id}")
         
         # 4. Copiar mensagens de vendas para ticket principal
@@ -1046,7 +1038,7 @@ async def assume_ai_session(
                         "original_message_id": msg.get("message_id")
                     }
                 }
-                await db.messages.insert_one(main_chat_message)
+                await db.messages.insert_one(stamp(main_chat_message))
                 messages_copied += 1
         
         logger.info(f"📨 {messages_copied} mensagens copiadas para ticket {ticket_id}")
@@ -5,6 +5,7 @@ Busca mensagens novas a cada 5 segundos
 import asyncio
 import httpx
 from motor.motor_asyncio import AsyncIOMotorClient
+from ticket_counters import ticket_counters
 from datetime import datetime, timezone
 import os
 import uuid
@@ -210,6 +211,7 @@ async def process_message(message, connection, db):
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
             await db.tickets.insert_one(ticket)
+            await ticket_counters.record_created(db, ticket)
             print(f"✅ Ticket criado: {ticket_id}")
         else:
             ticket_id = open_ticket["id"]
@@ -7,19 +7,18 @@ import logging
 from datetime import datetime, timezone
 import uuid
 import httpx
-from motor.motor_asyncio import AsyncIOMotorClient
+from database import get_db
+from ticket_counters import ticket_counters
 import os
 
 logger = logging.getLogger(__name__)
 
 EVOLUTION_API_URL = os.environ.get('EVOLUTION_API_URL', 'http://151.243.218.223:9000')
 EVOLUTION_API_KEY = os.environ.get('EVOLUTION_API_KEY', 'iaze-evolution-2025-secure-key')
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 
 class WhatsAppPollingService:
     def __init__(self):
-        self.client = AsyncIOMotorClient(MONGO_URL)
-        self.db = self.client.support_chat
+        self.db = get_db()
         self.running = False
         self.http_client = httpx.AsyncClient(timeout=30.0)
         
@@ -132,6 +131,7 @@ class WhatsAppPollingService:
                     "updated_at": datetime.now(timezone.utc).isoformat()
                 }
                 await self.db.tickets.insert_one(ticket)
+                await ticket_counters.record_created(self.db, ticket)
                 logger.info(f"✅ Ticket criado: {ticket_id}")
             else:
                 ticket_id = ticket["id"]
@@ -190,7 +190,6 @@ class WhatsAppPollingService:
         """Para o serviço de polling"""
         self.running = False
         await self.http_client.aclose()
-        self.client.close()
 
 # Instância global
 polling_service = WhatsAppPollingService()
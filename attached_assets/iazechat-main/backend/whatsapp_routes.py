@@ -18,6 +18,8 @@ from whatsapp_service_mock import get_mock_service
 USE_MOCK = os.environ.get("WPPCONNECT_MOCK", "false").lower() == "true"
 print(f"🔧 [CONFIG] WPPCONNECT_MOCK={os.environ.get('WPPCONNECT_MOCK', 'not set')}, USE_MOCK={USE_MOCK}", flush=True)
 from tenant_helpers import get_tenant_filter, get_request_tenant
+from ticket_counters import ticket_counters
+from timestamps import stamp
 
 router = APIRouter(tags=["whatsapp"])
 
@@ -229,7 +231,8 @@ async def webhook_evolution(request: Request):
                             "updated_at": datetime.now(timezone.utc).isoformat()
                         }
                         
-                        await db.tickets.insert_one(ticket)
+                        await db.tickets.insert_one(stamp(ticket))
+                        await ticket_counters.record_created(db, ticket)
                         logger.info(f"   ✅ Ticket criado: {ticket_id}")
                     else:
                         ticket_id = ticket["id"]
@@ -247,7 +250,7 @@ async def webhook_evolution(request: Request):
                         "created_at": datetime.now(timezone.utc).isoformat()
                     }
                     
-                    await db.messages.insert_one(message)
+                    await db.messages.insert_one(stamp(message))
                     logger.info(f"   ✅ Mensagem salva: {message_id}")
                 
                 logger.info("✅ Processamento de mensagens concluído!")
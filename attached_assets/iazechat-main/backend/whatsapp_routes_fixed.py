@@ -13,6 +13,7 @@ from datetime import datetime, timezone
 from whatsapp_models import *
 from whatsapp_service_wppconnect_v2 import wppconnect_service
 from tenant_helpers import get_tenant_filter, get_request_tenant
+from ticket_counters import ticket_counters
 
 router = APIRouter(prefix="/whatsapp", tags=["whatsapp"])
 
@@ -171,6 +172,7 @@ async def webhook_evolution(request: Request):
                         }
                         
                         await db.tickets.insert_one(ticket)
+                        await ticket_counters.record_created(db, ticket)
                         logger.info(f"   ✅ Ticket criado: {ticket_id}")
                     else:
                         ticket_id = ticket["id"]
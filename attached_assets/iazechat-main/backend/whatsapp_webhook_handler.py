@@ -4,13 +4,10 @@ Webhook Handler para WPPConnect - Recebe notificações de status
 from fastapi import APIRouter, Request, HTTPException, status
 from datetime import datetime, timezone
 import logging
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
+from database import get_db as get_shared_db
 
-# Conexão MongoDB (mesma estrutura do server.py)
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'support_chat')]
+# Conexão MongoDB compartilhada com o server.py (database.py)
+db = get_shared_db()
 
 def get_db():
     return db
@@ -0,0 +1,61 @@
+import { useEffect, useRef } from 'react';
+import { createWebSocket } from '../lib/api';
+import { getAuth } from '../lib/auth';
+
+// Recebe pelo WebSocket as mudanças de presença dos atendentes
+// (presence_snapshot / presence_diff) em vez de fazer polling.
+export default function usePresenceFeed(onPresence, enabled = true) {
+  const handlerRef = useRef(onPresence);
+  handlerRef.current = onPresence;
+
+  useEffect(() => {
+    if (!enabled) return undefined;
+    const { userData } = getAuth();
+    if (!userData?.id) return undefined;
+
+    let ws = null;
+    let keepalive = null;
+    let reconnectTimeout = null;
+    let closed = false;
+
+    const connect = () => {
+      ws = createWebSocket(userData.id);
+
+      ws.onmessage = (event) => {
+        try {
+          const data = JSON.parse(event.data);
+          if (data.type === 'presence_snapshot' || data.type === 'presence_diff') {
+            handlerRef.current(data);
+          }
+        } catch (e) {
+          // Ignorar mensagens que não são JSON
+        }
+      };
+
+      // Keepalive: mantém a conexão viva (o servidor usa os pings como heartbeat)
+      keepalive = setInterval(() => {
+        if (ws.readyState === WebSocket.OPEN) {
+          ws.send(JSON.stringify({ type: 'ping' }));
+        }
+      }, 30000);
+
+      ws.onclose = () => {
+        clearInterval(keepalive);
+        if (!closed) {
+          reconnectTimeout = setTimeout(connect, 5000);
+        }
+      };
+
+      ws.onerror = () => {}; // Silencioso
+    };
+
+    connect();
+
+    return () => {
+      closed = true;
+      clearInterval(keepalive);
+      clearTimeout(reconnectTimeout);
+      if (ws) ws.close();
+    };
+  }, [enabled]);
+}
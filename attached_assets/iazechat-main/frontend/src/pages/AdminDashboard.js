@@ -10,6 +10,7 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { toast } from 'sonner';
 import api from '../lib/api';
+import usePresenceFeed from '../hooks/use-presence-feed';
 import { clearAuth } from '../lib/auth';
 import AIAgentsManager from '../components/AIAgentsManager';
 import DepartmentsManager from '../components/DepartmentsManager';
@@ -154,6 +155,20 @@ const AdminDashboard = () => {
     }
   };
 
+  const loadAgentsOnline = async () => {
+    try {
+      const { data } = await api.get('/admin/dashboard/agents-online');
+      setAgentsOnline(data);
+    } catch (error) {
+      console.error('Error loading agents online:', error);
+    }
+  };
+
+  // Presença dos atendentes chega por WebSocket (sem polling)
+  usePresenceFeed(() => {
+    loadAgentsOnline();
+  }, activeTab === 'dashboard');
+
   const loadDashboardData = async () => {
     setDashboardLoading(true);
     try {
@@ -292,11 +307,25 @@ const AdminDashboard = () => {
     try {
       const { data } = await api.post('/admin/replicate-config-to-resellers');
       
-      if (data.ok) {
-        toast.success(`✅ ${data.message}`, { duration: 5000 });
+      if (!data.ok) {
+        toast.error('Erro ao replicar configurações');
+        return;
+      }
+      
+      // A replicação roda em background: acompanhar o job até terminar
+      const toastId = toast.loading(`🔄 ${data.message}`);
+      let job = { status: data.status };
+      while (job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, 1500));
+        ({ data: job } = await api.get(`/admin/replicate-config-to-resellers/jobs/${data.job_id}`));
+        toast.loading(`🔄 Replicando... ${job.processed}/${job.total} revendas (${job.progress}%)`, { id: toastId });
+      }
+      
+      if (job.status === 'completed') {
+        toast.success(`✅ Configurações replicadas: ${job.replicated} revendas atualizadas, ${job.skipped} já estavam iguais`, { id: toastId, duration: 5000 });
         setReplicateModal(false);
       } else {
-        toast.error('Erro ao replicar configurações');
+        toast.error(`⚠️ Replicação terminou com ${job.failed} falha(s). Execute novamente para reprocessar apenas as revendas pendentes.`, { id: toastId, duration: 8000 });
       }
     } catch (error) {
       console.error('Erro ao replicar:', error);
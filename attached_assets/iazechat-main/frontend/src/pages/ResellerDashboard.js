@@ -10,6 +10,7 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { toast } from 'sonner';
 import api from '../lib/api';
+import usePresenceFeed from '../hooks/use-presence-feed';
 import { clearAuth } from '../lib/auth';
 import AIAgentsManager from '../components/AIAgentsManager';
 import DepartmentsManager from '../components/DepartmentsManager';
@@ -171,6 +172,20 @@ const ResellerDashboard = () => {
     }
   };
 
+  const loadAgentsOnline = async () => {
+    try {
+      const { data } = await api.get('/reseller/dashboard/agents-online');
+      setAgentsOnline(data);
+    } catch (error) {
+      console.error('Error loading agents online:', error);
+    }
+  };
+
+  // Presença dos atendentes chega por WebSocket (sem polling)
+  usePresenceFeed(() => {
+    loadAgentsOnline();
+  }, activeTab === 'dashboard');
+
   const loadDashboardData = async () => {
     setDashboardLoading(true);
     try {
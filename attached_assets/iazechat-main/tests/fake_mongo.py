@@ -0,0 +1,169 @@
+"""
+Collection Motor mínima em memória para testes unitários
+
+Cobre só o subconjunto de consultas que os módulos testados montam: igualdade,
+$or, $gt/$gte/$lt/$lte, $in, $exists e $eq. Ordenação acontece antes da projeção,
+como no Mongo. Updates suportam $set, $unset, $inc e $setOnInsert (com upsert).
+"""
+import copy
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+_MISSING = object()
+
+
+def _get(doc: Dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _compare(value, op: str, operand) -> bool:
+    if op == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if op == "$eq":
+        return (None if value is _MISSING else value) == operand
+    if op == "$ne":
+        return (None if value is _MISSING else value) != operand
+    if op == "$in":
+        return value in operand
+    if value is _MISSING or value is None:
+        return False
+    try:
+        return {
+            "$gt": value > operand,
+            "$gte": value >= operand,
+            "$lt": value < operand,
+            "$lte": value <= operand,
+        }[op]
+    except TypeError:
+        # Tipos diferentes (ex. string x data) nunca casam, como no Mongo
+        return False
+
+
+def matches(doc: Dict, query: Dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = _get(doc, key)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif (None if value is _MISSING else value) != condition:
+            return False
+    return True
+
+
+def _project(doc: Dict, projection: Optional[Dict]) -> Dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        result = {}
+        for path in include:
+            value = _get(doc, path)
+            if value is _MISSING:
+                continue
+            target = result
+            parts = path.split(".")
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = copy.deepcopy(value)
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {k: copy.deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+
+
+def _apply_update(doc: Dict, update: Dict, inserting: bool):
+    for field, value in (update.get("$set") or {}).items():
+        doc[field] = copy.deepcopy(value)
+    for field in (update.get("$unset") or {}):
+        doc.pop(field, None)
+    for field, delta in (update.get("$inc") or {}).items():
+        doc[field] = doc.get(field, 0) + delta
+    if inserting:
+        for field, value in (update.get("$setOnInsert") or {}).items():
+            doc[field] = copy.deepcopy(value)
+
+
+class FakeCursor:
+    def __init__(self, docs: List[Dict], projection: Optional[Dict]):
+        self._docs = docs
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self._docs.sort(key=lambda d: _get(d, field), reverse=direction < 0)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    async def to_list(self, length=None):
+        docs = self._docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(doc, self._projection) for doc in docs]
+
+
+class FakeCollection:
+    def __init__(self, docs: Optional[List[Dict]] = None):
+        self.docs = [dict(doc) for doc in (docs or [])]
+
+    def find(self, query: Optional[Dict] = None, projection: Optional[Dict] = None) -> FakeCursor:
+        return FakeCursor([d for d in self.docs if matches(d, query or {})], projection)
+
+    def _first(self, query: Dict) -> Optional[Dict]:
+        return next((d for d in self.docs if matches(d, query)), None)
+
+    def _upsert(self, query: Dict, update: Dict) -> Dict:
+        doc = {k: copy.deepcopy(v) for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        _apply_update(doc, update, inserting=True)
+        self.docs.append(doc)
+        return doc
+
+    async def update_one(self, query: Dict, update: Dict, upsert: bool = False):
+        doc = self._first(query)
+        if doc is not None:
+            _apply_update(doc, update, inserting=False)
+        elif upsert:
+            self._upsert(query, update)
+        return SimpleNamespace(matched_count=int(doc is not None))
+
+    async def find_one_and_update(self, query: Dict, update: Dict, projection: Optional[Dict] = None,
+                                  return_document: bool = False, upsert: bool = False):
+        # return_document: False = ReturnDocument.BEFORE, True = ReturnDocument.AFTER
+        doc = self._first(query)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+            return _project(doc, projection) if return_document else None
+        before = _project(doc, projection)
+        _apply_update(doc, update, inserting=False)
+        return _project(doc, projection) if return_document else before
+
+    async def delete_many(self, query: Dict):
+        kept = [d for d in self.docs if not matches(d, query)]
+        deleted = len(self.docs) - len(kept)
+        self.docs = kept
+        return SimpleNamespace(deleted_count=deleted)
+
+
+class FakeDB:
+    def __init__(self, **collections: List[Dict]):
+        for name, docs in collections.items():
+            setattr(self, name, FakeCollection(docs))
@@ -0,0 +1,155 @@
+"""
+Cache de respostas da IA: match exato, similaridade (MinHash/LSH), estado da
+conversa, credenciais e LRU
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from ai_response_cache import (  # noqa: E402
+    AIResponseCache,
+    last_assistant_reply,
+    normalize_question,
+)
+
+AGENT = {"id": "agent-1", "instructions": "vender planos"}
+QUESTION = "Como instalo no Firestick?"
+ANSWER = "Baixe o app Downloader e digite o código 1234."
+
+
+@pytest.fixture
+def cache():
+    return AIResponseCache(ttl_seconds=60, max_entries_per_agent=3, similarity_threshold=0.7)
+
+
+def test_normalize_question():
+    assert normalize_question("  Olá, COMO instalo?? ") == "ola como instalo"
+
+
+def test_exact_hit_ignores_case_accents_and_punctuation(cache):
+    assert cache.put(AGENT, QUESTION, ANSWER)
+    assert cache.get(AGENT, "como INSTALO no firestick") == ANSWER
+    assert cache.get_stats("agent-1")["hits"] == 1
+
+
+def test_short_questions_are_not_cached(cache):
+    assert cache.put(AGENT, "quero esse", ANSWER) is False
+    assert cache.get(AGENT, "quero esse") is None
+
+
+def test_similar_question_hits_through_lsh(cache):
+    cache.put(AGENT, "como instalo o app no firestick", ANSWER)
+
+    assert cache.get(AGENT, "como instalo o app no firestik") == ANSWER
+    assert cache.get_stats("agent-1")["similar_hits"] == 1
+
+
+def test_unrelated_question_misses(cache):
+    cache.put(AGENT, QUESTION, ANSWER)
+
+    assert cache.get(AGENT, "qual o valor do plano anual") is None
+    assert cache.get_stats("agent-1")["misses"] == 1
+
+
+def test_similarity_disabled():
+    cache = AIResponseCache(ttl_seconds=60, similarity_threshold=0)
+    cache.put(AGENT, "como instalo o app no firestick", ANSWER)
+
+    assert cache.get(AGENT, "como instalo o app no firestik") is None
+
+
+def test_agent_config_change_invalidates(cache):
+    cache.put(AGENT, QUESTION, ANSWER)
+
+    assert cache.get({**AGENT, "instructions": "nova versão"}, QUESTION) is None
+
+
+# ----------------------------------------------------------------------
+# Estado da conversa
+# ----------------------------------------------------------------------
+
+def test_answer_is_tied_to_the_previous_assistant_turn(cache):
+    question = "pode ser o primeiro entao"
+    cache.put(AGENT, question, "Plano mensal anotado!", previous_reply="Qual plano você prefere?")
+
+    assert cache.get(AGENT, question, previous_reply="Qual plano você prefere?") == "Plano mensal anotado!"
+    assert cache.get(AGENT, question, previous_reply="Qual aparelho você usa?") is None
+    assert cache.get(AGENT, question) is None
+
+
+def test_similar_match_stays_inside_the_same_conversation_state(cache):
+    cache.put(AGENT, "como instalo o app no firestick", ANSWER, previous_reply="Qual aparelho?")
+
+    assert cache.get(AGENT, "como instalo o app no firestik") is None
+    assert cache.get(AGENT, "como instalo o app no firestik", previous_reply="Qual aparelho?") == ANSWER
+
+
+def test_last_assistant_reply():
+    history = [
+        {"role": "user", "content": "oi"},
+        {"role": "assistant", "content": "Olá! Qual aparelho?"},
+        {"role": "user", "content": "firestick"},
+    ]
+    assert last_assistant_reply(history) == "Olá! Qual aparelho?"
+    assert last_assistant_reply([{"role": "user", "content": "oi"}]) == ""
+    assert last_assistant_reply(None) == ""
+
+
+# ----------------------------------------------------------------------
+# Credenciais
+# ----------------------------------------------------------------------
+
+@pytest.mark.parametrize("response", [
+    "Seu usuário: joao123 e sua senha: abc",
+    "Login: cliente42",
+    "password: xyz",
+])
+def test_responses_with_credential_patterns_are_not_stored(cache, response):
+    assert cache.put(AGENT, QUESTION, response) is False
+    assert cache.get(AGENT, QUESTION) is None
+    assert cache.get_stats("agent-1")["skipped_credentials"] == 1
+
+
+def test_responses_with_session_client_data_are_not_stored(cache):
+    session = {"iptv_user": "cliente777", "iptv_pass": "s3nh4", "whatsapp": "5511999998888"}
+
+    assert cache.put(AGENT, QUESTION, "Acesse com cliente777 no app", client_data=session) is False
+    assert cache.put(AGENT, QUESTION, "Enviamos para 5511999998888", client_data=session) is False
+    assert cache.put(AGENT, QUESTION, ANSWER, client_data=session) is True
+
+
+# ----------------------------------------------------------------------
+# LRU / invalidação
+# ----------------------------------------------------------------------
+
+def test_lru_eviction(cache):
+    questions = [f"pergunta numero {n} sobre planos" for n in ("um", "dois", "tres")]
+    for question in questions:
+        cache.put(AGENT, question, ANSWER)
+    cache.get(AGENT, questions[0])  # mais recente agora
+
+    cache.put(AGENT, "pergunta numero quatro sobre planos", ANSWER)
+
+    assert cache.get_stats("agent-1")["evictions"] == 1
+    assert cache.get(AGENT, questions[0]) == ANSWER
+    assert len(cache.agents["agent-1"].entries) == 3
+
+
+def test_eviction_cleans_lsh_buckets(cache):
+    for n in range(10):
+        cache.put(AGENT, f"pergunta {n} com texto diferente {n * 7919}", ANSWER)
+
+    agent = cache.agents["agent-1"]
+    indexed = set().union(*agent.buckets.values())
+    assert indexed == set(agent.entries)
+
+
+def test_invalidate_agent(cache):
+    cache.put(AGENT, QUESTION, ANSWER)
+    cache.invalidate_agent("agent-1")
+
+    assert cache.get(AGENT, QUESTION) is None
+    assert cache.agents["agent-1"].buckets == {}
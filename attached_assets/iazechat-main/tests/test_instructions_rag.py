@@ -0,0 +1,162 @@
+"""
+Busca de instruções: tokenização, stemming e ranqueamento BM25 (instructions_rag)
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import instructions_rag  # noqa: E402
+from instructions_rag import BM25Index, InstructionsRAG, normalize_text, stem, tokenize  # noqa: E402
+
+
+# ----------------------------------------------------------------------
+# Normalização / stemming
+# ----------------------------------------------------------------------
+
+def test_normalize_text_folds_case_and_accents():
+    assert normalize_text("INSTALAÇÃO Rápida") == "instalacao rapida"
+
+
+@pytest.mark.parametrize("variants", [
+    ("aplicativo", "aplicativos"),
+    ("instalar", "instalando", "instalacao", "instalacoes"),
+    ("canal", "canais"),
+    ("plano", "planos"),
+])
+def test_inflections_share_a_stem(variants):
+    assert len({stem(word) for word in variants}) == 1
+
+
+@pytest.mark.parametrize("word", ["tv", "app", "iptv", "2024"])
+def test_short_words_and_numbers_are_kept(word):
+    assert stem(word) == word
+
+
+# ----------------------------------------------------------------------
+# Tokenização
+# ----------------------------------------------------------------------
+
+def test_tokenize_drops_stopwords_and_single_chars():
+    assert tokenize("Oi, como eu instalo o app?") == [stem("instalo"), "app"]
+
+
+def test_tokenize_joins_neighbour_words():
+    terms = tokenize("Como instalar no Fire Stick?")
+
+    assert "firestick" in terms
+    assert tokenize("firestick") == ["firestick"]
+
+
+def test_tokenize_query_and_document_agree():
+    assert set(tokenize("INSTALAÇÃO")) == set(tokenize("instalacao"))
+
+
+# ----------------------------------------------------------------------
+# Ranqueamento BM25
+# ----------------------------------------------------------------------
+
+CHUNKS = [
+    {"id": 0, "content": "Planos e valores: plano mensal R$ 30, plano anual R$ 300."},
+    {"id": 1, "content": "Instalação no Fire Stick: baixe o Downloader e digite o código."},
+    {"id": 2, "content": "Smart TV Samsung: instale o aplicativo pela loja da TV."},
+    {"id": 3, "content": "Pagamento via PIX ou cartão. Envie o comprovante do pagamento."},
+]
+
+
+def _ids(results):
+    return [chunk["id"] for _score, chunk in results]
+
+
+def test_search_ranks_the_matching_chunk_first():
+    index = BM25Index(CHUNKS)
+
+    assert _ids(index.search("como instalo no firestick", top_k=1)) == [1]
+    assert _ids(index.search("quanto custa o plano anual", top_k=1)) == [0]
+    assert _ids(index.search("posso pagar no cartao?", top_k=1)) == [3]
+
+
+def test_search_orders_by_score_and_respects_top_k():
+    index = BM25Index(CHUNKS)
+    results = index.search("instalar aplicativo na tv", top_k=2)
+
+    assert _ids(results) == [2, 1]
+    assert results[0][0] > results[1][0]
+
+
+def test_rare_terms_outweigh_common_ones():
+    chunks = [
+        {"id": 0, "content": "canal canal canal"},
+        {"id": 1, "content": "canal esportes"},
+        {"id": 2, "content": "canal filmes"},
+    ]
+    index = BM25Index(chunks)
+
+    assert _ids(index.search("canal esportes", top_k=1)) == [1]
+
+
+def test_search_without_matches_is_empty():
+    assert BM25Index(CHUNKS).search("bom dia") == []
+    assert BM25Index([]).search("plano") == []
+
+
+def test_serialized_index_ranks_the_same():
+    index = BM25Index(CHUNKS)
+    restored = BM25Index.from_dict(CHUNKS, index.to_dict())
+
+    query = "instalar aplicativo na tv"
+    assert restored.search(query, top_k=3) == index.search(query, top_k=3)
+
+
+# ----------------------------------------------------------------------
+# Arquivo de instruções
+# ----------------------------------------------------------------------
+
+def test_relevant_chunks_follow_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(instructions_rag, "INDEX_DIR", str(tmp_path / ".index"))
+    path = tmp_path / "instrucoes.txt"
+    path.write_text("Planos: mensal R$ 30\n\n\n\nFire Stick: use o Downloader", encoding="utf-8")
+    rag = InstructionsRAG()
+
+    assert rag.get_relevant_chunks(str(path), "fire stick", max_chunks=1) == [
+        "Planos: mensal R$ 30\n\nFire Stick: use o Downloader"
+    ]
+
+    path.write_text("Roku: instale pela Channel Store", encoding="utf-8")
+    assert rag.get_relevant_chunks(str(path), "roku") == ["Roku: instale pela Channel Store"]
+
+
+def test_stale_artifacts_are_removed(tmp_path, monkeypatch):
+    index_dir = tmp_path / ".index"
+    monkeypatch.setattr(instructions_rag, "INDEX_DIR", str(index_dir))
+    path = tmp_path / "instrucoes.txt"
+    path.write_text("Planos: mensal R$ 30", encoding="utf-8")
+    rag = InstructionsRAG()
+
+    assert rag.load_and_prepare(str(path))
+    assert len(list(index_dir.glob("*.json"))) == 1
+
+    # Edição fora do upload: a recarga troca o artefato
+    path.write_text("Planos: mensal R$ 35 e anual R$ 300", encoding="utf-8")
+    assert rag.load_and_prepare(str(path))
+    assert len(list(index_dir.glob("*.json"))) == 1
+
+    # Upload/remoção: o artefato do conteúdo atual sai junto (mesmo após restart)
+    InstructionsRAG().invalidate(str(path), drop_artifact=True)
+    assert list(index_dir.glob("*.json")) == []
+
+
+def test_artifact_shared_by_another_file_is_kept(tmp_path, monkeypatch):
+    index_dir = tmp_path / ".index"
+    monkeypatch.setattr(instructions_rag, "INDEX_DIR", str(index_dir))
+    first, second = tmp_path / "a.txt", tmp_path / "b.txt"
+    for path in (first, second):
+        path.write_text("Mesmo conteúdo em dois departamentos", encoding="utf-8")
+    rag = InstructionsRAG()
+    rag.load_and_prepare(str(first))
+    rag.load_and_prepare(str(second))
+
+    rag.invalidate(str(first), drop_artifact=True)
+    assert len(list(index_dir.glob("*.json"))) == 1
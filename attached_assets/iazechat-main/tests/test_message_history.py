@@ -0,0 +1,185 @@
+"""
+Paginação por cursor do histórico de mensagens (message_history)
+"""
+import asyncio
+import base64
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fake_mongo import FakeDB  # noqa: E402
+from message_history import (  # noqa: E402
+    COMPACT_PROJECTION,
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    fetch_page,
+    page_etag,
+)
+
+TICKET = "t1"
+SAME_SECOND = "2024-05-01T10:00:01+00:00"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _message(message_id, created_at, ticket_id=TICKET, **extra):
+    return {
+        "_id": f"oid-{message_id}",
+        "id": message_id,
+        "ticket_id": ticket_id,
+        "from_type": "client",
+        "sender_type": "client",
+        "kind": "text",
+        "text": f"msg {message_id}",
+        "created_at": created_at,
+        "created_at_dt": "interno",
+        **extra
+    }
+
+
+@pytest.fixture
+def db():
+    # m2, m3 e m4 têm o mesmo created_at: o desempate é pelo id
+    return FakeDB(messages=[
+        _message("m1", "2024-05-01T10:00:00+00:00"),
+        _message("m2", SAME_SECOND),
+        _message("m3", SAME_SECOND),
+        _message("m4", SAME_SECOND),
+        _message("m5", "2024-05-01T10:00:02+00:00"),
+        _message("x1", SAME_SECOND, ticket_id="outro"),
+    ])
+
+
+def _ids(page):
+    return [m["id"] for m in page["messages"]]
+
+
+# ----------------------------------------------------------------------
+# Cursor
+# ----------------------------------------------------------------------
+
+def test_cursor_round_trip():
+    message = {"id": "abc|def-ção", "created_at": SAME_SECOND}
+    cursor = encode_cursor(message)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (SAME_SECOND, "abc|def-ção")
+
+
+def test_cursor_needs_created_at_and_id():
+    assert encode_cursor({"id": "m1"}) is None
+    assert encode_cursor({"created_at": SAME_SECOND}) is None
+
+
+@pytest.mark.parametrize("cursor", [
+    "%%%não-é-base64",
+    base64.urlsafe_b64encode(b"sem-separador").decode(),
+    base64.urlsafe_b64encode(b"|m1").decode(),
+    base64.urlsafe_b64encode(b"2024-05-01|").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe|x").decode(),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_fetch_page_rejects_invalid_cursor(db):
+    # get_messages converte InvalidCursor em HTTP 400
+    with pytest.raises(InvalidCursor):
+        run(fetch_page(db, TICKET, before="%%%"))
+    with pytest.raises(InvalidCursor):
+        run(fetch_page(db, TICKET, after="%%%"))
+
+
+# ----------------------------------------------------------------------
+# Páginas
+# ----------------------------------------------------------------------
+
+def test_latest_page_in_chronological_order(db):
+    page = run(fetch_page(db, TICKET, limit=2))
+
+    assert _ids(page) == ["m4", "m5"]
+    assert page["has_more"] is True
+    assert page["before"] == encode_cursor({"id": "m4", "created_at": SAME_SECOND})
+
+
+def test_scrolling_back_through_equal_created_at(db):
+    seen = []
+    page = run(fetch_page(db, TICKET, limit=2))
+    seen = _ids(page) + seen
+    while page["has_more"]:
+        page = run(fetch_page(db, TICKET, limit=2, before=page["before"]))
+        seen = _ids(page) + seen
+
+    assert seen == ["m1", "m2", "m3", "m4", "m5"]
+
+
+def test_polling_after_cursor_inside_equal_created_at(db):
+    cursor = encode_cursor({"id": "m2", "created_at": SAME_SECOND})
+
+    page = run(fetch_page(db, TICKET, limit=2, after=cursor))
+    assert _ids(page) == ["m3", "m4"]
+    assert page["has_more"] is True
+
+    page = run(fetch_page(db, TICKET, limit=2, after=page["after"]))
+    assert _ids(page) == ["m5"]
+    assert page["has_more"] is False
+
+
+def test_empty_poll_keeps_cursor(db):
+    cursor = encode_cursor({"id": "m5", "created_at": "2024-05-01T10:00:02+00:00"})
+    page = run(fetch_page(db, TICKET, after=cursor))
+
+    assert page["messages"] == []
+    assert page["after"] == cursor
+    assert page["has_more"] is False
+
+
+def test_legacy_offset_pagination(db):
+    page = run(fetch_page(db, TICKET, limit=2, offset=2))
+    assert _ids(page) == ["m2", "m3"]
+
+
+def test_compact_view_keeps_fields_the_chat_renders(db):
+    message = run(fetch_page(db, TICKET, limit=1))["messages"][0]
+
+    assert message["sender_type"] == "client"
+    assert "_id" not in message
+    assert "created_at_dt" not in message
+    assert set(message) <= set(COMPACT_PROJECTION)
+
+
+def test_full_view_hides_only_internal_fields(db):
+    message = run(fetch_page(db, TICKET, limit=1, compact=False))["messages"][0]
+
+    assert "_id" not in message
+    assert "created_at_dt" not in message
+    assert message["text"] == "msg m5"
+
+
+# ----------------------------------------------------------------------
+# ETag
+# ----------------------------------------------------------------------
+
+def test_etag_is_stable_for_the_same_page(db):
+    first = run(fetch_page(db, TICKET, limit=3))["messages"]
+    second = run(fetch_page(db, TICKET, limit=3))["messages"]
+    reordered_keys = [dict(reversed(list(m.items()))) for m in second]
+
+    assert page_etag(first) == page_etag(second) == page_etag(reordered_keys)
+    assert page_etag(first).startswith('W/"')
+
+
+def test_etag_changes_when_a_message_changes(db):
+    messages = run(fetch_page(db, TICKET, limit=3))["messages"]
+    before = page_etag(messages)
+    messages[-1]["read"] = True
+
+    assert page_etag(messages) != before
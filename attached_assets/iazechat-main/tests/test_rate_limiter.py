@@ -0,0 +1,198 @@
+"""
+Rate limiter GCRA (LocalRateLimitBackend) e IP do cliente atrás de proxy
+"""
+import asyncio
+import ipaddress
+import sys
+from pathlib import Path
+
+import pytest
+from starlette.requests import Request
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+import rate_limiter as rate_limiter_module  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from rate_limiter import (  # noqa: E402
+    TRUSTED_PROXIES,
+    LocalRateLimitBackend,
+    RateLimiter,
+    WINDOW_SECONDS,
+    _client_ip,
+    rate_limit,
+)
+
+LIMIT = 10
+INTERVAL = WINDOW_SECONDS / LIMIT
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 12345)})
+
+
+# ----------------------------------------------------------------------
+# GCRA
+# ----------------------------------------------------------------------
+
+def test_burst_up_to_limit_then_denied():
+    backend = LocalRateLimitBackend(shards=4)
+    now = 1000.0
+    results = [run(backend.acquire("login|a", INTERVAL, WINDOW_SECONDS, now)) for _ in range(LIMIT + 1)]
+
+    assert all(allowed for allowed, _ in results[:LIMIT])
+    allowed, retry_after = results[LIMIT]
+    assert not allowed
+    assert retry_after == pytest.approx(INTERVAL)
+
+
+def test_denied_request_does_not_consume_a_slot():
+    backend = LocalRateLimitBackend()
+    now = 1000.0
+    for _ in range(LIMIT):
+        run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now))
+    tat = backend._shard("k|a")["k|a"]
+
+    for _ in range(3):
+        assert run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now))[0] is False
+    assert backend._shard("k|a")["k|a"] == tat
+
+
+def test_slot_frees_after_one_interval():
+    backend = LocalRateLimitBackend()
+    now = 1000.0
+    for _ in range(LIMIT):
+        run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now))
+
+    assert run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now + INTERVAL / 2))[0] is False
+    assert run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now + INTERVAL))[0] is True
+
+
+def test_keys_are_independent():
+    backend = LocalRateLimitBackend()
+    now = 1000.0
+    for _ in range(LIMIT):
+        run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now))
+
+    assert run(backend.acquire("k|a", INTERVAL, WINDOW_SECONDS, now))[0] is False
+    assert run(backend.acquire("k|b", INTERVAL, WINDOW_SECONDS, now))[0] is True
+
+
+def test_check_rate_limit_rounds_retry_after_up():
+    limiter = RateLimiter(LocalRateLimitBackend())
+    limiter.action_limits["login"] = 2
+
+    assert run(limiter.check_rate_limit("ip:1.2.3.4", "client", "login")) == (True, None)
+    assert run(limiter.check_rate_limit("ip:1.2.3.4", "client", "login")) == (True, None)
+    allowed, retry_after = run(limiter.check_rate_limit("ip:1.2.3.4", "client", "login"))
+    assert allowed is False
+    assert isinstance(retry_after, int) and 1 <= retry_after <= 30
+
+
+def test_remaining_requests():
+    limiter = RateLimiter(LocalRateLimitBackend())
+    limit = limiter.limits["client"]
+    assert run(limiter.get_remaining_requests("u1", "client")) == limit
+
+    for _ in range(5):
+        run(limiter.check_rate_limit("u1", "client"))
+    assert run(limiter.get_remaining_requests("u1", "client")) == limit - 5
+
+
+# ----------------------------------------------------------------------
+# Limpeza e reset
+# ----------------------------------------------------------------------
+
+def test_evict_removes_only_idle_keys():
+    backend = LocalRateLimitBackend(shards=4)
+    run(backend.acquire("k|idle", INTERVAL, WINDOW_SECONDS, 1000.0))
+    run(backend.acquire("k|busy", INTERVAL, WINDOW_SECONDS, 1000.0 + INTERVAL))
+
+    # TAT de "idle" = 1000 + INTERVAL (já passou); "busy" ainda no futuro
+    removed = run(backend.evict(1000.0 + INTERVAL))
+
+    assert removed == 1
+    assert len(backend) == 1
+    assert "k|busy" in backend._shard("k|busy")
+
+
+def test_reset_user_limits_clears_every_scope_of_that_user():
+    limiter = RateLimiter(LocalRateLimitBackend())
+    for action in ("send_message", "create_ticket", None):
+        run(limiter.check_rate_limit("u1", "agent", action))
+    run(limiter.check_rate_limit("u2", "agent", "send_message"))
+    run(limiter.check_rate_limit("xu1", "agent", "send_message"))
+
+    run(limiter.reset_user_limits("u1"))
+
+    keys = {key for shard in limiter.backend.shards for key in shard}
+    assert keys == {"send_message|u2", "send_message|xu1"}
+
+
+# ----------------------------------------------------------------------
+# IP do cliente / X-Forwarded-For
+# ----------------------------------------------------------------------
+
+PROXIES = [ipaddress.ip_network("10.0.0.0/8"), ipaddress.ip_network("127.0.0.1/32")]
+
+
+def test_forwarded_header_ignored_without_trusted_proxies():
+    request = _request("203.0.113.7", forwarded="198.51.100.1")
+    assert _client_ip(request, trusted=[]) == "203.0.113.7"
+
+
+def test_forwarded_header_ignored_from_untrusted_peer():
+    request = _request("203.0.113.7", forwarded="198.51.100.1")
+    assert _client_ip(request, trusted=PROXIES) == "203.0.113.7"
+
+
+def test_trusted_proxy_uses_hop_it_appended():
+    # O cliente forjou o primeiro valor; o proxy acrescentou o IP real no fim
+    request = _request("127.0.0.1", forwarded="1.1.1.1, 198.51.100.1")
+    assert _client_ip(request, trusted=PROXIES) == "198.51.100.1"
+
+
+def test_chain_of_trusted_proxies_is_skipped():
+    request = _request("127.0.0.1", forwarded="spoofed, 198.51.100.1, 10.1.2.3")
+    assert _client_ip(request, trusted=PROXIES) == "198.51.100.1"
+
+
+# ----------------------------------------------------------------------
+# Login atrás do nginx + Docker (install-vps.sh)
+# ----------------------------------------------------------------------
+
+DOCKER_GATEWAY = "172.18.0.1"
+
+
+@pytest.mark.parametrize("peer", ["127.0.0.1", DOCKER_GATEWAY, "::1"])
+def test_default_trusts_local_proxy(peer):
+    request = _request(peer, forwarded="203.0.113.7")
+    assert _client_ip(request, trusted=TRUSTED_PROXIES) == "203.0.113.7"
+
+
+def test_default_does_not_trust_public_peer():
+    request = _request("198.51.100.9", forwarded="203.0.113.7")
+    assert _client_ip(request, trusted=TRUSTED_PROXIES) == "198.51.100.9"
+
+
+def test_login_limit_is_per_client_behind_the_proxy(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "rate_limiter", RateLimiter(LocalRateLimitBackend()))
+    check = rate_limit("login")
+
+    async def scenario():
+        for _ in range(LIMIT):
+            await check(_request(DOCKER_GATEWAY, forwarded="203.0.113.7"))
+        with pytest.raises(HTTPException) as blocked:
+            await check(_request(DOCKER_GATEWAY, forwarded="203.0.113.7"))
+        # Outro cliente chegando pelo mesmo proxy continua podendo logar
+        await check(_request(DOCKER_GATEWAY, forwarded="198.51.100.20"))
+        return blocked.value
+
+    blocked = run(scenario())
+    assert blocked.status_code == 429
+    assert int(blocked.headers["Retry-After"]) >= 1
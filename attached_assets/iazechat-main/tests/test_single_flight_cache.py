@@ -0,0 +1,105 @@
+"""
+SingleFlightCache: coalescência, erros e cancelamento de quem iniciou o cálculo
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from single_flight_cache import SingleFlightCache  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_callers_share_one_computation():
+    async def scenario():
+        cache = SingleFlightCache(ttl=60)
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(cache.get_or_compute("k", compute) for _ in range(5)))
+        cached = await cache.get_or_compute("k", compute)
+        return results, cached, calls, cache.get_stats()
+
+    results, cached, calls, stats = run(scenario())
+    assert results == [1] * 5
+    assert cached == 1 and calls == 1
+    assert stats["misses"] == 1 and stats["coalesced"] == 4 and stats["hits"] == 1
+    assert stats["inflight"] == 0
+
+
+def test_leader_cancellation_does_not_fail_followers():
+    async def scenario():
+        cache = SingleFlightCache(ttl=60)
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return "valor"
+
+        leader = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, await cache.get_or_compute("k", compute)
+
+    assert run(scenario()) == ("valor", "valor")
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    async def scenario():
+        cache = SingleFlightCache(ttl=60)
+        attempts = 0
+
+        async def failing():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("banco fora")
+
+        results = await asyncio.gather(
+            *(cache.get_or_compute("k", failing) for _ in range(3)), return_exceptions=True
+        )
+
+        async def ok():
+            return 42
+
+        return results, attempts, await cache.get_or_compute("k", ok)
+
+    results, attempts, value = run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert attempts == 1
+    assert value == 42
+
+
+def test_zero_ttl_is_not_stored():
+    async def scenario():
+        cache = SingleFlightCache(ttl=60)
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        await cache.get_or_compute("k", compute, ttl=0)
+        return await cache.get_or_compute("k", compute, ttl=0)
+
+    assert run(scenario()) == 2
@@ -0,0 +1,93 @@
+"""
+Orçamento de import do backend (cold start / reload do worker)
+
+Cada verificação roda num interpretador novo (subprocess) para medir o import de
+verdade, sem módulos já carregados por outros testes.
+
+    STARTUP_IMPORT_BUDGET_SECONDS=3.0 python -m pytest tests/test_startup_budget.py
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from startup_profile import HEAVY_MODULES  # noqa: E402
+
+IMPORT_BUDGET_SECONDS = float(os.environ.get("STARTUP_IMPORT_BUDGET_SECONDS", "3.0"))
+
+# Serviços que devem adiar Playwright / OpenAI / emergentintegrations até o primeiro uso
+LAZY_SERVICES = [
+    "ai_service",
+    "vendas_ai_service",
+    "media_service",
+    "office_service_playwright",
+    "office_sync_service",
+    "iptv_automation_service",
+]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - started
+from startup_profile import heavy_modules_loaded
+print(json.dumps({{"seconds": elapsed, "heavy": heavy_modules_loaded()}}))
+"""
+
+
+def _probe(modules, **env):
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(modules=modules)],
+        cwd=BACKEND_DIR,
+        env={
+            **os.environ,
+            "MONGO_URL": os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+            "LOG_FORMAT": "text",
+            **env
+        },
+        capture_output=True,
+        text=True,
+        timeout=120
+    )
+    if result.returncode != 0:
+        missing = re.search(r"No module named '([\w.]+)'", result.stderr)
+        if missing and missing.group(1).split(".")[0] not in HEAVY_MODULES:
+            # Ambiente sem todas as dependências do requirements.txt
+            pytest.skip(f"dependência ausente: {missing.group(1)}")
+        # Inclui o caso de um SDK pesado importado no topo de algum módulo
+        pytest.fail(result.stderr[-2000:])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", LAZY_SERVICES)
+def test_service_import_does_not_load_heavy_sdks(module):
+    probe = _probe([module])
+    assert probe["heavy"] == [], f"{module} carrega no import: {probe['heavy']}"
+
+
+def test_server_import_within_budget():
+    probe = _probe(["server"])
+    assert probe["heavy"] == [], f"server.py carrega no import: {probe['heavy']}"
+    assert probe["seconds"] <= IMPORT_BUDGET_SECONDS, (
+        f"import do server.py levou {probe['seconds']:.2f}s (orçamento {IMPORT_BUDGET_SECONDS}s)"
+    )
+
+
+def test_server_import_with_optional_subsystems_disabled():
+    probe = _probe(
+        ["server"],
+        FEATURE_OFFICE="false",
+        FEATURE_XUI="false",
+        FEATURE_IPTV_AUTOMATION="false",
+        FEATURE_MEDIA_AI="false"
+    )
+    assert probe["heavy"] == []
+    assert probe["seconds"] <= IMPORT_BUDGET_SECONDS
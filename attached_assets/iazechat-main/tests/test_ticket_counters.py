@@ -0,0 +1,185 @@
+"""
+Contadores materializados de tickets: deltas por transição e espelho em memória
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import ticket_counters as ticket_counters_module  # noqa: E402
+from fake_mongo import FakeDB  # noqa: E402
+from ticket_counters import TicketCounterStore  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _ticket(ticket_id, status="open", agent_id=None, reseller_id="r1"):
+    return {"id": ticket_id, "reseller_id": reseller_id, "status": status, "agent_id": agent_id}
+
+
+@pytest.fixture
+def db():
+    return FakeDB(tickets=[], ticket_counters=[])
+
+
+@pytest.fixture
+def store():
+    return TicketCounterStore()
+
+
+def _counts(db):
+    """_id -> count direto no collection (o que sobrevive a um restart)"""
+    return {doc["_id"]: doc["count"] for doc in db.ticket_counters.docs if doc["count"]}
+
+
+async def _create(db, store, ticket):
+    db.tickets.docs.append(dict(ticket))
+    await store.record_created(db, ticket)
+
+
+# ----------------------------------------------------------------------
+# Deltas
+# ----------------------------------------------------------------------
+
+def test_creation_increments_the_status_key(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await _create(db, store, _ticket("t2"))
+        await _create(db, store, _ticket("t3", reseller_id="r2"))
+
+    run(scenario())
+    assert _counts(db) == {"status|r1|open|": 2, "status|r2|open|": 1}
+
+
+def test_status_change_moves_one_unit(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await _create(db, store, _ticket("t2"))
+        return await store.update_ticket(db, {"id": "t1"}, {"$set": {"status": "ATENDENDO"}})
+
+    before = run(scenario())
+    assert before["status"] == "open"
+    assert _counts(db) == {"status|r1|open|": 1, "status|r1|ATENDENDO|": 1}
+
+
+def test_agent_assignment_and_unset(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1", status="ATENDENDO"))
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"agent_id": "a1"}})
+        assigned = dict(_counts(db))
+        await store.update_ticket(db, {"id": "t1"}, {"$unset": {"agent_id": ""}})
+        return assigned
+
+    assigned = run(scenario())
+    assert assigned == {"status|r1|ATENDENDO|a1": 1}
+    assert _counts(db) == {"status|r1|ATENDENDO|": 1}
+
+
+def test_reseller_change_moves_between_tenants(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"reseller_id": "r2"}})
+
+    run(scenario())
+    assert _counts(db) == {"status|r2|open|": 1}
+
+
+def test_updates_that_do_not_touch_counted_fields_are_free(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        writes_before = len(db.ticket_counters.docs)
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"status": "open", "client_name": "Ana"}})
+        return writes_before
+
+    writes_before = run(scenario())
+    assert len(db.ticket_counters.docs) == writes_before
+    assert _counts(db) == {"status|r1|open|": 1}
+
+
+def test_missing_ticket_records_nothing(db, store):
+    assert run(store.update_ticket(db, {"id": "nao-existe"}, {"$set": {"status": "closed"}})) is None
+    assert _counts(db) == {}
+
+
+def test_closing_counts_closed_today_once(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"status": "closed"}})
+        # Fechado -> fechado (ex. troca de agente) não conta de novo
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"agent_id": "a1"}})
+        return await store.closed_today(db, "r1")
+
+    assert run(scenario()) == 1
+    closed = [doc for doc in db.ticket_counters.docs if doc["kind"] == "closed_day"]
+    assert len(closed) == 1 and "expire_at" in closed[0]
+
+
+def test_removed_ticket_decrements(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await store.record_transition(db, _ticket("t1"), None)
+
+    run(scenario())
+    assert _counts(db) == {}
+
+
+def test_counter_failure_does_not_break_the_ticket_flow(db, store):
+    async def broken_update_one(*args, **kwargs):
+        raise RuntimeError("mongo fora")
+
+    db.ticket_counters.update_one = broken_update_one
+    run(store.record_created(db, _ticket("t1")))
+
+
+# ----------------------------------------------------------------------
+# Leitura pelo espelho
+# ----------------------------------------------------------------------
+
+def test_reads_follow_local_deltas(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await _create(db, store, _ticket("t2", status="ATENDENDO", agent_id="a1"))
+        await _create(db, store, _ticket("t3", status="ATENDENDO"))
+        await _create(db, store, _ticket("t4", reseller_id="r2"))
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"status": "ATENDENDO", "agent_id": "a1"}})
+        return (
+            await store.status_counts(db, "r1"),
+            await store.status_counts(db),
+            await store.assignment_counts(db, "ATENDENDO", "r1"),
+            await store.agent_counts(db, "ATENDENDO", "r1"),
+        )
+
+    status_r1, status_all, assignment, agents = run(scenario())
+    assert status_r1 == {"open": 0, "ATENDENDO": 3}
+    assert status_all == {"open": 1, "ATENDENDO": 3}
+    assert assignment == (1, 2)
+    assert agents == {"a1": 2}
+
+
+def test_mirror_reload_matches_collection(db, store, monkeypatch):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await store.update_ticket(db, {"id": "t1"}, {"$set": {"status": "closed"}})
+        # Outro worker: espelho vazio carregado do collection
+        other = TicketCounterStore()
+        return await other.status_counts(db, "r1"), await other.closed_today(db, "r1")
+
+    monkeypatch.setattr(ticket_counters_module, "MIRROR_TTL", 0)
+    assert run(scenario()) == ({"open": 0, "closed": 1}, 1)
+
+
+def test_drop_tenant(db, store):
+    async def scenario():
+        await _create(db, store, _ticket("t1"))
+        await _create(db, store, _ticket("t2", reseller_id="r2"))
+        await store.drop_tenant(db, "r1")
+        return await store.status_counts(db)
+
+    assert run(scenario()) == {"open": 1}
+    assert _counts(db) == {"status|r2|open|": 1}
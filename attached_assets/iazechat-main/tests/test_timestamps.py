@@ -0,0 +1,133 @@
+"""
+Timestamps tipados: conversão, escrita dupla e filtro de período compatível
+"""
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fake_mongo import matches  # noqa: E402
+from timestamps import as_datetime, since_filter, stamp, typed_value  # noqa: E402
+
+MOMENT = datetime(2024, 5, 1, 12, 30, 0, tzinfo=timezone.utc)
+
+
+# ----------------------------------------------------------------------
+# as_datetime
+# ----------------------------------------------------------------------
+
+@pytest.mark.parametrize("value", [
+    "2024-05-01T12:30:00+00:00",
+    "2024-05-01T12:30:00Z",
+    "2024-05-01T09:30:00-03:00",
+    "2024-05-01T12:30:00",
+])
+def test_iso_strings(value):
+    parsed = as_datetime(value)
+    assert parsed == MOMENT
+    assert parsed.tzinfo is not None
+
+
+def test_naive_datetime_is_utc():
+    # Motor devolve datas BSON sem tzinfo
+    assert as_datetime(datetime(2024, 5, 1, 12, 30)) == MOMENT
+    assert as_datetime(datetime(2024, 5, 1, 12, 30)).tzinfo == timezone.utc
+
+
+def test_aware_datetime_is_kept():
+    assert as_datetime(MOMENT) is MOMENT
+
+
+def test_epoch_seconds_and_milliseconds():
+    seconds = MOMENT.timestamp()
+    assert as_datetime(int(seconds)) == MOMENT
+    assert as_datetime(seconds * 1000) == MOMENT
+    assert as_datetime(float(seconds)) == MOMENT
+
+
+@pytest.mark.parametrize("value", [None, "", "ontem", {"$date": 1}, []])
+def test_unparseable_values(value):
+    assert as_datetime(value) is None
+
+
+# ----------------------------------------------------------------------
+# stamp / typed_value
+# ----------------------------------------------------------------------
+
+def test_stamp_adds_typed_fields_without_touching_original():
+    doc = {"id": "t1", "created_at": MOMENT.isoformat(), "updated_at": "2024-05-01T12:30:00Z"}
+    stamped = stamp(doc)
+
+    assert stamped["created_at_dt"] == MOMENT
+    assert stamped["updated_at_dt"] == MOMENT
+    assert "created_at_dt" not in doc
+    assert stamped["created_at"] == doc["created_at"]
+
+
+def test_stamp_uses_legacy_timestamp_for_created_at():
+    stamped = stamp({"id": "m1", "timestamp": MOMENT.isoformat()})
+
+    assert stamped["created_at"] == MOMENT.isoformat()
+    assert stamped["created_at_dt"] == MOMENT
+
+
+def test_stamp_only_requested_fields_and_skips_invalid():
+    stamped = stamp({"created_at": "inválida", "updated_at": MOMENT.isoformat()}, fields=("created_at",))
+
+    assert "created_at_dt" not in stamped
+    assert "updated_at_dt" not in stamped
+
+
+def test_typed_value_prefers_typed_field():
+    other = MOMENT - timedelta(days=1)
+    assert typed_value({"created_at": other.isoformat(), "created_at_dt": MOMENT}) == MOMENT
+
+
+def test_typed_value_falls_back_to_iso_and_timestamp():
+    assert typed_value({"created_at": MOMENT.isoformat()}) == MOMENT
+    assert typed_value({"timestamp": MOMENT.isoformat()}) == MOMENT
+    assert typed_value({"timestamp": MOMENT.isoformat()}, "updated_at") is None
+
+
+# ----------------------------------------------------------------------
+# since_filter
+# ----------------------------------------------------------------------
+
+SINCE = MOMENT - timedelta(hours=1)
+AFTER = MOMENT
+BEFORE = SINCE - timedelta(hours=1)
+
+
+def test_since_filter_on_migrated_documents():
+    query = since_filter("created_at", SINCE)
+
+    assert matches({"created_at": AFTER.isoformat(), "created_at_dt": AFTER}, query)
+    assert not matches({"created_at": BEFORE.isoformat(), "created_at_dt": BEFORE}, query)
+
+
+def test_since_filter_on_documents_not_yet_migrated():
+    query = since_filter("created_at", SINCE)
+
+    assert matches({"created_at": AFTER.isoformat()}, query)
+    assert not matches({"created_at": BEFORE.isoformat()}, query)
+
+
+def test_since_filter_legacy_timestamp_field():
+    whatsapp = {"timestamp": AFTER.isoformat()}
+
+    assert not matches(whatsapp, since_filter("created_at", SINCE))
+    assert matches(whatsapp, since_filter("created_at", SINCE, legacy_fields=("timestamp",)))
+    assert not matches(
+        {"timestamp": BEFORE.isoformat()},
+        since_filter("created_at", SINCE, legacy_fields=("timestamp",))
+    )
+
+
+def test_typed_field_wins_over_legacy_string():
+    # Migrado: a string antiga não é mais consultada
+    doc = {"created_at": AFTER.isoformat(), "created_at_dt": BEFORE}
+    assert not matches(doc, since_filter("created_at", SINCE))